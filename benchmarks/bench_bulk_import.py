@@ -0,0 +1,66 @@
+"""
+Compares importVisits with adding the same visits one addPatientData call at a time.
+
+Both start from a loaded VisitStore of baseVisits visits. Single adds wait
+for their own fsync, so they are only timed up to MAX_SINGLE_ADDS visits and
+reported per visit.
+
+usage: python benchmarks/bench_bulk_import.py [baseVisits] [batchSize ...]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+import common
+import main
+from journal import closeJournals
+
+MAX_SINGLE_ADDS = 2000
+
+
+def _rows(numVisits):
+    # New patients, so the batch lands on top of the existing data.
+    return [(1_000_000 + patientId,) + tuple(visit)
+            for patientId, visit in common.syntheticVisits(numVisits, seed=7)]
+
+
+def _load(directory, name, baseFile):
+    fileName = os.path.join(directory, name)
+    shutil.copyfile(baseFile, fileName)
+    return fileName, main.readPatientsFromFile(fileName, cacheEntries=0)
+
+
+def run(baseVisits, batchSizes):
+    directory = tempfile.mkdtemp()
+    try:
+        baseFile = os.path.join(directory, 'base.txt')
+        common.writeSyntheticFile(baseFile, baseVisits)
+        print(f"{'batch':>9} {'single add/visit':>17} {'import':>10} {'import/visit':>13} {'speed-up':>9}")
+        for size in batchSizes:
+            rows = _rows(size)
+            singles = rows[:MAX_SINGLE_ADDS]
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                fileName, patients = _load(directory, f'single-{size}.txt', baseFile)
+                start = time.perf_counter()
+                for row in singles:
+                    main.addPatientData(patients, *row, fileName)
+                single = (time.perf_counter() - start) / len(singles)
+
+                fileName, patients = _load(directory, f'bulk-{size}.txt', baseFile)
+                start = time.perf_counter()
+                result = main.importVisits(patients, rows, fileName)
+                bulk = time.perf_counter() - start
+            assert result.accepted == size, result
+            print(f"{size:>9} {single * 1000:>14.3f} ms {bulk * 1000:>7.1f} ms {bulk / size * 1e6:>10.2f} us "
+                  f"{single * size / bulk:>8.0f}x")
+        closeJournals()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    args = [int(x) for x in sys.argv[1:]]
+    run(args[0] if args else 100_000, args[1:] or [100, 1_000, 10_000, 100_000])
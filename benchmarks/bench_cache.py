@@ -0,0 +1,85 @@
+"""
+Measures the query cache on a repeated query mix with occasional writes.
+
+The same stream of date, stats and follow-up queries, with one added visit
+every few queries, is run against a VisitStore and a SQLite database, first
+without a cache and then with one. The cache counters show how many entries
+each write invalidated.
+
+usage: python benchmarks/bench_cache.py [numVisits] [queries] [queriesPerWrite]
+"""
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+
+import common
+import main
+import storage
+from cache import DEFAULT_MAX_ENTRIES, QueryCache
+
+
+def _workload(numQueries, queriesPerWrite, numPatients, seed=42):
+    rng = random.Random(seed)
+    operations = []
+    for index in range(numQueries):
+        if queriesPerWrite and index % queriesPerWrite == queriesPerWrite - 1:
+            year, month = rng.randint(2015, 2024), rng.randint(1, 12)
+            operations.append((main.addPatientData, rng.randint(1, numPatients), f'{year}-{month:02}-15',
+                               37.0, 72, 16, 120, 80, 98))
+            continue
+        choice = rng.random()
+        if choice < 0.4:
+            operations.append((main.findVisitsByDate, rng.randint(2015, 2024), rng.randint(1, 12)))
+        elif choice < 0.6:
+            day = rng.randint(1, 20)
+            operations.append((main.findVisitsInRange, f'2018-06-{day:02}', f'2018-06-{day + 7:02}'))
+        elif choice < 0.9:
+            operations.append((main.vitalSummaries, rng.choice([0, rng.randint(1, numPatients)])))
+        else:
+            operations.append((main.findPatientsWhoNeedFollowUp,))
+    return operations
+
+
+def _run(patients, operations, fileName):
+    with contextlib.redirect_stdout(io.StringIO()):
+        for function, *args in operations:
+            if function is main.addPatientData:
+                function(patients, *args, fileName)
+            else:
+                function(patients, *args)
+
+
+def run(numVisits, numQueries, queriesPerWrite):
+    with tempfile.TemporaryDirectory() as directory:
+        fileName = os.path.join(directory, 'patients.txt')
+        numPatients = max(1, numVisits // 10)
+        common.writeSyntheticFile(fileName, numVisits, numPatients)
+        storage.importTextFile(fileName, os.path.join(directory, 'patients.db'))
+        operations = _workload(numQueries, queriesPerWrite, numPatients)
+        print(f"{numVisits} visits, {numQueries} operations, one write every {queriesPerWrite}")
+        for name in ('patients.txt', 'patients.db'):
+            timings = []
+            for cached in (False, True):
+                patients = main.readPatientsFromFile(os.path.join(directory, name),
+                                                     cacheEntries=DEFAULT_MAX_ENTRIES if cached else 0)
+                cache = QueryCache.find(patients)
+                # The first pass builds the indexes and engines of a VisitStore.
+                _run(patients, operations[:50], fileName)
+                elapsed, _ = common.timeit(_run, patients, operations, fileName, repeat=1)
+                timings.append(elapsed)
+                if isinstance(patients, storage.StorageBackend):
+                    patients.close()
+            counters = cache.counters()
+            print(f"  {name:>12}: uncached {timings[0]:.2f} s, cached {timings[1]:.2f} s "
+                  f"({timings[0] / timings[1]:.1f}x), hit rate "
+                  f"{counters['hits'] / max(1, counters['hits'] + counters['misses']):.0%}, {counters}")
+
+
+if __name__ == '__main__':
+    numVisits = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    numQueries = int(sys.argv[2]) if len(sys.argv) > 2 else 2_000
+    queriesPerWrite = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+    run(numVisits, numQueries, queriesPerWrite)
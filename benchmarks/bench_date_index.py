@@ -0,0 +1,43 @@
+"""
+Compares findVisitsByDate scanning every visit with the date index of a VisitStore.
+
+usage: python benchmarks/bench_date_index.py [numVisits]
+"""
+import sys
+
+import common
+import main
+from date_index import DateIndex
+from visit_store import VisitStore
+
+
+QUERIES = [
+    ('year+month', (2018, 6)),
+    ('year', (2018, None)),
+    ('month', (None, 6)),
+]
+
+
+def run(numVisits):
+    store = VisitStore()
+    for patientId, visit in common.syntheticVisits(numVisits):
+        store.append(patientId, visit)
+    patients = {patientId: store[patientId] for patientId in store}
+    buildTime, _ = common.timeit(DateIndex.forStore, store, repeat=1)
+    print(f"{numVisits} visits, index built in {buildTime:.3f} s")
+    print(f"{'query':>12} {'results':>8} {'scan ms':>9} {'index ms':>9} {'speedup':>8}")
+    for name, (year, month) in QUERIES:
+        scanTime, scanned = common.timeit(main.findVisitsByDate, patients, year, month)
+        indexTime, indexed = common.timeit(main.findVisitsByDate, store, year, month)
+        assert len(scanned) == len(indexed)
+        print(f"{name:>12} {len(indexed):>8} {scanTime * 1000:>9.1f} {indexTime * 1000:>9.1f} "
+              f"{scanTime / indexTime:>7.1f}x")
+    scanTime, scanned = common.timeit(main.findVisitsInRange, patients, '2018-06-10', '2018-06-20')
+    indexTime, indexed = common.timeit(main.findVisitsInRange, store, '2018-06-10', '2018-06-20')
+    assert len(scanned) == len(indexed)
+    print(f"{'range':>12} {len(indexed):>8} {scanTime * 1000:>9.1f} {indexTime * 1000:>9.1f} "
+          f"{scanTime / indexTime:>7.1f}x")
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
@@ -0,0 +1,33 @@
+"""
+Compares scoring every visit one at a time with the column-at-a-time NEWS2 scorer.
+
+usage: python benchmarks/bench_early_warning.py [numVisits]
+"""
+import sys
+
+import common
+import early_warning
+from visit_store import VisitStore
+
+
+def scoreOneByOne(patients):
+    return [early_warning.scoreVisit(visit) for visits in patients.values() for visit in visits]
+
+
+def run(numVisits):
+    store = VisitStore()
+    for patientId, visit in common.syntheticVisits(numVisits):
+        store.append(patientId, visit)
+    patients = {patientId: store[patientId] for patientId in store}
+    loopTime, _ = common.timeit(scoreOneByOne, patients, repeat=1)
+    vectorTime, (scores, _) = common.timeit(early_warning.scoreRows, store)
+    buildTime, engine = common.timeit(early_warning.EarlyWarningEngine, store, repeat=1)
+    worklistTime, worklist = common.timeit(engine.worklist, 20)
+    print(f"{numVisits} visits: per-visit loop {loopTime:.2f} s, column scorer {vectorTime:.3f} s "
+          f"({loopTime / vectorTime:.0f}x)")
+    print(f"  engine build (scores + latest visits) {buildTime:.2f} s, worklist of 20 {worklistTime * 1000:.1f} ms")
+    print(f"  mean score {sum(scores) / len(scores):.2f}, top patient {worklist[0]}")
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
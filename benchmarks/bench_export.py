@@ -0,0 +1,97 @@
+"""
+Throughput of export.py: full exports, reading them back and change-feed exports.
+
+For each size a loaded VisitStore is exported in every available format
+(arrow needs pyarrow), and the MB/s is the size of the export over the time
+to write it (fsync included). Read is readBatches over a column file: it maps
+every batch and hands out views of its columns without copying the values,
+which is what a reader pays before computing anything.
+Changes exports the visits added by CHANGES single adds since a checkpoint.
+Memory is the peak traced by tracemalloc during the export, in a separate
+run; it depends on the batch size, not on the number of visits. The time to
+parse patients.txt, what downstream tools did before, is shown to compare.
+
+usage: python benchmarks/bench_export.py [size ...] [--batch-rows N]
+"""
+import argparse
+import io
+import os
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+import common
+import export
+import main
+from journal import closeJournals
+
+CHANGES = 1000
+
+
+def _timed(call):
+    start = time.perf_counter()
+    value = call()
+    return value, time.perf_counter() - start
+
+
+def _peak(call):
+    tracemalloc.start()
+    try:
+        call()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _readAll(fileName):
+    rows = 0
+    for batch in export.readBatches(fileName):
+        rows += len(batch.columns['patientId'])
+    return rows
+
+
+def _row(size, name, seconds, numBytes, rows, peak):
+    print(f"{size:>10} {name:>14} {seconds * 1000:>9.1f} {numBytes / 2 ** 20 / seconds:>9.1f} "
+          f"{rows / seconds:>13,.0f} {peak / 2 ** 20 if peak is not None else float('nan'):>9.1f}")
+
+
+def run(sizes, batchRows):
+    formats = ['columns'] + (['arrow'] if export.pyarrow is not None else [])
+    print(f"batches of {batchRows} rows; formats: {', '.join(formats)}")
+    print(f"{'visits':>10} {'operation':>14} {'ms':>9} {'MB/s':>9} {'rows/s':>13} {'peak MiB':>9}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            fileName = os.path.join(directory, 'patients.txt')
+            common.writeSyntheticFile(fileName, size)
+            with redirect_stdout(io.StringIO()):
+                patients, seconds = _timed(lambda: main.readPatientsFromFile(fileName, useSnapshot=False))
+            _row(size, 'parse text', seconds, os.path.getsize(fileName), patients.visitCount, None)
+            for outputFormat in formats:
+                output = os.path.join(directory, f'export.{outputFormat}')
+                call = lambda: export.exportVisits(patients, output, fileName, batchRows, outputFormat)
+                result, seconds = _timed(call)
+                _row(size, f'export {outputFormat}', seconds, result.bytes, result.rows, _peak(call))
+            output = os.path.join(directory, 'export.columns')
+            rows, seconds = _timed(lambda: _readAll(output))
+            _row(size, 'read columns', seconds, os.path.getsize(output), rows, _peak(lambda: _readAll(output)))
+
+            checkpoint = result.checkpoint
+            newId = max(patients) + 1
+            with redirect_stdout(io.StringIO()):
+                for index in range(CHANGES):
+                    main.addPatientData(patients, newId + index % 10, '2024-01-15', 37.2, 80, 16, 120, 80, 97,
+                                        fileName)
+            changes = os.path.join(directory, 'changes.columns')
+            result, seconds = _timed(lambda: export.exportChanges(fileName, checkpoint, changes, batchRows,
+                                                                  'columns'))
+            _row(size, 'changes', seconds, result.bytes, result.rows, None)
+            closeJournals()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time full and incremental exports.")
+    parser.add_argument('sizes', type=int, nargs='*', default=[100_000, 1_000_000])
+    parser.add_argument('--batch-rows', dest='batchRows', type=int, default=export.DEFAULT_BATCH_ROWS)
+    args = parser.parse_args()
+    run(args.sizes, args.batchRows)
@@ -0,0 +1,37 @@
+"""
+Compares the incremental FollowUpEngine with a brute-force scan.
+
+Its agreement with the scan through adds, deletes and rule changes is checked
+by tests/test_followup.py.
+
+usage: python benchmarks/bench_followup.py [numVisits]
+"""
+import sys
+
+import common
+import main
+from followup import FollowUpEngine, FollowUpRule
+from visit_store import VisitStore
+
+
+def run(numVisits):
+    store = VisitStore()
+    for patientId, visit in common.syntheticVisits(numVisits):
+        store.append(patientId, visit)
+    patients = {patientId: store[patientId] for patientId in store}
+
+    buildTime, engine = common.timeit(FollowUpEngine.forStore, store, repeat=1)
+    scanTime, scanned = common.timeit(main.findPatientsWhoNeedFollowUp, patients)
+    queryTime, flagged = common.timeit(main.findPatientsWhoNeedFollowUp, store)
+    assert scanned == flagged
+    print(f"{numVisits} visits, {len(flagged)} patients flagged")
+    print(f"  engine build {buildTime * 1000:.1f} ms, scan {scanTime * 1000:.1f} ms, "
+          f"incremental query {queryTime * 1000:.2f} ms")
+
+    stricter = FollowUpRule('low oxygen saturation', 'spo2', '<', 94)
+    changeTime, _ = common.timeit(engine.setRule, stricter, repeat=1)
+    print(f"  one rule change {changeTime * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
@@ -0,0 +1,85 @@
+"""
+Compares journaled adds and deletes with rewriting/reopening patients.txt.
+
+usage: python benchmarks/bench_journal.py [numVisits] [numOperations]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import common
+from journal import VisitJournal
+from patient_parser import readPatientsStreaming
+
+
+def rewriteWithout(store, patientId, fileName):
+    # What deleteAllVisitsOfPatient used to do: rewrite every remaining visit.
+    store.deletePatient(patientId)
+    with open(fileName, 'w') as f:
+        for pid, visits in store.items():
+            for visit in visits:
+                f.write(f"{pid},{','.join(str(x) for x in visit)}\n")
+
+
+def appendByReopening(fileName, patientId, visit):
+    # What the old addPatientData did: open the file for every visit.
+    with open(fileName, 'a') as f:
+        f.write(f"{patientId},{','.join(str(x) for x in visit)}\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def main(numVisits, numOperations):
+    directory = tempfile.mkdtemp()
+    fileName = os.path.join(directory, 'patients.txt')
+    try:
+        common.writeSyntheticFile(fileName, numVisits)
+        store = readPatientsStreaming(fileName)
+        victims = list(store)[:numOperations]
+        visit = ['2024-01-01', 37.0, 80, 16, 120, 80, 98]
+
+        start = time.perf_counter()
+        for patientId in victims[:max(1, numOperations // 10)]:
+            rewriteWithout(store, patientId, fileName)
+        rewrite = (time.perf_counter() - start) / max(1, numOperations // 10)
+
+        journal = VisitJournal(fileName, compactThreshold=10 ** 9)
+        start = time.perf_counter()
+        for patientId in victims:
+            journal.logDelete(patientId)
+        logged = (time.perf_counter() - start) / len(victims)
+        print(f"delete: rewrite {rewrite * 1000:.2f} ms, journal {logged * 1000:.3f} ms")
+
+        start = time.perf_counter()
+        for _ in range(numOperations):
+            appendByReopening(fileName, 1, visit)
+        reopen = (time.perf_counter() - start) / numOperations
+        start = time.perf_counter()
+        for _ in range(numOperations):
+            journal.logAdd(1, visit)
+        logged = (time.perf_counter() - start) / numOperations
+        print(f"add (fsync each): reopen {reopen * 1000:.3f} ms, journal {logged * 1000:.3f} ms")
+
+        # Group commit: concurrent writers share fsyncs.
+        def writer():
+            for _ in range(numOperations // 8):
+                journal.logAdd(1, visit)
+        threads = [threading.Thread(target=writer) for _ in range(8)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        perAdd = (time.perf_counter() - start) / (8 * (numOperations // 8))
+        print(f"add (8 concurrent writers): journal {perAdd * 1000:.3f} ms per durable add")
+        journal.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    args = [int(x) for x in sys.argv[1:]]
+    main(args[0] if args else 200_000, args[1] if len(args) > 1 else 200)
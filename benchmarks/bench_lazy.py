@@ -0,0 +1,78 @@
+"""
+Time to look up a few patients: full parse, snapshot and lazy loading through the offset index.
+
+For each size, every approach opens the file and fetches the same patients.
+The index and the snapshot are built beforehand (their build time is shown
+separately), as they would be after the first start. Memory is the peak
+traced by tracemalloc while opening and fetching, in a separate run.
+
+usage: python benchmarks/bench_lazy.py [size ...]
+"""
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+import common
+import main
+from patient_index import LazyPatients
+
+LOOKUPS = 10
+
+
+def _openAndLook(open_, patientIds):
+    with redirect_stdout(io.StringIO()):
+        patients = open_()
+    return patients, sum(len(patients[patientId]) for patientId in patientIds)
+
+
+def _measure(open_, patientIds):
+    # Timed without tracemalloc, which slows allocation-heavy code down a lot.
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        patients = open_()
+    opened = time.perf_counter()
+    visits = sum(len(patients[patientId]) for patientId in patientIds)
+    done = time.perf_counter()
+    del patients
+    tracemalloc.start()
+    _openAndLook(open_, patientIds)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return opened - start, done - opened, peak, visits
+
+
+def run(sizes):
+    print(f"{'visits':>10} {'approach':>9} {'open ms':>10} {f'{LOOKUPS} lookups ms':>16} {'peak MiB':>9}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            fileName = os.path.join(directory, 'patients.txt')
+            common.writeSyntheticFile(fileName, size)
+            with redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                main.readPatientsFromFile(fileName, useSnapshot=True)
+                snapshotBuild = time.perf_counter() - start
+                start = time.perf_counter()
+                LazyPatients(fileName).close()
+                indexBuild = time.perf_counter() - start
+            patientIds = random.Random(1).sample(range(1, max(2, size // 10)), min(LOOKUPS, max(1, size // 10 - 1)))
+            approaches = [
+                ('parse', lambda: main.readPatientsFromFile(fileName, useSnapshot=False)),
+                ('snapshot', lambda: main.readPatientsFromFile(fileName, useSnapshot=True)),
+                ('lazy', lambda: main.readPatientsFromFile(fileName, lazy=True)),
+            ]
+            counts = set()
+            for name, open_ in approaches:
+                opened, looked, peak, visits = _measure(open_, patientIds)
+                counts.add(visits)
+                print(f"{size:>10} {name:>9} {opened * 1000:>10.2f} {looked * 1000:>16.2f} {peak / 2 ** 20:>9.1f}")
+            assert len(counts) == 1, counts
+            print(f"{'':>10} build: snapshot {snapshotBuild * 1000:.0f} ms, index {indexBuild * 1000:.0f} ms")
+
+
+if __name__ == '__main__':
+    run([int(x) for x in sys.argv[1:]] or [10_000, 100_000, 1_000_000])
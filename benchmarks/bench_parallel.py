@@ -0,0 +1,46 @@
+"""
+Measures how parallel ingest scales with the number of worker processes.
+
+Every parallel result is checked against the serial reader, including the
+rejected lines.
+
+usage: python benchmarks/bench_parallel.py [numVisits] [maxWorkers]
+"""
+import os
+import sys
+import tempfile
+
+import common
+from patient_parser import RejectLog, readPatientsParallel, readPatientsStreaming
+
+
+def main(numVisits, maxWorkers):
+    fd, fileName = tempfile.mkstemp(suffix='.txt')
+    os.close(fd)
+    try:
+        common.writeSyntheticFile(fileName, numVisits)
+        with open(fileName, 'a') as f:
+            # a few invalid lines so reject handling is compared too
+            f.write("1,2020-01-01,50.0,80,16,120,80,98\nnot,a,row\n")
+        serialRejects = RejectLog(keep=numVisits)
+        serialTime, serial = common.timeit(readPatientsStreaming, fileName, rejectLog=serialRejects, repeat=1)
+        print(f"{'workers':>8} {'seconds':>8} {'rows/s':>12} {'speedup':>8}")
+        print(f"{'serial':>8} {serialTime:>8.2f} {numVisits / serialTime:>12,.0f} {1:>7.2f}x")
+        workers = 1
+        while workers <= maxWorkers:
+            rejects = RejectLog(keep=numVisits)
+            # Small shards so that even modest files are spread over every worker.
+            seconds, store = common.timeit(readPatientsParallel, fileName, rejectLog=rejects, workers=workers,
+                                           shardBytes=max(1 << 16, os.path.getsize(fileName) // (4 * workers)),
+                                           repeat=1)
+            assert list(store.patientIds) == list(serial.patientIds)
+            assert rejects.records == serialRejects.records
+            print(f"{workers:>8} {seconds:>8.2f} {numVisits / seconds:>12,.0f} {serialTime / seconds:>7.2f}x")
+            workers *= 2
+    finally:
+        os.remove(fileName)
+
+
+if __name__ == '__main__':
+    args = [int(x) for x in sys.argv[1:]]
+    main(args[0] if args else 1_000_000, args[1] if len(args) > 1 else os.cpu_count() or 1)
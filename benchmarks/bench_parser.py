@@ -0,0 +1,70 @@
+"""
+Measures patient file parsing throughput in rows/sec.
+
+Compares the streaming, column-at-a-time reader with a line-by-line loop
+equivalent to the original readPatientsFromFile.
+
+usage: python benchmarks/bench_parser.py [numVisits ...]
+"""
+import os
+import sys
+import tempfile
+
+import common
+from patient_parser import readPatientsStreaming
+
+
+def readLineByLine(fileName):
+    patients = {}
+    with open(fileName, 'r') as file:
+        for line in file:
+            fields = line.strip().split(',')
+            if len(fields) != 8:
+                continue
+            try:
+                patientId = int(fields[0])
+                date = str(fields[1])
+                temperature = float(fields[2])
+                heartRate = int(fields[3])
+                respiratoryRate = int(fields[4])
+                sbp = int(fields[5])
+                dbp = int(fields[6])
+                spo2 = int(fields[7])
+            except ValueError:
+                continue
+            if temperature < 35 or temperature > 42:
+                continue
+            if heartRate < 30 or heartRate > 180:
+                continue
+            if respiratoryRate < 5 or respiratoryRate > 40:
+                continue
+            if sbp < 70 or sbp > 200:
+                continue
+            if dbp < 40 or dbp > 120:
+                continue
+            if spo2 < 70 or spo2 > 100:
+                continue
+            visit = [date, temperature, heartRate, respiratoryRate, sbp, dbp, spo2]
+            if patientId not in patients:
+                patients[patientId] = []
+            patients[patientId].append(visit)
+    return patients
+
+
+def main(sizes):
+    print(f"{'visits':>10} {'line-by-line rows/s':>20} {'streaming rows/s':>18} {'speedup':>8}")
+    for numVisits in sizes:
+        fd, fileName = tempfile.mkstemp(suffix='.txt')
+        os.close(fd)
+        try:
+            common.writeSyntheticFile(fileName, numVisits)
+            legacy, _ = common.timeit(readLineByLine, fileName)
+            streaming, _ = common.timeit(readPatientsStreaming, fileName)
+            print(f"{numVisits:>10} {numVisits / legacy:>20,.0f} {numVisits / streaming:>18,.0f} "
+                  f"{legacy / streaming:>7.2f}x")
+        finally:
+            os.remove(fileName)
+
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [100_000, 1_000_000])
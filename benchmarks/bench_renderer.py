@@ -0,0 +1,60 @@
+"""
+Compares printing every line of every visit with the batched renderer.
+
+Output goes to a temporary file so the terminal does not dominate the timings;
+pass a path (e.g. /dev/tty) as the second argument to measure another sink.
+
+usage: python benchmarks/bench_renderer.py [numVisits] [outputPath]
+"""
+import contextlib
+import os
+import sys
+import tempfile
+
+import common
+import renderer
+from visit_store import VisitStore
+
+
+def printEveryLine(patients):
+    # The loop displayPatientData used to run.
+    for patientId, patientData in patients.items():
+        print("Patient ID:", patientId)
+        for visit in patientData:
+            print(" Visit Date:", visit[0])
+            print("  Temperature:", "%.2f" % visit[1], "C")
+            print("  Heart Rate:", visit[2], "bpm")
+            print("  Respiratory Rate:", visit[3], "bpm")
+            print("  Systolic Blood Pressure:", visit[4], "mmHg")
+            print("  Diastolic Blood Pressure:", visit[5], "mmHg")
+            print("  Oxygen Saturation:", visit[6], "%")
+
+
+def run(numVisits, outputPath):
+    store = VisitStore()
+    for patientId, visit in common.syntheticVisits(numVisits):
+        store.append(patientId, visit)
+    patients = {patientId: store[patientId] for patientId in store}
+
+    # Line buffering makes every print a write() call, as on a terminal.
+    with open(outputPath, 'w', buffering=1) as out:
+        with contextlib.redirect_stdout(out):
+            printTime, _ = common.timeit(printEveryLine, patients, repeat=1)
+        renderTime, _ = common.timeit(renderer.renderTo, out, renderer.patientRecords(store), repeat=1)
+    print(f"{numVisits} visits: print per line {printTime:.2f} s, batched renderer {renderTime:.2f} s "
+          f"({printTime / renderTime:.1f}x)")
+    pageTime, _ = common.timeit(renderer.renderPage, renderer.patientRecords(store), 50, numVisits // 2)
+    print(f"  one page of 50 visits from the middle, streamed: {pageTime * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    numVisits = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    if len(sys.argv) > 2:
+        run(numVisits, sys.argv[2])
+    else:
+        fd, path = tempfile.mkstemp(suffix='.txt')
+        os.close(fd)
+        try:
+            run(numVisits, path)
+        finally:
+            os.remove(path)
@@ -0,0 +1,95 @@
+"""
+Scaling of a sharded dataset (see shards.py) with the number of shards and of worker processes.
+
+The same synthetic file is split into each number of shards and opened with
+each number of workers; the single file, loaded in this process, is the
+baseline. Parse is the first open, which parses the text and writes the
+snapshots; load is the next open, from those snapshots. Queries are timed from their second run,
+once every shard has built its indexes. Speed-ups need as many CPUs as
+workers; this machine has os.cpu_count() of them.
+
+usage: python benchmarks/bench_shards.py [visits] [--shards N ...] [--workers N ...]
+"""
+import argparse
+import io
+import os
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+import common
+import main
+import shards
+
+REPEAT = 3
+
+
+def _best(call):
+    call()
+    times = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def _timings(patients, year):
+    return [
+        _best(lambda: main.findVisitsByDate(patients, year)),
+        _best(lambda: main.findPatientsWhoNeedFollowUp(patients)),
+        _best(lambda: main.displayStats(patients)),
+    ]
+
+
+def _open(fileName, workers):
+    with redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        patients = main.readPatientsFromFile(fileName, workers=workers, useSnapshot=True, cacheEntries=0)
+        return patients, time.perf_counter() - start
+
+
+def _row(name, timings, baseline):
+    print(f"{name:>16}" + ''.join(f"{seconds * 1000:>10.1f} {baseline[index] / seconds:>5.1f}x"
+                                  for index, seconds in enumerate(timings)))
+
+
+def run(numVisits, shardCounts, workerCounts):
+    print(f"{numVisits} visits, {os.cpu_count()} CPU(s)")
+    print(f"{'shards/workers':>16}" + ''.join(f"{name:>17}" for name in
+                                             ('parse ms', 'load ms', 'by year ms', 'follow-up ms', 'stats ms')))
+    with tempfile.TemporaryDirectory() as directory:
+        fileName = os.path.join(directory, 'patients.txt')
+        common.writeSyntheticFile(fileName, numVisits)
+        parse = _open(fileName, 1)[1]
+        patients, load = _open(fileName, 1)
+        year = int(patients.dateString(len(patients.patientIds) // 2)[:4])
+        with redirect_stdout(io.StringIO()):
+            baseline = [parse, load] + _timings(patients, year)
+        _row('single file', baseline, baseline)
+        for numShards in shardCounts:
+            dataset = os.path.join(directory, f'shards-{numShards}')
+            with redirect_stdout(io.StringIO()):
+                shards.splitFile(fileName, dataset, numShards)
+            for workers in workerCounts:
+                if workers > numShards:
+                    continue
+                for name in os.listdir(dataset):
+                    if name.endswith('.snap'):
+                        os.remove(os.path.join(dataset, name))
+                patients, parse = _open(dataset, workers)
+                patients.close()
+                patients, load = _open(dataset, workers)
+                with redirect_stdout(io.StringIO()):
+                    timings = [parse, load] + _timings(patients, year)
+                patients.close()
+                _row(f'{numShards}/{workers}', timings, baseline)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time sharded datasets against a single file.")
+    parser.add_argument('visits', type=int, nargs='?', default=1_000_000)
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--workers', type=int, nargs='+', default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    args = parser.parse_args()
+    run(args.visits, args.shards, args.workers)
@@ -0,0 +1,39 @@
+"""
+Compares startup time from patients.txt with startup from its binary snapshot.
+
+usage: python benchmarks/bench_snapshot.py [numVisits ...]
+"""
+import os
+import sys
+import tempfile
+
+import common
+import snapshot
+from patient_parser import readPatientsStreaming
+
+
+def main(sizes):
+    print(f"{'visits':>10} {'text s':>8} {'snapshot s':>11} {'write s':>8} {'snapshot MiB':>13}")
+    for numVisits in sizes:
+        directory = tempfile.mkdtemp()
+        fileName = os.path.join(directory, 'patients.txt')
+        snapshotName = snapshot.snapshotPath(fileName)
+        try:
+            common.writeSyntheticFile(fileName, numVisits)
+            sourceStat = os.stat(fileName)
+            textTime, store = common.timeit(readPatientsStreaming, fileName, repeat=1)
+            writeTime, _ = common.timeit(snapshot.writeSnapshot, store, snapshotName, sourceStat, repeat=1)
+            loadTime, loaded = common.timeit(snapshot.loadSnapshot, snapshotName, fileName)
+            assert loaded is not None and loaded.visitCount == store.visitCount
+            print(f"{numVisits:>10} {textTime:>8.3f} {loadTime:>11.4f} {writeTime:>8.3f} "
+                  f"{os.path.getsize(snapshotName) / 2**20:>13.2f}")
+            del loaded
+        finally:
+            for name in (fileName, snapshotName):
+                if os.path.exists(name):
+                    os.remove(name)
+            os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [100_000, 1_000_000])
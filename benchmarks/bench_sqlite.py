@@ -0,0 +1,57 @@
+"""
+Compares the in-memory VisitStore with the SQLite backend at several dataset sizes.
+
+For each size a synthetic patients.txt is written and then:
+  - loaded into a VisitStore (parse) and imported into a database (import, once);
+  - opened (a VisitStore has to parse again; the database only connects);
+  - queried through the main.py functions, which the database answers in SQL.
+The first VisitStore query of each kind includes building its index or engine.
+
+usage: python benchmarks/bench_sqlite.py [size ...]
+"""
+import os
+import sys
+import tempfile
+
+import common
+import main
+import storage
+
+
+def _queries(patientId):
+    return [
+        ('patient lookup', lambda patients: patients[patientId]),
+        ('month of year', lambda patients: main.findVisitsByDate(patients, 2018, 6)),
+        ('date range', lambda patients: main.findVisitsInRange(patients, '2018-06-10', '2018-06-20')),
+        ('follow-up', lambda patients: main.findPatientsWhoNeedFollowUp(patients)),
+        ('stats (all)', lambda patients: main.vitalSummaries(patients, 0)),
+        ('stats (one)', lambda patients: main.vitalSummaries(patients, patientId)),
+    ]
+
+
+def run(numVisits, directory):
+    fileName = os.path.join(directory, f'patients-{numVisits}.txt')
+    dbName = os.path.join(directory, f'patients-{numVisits}.db')
+    common.writeSyntheticFile(fileName, numVisits)
+    loadTime, store = common.timeit(main.readPatientsFromFile, fileName, useSnapshot=False,
+                                   cacheEntries=0, repeat=1)
+    importTime, _ = common.timeit(storage.importTextFile, fileName, dbName, repeat=1)
+    openTime, db = common.timeit(storage.SqliteBackend, dbName, repeat=1)
+    print(f"{numVisits} visits: parse {loadTime:.2f} s, import {importTime:.2f} s, open db {openTime * 1000:.1f} ms, "
+          f"db size {os.path.getsize(dbName) / 2 ** 20:.1f} MiB")
+    print(f"  {'query':>15} {'memory ms':>10} {'first':>8} {'sqlite ms':>10}")
+    patientId = next(iter(store))
+    for name, query in _queries(patientId):
+        firstTime, _ = common.timeit(query, store, repeat=1)
+        memoryTime, expected = common.timeit(query, store)
+        sqliteTime, result = common.timeit(query, db)
+        assert len(result) == len(expected), name
+        print(f"  {name:>15} {memoryTime * 1000:>10.2f} {firstTime * 1000:>8.1f} {sqliteTime * 1000:>10.2f}")
+    db.close()
+
+
+if __name__ == '__main__':
+    sizes = [int(size) for size in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            run(size, directory)
@@ -0,0 +1,41 @@
+"""
+Compares recomputing vital sign statistics from the visit lists with the
+running VitalStats of a VisitStore.
+
+usage: python benchmarks/bench_stats.py [numVisits]
+"""
+import sys
+
+import common
+import vital_stats
+from visit_store import VisitStore
+from vital_stats import VitalStats, computePatientAggregates, summarizeVisits
+
+
+def run(numVisits):
+    store = VisitStore()
+    for patientId, visit in common.syntheticVisits(numVisits):
+        store.append(patientId, visit)
+    patients = {patientId: store[patientId] for patientId in store}
+    somePatient = next(iter(store))
+
+    backend = 'numpy' if vital_stats.numpy is not None else 'pure Python'
+    batchTime, _ = common.timeit(computePatientAggregates, store, repeat=1)
+    buildTime, stats = common.timeit(VitalStats.forStore, store, repeat=1)
+    scanTime, _ = common.timeit(lambda: summarizeVisits(v for visits in patients.values() for v in visits))
+    populationTime, _ = common.timeit(stats.population)
+    patientScanTime, _ = common.timeit(summarizeVisits, patients[somePatient])
+    patientTime, _ = common.timeit(stats.patient, somePatient)
+    print(f"{numVisits} visits, {len(store)} patients")
+    print(f"  per-patient batch aggregates ({backend}): {batchTime * 1000:.1f} ms")
+    print(f"  VitalStats build: {buildTime * 1000:.1f} ms")
+    print(f"  population: scan {scanTime * 1000:.1f} ms, running {populationTime * 1000:.3f} ms")
+    print(f"  one patient: scan {patientScanTime * 1000:.3f} ms, running {patientTime * 1000:.3f} ms")
+
+    store.append(somePatient, ['2024-01-01', 37.0, 80, 16, 120, 80, 98])
+    addTime, _ = common.timeit(store.append, somePatient, ['2024-01-01', 37.0, 80, 16, 120, 80, 98])
+    print(f"  add with statistics attached: {addTime * 1e6:.1f} us")
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
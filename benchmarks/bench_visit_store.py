@@ -0,0 +1,52 @@
+"""
+Compares the memory used by the dict-of-lists visit model with VisitStore.
+
+usage: python benchmarks/bench_visit_store.py [numVisits ...]
+"""
+import gc
+import sys
+import tracemalloc
+
+import common
+from visit_store import VisitStore
+
+
+def buildDict(pairs):
+    patients = {}
+    for patientId, visit in pairs:
+        if patientId not in patients:
+            patients[patientId] = []
+        patients[patientId].append(visit)
+    return patients
+
+
+def buildStore(pairs):
+    store = VisitStore()
+    for patientId, visit in pairs:
+        store.append(patientId, visit)
+    return store
+
+
+def measure(builder, numVisits):
+    """Returns the bytes still held once builder has consumed numVisits generated visits."""
+    gc.collect()
+    tracemalloc.start()
+    result = builder(common.syntheticVisits(numVisits))
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current
+
+
+def main(sizes):
+    print(f"{'visits':>10} {'dict MiB':>10} {'store MiB':>10} {'ratio':>7}")
+    for numVisits in sizes:
+        dictBytes = measure(buildDict, numVisits)
+        storeBytes = measure(buildStore, numVisits)
+        print(f"{numVisits:>10} {dictBytes / 2**20:>10.2f} {storeBytes / 2**20:>10.2f} "
+              f"{dictBytes / max(storeBytes, 1):>6.1f}x")
+
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [10_000, 100_000, 1_000_000])
@@ -0,0 +1,55 @@
+"""
+Helpers shared by the benchmark scripts.
+
+The scripts are meant to be run from the repository root, e.g.
+    python benchmarks/bench_visit_store.py
+"""
+import os
+import sys
+import time
+
+# Make the modules in the repository root importable when a script is run directly.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def syntheticVisits(numVisits, numPatients=None, seed=42):
+    """
+    Generates valid (patientId, visit) pairs in the format used by readPatientsFromFile.
+
+    The visits are those of generate_patients.PatientGenerator, with its defaults.
+
+    numVisits: The number of visits to generate.
+    numPatients: The number of distinct patients. Defaults to one patient per 10 visits.
+    seed: The seed for the random number generator.
+    """
+    # Imported here: generate_patients imports this module for sys.path.
+    from generate_patients import PatientGenerator
+    return PatientGenerator(numVisits, numPatients, seed=seed).visits()
+
+
+def writeSyntheticFile(fileName, numVisits, numPatients=None, seed=42):
+    """
+    Writes a patients.txt style file of synthetic visits, as generate_patients.py does.
+
+    fileName: The file to write.
+    numVisits: The number of visits to write.
+    numPatients: The number of distinct patients.
+    seed: The seed for the random number generator.
+    """
+    from generate_patients import PatientGenerator
+    PatientGenerator(numVisits, numPatients, seed=seed).write(fileName)
+
+
+def timeit(func, *args, repeat=3, **kwargs):
+    """
+    Times a call, keeping the best of several runs.
+
+    return: (best time in seconds, result of the last call)
+    """
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
@@ -0,0 +1,198 @@
+"""
+Writes realistic synthetic patients.txt files.
+
+Every patient has baseline vital signs of their own, and each visit varies
+around that baseline; a few visits catch the patient acutely unwell (fever,
+tachycardia, fast breathing, low blood pressure and oxygen saturation).
+Values are kept inside the ranges readPatientsFromFile accepts, and the
+diastolic pressure stays below the systolic one.
+
+Visits are spread over the patients uniformly, or skewed so that a few
+patients have most of the visits: with skew S, patient IDs are drawn as
+numPatients * u ** S for a uniform u, so S=1 is uniform and S=3 gives the 10%
+lowest IDs about 46% of the visits. Dates advance through the date span as
+the file goes on, like a log appended to over the years, with some jitter.
+
+A fraction of the lines can be made invalid, split evenly between a wrong
+number of fields, a value that is not a number and a vital sign out of range.
+Rows are generated one at a time, so files of any size are written in
+constant memory.
+
+The other benchmark scripts get their visits and files from here too,
+through common.syntheticVisits and common.writeSyntheticFile.
+
+usage: python benchmarks/generate_patients.py OUTPUT --visits N [--patients N] [--skew S]
+                                              [--start YYYY-MM-DD] [--end YYYY-MM-DD]
+                                              [--invalid FRACTION] [--seed N]
+"""
+import argparse
+import datetime
+import random
+
+import common  # puts the repository root on sys.path
+from patient_parser import VITAL_RANGES
+
+
+# (mean, standard deviation) of the baseline of each vital sign across patients,
+# and the standard deviation from visit to visit around a patient's baseline.
+BASELINES = (
+    (36.8, 0.3, 0.3),  # temperature
+    (75, 10, 8),  # heart rate
+    (16, 2, 2),  # respiratory rate
+    (122, 14, 10),  # systolic blood pressure
+    (78, 8, 6),  # diastolic blood pressure
+    (97, 1.2, 1.0),  # oxygen saturation
+)
+
+# Fraction of visits at which the patient is acutely unwell, and how much that shifts each vital.
+ACUTE_FRACTION = 0.05
+ACUTE_SHIFT = (2.0, 30, 9, -25, -10, -7)
+
+# Days by which a visit date may stray from its place in the span.
+DATE_JITTER = 15
+
+# Kinds of invalid line, chosen in turn.
+INVALID_KINDS = ('field count', 'data type', 'range')
+
+
+def _clamp(value, low, high):
+    return low if value < low else high if value > high else value
+
+
+class PatientGenerator:
+    """
+    Generates the lines of a synthetic patient file.
+
+    numVisits: The number of lines to generate, invalid ones included.
+    numPatients: The number of distinct patients. Defaults to one per 10 visits.
+    skew: How unevenly visits are spread over patients; 1 is uniform.
+    startDate, endDate: The span of the visit dates, as datetime.date.
+    invalidFraction: The fraction of lines that are invalid.
+    seed: The seed for the random number generator.
+    """
+
+    def __init__(self, numVisits, numPatients=None, skew=1.0, startDate=datetime.date(2015, 1, 1),
+                 endDate=datetime.date(2024, 12, 31), invalidFraction=0.0, seed=42):
+        if skew <= 0:
+            raise ValueError("skew should be positive")
+        if endDate < startDate:
+            raise ValueError("the end date should not be before the start date")
+        if not 0 <= invalidFraction <= 1:
+            raise ValueError("invalidFraction should be between 0 and 1")
+        self.numVisits = numVisits
+        self.numPatients = numPatients or max(1, numVisits // 10)
+        self.skew = skew
+        self.startDate = startDate
+        self.endDate = endDate
+        self.invalidFraction = invalidFraction
+        self.seed = seed
+        self.invalid = 0
+
+    def _baselines(self, rng):
+        # One list per vital sign, indexed by patient ID - 1.
+        return [[rng.gauss(mean, spread) for _ in range(self.numPatients)] for mean, spread, _ in BASELINES]
+
+    def visits(self):
+        """
+        Generates valid (patientId, visit) pairs.
+
+        return: A generator of (patientId, [date, temperature, heart rate, respiratory rate,
+                systolic bp, diastolic bp, oxygen saturation]).
+        """
+        rng = random.Random(self.seed)
+        baselines = self._baselines(rng)
+        ranges = [(low, high) for _, _, low, high in VITAL_RANGES]
+        start = self.startDate.toordinal()
+        span = self.endDate.toordinal() - start
+        step = span / max(1, self.numVisits)
+        numPatients = self.numPatients
+        skew = self.skew
+        gauss = rng.gauss
+        random_ = rng.random
+        for index in range(self.numVisits):
+            patientIndex = min(numPatients - 1, int(numPatients * random_() ** skew))
+            day = start + _clamp(int(index * step) + rng.randint(-DATE_JITTER, DATE_JITTER), 0, span)
+            acute = random_() < ACUTE_FRACTION
+            values = []
+            for (_, _, noise), baseline, shift, (low, high) in zip(BASELINES, baselines, ACUTE_SHIFT, ranges):
+                value = gauss(baseline[patientIndex], noise) + (shift if acute else 0)
+                values.append(_clamp(value, low, high))
+            temperature, heartRate, respiratoryRate, sbp, dbp, spo2 = values
+            sbp = round(sbp)
+            dbp = min(round(dbp), sbp - 10)
+            yield patientIndex + 1, [datetime.date.fromordinal(day).isoformat(), round(temperature, 1),
+                                     round(heartRate), round(respiratoryRate), sbp, max(dbp, ranges[4][0]),
+                                     round(spo2)]
+
+    def _invalidLine(self, rng, fields):
+        kind = INVALID_KINDS[self.invalid % len(INVALID_KINDS)]
+        self.invalid += 1
+        if kind == 'field count':
+            return ','.join(fields[:rng.randint(1, len(fields) - 1)])
+        position = rng.randint(2, len(fields) - 1)
+        if kind == 'data type':
+            fields[position] = rng.choice(('', 'n/a', '?', '12a'))
+        else:
+            _, _, low, high = VITAL_RANGES[position - 2]
+            fields[position] = str(rng.choice((low - rng.randint(1, 20), high + rng.randint(1, 20))))
+        return ','.join(fields)
+
+    def lines(self):
+        """
+        Generates the lines of the file, without newlines.
+
+        The invalid lines take the place of valid ones, so there are numVisits lines in all.
+        """
+        self.invalid = 0
+        rng = random.Random(self.seed + 1)
+        invalidFraction = self.invalidFraction
+        for patientId, visit in self.visits():
+            fields = [str(patientId)] + [str(value) for value in visit]
+            if invalidFraction and rng.random() < invalidFraction:
+                yield self._invalidLine(rng, fields)
+            else:
+                yield ','.join(fields)
+
+    def write(self, fileName):
+        """
+        Writes the file.
+
+        fileName: The file to write.
+        return: The number of invalid lines written.
+        """
+        with open(fileName, 'w') as file:
+            file.writelines(line + '\n' for line in self.lines())
+        return self.invalid
+
+
+def _date(text):
+    try:
+        return datetime.date.fromisoformat(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date: {text!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic patients.txt file.")
+    parser.add_argument('output', help="the file to write")
+    parser.add_argument('--visits', type=int, required=True, help="the number of lines")
+    parser.add_argument('--patients', type=int, help="the number of patients (default: visits / 10)")
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help="1 spreads visits evenly over patients, higher values favour a few (default: 1)")
+    parser.add_argument('--start', type=_date, default=datetime.date(2015, 1, 1), help="first visit date")
+    parser.add_argument('--end', type=_date, default=datetime.date(2024, 12, 31), help="last visit date")
+    parser.add_argument('--invalid', type=float, default=0.0, help="fraction of invalid lines (default: 0)")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    try:
+        generator = PatientGenerator(args.visits, args.patients, args.skew, args.start, args.end,
+                                     args.invalid, args.seed)
+    except ValueError as e:
+        parser.error(str(e))
+    invalid = generator.write(args.output)
+    print(f"Wrote {args.visits} lines for {generator.numPatients} patients to '{args.output}' "
+          f"({invalid} invalid).")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Load test of the query server.
+
+Starts server.py in a separate process on a synthetic patient file, then has
+many concurrent tasks send a mix of requests through one pooled QueryClient,
+and reports throughput and latency percentiles per operation.
+
+usage: python benchmarks/load_test.py [--visits N] [--requests N] [--concurrency N]
+                                      [--pool N] [--write-ratio R] [--tcp]
+"""
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import common
+from server import QueryClient
+
+
+def percentile(sortedValues, fraction):
+    """Returns the value below which a fraction of the sorted values lie (nearest rank)."""
+    index = min(len(sortedValues) - 1, max(0, int(round(fraction * len(sortedValues) + 0.5)) - 1))
+    return sortedValues[index]
+
+
+def _makeRequest(rng, numPatients, writeRatio):
+    # (name, coroutine function) of one random request.
+    if rng.random() < writeRatio:
+        patientId = rng.randint(1, numPatients)
+        return 'add', lambda client: client.add(patientId, '2024-01-15', 37.0, 72, 16, 120, 80, 98)
+    choice = rng.random()
+    if choice < 0.5:
+        patientId = rng.randint(1, numPatients)
+        return 'display patient', lambda client: client.request('display', patientId=patientId)
+    if choice < 0.7:
+        patientId = rng.randint(1, numPatients)
+        return 'stats patient', lambda client: client.stats(patientId)
+    if choice < 0.85:
+        day = rng.randint(1, 20)
+        return 'date range', lambda client: client.findVisitsInRange(f'2018-06-{day:02}', f'2018-06-{day + 7:02}')
+    if choice < 0.95:
+        return 'stats all', lambda client: client.stats()
+    return 'follow-up', lambda client: client.followUp()
+
+
+async def _load(client, requests, concurrency):
+    latencies = {}
+    errors = 0
+    queue = iter(requests)
+
+    async def worker():
+        nonlocal errors
+        for name, call in queue:
+            start = time.perf_counter()
+            try:
+                await call(client)
+            except Exception:
+                # e.g. a random patient ID that does not exist
+                errors += 1
+            latencies.setdefault(name, []).append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    await client.close()
+    return elapsed, latencies, errors
+
+
+def _waitForServer(process, timeout=120):
+    # The server prints one line once it is listening.
+    line = process.stdout.readline()
+    if not line:
+        raise RuntimeError(f"the server did not start (exit status {process.wait(timeout)})")
+    print(line.strip())
+
+
+def run(args):
+    with tempfile.TemporaryDirectory() as directory:
+        fileName = os.path.join(directory, 'patients.txt')
+        numPatients = max(1, args.visits // 10)
+        common.writeSyntheticFile(fileName, args.visits, numPatients)
+        command = [sys.executable, os.path.join(os.path.dirname(common.__file__), '..', 'server.py'),
+                   '--file', fileName]
+        if args.tcp:
+            command += ['--port', str(args.port)]
+            client = QueryClient(port=args.port, poolSize=args.pool)
+        else:
+            path = os.path.join(directory, 'server.sock')
+            command += ['--socket', path]
+            client = QueryClient(path=path, poolSize=args.pool)
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+        try:
+            _waitForServer(process)
+            rng = random.Random(args.seed)
+            requests = [_makeRequest(rng, numPatients, args.write_ratio) for _ in range(args.requests)]
+            elapsed, latencies, errors = asyncio.run(_load(client, requests, args.concurrency))
+        finally:
+            process.terminate()
+            process.wait()
+
+    allLatencies = sorted(value for values in latencies.values() for value in values)
+    print(f"{args.requests} requests, {args.concurrency} concurrent, pool of {args.pool}: "
+          f"{args.requests / elapsed:.0f} requests/s, {errors} error(s)")
+    print(f"  {'operation':>16} {'count':>7} {'p50 ms':>8} {'p99 ms':>8}")
+    for name, values in sorted(latencies.items()) + [('all', allLatencies)]:
+        values = sorted(values)
+        print(f"  {name:>16} {len(values):>7} {percentile(values, 0.5) * 1000:>8.2f} "
+              f"{percentile(values, 0.99) * 1000:>8.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test of the query server.")
+    parser.add_argument('--visits', type=int, default=200_000, help="visits in the synthetic file")
+    parser.add_argument('--requests', type=int, default=20_000)
+    parser.add_argument('--concurrency', type=int, default=64, help="requests in flight")
+    parser.add_argument('--pool', type=int, default=16, help="connections of the client")
+    parser.add_argument('--write-ratio', type=float, default=0.05, help="fraction of requests that add a visit")
+    parser.add_argument('--tcp', action='store_true', help="use TCP instead of a Unix socket")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--seed', type=int, default=42)
+    run(parser.parse_args())
@@ -0,0 +1,273 @@
+"""
+Benchmark suite of the main.py operations at several dataset sizes.
+
+For each size a synthetic patients.txt is written with generate_patients.py
+(or reused from --data-dir), then a fresh process loads it and times:
+    load          readPatientsFromFile, parsing the text (no snapshot)
+    display       displayPatientData of every patient, printed to /dev/null
+    display one   displayPatientData of one patient
+    stats         displayStats of every patient
+    find-by-date  findVisitsByDate of a year, and of a month of that year
+    follow-up     findPatientsWhoNeedFollowUp
+    add           addPatientData, one visit at a time
+    delete        deleteAllVisitsOfPatient, one patient at a time
+Each operation but add and delete runs --repeat times; the first run
+includes building any index it needs, and the throughput is taken from the
+best run. Peak memory is the high-water mark of the process resident set
+after each operation, so the operation that raises it stands out; with
+--trace-memory each operation also runs once under tracemalloc to get the
+peak bytes it allocated.
+
+The results are written as JSON, with the commit they were measured at.
+--compare OLD.json prints the change of every operation against an earlier
+run and exits with status 1 if any got slower than --threshold times (and
+by more than a millisecond), so it can gate a build.
+
+usage: python benchmarks/run_benchmarks.py [--sizes N ...] [--skew S] [--invalid F]
+                                           [--repeat N] [--output results.json]
+                                           [--data-dir DIR] [--trace-memory]
+                                           [--compare OLD.json] [--threshold R]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+import common  # puts the repository root on sys.path
+from generate_patients import PatientGenerator
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak memory is then not reported.
+    resource = None
+
+
+DEFAULT_SIZES = (1_000, 10_000, 100_000, 1_000_000)
+
+# Visits added, and patients deleted, by the add and delete operations.
+ADDS = 1000
+DELETES = 100
+
+# Slowdowns smaller than this many seconds are noise, whatever their ratio.
+MIN_SLOWDOWN = 0.001
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def peakRss():
+    """Returns the peak resident set size of this process in bytes, or None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _tracedPeak(call):
+    tracemalloc.start()
+    try:
+        call()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _operations(main, patients, fileName, numVisits):
+    # (name, call, items handled per call, repeatable)
+    patientIds = sorted(patients)
+    middle = patientIds[len(patientIds) // 2] if patientIds else 1
+    dates = sorted(patients.dateString(row) for row in range(0, len(patients.patientIds), 997)) or ['2020-06-01']
+    year, month = int(dates[len(dates) // 2][:4]), int(dates[len(dates) // 2][5:7])
+    newId = (patientIds[-1] if patientIds else 0) + 1
+    adds = [(newId + index % 100, f'{year}-{month:02}-15', 37.2, 80, 16, 120, 80, 97) for index in range(ADDS)]
+    victims = patientIds[:DELETES]
+
+    def addAll():
+        for visit in adds:
+            main.addPatientData(patients, *visit, fileName)
+
+    def deleteAll():
+        for patientId in victims:
+            main.deleteAllVisitsOfPatient(patients, patientId, fileName)
+
+    return [
+        ('display', lambda: main.displayPatientData(patients), numVisits, True),
+        ('display one', lambda: main.displayPatientData(patients, middle), 1, True),
+        ('stats', lambda: main.displayStats(patients), numVisits, True),
+        ('find-by-date year', lambda: main.findVisitsByDate(patients, year), numVisits, True),
+        ('find-by-date month', lambda: main.findVisitsByDate(patients, year, month), numVisits, True),
+        ('follow-up', lambda: main.findPatientsWhoNeedFollowUp(patients), numVisits, True),
+        ('add', addAll, len(adds), False),
+        ('delete', deleteAll, len(victims), False),
+    ]
+
+
+def _measure(call, items, repeat, traceMemory):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    result = {'firstSeconds': times[0], 'bestSeconds': best, 'items': items,
+              'itemsPerSecond': items / best if best else None, 'peakRssBytes': peakRss()}
+    if traceMemory:
+        result['tracedPeakBytes'] = _tracedPeak(call)
+    return result
+
+
+def runSize(fileName, numVisits, repeat, traceMemory):
+    """
+    Times every operation on one file; meant to run in a process of its own.
+
+    fileName: The patient file, which gets a journal from add and delete.
+    numVisits: The number of lines of the file, for throughputs.
+    repeat: How many times each repeatable operation runs.
+    traceMemory: Also run each operation once under tracemalloc.
+    return: A dictionary of operation name -> measurements.
+    """
+    import main
+    import journal
+
+    results = {}
+    # The functions print their answers; only the timings matter here.
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        results['load'] = _measure(lambda: main.readPatientsFromFile(fileName, useSnapshot=False), numVisits,
+                                   repeat, traceMemory)
+        patients = main.readPatientsFromFile(fileName, cacheEntries=0)
+        for name, call, items, repeatable in _operations(main, patients, fileName, numVisits):
+            results[name] = _measure(call, items, repeat if repeatable else 1, traceMemory and repeatable)
+    # Leave the file as it was for the next run.
+    journal.closeJournals()
+    journalName = journal.journalPath(fileName)
+    if os.path.exists(journalName):
+        os.remove(journalName)
+    return results
+
+
+def _runChild(fileName, numVisits, args):
+    command = [sys.executable, os.path.abspath(__file__), '--child', fileName, '--child-visits', str(numVisits),
+               '--repeat', str(args.repeat)]
+    if args.trace_memory:
+        command.append('--trace-memory')
+    output = subprocess.run(command, stdout=subprocess.PIPE, check=True, text=True).stdout
+    return json.loads(output)
+
+
+def _dataFile(directory, numVisits, args):
+    fileName = os.path.join(directory, f'patients-{numVisits}-skew{args.skew:g}-invalid{args.invalid:g}.txt')
+    if not os.path.exists(fileName):
+        start = time.perf_counter()
+        PatientGenerator(numVisits, skew=args.skew, invalidFraction=args.invalid, seed=args.seed).write(fileName)
+        print(f"  generated {fileName} in {time.perf_counter() - start:.1f} s", file=sys.stderr)
+    return fileName
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _printSize(numVisits, results):
+    print(f"{numVisits} visits")
+    print(f"  {'operation':>18} {'first ms':>10} {'best ms':>10} {'items/s':>14} {'peak RSS MiB':>13}")
+    for name, result in results.items():
+        rate = f"{result['itemsPerSecond']:,.0f}" if result['itemsPerSecond'] else '-'
+        rss = f"{result['peakRssBytes'] / 2 ** 20:.1f}" if result['peakRssBytes'] else '-'
+        print(f"  {name:>18} {result['firstSeconds'] * 1000:>10.2f} {result['bestSeconds'] * 1000:>10.2f} "
+              f"{rate:>14} {rss:>13}")
+
+
+def compare(old, new, threshold):
+    """
+    Prints the change of every operation measured in two runs.
+
+    old, new: The results, as written by this script.
+    threshold: The ratio of best times above which an operation counts as slower.
+    return: The number of operations that got slower.
+    """
+    oldSizes = {entry['visits']: entry['operations'] for entry in old['results']}
+    slower = 0
+    print(f"compared with {old.get('commit') or 'an earlier run'} ({old.get('timestamp')}):")
+    for entry in new['results']:
+        before = oldSizes.get(entry['visits'])
+        if before is None:
+            continue
+        for name, result in entry['operations'].items():
+            if name not in before or not before[name]['bestSeconds']:
+                continue
+            ratio = result['bestSeconds'] / before[name]['bestSeconds']
+            flag = ''
+            if ratio > threshold and result['bestSeconds'] - before[name]['bestSeconds'] > MIN_SLOWDOWN:
+                slower += 1
+                flag = '  SLOWER'
+            print(f"  {entry['visits']:>9} {name:>18} {ratio:>6.2f}x{flag}")
+    return slower
+
+
+def run(args):
+    results = []
+    with tempfile.TemporaryDirectory() as temporary:
+        directory = args.data_dir or temporary
+        os.makedirs(directory, exist_ok=True)
+        for numVisits in args.sizes:
+            fileName = _dataFile(directory, numVisits, args)
+            operations = _runChild(fileName, numVisits, args)
+            _printSize(numVisits, operations)
+            results.append({'visits': numVisits, 'fileBytes': os.path.getsize(fileName), 'operations': operations})
+    report = {
+        'commit': _commit(),
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {'skew': args.skew, 'invalid': args.invalid, 'seed': args.seed, 'repeat': args.repeat,
+                     'adds': ADDS, 'deletes': DELETES},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+            file.write('\n')
+        print(f"results written to {args.output}")
+    if args.compare:
+        with open(args.compare) as file:
+            old = json.load(file)
+        if compare(old, report, args.threshold):
+            return 1
+    return 0
+
+
+def _child(args):
+    results = runSize(args.child, args.child_visits, args.repeat, args.trace_memory)
+    sys.stdout.write(json.dumps(results))
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the main.py operations at several dataset sizes.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help="visits per dataset")
+    parser.add_argument('--skew', type=float, default=1.0, help="skew of visits over patients (see generate_patients.py)")
+    parser.add_argument('--invalid', type=float, default=0.0, help="fraction of invalid lines")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--repeat', type=int, default=3, help="runs of each operation")
+    parser.add_argument('--output', default='benchmark-results.json', help="the JSON file to write ('' for none)")
+    parser.add_argument('--data-dir', help="keep the generated files here and reuse them on later runs")
+    parser.add_argument('--trace-memory', action='store_true', help="also measure peak allocations (slow)")
+    parser.add_argument('--compare', metavar='OLD.json', help="compare with the results of an earlier run")
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help="slowdown ratio reported as a regression (default: %(default)s)")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--child-visits', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    sys.exit(_child(args) if args.child else run(args))
@@ -0,0 +1,264 @@
+"""
+Result cache for the queries that are asked over and over.
+
+A QueryCache registered on a VisitStore or a storage.StorageBackend keeps the
+results of findVisitsByDate, findVisitsInRange, vitalSummaries (and so
+displayStats) and findPatientsWhoNeedFollowUp, bounded in size (least
+recently used entries go first) and optionally in age.
+
+Entries are only dropped when a change could alter them:
+    - a visit added for patient X on a date in year Y, month M drops the
+      date searches for (Y, M), (Y, any), (any, M) and (any, any), the ranges
+      containing the date, the statistics of X and of everyone, and the
+      follow-up lists that do not list X yet and whose rules the visit breaks;
+    - deleting patient X does the same for each date X had a visit on,
+      except that follow-up lists are dropped only if they contain X.
+Everything else stays warm. Loading a large batch at once clears the cache.
+
+main.readPatientsFromFile registers one on the data it loads, so the menu,
+cli.py sessions and server.py all use it; QueryCache.forStore(patients)
+registers one on other data. main.py uses it whenever one is registered.
+"""
+import copy
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+from date_index import yearMonth
+from followup import DEFAULT_RULES, breaksRule
+from storage import BackendListener
+from visit_store import INVALID_DATE, StoreListener, dateToOrdinal
+
+
+DEFAULT_MAX_ENTRIES = 1024
+
+# Visits added at once above which the whole cache is cleared.
+CLEAR_BATCH = 4096
+
+
+def _copyResult(value):
+    # The cached results are lists of (patientId, visit list), lists of patient IDs
+    # and dictionaries of vital_stats.Summary tuples; below the top level, only the
+    # visit lists can be modified.
+    if isinstance(value, list):
+        return [(item[0], list(item[1])) if isinstance(item, tuple) else item for item in value]
+    return copy.copy(value)
+
+
+class QueryCache(StoreListener, BackendListener):
+    """
+    LRU cache of query results with invalidation tied to the changes of one store.
+
+    store: The VisitStore or storage.StorageBackend whose queries are cached.
+    maxEntries: The number of results kept.
+    ttl: Seconds after which a result is recomputed, or None to keep results until
+         they are invalidated or evicted.
+    """
+
+    def __init__(self, store, maxEntries=DEFAULT_MAX_ENTRIES, ttl=None):
+        if maxEntries < 1:
+            raise ValueError("maxEntries should be at least 1")
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        # key -> (value, expiry time or None)
+        self._entries = OrderedDict()
+        # Held while the entries change; lookups come from the server's read threads too.
+        self._lock = threading.Lock()
+        # Bumped by every invalidation, so a result computed meanwhile is not stored.
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @classmethod
+    def forStore(cls, store, maxEntries=DEFAULT_MAX_ENTRIES, ttl=None):
+        """
+        Returns the cache registered on a store, creating and registering it if needed.
+
+        store: The VisitStore or storage.StorageBackend.
+        maxEntries, ttl: The settings of a new cache; an existing one is returned unchanged.
+        """
+        cache = store.findListener(cls)
+        if cache is None:
+            cache = cls(store, maxEntries, ttl)
+            store.addListener(cache)
+        return cache
+
+    @classmethod
+    def find(cls, patients):
+        """
+        Returns the cache registered on some patient data, or None.
+
+        patients: A VisitStore, a storage.StorageBackend or a dictionary (which never has a cache).
+        """
+        findListener = getattr(patients, 'findListener', None)
+        return findListener(cls) if findListener is not None else None
+
+    def lookup(self, key, compute):
+        """
+        Returns the cached result for a key, computing and storing it on a miss.
+
+        key: A hashable key; see the keys built by cachedQuery.
+        compute: Called without arguments to produce the result.
+        return: A copy of the result, visit lists included, so callers may modify it.
+        compute runs without the lock; if the store changed while it ran, its result
+        is returned but not stored, since it may predate the change.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expiry = entry
+                if expiry is None or time.monotonic() < expiry:
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                    return _copyResult(value)
+                del self._entries[key]
+                self.expirations += 1
+            self.misses += 1
+            generation = self._generation
+        value = compute()
+        with self._lock:
+            if generation != self._generation:
+                return _copyResult(value)
+            self._entries[key] = (value, time.monotonic() + self.ttl if self.ttl is not None else None)
+            if len(self._entries) > self.maxEntries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return _copyResult(value)
+
+    def clear(self):
+        """Drops every entry."""
+        with self._lock:
+            self._generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def counters(self):
+        """
+        Returns the counters used to size the cache.
+
+        return: A dictionary with the entries held, the maximum, and the hits, misses,
+                evictions (for size), expirations (for age) and invalidations (for changes).
+        """
+        return {'entries': len(self._entries), 'maxEntries': self.maxEntries, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions, 'expirations': self.expirations,
+                'invalidations': self.invalidations}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _drop(self, key):
+        if self._entries.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def _invalidate(self, patientId, dates, affectsFollowUp):
+        # dates: the date strings of the visits added or deleted for patientId.
+        with self._lock:
+            self._generation += 1
+            self._invalidateLocked(patientId, dates, affectsFollowUp)
+
+    def _invalidateLocked(self, patientId, dates, affectsFollowUp):
+        buckets = set()
+        ordinals = set()
+        for date in dates:
+            ordinal = dateToOrdinal(date)
+            if ordinal != INVALID_DATE:
+                ordinals.add(ordinal)
+            parts = yearMonth(date)
+            if parts is not None:
+                buckets.add(parts)
+        for year, month in buckets:
+            for key in (('visits', year, month), ('visits', year, None), ('visits', None, month)):
+                self._drop(key)
+        if buckets:
+            self._drop(('visits', None, None))
+        self._drop(('stats', patientId))
+        self._drop(('stats', 0))
+        for key in list(self._entries):
+            if key[0] == 'range':
+                if any(key[1] <= ordinal <= key[2] for ordinal in ordinals):
+                    self._drop(key)
+            elif key[0] == 'follow-up' and affectsFollowUp(key[1], self._entries[key][0]):
+                self._drop(key)
+
+    def _visitsAdded(self, records):
+        if len(records) > CLEAR_BATCH:
+            self.clear()
+            return
+        for patientId, visit in records:
+            # A visit can only add its patient to the follow-up lists whose rules it breaks.
+            self._invalidate(patientId, [visit[0]], lambda rules, patientIds: patientId not in patientIds
+                             and any(breaksRule(rule, visit) for rule in rules))
+
+    def _patientDeleted(self, patientId, dates):
+        self._invalidate(patientId, dates, lambda rules, patientIds: patientId in patientIds)
+
+    # StoreListener
+
+    def visitsAdded(self, store, firstRow, endRow):
+        if endRow - firstRow > CLEAR_BATCH:
+            self.clear()
+            return
+        self._visitsAdded([(store.patientIds[row], store.visit(row)) for row in range(firstRow, endRow)])
+
+    def patientDeleted(self, store, patientId, rows):
+        self._patientDeleted(patientId, [store.dateString(row) for row in rows])
+
+    def storeCompacted(self, store):
+        # Compaction renumbers rows but changes no result.
+        pass
+
+    # BackendListener
+
+    def visitsStored(self, backend, records):
+        self._visitsAdded(records)
+
+    def patientRemoved(self, backend, patientId, dates):
+        self._patientDeleted(patientId, dates)
+
+
+def cachedQuery(makeKey):
+    """
+    Decorates a query function taking the patient data as first argument so its
+    results go through the QueryCache of that data, when one is registered.
+
+    makeKey: Called with the remaining arguments of the query; returns the cache
+             key, or None for calls that should not be cached.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(patients, *args, **kwargs):
+            cache = QueryCache.find(patients)
+            key = makeKey(*args, **kwargs) if cache is not None else None
+            if key is None:
+                return function(patients, *args, **kwargs)
+            return cache.lookup(key, lambda: function(patients, *args, **kwargs))
+        return wrapper
+    return decorate
+
+
+def visitsKey(year=None, month=None):
+    """Cache key of findVisitsByDate."""
+    return ('visits', year, month)
+
+
+def rangeKey(startDate, endDate):
+    """Cache key of findVisitsInRange; invalid dates are not cached, so their message is printed every time."""
+    start = dateToOrdinal(startDate)
+    end = dateToOrdinal(endDate)
+    if start == INVALID_DATE or end == INVALID_DATE:
+        return None
+    return ('range', start, end)
+
+
+def statsKey(patientId=0):
+    """Cache key of vitalSummaries."""
+    return ('stats', patientId)
+
+
+def followUpKey(rules=None):
+    """Cache key of findPatientsWhoNeedFollowUp."""
+    return ('follow-up', tuple(DEFAULT_RULES if rules is None else rules))
@@ -0,0 +1,531 @@
+"""
+Non-interactive command line for the Health Information System.
+
+    python cli.py [--file patients.txt] [--format text|csv|jsonl] [--time] [--profile] <command> [arguments]
+
+Commands:
+    display [--patient ID]                          visits of one or all patients
+    stats [--patient ID]                            vital sign statistics
+    find-by-date [--year Y] [--month M]             visits of a year and/or month
+    find-by-date --from YYYY-MM-DD --to YYYY-MM-DD  visits between two dates, both included
+    follow-up                                       patients who need a follow-up visit
+    worklist [--limit N] [--min-score S]            patients ranked by early-warning score
+    trends --patient ID [--window N]                trend of each vital sign of a patient
+    add ID DATE TEMP HR RR SBP DBP SPO2             record a visit
+    delete ID                                       delete all visits of a patient
+    import PATH [--strict]                          add the visits of a CSV file ('-' for stdin)
+    export PATH [--since CKPT] [--checkpoint CKPT]  visits, or changes since CKPT, as columnar batches
+    run-file PATH                                   run the commands in PATH ('-' for stdin)
+
+A run-file holds one command per line, written as on the command line without
+the global options; blank lines and '#' comments are ignored. The patient file
+is loaded once, however many commands are run, and changes made by add and
+delete are seen by the commands after them.
+
+--format text prints what the interactive menu prints. csv writes a header
+line followed by one row per visit, statistic or patient; jsonl writes one
+JSON object per row. With csv and jsonl, status messages go to standard error
+so standard output stays machine-readable.
+
+--lazy opens the file through its per-patient offset index (see
+patient_index.py) and parses only the patients a command looks at, which
+makes display --patient and trends fast on large files; commands over every
+patient still work but parse the whole file.
+
+Query results are cached (see cache.py) for the commands after them in a
+run-file; adds and deletes drop only the results they change.
+--cache-entries 0 turns the cache off.
+
+--file may also name a sharded dataset directory (see shards.py). Its shards
+are then loaded in --workers processes (by default one per shard, up to one
+per CPU), which run every query in parallel.
+
+export writes the visits in columnar batches (see export.py): an Arrow IPC
+file when pyarrow is installed, a column file otherwise. --checkpoint saves
+where the export stopped; a later export --since that file writes only the
+visits added and patients deleted since, and --checkpoint moves it forward:
+
+    python cli.py export full.arrow --checkpoint feed.json
+    python cli.py export changes.arrow --since feed.json --checkpoint feed.json
+
+--time prints the time spent loading the data and, per command, in the query
+and in rendering its output, to standard error. Visit listings are fetched
+lazily while they are written, so their fetching counts as rendering.
+
+--profile prints, to standard error, the calls and time of each function of
+main.py and of each parser stage (see instrumentation.py); --profile-memory
+adds the bytes each one allocated, at a large cost in speed. --profile-json
+PATH writes the same measurements as JSON, and --cprofile PATH writes a
+cProfile export of the whole run for pstats. Without these options nothing is
+measured.
+
+The exit status is 1 if any command failed, 2 on a usage error.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import shlex
+import sys
+import time
+from collections import namedtuple
+from contextlib import redirect_stdout
+
+import export
+import instrumentation
+from cache import DEFAULT_MAX_ENTRIES
+from early_warning import patientTrends
+from main import (addPatientData, deleteAllVisitsOfPatient, earlyWarningWorklist, findPatientsWhoNeedFollowUp,
+                  findVisitsByDate, findVisitsInRange, importVisits, printStats, readPatientsFromFile,
+                  vitalSummaries)
+from renderer import patientRecords, renderTo
+from vital_stats import VITALS
+
+
+VISIT_FIELDS = ('patientId', 'date') + VITALS
+STATS_FIELDS = ('patientId', 'vital', 'count', 'mean', 'min', 'max', 'std')
+WORKLIST_FIELDS = ('rank', 'patientId', 'date', 'score', 'risk', 'redFlag', 'change')
+TRENDS_FIELDS = ('patientId', 'vital', 'visits', 'first', 'last', 'change', 'rollingMean', 'slopePerDay')
+
+FORMATS = ('text', 'csv', 'jsonl')
+
+Result = namedtuple('Result', ['fields', 'rows', 'printText', 'message'], defaults=(None,))
+Result.__doc__ = """
+The answer to a command, before it is rendered.
+
+fields: The names of the columns of each row.
+rows: An iterable of tuples, one per row.
+printText: Called without arguments to print the answer as the interactive menu does.
+message: A status message, shown on standard error in the csv and jsonl formats.
+"""
+
+
+class CommandError(Exception):
+    """A command that could not be carried out; the message is shown to the user."""
+
+
+def _visitRows(records):
+    for patientId, visit in records:
+        yield (patientId,) + tuple(visit)
+
+
+def _visitResult(records, grouped, emptyMessage=None):
+    # records must be re-iterable when it is a list; patientRecords generators are used once.
+    def printText():
+        if emptyMessage is not None and not records:
+            print(emptyMessage)
+        else:
+            renderTo(sys.stdout, records, grouped)
+    return Result(VISIT_FIELDS, _visitRows(records), printText)
+
+
+def _captured(function, *args):
+    # Runs one of the main.py functions, returning (its result, what it printed).
+    output = io.StringIO()
+    with redirect_stdout(output):
+        value = function(*args)
+    return value, output.getvalue().rstrip('\n')
+
+
+def _display(patients, args):
+    if args.patient is None:
+        return _visitResult(patientRecords(patients), grouped=True)
+    if args.patient not in patients:
+        raise CommandError(f"Patient with ID {args.patient} not found.")
+    return _visitResult(patientRecords(patients, [args.patient]), grouped=True)
+
+
+def _stats(patients, args):
+    patientId = args.patient or 0
+    summaries = vitalSummaries(patients, patientId)
+    if not summaries:
+        raise CommandError("No patient data found." if patientId == 0 else f"Patient with ID {patientId} not found.")
+    rows = [(patientId, name) + tuple(summaries[name]) for name in VITALS]
+    return Result(STATS_FIELDS, rows, lambda: printStats(summaries, patientId))
+
+
+def _findByDate(patients, args):
+    if (args.start is None) != (args.end is None):
+        raise CommandError("--from and --to must be given together.")
+    if args.start is not None:
+        if args.year is not None or args.month is not None:
+            raise CommandError("--from/--to cannot be combined with --year or --month.")
+        visits, message = _captured(findVisitsInRange, patients, args.start, args.end)
+        if message:
+            raise CommandError(message)
+        return _visitResult(visits, grouped=False, emptyMessage="No visits found between the specified dates.")
+    visits = findVisitsByDate(patients, args.year, args.month)
+    return _visitResult(visits, grouped=False, emptyMessage="No visits found for the specified year/month.")
+
+
+def _followUp(patients, args):
+    patientIds = findPatientsWhoNeedFollowUp(patients)
+
+    def printText():
+        if patientIds:
+            print("Patients who need follow-up visits:")
+            sys.stdout.write(''.join(f"{patientId}\n" for patientId in patientIds))
+        else:
+            print("No patients found who need follow-up visits.")
+    return Result(('patientId',), [(patientId,) for patientId in patientIds], printText)
+
+
+def _worklist(patients, args):
+    entries = earlyWarningWorklist(patients, args.limit, args.min_score)
+    rows = [(rank,) + tuple(entry) for rank, entry in enumerate(entries, start=1)]
+
+    def printText():
+        if not rows:
+            print("No patients found on the early-warning worklist.")
+            return
+        print("Patients ranked by early-warning (NEWS2) score of their latest visit:")
+        sys.stdout.write(''.join(
+            f"{rank:>5}. Patient {patientId}: score {score} ({risk}{', red flag' if redFlag else ''}) on {date}"
+            f"{'' if change is None else f', {change:+d} since the previous visit'}\n"
+            for rank, patientId, date, score, risk, redFlag, change in rows))
+    return Result(WORKLIST_FIELDS, rows, printText)
+
+
+def _trends(patients, args):
+    if args.patient not in patients:
+        raise CommandError(f"Patient with ID {args.patient} not found.")
+    trends = patientTrends(patients[args.patient], args.window)
+    rows = [(args.patient, name, len(trend.values), trend.values[0], trend.values[-1],
+             trend.values[-1] - trend.values[0], trend.rollingMeans[-1], trend.slope)
+            for name, trend in trends.items() if trend.values]
+    if not rows:
+        raise CommandError(f"Patient with ID {args.patient} has no dated visits.")
+
+    def printText():
+        print(f"Trends for Patient {args.patient} over {rows[0][2]} visit(s):")
+        for _, name, _, first, last, change, rollingMean, slope in rows:
+            perYear = "n/a" if slope is None else "%+.2f per year" % (slope * 365.25)
+            print(f"  {name}: {first:g} -> {last:g} ({change:+g}), "
+                  f"mean of last {args.window} {rollingMean:.2f}, trend {perYear}")
+    return Result(TRENDS_FIELDS, rows, printText)
+
+
+def _statusResult(patientId, status, message):
+    return Result(('patientId', 'status'), [(patientId, status)], lambda: print(message), message)
+
+
+def _add(patients, args):
+    before = len(patients.get(args.patientId) or ())
+    _, message = _captured(addPatientData, patients, args.patientId, args.date, args.temp, args.hr, args.rr,
+                           args.sbp, args.dbp, args.spo2, args.fileName)
+    if len(patients.get(args.patientId) or ()) == before:
+        raise CommandError(message)
+    return _statusResult(args.patientId, 'added', message)
+
+
+def _delete(patients, args):
+    _, message = _captured(deleteAllVisitsOfPatient, patients, args.patientId, args.fileName)
+    if args.patientId in patients:
+        raise CommandError(message)
+    return _statusResult(args.patientId, 'deleted', message)
+
+
+def _import(patients, args):
+    source = sys.stdin if args.path == '-' else args.path
+    result, message = _captured(importVisits, patients, source, args.fileName, args.strict)
+    if not result.accepted:
+        raise CommandError(message)
+
+    def printText():
+        print(message)
+        for lineNumber, reason, line in result.rejects:
+            print(f"  line {lineNumber}: {reason}: {line}")
+    return Result(('line', 'reason', 'row'), result.rejects, printText, message)
+
+
+def _export(patients, args):
+    try:
+        if args.since:
+            result = export.exportChanges(args.fileName, export.loadCheckpoint(args.since), args.path,
+                                          args.batchRows, args.columnarFormat)
+        else:
+            result = export.exportVisits(patients, args.path, args.fileName, args.batchRows, args.columnarFormat)
+        if args.checkpoint and result.checkpoint is not None:
+            export.saveCheckpoint(result.checkpoint, args.checkpoint)
+    except (OSError, ValueError, export.CheckpointError) as e:
+        raise CommandError(f"Could not export the visits: {e}")
+    message = f"Exported {result.rows} row(s) in {result.batches} batch(es), {result.bytes} bytes, to '{args.path}'."
+    row = (args.path, result.rows, result.batches, result.bytes)
+    return Result(('path', 'rows', 'batches', 'bytes'), [row], lambda: print(message), message)
+
+
+def _nonNegative(text):
+    value = int(text)
+    if value < 0:
+        raise ValueError(text)
+    return value
+
+
+def _positive(text):
+    value = int(text)
+    if value < 1:
+        raise ValueError(text)
+    return value
+
+
+def _addCommands(subparsers):
+    display = subparsers.add_parser('display', help="visits of one or all patients")
+    display.add_argument('--patient', type=_nonNegative, help="the patient ID (default: all patients)")
+    display.set_defaults(handler=_display)
+
+    stats = subparsers.add_parser('stats', help="vital sign statistics")
+    stats.add_argument('--patient', type=_nonNegative, help="the patient ID (default: all patients)")
+    stats.set_defaults(handler=_stats)
+
+    find = subparsers.add_parser('find-by-date', help="visits of a year and/or month, or between two dates")
+    find.add_argument('--year', type=int)
+    find.add_argument('--month', type=int)
+    find.add_argument('--from', dest='start', metavar='YYYY-MM-DD', help="first date, included")
+    find.add_argument('--to', dest='end', metavar='YYYY-MM-DD', help="last date, included")
+    find.set_defaults(handler=_findByDate)
+
+    followUp = subparsers.add_parser('follow-up', help="patients who need a follow-up visit")
+    followUp.set_defaults(handler=_followUp)
+
+    worklist = subparsers.add_parser('worklist', help="patients ranked by early-warning score, sickest first")
+    worklist.add_argument('--limit', type=_nonNegative, help="the number of patients to list")
+    worklist.add_argument('--min-score', type=_nonNegative, default=0, help="leave out patients scoring lower")
+    worklist.set_defaults(handler=_worklist)
+
+    trends = subparsers.add_parser('trends', help="trend of each vital sign of a patient")
+    trends.add_argument('--patient', type=_nonNegative, required=True, help="the patient ID")
+    trends.add_argument('--window', type=_positive, default=3, help="visits in the rolling mean (default: %(default)s)")
+    trends.set_defaults(handler=_trends)
+
+    add = subparsers.add_parser('add', help="record a visit")
+    add.add_argument('patientId', type=_nonNegative)
+    add.add_argument('date', help="YYYY-MM-DD")
+    add.add_argument('temp', type=float, help="temperature (Celsius)")
+    add.add_argument('hr', type=int, help="heart rate (bpm)")
+    add.add_argument('rr', type=int, help="respiratory rate (breaths per minute)")
+    add.add_argument('sbp', type=int, help="systolic blood pressure (mmHg)")
+    add.add_argument('dbp', type=int, help="diastolic blood pressure (mmHg)")
+    add.add_argument('spo2', type=int, help="oxygen saturation (%%)")
+    add.set_defaults(handler=_add)
+
+    delete = subparsers.add_parser('delete', help="delete all visits of a patient")
+    delete.add_argument('patientId', type=_nonNegative)
+    delete.set_defaults(handler=_delete)
+
+    bulk = subparsers.add_parser('import', help="add the visits of a CSV file in one batch ('-' for stdin)")
+    bulk.add_argument('path')
+    bulk.add_argument('--strict', action='store_true', help="import nothing if any row is invalid")
+    bulk.set_defaults(handler=_import)
+
+    exporter = subparsers.add_parser('export', help="write the visits, or the changes since a checkpoint, "
+                                                    "as columnar batches")
+    exporter.add_argument('path')
+    exporter.add_argument('--since', metavar='CHECKPOINT', help="export only the changes after this checkpoint file")
+    exporter.add_argument('--checkpoint', metavar='CHECKPOINT', help="write the checkpoint of the export here")
+    exporter.add_argument('--batch-rows', dest='batchRows', type=_positive, default=export.DEFAULT_BATCH_ROWS,
+                          help="rows per batch (default: %(default)s)")
+    exporter.add_argument('--columnar-format', dest='columnarFormat', choices=export.FORMATS,
+                          help="arrow (needs pyarrow, the default when installed) or columns")
+    exporter.set_defaults(handler=_export)
+
+
+def buildParser():
+    """Returns the parser of the command line."""
+    parser = argparse.ArgumentParser(prog='cli.py', description="Query and update the patient file without the menu.")
+    parser.add_argument('--file', dest='fileName', default='patients.txt', help="the patient file (default: %(default)s)")
+    parser.add_argument('--format', choices=FORMATS, default='text', help="output format (default: %(default)s)")
+    parser.add_argument('--time', action='store_true', help="print per-phase timings to standard error")
+    parser.add_argument('--workers', type=_nonNegative,
+                        help="processes parsing the file when it has no up-to-date snapshot (default: 1), or "
+                             "holding the shards of a dataset directory (default: one per shard, up to one "
+                             "per CPU); 0: one per CPU")
+    parser.add_argument('--no-snapshot', dest='useSnapshot', action='store_false',
+                        help="always parse the text file instead of opening its snapshot")
+    parser.add_argument('--lazy', action='store_true',
+                        help="parse only the patients a command looks at, using an offset index of the file")
+    parser.add_argument('--cache-entries', dest='cacheEntries', type=_nonNegative, default=DEFAULT_MAX_ENTRIES,
+                        help="query results kept for later commands, 0 to disable the cache (default: %(default)s)")
+    parser.add_argument('--profile', action='store_true',
+                        help="print calls and time per function and parser stage to standard error")
+    parser.add_argument('--profile-memory', dest='profileMemory', action='store_true',
+                        help="with --profile or --profile-json, also record allocated bytes (slow)")
+    parser.add_argument('--profile-json', dest='profileJson', metavar='PATH',
+                        help="write the calls and time per function and parser stage to PATH as JSON")
+    parser.add_argument('--cprofile', metavar='PATH', help="write a cProfile export of the run to PATH")
+    subparsers = parser.add_subparsers(dest='command', metavar='command', required=True)
+    _addCommands(subparsers)
+    runFile = subparsers.add_parser('run-file', help="run a file of commands, one per line ('-' for stdin)")
+    runFile.add_argument('path')
+    return parser
+
+
+def _buildLineParser():
+    # Parses one line of a run-file: the commands without the global options or run-file itself.
+    parser = argparse.ArgumentParser(prog='run-file', add_help=False)
+    subparsers = parser.add_subparsers(dest='command', metavar='command', required=True)
+    _addCommands(subparsers)
+    return parser
+
+
+def renderResult(result, outputFormat, out=None):
+    """
+    Writes the answer to a command.
+
+    result: The Result.
+    outputFormat: 'text', 'csv' or 'jsonl'.
+    out: The stream to write csv and jsonl to instead of sys.stdout.
+    """
+    out = out if out is not None else sys.stdout
+    if outputFormat == 'text':
+        result.printText()
+    elif outputFormat == 'csv':
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(result.fields)
+        writer.writerows(result.rows)
+    else:
+        fields = result.fields
+        out.writelines(json.dumps(dict(zip(fields, row))) + '\n' for row in result.rows)
+
+
+class Session:
+    """
+    Runs commands against patient data loaded once.
+
+    fileName: The patient file.
+    outputFormat: 'text', 'csv' or 'jsonl'.
+    timed: Print per-phase timings to standard error.
+    cacheEntries: The size of the query cache, 0 for none.
+    """
+
+    def __init__(self, fileName, outputFormat='text', timed=False, workers=None, useSnapshot=True, lazy=False,
+                 cacheEntries=DEFAULT_MAX_ENTRIES):
+        self.fileName = fileName
+        self.outputFormat = outputFormat
+        self.timed = timed
+        self.failures = 0
+        self.queryTime = 0.0
+        self.renderTime = 0.0
+        self.commands = 0
+        start = time.perf_counter()
+        # Load messages (e.g. skipped lines) are status, not output.
+        with redirect_stdout(sys.stdout if outputFormat == 'text' else sys.stderr):
+            self.patients = readPatientsFromFile(fileName, workers=workers, useSnapshot=useSnapshot,
+                                                 lazy=lazy, cacheEntries=cacheEntries)
+        self.loadTime = time.perf_counter() - start
+        if timed:
+            print(f"[time] load: {self.loadTime * 1000:.1f} ms", file=sys.stderr)
+
+    def run(self, args, label=None):
+        """
+        Runs one parsed command and writes its answer.
+
+        args: The argparse namespace of the command.
+        label: How to refer to the command in error messages and timings.
+        return: True if the command succeeded.
+        """
+        label = label or args.command
+        args.fileName = self.fileName
+        self.commands += 1
+        start = time.perf_counter()
+        try:
+            # Status printed by the main.py functions stays off stdout in machine formats.
+            with redirect_stdout(sys.stdout if self.outputFormat == 'text' else sys.stderr):
+                result = args.handler(self.patients, args)
+        except CommandError as e:
+            self.failures += 1
+            print(f"{label}: {e}", file=sys.stderr)
+            return False
+        queried = time.perf_counter()
+        if result.message is not None and self.outputFormat != 'text':
+            print(result.message, file=sys.stderr)
+        renderResult(result, self.outputFormat)
+        sys.stdout.flush()
+        rendered = time.perf_counter()
+        self.queryTime += queried - start
+        self.renderTime += rendered - queried
+        if self.timed:
+            print(f"[time] {label}: query {(queried - start) * 1000:.1f} ms, "
+                  f"render {(rendered - queried) * 1000:.1f} ms", file=sys.stderr)
+        return True
+
+    def runFile(self, path):
+        """
+        Runs every command of a run-file.
+
+        path: The name of the file, or '-' for standard input.
+        """
+        parser = _buildLineParser()
+        lines = sys.stdin if path == '-' else open(path, 'r')
+        with lines:
+            for lineNumber, line in enumerate(lines, start=1):
+                try:
+                    words = shlex.split(line, comments=True)
+                except ValueError as e:
+                    self._lineError(path, lineNumber, e)
+                    continue
+                if not words:
+                    continue
+                try:
+                    args = parser.parse_args(words)
+                except SystemExit:
+                    # argparse has already explained the problem on stderr.
+                    self._lineError(path, lineNumber, "invalid command")
+                    continue
+                self.run(args, label=f"{path}:{lineNumber}: {words[0]}")
+
+    def _lineError(self, path, lineNumber, message):
+        self.failures += 1
+        print(f"{path}:{lineNumber}: {message}", file=sys.stderr)
+
+    def printTotals(self):
+        """Prints the time spent in each phase over all commands to standard error."""
+        print(f"[time] total: load {self.loadTime * 1000:.1f} ms, query {self.queryTime * 1000:.1f} ms, "
+              f"render {self.renderTime * 1000:.1f} ms, {self.commands} command(s)", file=sys.stderr)
+
+
+def main(argv=None):
+    """
+    Runs the command line.
+
+    argv: The arguments, without the program name; defaults to sys.argv[1:].
+    return: The exit status.
+    """
+    args = buildParser().parse_args(argv)
+    if args.profile or args.profileJson:
+        instrumentation.enable(traceMemory=args.profileMemory)
+    if args.cprofile:
+        with instrumentation.profileTo(args.cprofile):
+            status = _run(args)
+    else:
+        status = _run(args)
+    if args.profile:
+        instrumentation.printSummary()
+    if args.profileJson:
+        instrumentation.writeJson(args.profileJson)
+    return status
+
+
+def _run(args):
+    session = Session(args.fileName, args.format, args.time, args.workers, args.useSnapshot, args.lazy,
+                      args.cacheEntries)
+    if args.command == 'run-file':
+        try:
+            session.runFile(args.path)
+        except OSError as e:
+            print(f"run-file: {e}", file=sys.stderr)
+            return 1
+    else:
+        session.run(args)
+    if args.time:
+        session.printTotals()
+    return 1 if session.failures else 0
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except BrokenPipeError:
+        # The reader went away (e.g. `| head`); stop quietly.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
@@ -0,0 +1,213 @@
+"""
+Date index over a VisitStore.
+
+Keeps the row numbers of all visits sorted by date ordinal, so a year, a
+month of a year or any date range is found with two bisections instead of a
+scan over every visit. The index follows the store as a StoreListener:
+added visits wait in an unsorted tail that the next query sorts and merges
+in one pass, and rows of deleted patients are skipped at query time until
+enough of them pile up to be worth a rebuild.
+"""
+import datetime
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+from visit_store import INVALID_DATE, StoreListener
+
+
+# Added rows above which the index is rebuilt rather than inserted into.
+REBUILD_BATCH = 4096
+
+
+def yearMonth(date):
+    """
+    Extracts the year and month of a date string that has no day ordinal,
+    using the same lenient split as the original findVisitsByDate.
+
+    date: The date string, e.g. '2023-02-30'.
+    return: (year, month), or None if the string does not split into three integers.
+    """
+    try:
+        year, month, _ = [int(x) for x in date.split("-")]
+    except ValueError:
+        return None
+    return year, month
+
+
+def monthStart(year, month):
+    """
+    Returns the day ordinal of the first day of a month, clamped to the representable range.
+
+    year: The year.
+    month: The month; values past 12 or below 1 roll over into the next or previous years.
+    """
+    year += (month - 1) // 12
+    month = (month - 1) % 12 + 1
+    if year > datetime.MAXYEAR:
+        return datetime.date.max.toordinal() + 1
+    if year < datetime.MINYEAR:
+        return INVALID_DATE + 1
+    return datetime.date(year, month, 1).toordinal()
+
+
+class DateIndex(StoreListener):
+    """
+    Rows of a VisitStore sorted by (date ordinal, row number).
+
+    Use DateIndex.forStore to get the index of a store, building it on first use.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        # Held while a query merges the tail; queries may come from several threads.
+        self._lock = threading.RLock()
+        self.rebuild()
+
+    @classmethod
+    def forStore(cls, store):
+        """
+        Returns the date index registered on a store, building and registering it if needed.
+
+        store: The VisitStore.
+        """
+        index = store.findListener(cls)
+        if index is None:
+            index = cls(store)
+            store.addListener(index)
+        return index
+
+    def rebuild(self):
+        """Rebuilds the index from the live rows of the store."""
+        store = self._store
+        dates = store.dates
+        live = store._live
+        rows = sorted((row for row in range(len(dates)) if live[row] and dates[row] != INVALID_DATE),
+                      key=dates.__getitem__)
+        self._rows = array('I', rows)
+        self._ordinals = array('i', map(dates.__getitem__, rows))
+        # (ordinal, row) of the visits added since the last query, not merged yet
+        self._tail = []
+        # first row of the patient of each row, which orders patients as the store does
+        self._firstRows = array('I', [0]) * len(dates)
+        for patientId in store:
+            patientRows = store.rows(patientId)
+            first = patientRows[0]
+            if type(patientRows) is range:
+                self._firstRows[first:patientRows.stop] = array('I', [first]) * len(patientRows)
+            else:
+                for row in patientRows:
+                    self._firstRows[row] = first
+        self._deadRows = 0
+        # (year, month, row) of rows whose date has no ordinal but still has a year and month
+        self._undated = []
+        for row, date in store._rawDates.items():
+            if live[row] and dates[row] == INVALID_DATE:
+                parts = yearMonth(date)
+                if parts is not None:
+                    self._undated.append(parts + (row,))
+
+    def visitsAdded(self, store, firstRow, endRow):
+        if endRow - firstRow > REBUILD_BATCH:
+            self.rebuild()
+            return
+        dates = store.dates
+        patientIds = store.patientIds
+        for row in range(firstRow, endRow):
+            self._firstRows.append(store.rows(patientIds[row])[0])
+            ordinal = dates[row]
+            if ordinal == INVALID_DATE:
+                parts = yearMonth(store.dateString(row))
+                if parts is not None:
+                    self._undated.append(parts + (row,))
+                continue
+            self._tail.append((ordinal, row))
+
+    def _mergeTail(self):
+        # Merges the sorted tail into the arrays, copying each run between two
+        # tail entries with one slice instead of shifting the arrays per visit.
+        if not self._tail:
+            return
+        tail, self._tail = sorted(self._tail), []
+        oldOrdinals, oldRows = self._ordinals, self._rows
+        ordinals = array('i')
+        rows = array('I')
+        start = 0
+        for ordinal, row in tail:
+            # New rows have the highest row numbers, so they go after equal dates.
+            position = bisect_right(oldOrdinals, ordinal, start)
+            ordinals.extend(oldOrdinals[start:position])
+            rows.extend(oldRows[start:position])
+            ordinals.append(ordinal)
+            rows.append(row)
+            start = position
+        ordinals.extend(oldOrdinals[start:])
+        rows.extend(oldRows[start:])
+        self._ordinals, self._rows = ordinals, rows
+
+    def patientDeleted(self, store, patientId, rows):
+        self._deadRows += len(rows)
+        if self._deadRows > len(self._rows) // 2:
+            self.rebuild()
+
+    def storeCompacted(self, store):
+        self.rebuild()
+
+    def rowsBetween(self, startOrdinal, endOrdinal):
+        """
+        Returns the live rows dated in [startOrdinal, endOrdinal), sorted by date.
+
+        startOrdinal: The first day ordinal included.
+        endOrdinal: The first day ordinal excluded.
+        """
+        with self._lock:
+            self._mergeTail()
+            low = bisect_left(self._ordinals, startOrdinal)
+            high = bisect_left(self._ordinals, endOrdinal, low)
+            rows = self._rows[low:high]
+        if self._deadRows:
+            live = self._store._live
+            return [row for row in rows if live[row]]
+        return list(rows)
+
+    def rowsByYearMonth(self, year=None, month=None):
+        """
+        Returns the live rows of a year, a month (of every year) or a month of a year.
+
+        year: The year to filter by, or None for all years.
+        month: The month to filter by, or None for all months.
+        return: A list of row numbers in the order the original findVisitsByDate
+                lists them: patient by patient in store order, and in row order
+                for each patient. Dates that are not real calendar days (e.g.
+                '2023-02-30') match by their year and month.
+        """
+        with self._lock:
+            self._mergeTail()
+            rows = self._rowsByYearMonth(year, month)
+        # Both sorts are stable and compare plain integers.
+        rows.sort()
+        rows.sort(key=self._firstRows.__getitem__)
+        return rows
+
+    def _rowsByYearMonth(self, year, month):
+        if month is not None and not 1 <= month <= 12:
+            rows = []
+        elif year is not None and month is not None:
+            rows = self.rowsBetween(monthStart(year, month), monthStart(year, month + 1))
+        elif year is not None:
+            rows = self.rowsBetween(monthStart(year, 1), monthStart(year + 1, 1))
+        elif month is not None:
+            rows = []
+            if self._ordinals:
+                firstYear = datetime.date.fromordinal(self._ordinals[0]).year
+                lastYear = datetime.date.fromordinal(self._ordinals[-1]).year
+                for eachYear in range(firstYear, lastYear + 1):
+                    rows.extend(self.rowsBetween(monthStart(eachYear, month), monthStart(eachYear, month + 1)))
+        else:
+            rows = self.rowsBetween(INVALID_DATE + 1, datetime.date.max.toordinal() + 1)
+        if self._undated:
+            live = self._store._live
+            rows.extend(row for eachYear, eachMonth, row in self._undated
+                        if live[row] and (year is None or year == eachYear)
+                        and (month is None or month == eachMonth))
+        return rows
@@ -0,0 +1,388 @@
+"""
+NEWS2-style early-warning scores and per-patient vital sign trends.
+
+Every visit gets a National Early Warning Score (NEWS2) from its respiratory
+rate, oxygen saturation (scale 1), systolic blood pressure, heart rate and
+temperature. The visits do not record supplemental oxygen or consciousness,
+so those parameters are taken as 'on air' and 'alert' and score 0.
+
+    parameter          3       2        1          0          1          2          3
+    respiratory rate   <=8              9-11       12-20                 21-24      >=25
+    oxygen saturation  <=91    92-93    94-95      >=96
+    systolic bp        <=90    91-100   101-110    111-219                          >=220
+    heart rate         <=40             41-50      51-90      91-110     111-130    >=131
+    temperature        <=35.0           35.1-36.0  36.1-38.0  38.1-39.0  >=39.1
+
+Scores are computed a whole column at a time: each integer column is mapped
+one byte per value (see visit_store.byteColumn) through a 256-entry table
+with bytes.translate, the temperature column with
+a C-level bisect, and the five score vectors are added as big integers, so
+millions of visits are scored in about a second. EarlyWarningEngine keeps the
+scores of a VisitStore up to date as visits are added and builds a worklist
+of patients ranked by the score of their latest visit. BackendWorklist does
+the same for a storage.StorageBackend, keeping only the latest two visits of
+each patient, so the data is read once and not copied.
+
+patientTrends works on the visit lists of one patient, in the layout
+returned by readPatientsFromFile, and gives per-vital deltas, rolling means
+and slopes over time.
+"""
+import heapq
+from bisect import bisect_left
+from collections import namedtuple
+from itertools import repeat
+
+from storage import BackendListener
+from visit_store import COLUMNS, INVALID_DATE, StoreListener, byteColumn, dateToOrdinal
+from vital_stats import VITALS
+
+
+# (column, upper bounds of each band, score of each band); a value belongs to
+# the first band whose upper bound it does not exceed, the last band has no bound.
+NEWS2_BANDS = (
+    ('respiratoryRate', (8, 11, 20, 24), (3, 1, 0, 2, 3)),
+    ('spo2', (91, 93, 95), (3, 2, 1, 0)),
+    ('sbp', (90, 100, 110, 219), (3, 2, 1, 0, 3)),
+    ('heartRate', (40, 50, 90, 110, 130), (3, 1, 0, 1, 2, 3)),
+    ('temperature', (35.0, 36.0, 38.0, 39.0), (3, 1, 0, 1, 2)),
+)
+
+# Position of each column in a visit list.
+VISIT_INDEX = {name: index for index, (name, _) in enumerate(COLUMNS)}
+
+# Aggregate score from which the clinical risk is medium, and high.
+MEDIUM_RISK = 5
+HIGH_RISK = 7
+
+# Added rows above which the engine rescores everything rather than the new rows.
+REBUILD_BATCH = 4096
+
+WorklistEntry = namedtuple('WorklistEntry', ['patientId', 'date', 'score', 'risk', 'redFlag', 'change'])
+WorklistEntry.__doc__ = """
+One patient on the early-warning worklist.
+
+patientId: The ID of the patient.
+date: The date of the patient's latest visit.
+score: The NEWS2 score of that visit.
+risk: 'high', 'medium', 'low-medium' (a single parameter scoring 3) or 'low'.
+redFlag: True if a single parameter of that visit scored 3.
+change: The score minus the score of the visit before it, or None for a first visit.
+"""
+
+Trend = namedtuple('Trend', ['dates', 'values', 'deltas', 'rollingMeans', 'slope'])
+Trend.__doc__ = """
+The time series of one vital sign (or of the NEWS2 score) of one patient.
+
+dates: The visit dates, oldest first; visits without a valid date are left out.
+values: The value at each date.
+deltas: The change since the previous visit, one fewer than values.
+rollingMeans: The mean of the last `window` values at each date (fewer at the start).
+slope: The least-squares change per day, or None with fewer than two distinct dates.
+"""
+
+
+def _scoreFor(bounds, scores, value):
+    return scores[bisect_left(bounds, value)]
+
+
+def _byteTables():
+    # column -> (score table, red flag table) for the integer columns
+    tables = {}
+    for column, bounds, scores in NEWS2_BANDS:
+        if column != 'temperature':
+            score = bytes(_scoreFor(bounds, scores, value) for value in range(256))
+            tables[column] = (score, score.translate(bytes(int(value == 3) for value in range(256))))
+    return tables
+
+
+_BYTE_TABLES = _byteTables()
+_TEMPERATURE_BOUNDS, _TEMPERATURE_SCORES = NEWS2_BANDS[-1][1:]
+_RED_FLAG = bytes(int(value == 3) for value in range(256))
+
+
+def scoreVisit(visit):
+    """
+    Computes the NEWS2 score of one visit.
+
+    visit: [date, temperature, heart rate, respiratory rate, systolic bp, diastolic bp, oxygen saturation]
+    return: (score, True if a single parameter scored 3)
+    """
+    total = 0
+    redFlag = False
+    for column, bounds, scores in NEWS2_BANDS:
+        score = _scoreFor(bounds, scores, visit[VISIT_INDEX[column]])
+        total += score
+        redFlag = redFlag or score == 3
+    return total, redFlag
+
+
+def riskLevel(score, redFlag):
+    """
+    Returns the clinical risk of a NEWS2 score: 'high', 'medium', 'low-medium' or 'low'.
+
+    score: The aggregate score.
+    redFlag: True if a single parameter scored 3.
+    """
+    if score >= HIGH_RISK:
+        return 'high'
+    if score >= MEDIUM_RISK:
+        return 'medium'
+    return 'low-medium' if redFlag else 'low'
+
+
+def scoreRows(store, start=0, end=None):
+    """
+    Scores a range of rows of a VisitStore, whole columns at a time.
+
+    store: The VisitStore.
+    start, end: The rows to score; end defaults to the last row.
+    return: (scores, red flags), two bytearrays with one byte per row.
+    """
+    end = len(store.patientIds) if end is None else end
+    count = end - start
+    total = 0
+    flags = 0
+    for column, (scoreTable, flagTable) in _BYTE_TABLES.items():
+        values = byteColumn(getattr(store, column), start, end)
+        if values is None:
+            # Every band bound is below 255, so larger values score as 255 does.
+            values = bytes(map(min, getattr(store, column)[start:end], repeat(255, count)))
+        total += int.from_bytes(values.translate(scoreTable), 'little')
+        flags |= int.from_bytes(values.translate(flagTable), 'little')
+    temperatures = bytes(map(_TEMPERATURE_SCORES.__getitem__,
+                             map(bisect_left, repeat(_TEMPERATURE_BOUNDS, count), store.temperature[start:end])))
+    total += int.from_bytes(temperatures, 'little')
+    flags |= int.from_bytes(temperatures.translate(_RED_FLAG), 'little')
+    # At most 3 per parameter, so no byte of the sum carries into the next.
+    return bytearray(total.to_bytes(count, 'little')), bytearray(flags.to_bytes(count, 'little'))
+
+
+class EarlyWarningEngine(StoreListener):
+    """
+    NEWS2 score of every visit of a VisitStore, and the latest two visits of every patient.
+
+    Use EarlyWarningEngine.forStore to get the engine of a store, building it on first use.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self.rebuild()
+
+    @classmethod
+    def forStore(cls, store):
+        """
+        Returns the engine registered on a store, building and registering it if needed.
+
+        store: The VisitStore.
+        """
+        engine = store.findListener(cls)
+        if engine is None:
+            engine = cls(store)
+            store.addListener(engine)
+        return engine
+
+    def rebuild(self):
+        """Rescores every row and finds the latest visits of every patient again."""
+        store = self._store
+        self.scores, self.redFlags = scoreRows(store)
+        # Row numbers of a patient ascend, so a stable sort by date orders them by (date, row).
+        byDate = store.dates.__getitem__
+        self._latest = {}
+        self._previous = {}
+        for patientId in store:
+            rows = store.rows(patientId)
+            if len(rows) == 1:
+                self._latest[patientId] = rows[0]
+                continue
+            ordered = sorted(rows, key=byDate)
+            self._latest[patientId] = ordered[-1]
+            self._previous[patientId] = ordered[-2]
+
+    def _later(self, row, other):
+        # Whether row is a later visit than other.
+        dates = self._store.dates
+        return (dates[row], row) > (dates[other], other)
+
+    def visitsAdded(self, store, firstRow, endRow):
+        if endRow - firstRow > REBUILD_BATCH:
+            self.rebuild()
+            return
+        scores, flags = scoreRows(store, firstRow, endRow)
+        self.scores += scores
+        self.redFlags += flags
+        for row in range(firstRow, endRow):
+            patientId = store.patientIds[row]
+            latest = self._latest.get(patientId)
+            if latest is None or self._later(row, latest):
+                self._latest[patientId] = row
+                if latest is not None:
+                    self._previous[patientId] = latest
+            else:
+                previous = self._previous.get(patientId)
+                if previous is None or self._later(row, previous):
+                    self._previous[patientId] = row
+
+    def patientDeleted(self, store, patientId, rows):
+        self._latest.pop(patientId, None)
+        self._previous.pop(patientId, None)
+
+    def storeCompacted(self, store):
+        self.rebuild()
+
+    def score(self, row):
+        """
+        Returns the NEWS2 score of a row.
+
+        row: The row number of the visit.
+        return: (score, True if a single parameter scored 3)
+        """
+        return self.scores[row], bool(self.redFlags[row])
+
+    def worklist(self, limit=None, minScore=0):
+        """
+        Ranks patients by the NEWS2 score of their latest visit, sickest first.
+
+        Ties are broken by a red flag, then by the largest rise since the previous visit.
+
+        limit: The number of patients to return, or None for all of them.
+        minScore: Leave out patients whose latest score is lower.
+        return: A list of WorklistEntry.
+        """
+        scores = self.scores
+        redFlags = self.redFlags
+        previous = self._previous
+        latest = ((patientId, row, scores[row], redFlags[row],
+                   scores[previous[patientId]] if patientId in previous else None)
+                  for patientId, row in self._latest.items())
+        return _rankWorklist(latest, limit, minScore, self._store.dateString)
+
+
+def _rankWorklist(latest, limit, minScore, dateOf):
+    # latest: (patientId, visit, score, red flag as 0 or 1, previous score or None) of every
+    # patient; dateOf(visit) gives the date of the visit, for the entries returned only.
+    ranked = []
+    for patientId, visit, score, redFlag, before in latest:
+        if score < minScore:
+            continue
+        change = score - before if before is not None else None
+        ranked.append((-score, -redFlag, -(change or 0), patientId, visit, change))
+    ranked = heapq.nsmallest(limit, ranked) if limit is not None else sorted(ranked)
+    return [WorklistEntry(patientId, dateOf(visit), -negativeScore, riskLevel(-negativeScore, flag < 0),
+                          flag < 0, change)
+            for negativeScore, flag, _, patientId, visit, change in ranked]
+
+
+class BackendWorklist(BackendListener):
+    """
+    The NEWS2 scores of the latest two visits of every patient of a storage.StorageBackend, kept up to date.
+
+    Building it reads every visit once; adds and deletes then only update the
+    patients they change. Use BackendWorklist.forStore to get the one of a
+    backend, building it on first use.
+    """
+
+    def __init__(self, backend):
+        self._backend = backend
+        self.rebuild()
+
+    @classmethod
+    def forStore(cls, backend):
+        """
+        Returns the worklist registered on a backend, building and registering it if needed.
+
+        backend: The storage.StorageBackend.
+        """
+        worklist = backend.findListener(cls)
+        if worklist is None:
+            worklist = cls(backend)
+            backend.addListener(worklist)
+        return worklist
+
+    def rebuild(self):
+        """Reads and scores every visit of the backend again."""
+        # patientId -> [latest visit, previous visit or None], each visit being
+        # (date ordinal, arrival, date, score, red flag); like the rows of a
+        # VisitStore, the arrival breaks ties between visits of the same date.
+        self._visits = {}
+        self._arrivals = 0
+        self._add(self._backend.records())
+
+    def _add(self, records):
+        visits = self._visits
+        for patientId, visit in records:
+            self._arrivals += 1
+            score, redFlag = scoreVisit(visit)
+            entry = (dateToOrdinal(visit[0]), self._arrivals, visit[0], score, int(redFlag))
+            latest = visits.get(patientId)
+            if latest is None:
+                visits[patientId] = [entry, None]
+            elif entry > latest[0]:
+                latest[1] = latest[0]
+                latest[0] = entry
+            elif latest[1] is None or entry > latest[1]:
+                latest[1] = entry
+
+    def visitsStored(self, backend, records):
+        self._add(records)
+
+    def patientRemoved(self, backend, patientId, dates):
+        self._visits.pop(patientId, None)
+
+    def worklist(self, limit=None, minScore=0):
+        """
+        Ranks patients by the NEWS2 score of their latest visit, sickest first, as EarlyWarningEngine.worklist does.
+
+        limit: The number of patients to return, or None for all of them.
+        minScore: Leave out patients whose latest score is lower.
+        return: A list of WorklistEntry.
+        """
+        latest = ((patientId, entry[2], entry[3], entry[4], previous[3] if previous is not None else None)
+                  for patientId, (entry, previous) in self._visits.items())
+        return _rankWorklist(latest, limit, minScore, str)
+
+
+def _rollingMeans(values, window):
+    means = []
+    total = 0.0
+    for index, value in enumerate(values):
+        total += value
+        if index >= window:
+            total -= values[index - window]
+        means.append(total / min(index + 1, window))
+    return means
+
+
+def _slope(days, values):
+    count = len(days)
+    if count < 2:
+        return None
+    meanDay = sum(days) / count
+    meanValue = sum(values) / count
+    spread = sum((day - meanDay) ** 2 for day in days)
+    if not spread:
+        return None
+    return sum((day - meanDay) * (value - meanValue) for day, value in zip(days, values)) / spread
+
+
+def patientTrends(visits, window=3):
+    """
+    Computes the trend of every vital sign, and of the NEWS2 score, over the visits of one patient.
+
+    visits: The visit lists of the patient, as in readPatientsFromFile: [date, temperature,
+            heart rate, respiratory rate, systolic bp, diastolic bp, oxygen saturation].
+    window: The number of visits averaged by the rolling means.
+    return: A dictionary of vital name (VITALS, plus 'news2') -> Trend.
+    """
+    dated = [(dateToOrdinal(visit[0]), position, visit) for position, visit in enumerate(visits)]
+    dated = sorted(entry for entry in dated if entry[0] != INVALID_DATE)
+    days = [ordinal for ordinal, _, _ in dated]
+    dates = [visit[0] for _, _, visit in dated]
+    series = {name: [visit[VISIT_INDEX[name]] for _, _, visit in dated] for name in VITALS}
+    series['news2'] = [scoreVisit(visit)[0] for _, _, visit in dated]
+    trends = {}
+    for name, values in series.items():
+        trends[name] = Trend(dates, values,
+                             [later - earlier for earlier, later in zip(values, values[1:])],
+                             _rollingMeans(values, window),
+                             _slope(days, values))
+    return trends
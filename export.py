@@ -0,0 +1,511 @@
+"""
+Export of visits as columnar record batches, in full or as a change feed.
+
+An export streams visits out in batches of at most batchRows rows, each
+batch holding one typed column per field, so any dataset is exported in
+memory proportional to one batch:
+    change          int8, CHANGE_ADDED for a visit, CHANGE_DELETED for the
+                    deletion of every visit of a patient (its other columns are 0)
+    patientId       int64
+    dates           day ordinals (int32); visits whose date is not a real
+                    calendar day have INVALID_DATE and their text in rawDates
+    temperature     float32
+    heartRate, sbp, dbp                             uint16
+    respiratoryRate, spo2                           uint8
+These are the typed columns of visit_store.VisitStore, so exporting a store
+copies slices of its arrays, never individual visits.
+
+If pyarrow is installed the export is an Arrow IPC file (readable with
+pyarrow.ipc.open_file, pandas, polars, DuckDB...), where dates is a date32
+column (null for invalid dates and deletions) and rawDates a string column.
+Otherwise, or with outputFormat='columns', it is the file format below,
+whose batches readBatches maps into memory and hands out as memoryviews
+without copying.
+
+A full export returns a Checkpoint: the position of the patient file's
+journal (see journal.py) it includes. exportChanges writes only the visits
+added and patients deleted since a checkpoint, in the order they happened,
+and returns the next checkpoint. The journal is folded into the patient file
+once it grows past journal.DEFAULT_COMPACT_THRESHOLD records; a checkpoint
+taken part way through a journal that has since been folded raises
+CheckpointError and calls for a new full export, so export changes at least
+once per compaction. For a sharded dataset (see shards.py), export the changes of each
+shard file.
+
+Column file layout (little-endian, every section starts on an 8-byte boundary):
+    header          FILE_HEADER struct: magic, version, number of columns
+    batches         BATCH_HEADER struct: rows, raw dates bytes, crc32 of the
+                    sections that follow; then one section per column of
+                    EXPORT_COLUMNS, in order; then the raw dates as a UTF-8
+                    JSON object {row: date text}
+    end             a BATCH_HEADER of 0 rows
+"""
+import json
+import mmap
+import os
+import sys
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from itertools import compress, islice
+from struct import Struct
+
+import storage
+from journal import compactedJournal, journalPath, readJournal, unfoldedJournals
+from patient_parser import ParsedChunk, parseLines
+from renderer import patientRecords
+from visit_store import COLUMNS, INVALID_DATE, VisitStore
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.ipc
+except ImportError:
+    # Exports then use the column file format only.
+    pyarrow = None
+
+
+MAGIC = b'EHRCOLS\x00'
+# 2: heart rate and blood pressures are uint16 (uint8 in 1)
+VERSION = 2
+
+# magic, version, number of columns
+FILE_HEADER = Struct('<8sII')
+# rows, raw dates bytes, crc32 of the column sections and raw dates
+BATCH_HEADER = Struct('<qqI4x')
+
+# (name, array typecode) of every exported column, in order.
+EXPORT_COLUMNS = (('change', 'b'), ('patientId', 'q')) + COLUMNS
+
+CHANGE_ADDED = 1
+CHANGE_DELETED = -1
+
+DEFAULT_BATCH_ROWS = 65536
+
+FORMATS = ('arrow', 'columns')
+
+# date.toordinal() of 1970-01-01, day 0 of an Arrow date32.
+_EPOCH_ORDINAL = 719163
+
+ColumnBatch = namedtuple('ColumnBatch', ['columns', 'rawDates'])
+ColumnBatch.__doc__ = """
+Rows of an export.
+
+columns: A dictionary of column name (see EXPORT_COLUMNS) -> array or memoryview.
+rawDates: A dictionary of row -> date text, for dates the ordinal cannot reproduce.
+"""
+
+Checkpoint = namedtuple('Checkpoint', ['journalId', 'records', 'compactedId'])
+Checkpoint.__doc__ = """
+A position in the changes of a patient file.
+
+journalId: The id of the journal, or None if the file had no journal.
+records: The number of records of that journal included.
+compactedId: The id of the journal last folded into the file, or None.
+"""
+
+ExportResult = namedtuple('ExportResult', ['rows', 'batches', 'bytes', 'checkpoint'])
+ExportResult.__doc__ = """
+The outcome of an export.
+
+rows, batches: The number of rows and batches written.
+bytes: The size of the file written.
+checkpoint: The Checkpoint to export the next changes from.
+"""
+
+
+class CheckpointError(Exception):
+    """A checkpoint that no longer matches the journal; the message is shown to the user."""
+
+
+def batchRowCount(batch):
+    """Returns the number of rows of a ColumnBatch."""
+    return len(batch.columns['patientId'])
+
+
+def _slice(column, typecode, start, end):
+    # A copy of column[start:end]; snapshot columns are memoryviews.
+    part = column[start:end]
+    if isinstance(part, array):
+        return part
+    copy = array(typecode)
+    copy.frombytes(part.cast('B'))
+    return copy
+
+
+def storeBatches(store, batchRows=DEFAULT_BATCH_ROWS):
+    """
+    Splits the live visits of a store into batches, in row order.
+
+    store: The VisitStore.
+    batchRows: The largest number of rows in a batch.
+    return: A generator of ColumnBatch.
+    """
+    rawRows = sorted(store._rawDates)
+    total = len(store.patientIds)
+    for start in range(0, total, batchRows):
+        end = min(start + batchRows, total)
+        live = store._live[start:end]
+        columns = {}
+        for name, typecode in (('patientId', 'q'),) + COLUMNS:
+            column = store.patientIds if name == 'patientId' else getattr(store, name)
+            columns[name] = _slice(column, typecode, start, end)
+        rawDates = {row - start: store._rawDates[row]
+                    for row in rawRows[bisect_left(rawRows, start):bisect_left(rawRows, end)]}
+        if 0 in live:
+            for name, typecode in (('patientId', 'q'),) + COLUMNS:
+                columns[name] = array(typecode, compress(columns[name], live))
+            positions = {row: position for position, row in enumerate(i for i, alive in enumerate(live) if alive)}
+            rawDates = {positions[row]: date for row, date in rawDates.items() if row in positions}
+        if not len(columns['patientId']):
+            continue
+        columns['change'] = array('b', [CHANGE_ADDED]) * len(columns['patientId'])
+        yield ColumnBatch({name: columns[name] for name, _ in EXPORT_COLUMNS}, rawDates)
+
+
+def patientBatches(patients, batchRows=DEFAULT_BATCH_ROWS):
+    """
+    Splits the visits of any patient data into batches.
+
+    patients: A VisitStore, a storage.StorageBackend or a dictionary of patient IDs
+              where each patient has a list of visits.
+    batchRows: The largest number of rows in a batch.
+    return: A generator of ColumnBatch; other data than a VisitStore is read
+            batchRows visits at a time.
+    """
+    if isinstance(patients, VisitStore):
+        yield from storeBatches(patients, batchRows)
+        return
+    records = patientRecords(patients)
+    while True:
+        store = VisitStore()
+        for patientId, visit in islice(records, batchRows):
+            store.append(patientId, visit)
+        if not store.visitCount:
+            return
+        yield from storeBatches(store, batchRows)
+
+
+def _changeBatch(records):
+    chunk = ParsedChunk()
+    change = array('b')
+    adds = []
+    for kind, payload in records + [('D', None)]:
+        if kind == 'A':
+            adds.append(payload)
+            continue
+        if adds:
+            added = parseLines(adds)
+            chunk.extend(added)
+            change.extend([CHANGE_ADDED] * len(added))
+            adds = []
+        if payload is not None:
+            chunk.patientIds.append(int(payload))
+            for name, _ in COLUMNS:
+                getattr(chunk, name).append(0)
+            change.append(CHANGE_DELETED)
+    columns = {name: getattr(chunk, name) for name, _ in COLUMNS}
+    columns['change'] = change
+    columns['patientId'] = chunk.patientIds
+    return ColumnBatch({name: columns[name] for name, _ in EXPORT_COLUMNS}, chunk.rawDates)
+
+
+def changeBatches(records, batchRows=DEFAULT_BATCH_ROWS):
+    """
+    Turns journal records into batches, in the order they were written.
+
+    records: A list of (kind, payload), as returned by journal.readJournal.
+    batchRows: The largest number of rows in a batch.
+    return: A generator of ColumnBatch.
+    """
+    for start in range(0, len(records), batchRows):
+        batch = _changeBatch(records[start:start + batchRows])
+        if batchRowCount(batch):
+            yield batch
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+class ColumnFileWriter:
+    """
+    Writes batches in the column file format; see the module documentation.
+
+    file: A binary file open for writing, positioned at its start.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.bytes = 0
+        self._write(FILE_HEADER.pack(MAGIC, VERSION, len(EXPORT_COLUMNS)))
+
+    def _write(self, data):
+        self.file.write(data)
+        self.bytes += len(data)
+
+    def _pad(self):
+        self._write(b'\x00' * (_align(self.bytes) - self.bytes))
+
+    def write(self, batch):
+        """Appends one ColumnBatch."""
+        sections = []
+        for name, typecode in EXPORT_COLUMNS:
+            column = batch.columns[name]
+            if sys.byteorder != 'little' and array(typecode).itemsize > 1:
+                column = array(typecode, column)
+                column.byteswap()
+            sections.append(memoryview(column).cast('B'))
+        rawDates = json.dumps(batch.rawDates, separators=(',', ':')).encode('utf-8') if batch.rawDates else b''
+        crc = 0
+        for section in sections:
+            crc = zlib.crc32(section, crc)
+        crc = zlib.crc32(rawDates, crc)
+        self._pad()
+        self._write(BATCH_HEADER.pack(batchRowCount(batch), len(rawDates), crc))
+        for section in sections:
+            self._pad()
+            self._write(section)
+        self._pad()
+        self._write(rawDates)
+
+    def close(self):
+        """Writes the end marker."""
+        self._pad()
+        self._write(BATCH_HEADER.pack(0, 0, 0))
+
+
+# Arrow type of the values of each array typecode, as handed over.
+_ARROW_TYPES = {'b': 'int8', 'q': 'int64', 'i': 'int32', 'f': 'float32', 'B': 'uint8', 'H': 'uint16'}
+
+
+def _arrowSchema():
+    types = {'b': pyarrow.int8(), 'q': pyarrow.int64(), 'i': pyarrow.date32(), 'f': pyarrow.float32(),
+             'B': pyarrow.uint8(), 'H': pyarrow.uint16()}
+    fields = [pyarrow.field(name, types[typecode], nullable=name == 'dates') for name, typecode in EXPORT_COLUMNS]
+    fields.append(pyarrow.field('rawDates', pyarrow.string()))
+    return pyarrow.schema(fields)
+
+
+class ArrowFileWriter:
+    """
+    Writes batches as an Arrow IPC file; the columns are handed to Arrow without copying.
+
+    file: A binary file open for writing.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.schema = _arrowSchema()
+        self._writer = pyarrow.ipc.new_file(file, self.schema)
+
+    @property
+    def bytes(self):
+        """The number of bytes written so far."""
+        return self.file.tell()
+
+    def write(self, batch):
+        """Appends one ColumnBatch."""
+        rows = batchRowCount(batch)
+        arrays = []
+        for name, typecode in EXPORT_COLUMNS:
+            column = pyarrow.Array.from_buffers(getattr(pyarrow, _ARROW_TYPES[typecode])(), rows,
+                                                [None, pyarrow.py_buffer(batch.columns[name])])
+            if name == 'dates':
+                invalid = pyarrow.compute.equal(column, INVALID_DATE)
+                epoch = pyarrow.scalar(_EPOCH_ORDINAL, pyarrow.int32())
+                days = pyarrow.compute.subtract(column, epoch).cast(pyarrow.date32())
+                column = pyarrow.compute.if_else(invalid, pyarrow.scalar(None, pyarrow.date32()), days)
+            arrays.append(column)
+        if batch.rawDates:
+            arrays.append(pyarrow.array([batch.rawDates.get(row) for row in range(rows)], pyarrow.string()))
+        else:
+            arrays.append(pyarrow.nulls(rows, pyarrow.string()))
+        self._writer.write_batch(pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        """Writes the footer of the file."""
+        self._writer.close()
+
+
+def _writeBatches(batches, output, outputFormat):
+    # Writes under a temporary name renamed into place; returns (rows, batches, bytes).
+    if outputFormat is None:
+        outputFormat = 'arrow' if pyarrow is not None else 'columns'
+    if outputFormat not in FORMATS:
+        raise ValueError(f"unknown export format {outputFormat!r}")
+    if outputFormat == 'arrow' and pyarrow is None:
+        raise ValueError("the arrow format needs pyarrow; install it or use the columns format")
+    rows = count = 0
+    temporary = output + '.tmp'
+    try:
+        with open(temporary, 'wb') as f:
+            writer = ArrowFileWriter(f) if outputFormat == 'arrow' else ColumnFileWriter(f)
+            for batch in batches:
+                writer.write(batch)
+                rows += batchRowCount(batch)
+                count += 1
+            writer.close()
+            size = writer.bytes
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, output)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return rows, count, size
+
+
+def currentCheckpoint(fileName):
+    """
+    Returns the position of the latest change of a patient file.
+
+    fileName: The name of the patient text file.
+    """
+    journalId, records = readJournal(journalPath(fileName))
+    return Checkpoint(journalId, len(records), compactedJournal(fileName)[0])
+
+
+def saveCheckpoint(checkpoint, checkpointName):
+    """
+    Writes a checkpoint as JSON, under a temporary name renamed into place.
+
+    checkpoint: The Checkpoint.
+    checkpointName: The name of the checkpoint file.
+    """
+    temporary = checkpointName + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(checkpoint._asdict(), f)
+        f.write('\n')
+    os.replace(temporary, checkpointName)
+
+
+def loadCheckpoint(checkpointName):
+    """
+    Reads a checkpoint written by saveCheckpoint.
+
+    return: The Checkpoint.
+    """
+    with open(checkpointName, 'r') as f:
+        fields = json.load(f)
+    try:
+        return Checkpoint(fields['journalId'], int(fields['records']), fields['compactedId'])
+    except (KeyError, TypeError, ValueError):
+        raise CheckpointError(f"'{checkpointName}' is not a checkpoint")
+
+
+def changesSince(fileName, since):
+    """
+    Returns the journal records of a patient file written after a checkpoint.
+
+    fileName: The name of the patient text file.
+    since: The Checkpoint.
+    return: (list of (kind, payload) as returned by journal.readJournal, Checkpoint after them)
+    """
+    journals = unfoldedJournals(fileName)
+    compactedId, compactedRecords = compactedJournal(fileName)
+    latest = Checkpoint(journals[-1][0], len(journals[-1][1]), compactedId)
+    # With no journal then, or all of the journal since folded into the file,
+    # every journal not yet folded came later.
+    if (since.journalId is None and since.compactedId == compactedId
+            or since.journalId == compactedId and since.records == compactedRecords):
+        return [record for _, records in journals for record in records], latest
+    if since.journalId is None:
+        raise CheckpointError("the changes after the checkpoint were compacted into the file; make a full export")
+    for position, (journalId, records) in enumerate(journals):
+        if journalId == since.journalId:
+            if since.records > len(records):
+                raise CheckpointError("the checkpoint is ahead of the journal")
+            changes = records[since.records:]
+            for _, later in journals[position + 1:]:
+                changes.extend(later)
+            return changes, latest
+    raise CheckpointError("the journal of the checkpoint was compacted into the file; make a full export")
+
+
+def exportVisits(patients, output, fileName=None, batchRows=DEFAULT_BATCH_ROWS, outputFormat=None):
+    """
+    Exports every visit.
+
+    patients: The patient data, as accepted by patientBatches.
+    output: The name of the file to write.
+    fileName: The patient text file the data was read from, to return a checkpoint of.
+    batchRows: The largest number of rows in a batch.
+    outputFormat: 'arrow', 'columns', or None for arrow when pyarrow is installed.
+    return: An ExportResult; its checkpoint is None without a patient text file.
+    """
+    checkpoint = None
+    if fileName is not None and os.path.isfile(fileName) and not storage.isDatabase(fileName):
+        # Taken first: the patients already hold every change journaled so far.
+        checkpoint = currentCheckpoint(fileName)
+    rows, batches, size = _writeBatches(patientBatches(patients, batchRows), output, outputFormat)
+    return ExportResult(rows, batches, size, checkpoint)
+
+
+def exportChanges(fileName, since, output, batchRows=DEFAULT_BATCH_ROWS, outputFormat=None):
+    """
+    Exports the visits added and the patients deleted since a checkpoint.
+
+    fileName: The patient text file.
+    since: The Checkpoint of the previous export.
+    output: The name of the file to write.
+    batchRows: The largest number of rows in a batch.
+    outputFormat: 'arrow', 'columns', or None for arrow when pyarrow is installed.
+    return: An ExportResult with the checkpoint to pass to the next exportChanges.
+    """
+    if not os.path.isfile(fileName) or storage.isDatabase(fileName):
+        raise CheckpointError(f"'{fileName}' is not a patient text file with a journal")
+    records, checkpoint = changesSince(fileName, since)
+    rows, batches, size = _writeBatches(changeBatches(records, batchRows), output, outputFormat)
+    return ExportResult(rows, batches, size, checkpoint)
+
+
+def readBatches(fileName, verify=False):
+    """
+    Reads a column file without copying its columns.
+
+    fileName: The name of the column file.
+    verify: Also check the CRC of every batch (reads every byte).
+    return: A generator of ColumnBatch whose columns are memoryviews of the mapped
+            file (copies on big-endian machines).
+    """
+    with open(fileName, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    magic, version, columnCount = FILE_HEADER.unpack_from(view)
+    if magic != MAGIC or version != VERSION or columnCount != len(EXPORT_COLUMNS):
+        raise ValueError(f"'{fileName}' is not a column file of version {VERSION}")
+    offset = FILE_HEADER.size
+    while True:
+        offset = _align(offset)
+        rows, rawBytes, crc = BATCH_HEADER.unpack_from(view, offset)
+        offset += BATCH_HEADER.size
+        if rows == 0:
+            return
+        columns = {}
+        sections = []
+        for name, typecode in EXPORT_COLUMNS:
+            offset = _align(offset)
+            size = array(typecode).itemsize * rows
+            data = view[offset:offset + size]
+            sections.append(data)
+            if sys.byteorder == 'little':
+                columns[name] = data.cast(typecode)
+            else:
+                columns[name] = array(typecode)
+                columns[name].frombytes(data)
+                columns[name].byteswap()
+            offset += size
+        offset = _align(offset)
+        rawDates = view[offset:offset + rawBytes]
+        if verify:
+            check = 0
+            for section in sections + [rawDates]:
+                check = zlib.crc32(section, check)
+            if check != crc:
+                raise ValueError(f"a batch of '{fileName}' is corrupt")
+        offset += rawBytes
+        yield ColumnBatch(columns, {int(row): date for row, date in json.loads(bytes(rawDates)).items()}
+                          if rawBytes else {})
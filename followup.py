@@ -0,0 +1,241 @@
+"""
+Incrementally maintained set of patients who need a follow-up visit.
+
+A FollowUpEngine keeps, for every row of a VisitStore, how many follow-up
+rules the visit breaks, and for every patient how many of its visits break at
+least one. Loading, adding and deleting visits update those counts as they
+happen, so asking for the patients who need follow-up costs O(result size).
+Changing one rule only revisits the rows whose verdict for that rule changed.
+"""
+import operator
+import re
+from collections import namedtuple
+from itertools import repeat
+
+from visit_store import COLUMNS, StoreListener, byteColumn
+
+
+FollowUpRule = namedtuple('FollowUpRule', ['name', 'column', 'op', 'threshold'])
+FollowUpRule.__doc__ = """
+A threshold on one vital sign. A visit breaks the rule when
+`visit[column] <op> threshold` is true.
+
+name: A unique name for the rule.
+column: A VisitStore column other than 'dates', e.g. 'heartRate'.
+op: '<' or '>'.
+threshold: The value compared with.
+"""
+
+DEFAULT_RULES = (
+    FollowUpRule('high heart rate', 'heartRate', '>', 100),
+    FollowUpRule('low heart rate', 'heartRate', '<', 60),
+    FollowUpRule('high systolic blood pressure', 'sbp', '>', 140),
+    FollowUpRule('high diastolic blood pressure', 'dbp', '>', 90),
+    FollowUpRule('low oxygen saturation', 'spo2', '<', 90),
+)
+
+_OPERATORS = {'<': operator.lt, '>': operator.gt}
+
+# Position of each column in a visit list.
+VISIT_INDEX = {name: index for index, (name, _) in enumerate(COLUMNS)}
+
+_NONZERO = re.compile(rb'[^\x00]')
+
+# Added rows above which the engine is rebuilt rather than updated row by row.
+REBUILD_BATCH = 4096
+
+
+def checkRule(rule):
+    """
+    Raises ValueError if a rule cannot be evaluated.
+
+    rule: The FollowUpRule.
+    """
+    if rule.column not in VISIT_INDEX or rule.column == 'dates':
+        raise ValueError(f"rule '{rule.name}' uses unknown column '{rule.column}'")
+    if rule.op not in _OPERATORS:
+        raise ValueError(f"rule '{rule.name}' uses unknown operator '{rule.op}'")
+
+
+def breaksRule(rule, visit):
+    """
+    Tells whether a visit list breaks a rule.
+
+    rule: The FollowUpRule.
+    visit: [date, temperature, heart rate, respiratory rate, systolic bp, diastolic bp, oxygen saturation]
+    """
+    return _OPERATORS[rule.op](visit[VISIT_INDEX[rule.column]], rule.threshold)
+
+
+def _violations(store, rule):
+    # One byte per row: 1 if the row breaks the rule, else 0.
+    column = getattr(store, rule.column)
+    test = _OPERATORS[rule.op]
+    typecode = column.format if isinstance(column, memoryview) else column.typecode
+    values = byteColumn(column) if typecode in ('B', 'H') else None
+    if values is not None:
+        # Values below 256 are mapped through a 256-entry table entirely in C.
+        table = bytes(int(test(value, rule.threshold)) for value in range(256))
+        return bytearray(values.translate(table))
+    return bytearray(map(test, column, repeat(rule.threshold, len(column))))
+
+
+class FollowUpEngine(StoreListener):
+    """
+    The patients of a VisitStore with at least one visit breaking a follow-up rule.
+
+    Use FollowUpEngine.forStore to get the engine of a store, building it on first use.
+    """
+
+    def __init__(self, store, rules=DEFAULT_RULES):
+        for rule in rules:
+            checkRule(rule)
+        self._store = store
+        self._rules = {rule.name: rule for rule in rules}
+        self.rebuild()
+
+    @classmethod
+    def forStore(cls, store):
+        """
+        Returns the engine registered on a store, building and registering it if needed.
+
+        store: The VisitStore.
+        """
+        engine = store.findListener(cls)
+        if engine is None:
+            engine = cls(store)
+            store.addListener(engine)
+        return engine
+
+    @property
+    def rules(self):
+        """The current rules, in the order they were added."""
+        return tuple(self._rules.values())
+
+    def rebuild(self):
+        """Recomputes every rule for every row."""
+        store = self._store
+        self._violationsByRule = {name: _violations(store, rule) for name, rule in self._rules.items()}
+        # Rules broken by each row. Every byte stays below 256 as long as there
+        # are fewer than 256 rules, so the vectors can be added as big integers.
+        total = sum(int.from_bytes(vector, 'little') for vector in self._violationsByRule.values())
+        self._hits = bytearray(total.to_bytes(len(store.patientIds), 'little'))
+        self._abnormalVisits = {}
+        self._countRows((match.start() for match in _NONZERO.finditer(self._hits)), +1)
+
+    def _countRows(self, rows, sign):
+        # Adds sign to the abnormal visit count of the patient of each live row.
+        live = self._store._live
+        patientIds = self._store.patientIds
+        counts = self._abnormalVisits
+        for row in rows:
+            if live[row]:
+                patientId = patientIds[row]
+                count = counts.get(patientId, 0) + sign
+                if count:
+                    counts[patientId] = count
+                else:
+                    del counts[patientId]
+
+    def visitsAdded(self, store, firstRow, endRow):
+        if endRow - firstRow > REBUILD_BATCH:
+            self.rebuild()
+            return
+        visits = [store.visit(row) for row in range(firstRow, endRow)]
+        added = bytearray(len(visits))
+        for name, rule in self._rules.items():
+            vector = bytearray(int(breaksRule(rule, visit)) for visit in visits)
+            self._violationsByRule[name] += vector
+            for position, broken in enumerate(vector):
+                added[position] += broken
+        self._hits += added
+        counts = self._abnormalVisits
+        for row, hits in zip(range(firstRow, endRow), added):
+            if hits:
+                patientId = store.patientIds[row]
+                counts[patientId] = counts.get(patientId, 0) + 1
+
+    def patientDeleted(self, store, patientId, rows):
+        self._abnormalVisits.pop(patientId, None)
+
+    def storeCompacted(self, store):
+        self.rebuild()
+
+    def setRule(self, rule):
+        """
+        Adds a rule, or replaces the rule with the same name.
+
+        Only rows whose verdict for this rule changes are revisited.
+
+        rule: The FollowUpRule.
+        """
+        checkRule(rule)
+        old = self._violationsByRule.get(rule.name)
+        if old is None:
+            old = bytearray(len(self._store.patientIds))
+        elif self._rules[rule.name] == rule:
+            return
+        if len(self._rules) >= 255 and rule.name not in self._rules:
+            raise ValueError("at most 255 follow-up rules are supported")
+        new = _violations(self._store, rule)
+        self._rules[rule.name] = rule
+        self._violationsByRule[rule.name] = new
+        self._applyChange(old, new)
+
+    def removeRule(self, name):
+        """
+        Removes a rule.
+
+        name: The name of the rule.
+        """
+        rule = self._rules.pop(name)
+        old = self._violationsByRule.pop(rule.name)
+        self._applyChange(old, bytearray(len(old)))
+
+    def setRules(self, rules):
+        """
+        Makes the given rules the current ones, touching only the rules that differ.
+
+        rules: An iterable of FollowUpRule.
+        """
+        rules = list(rules)
+        names = {rule.name for rule in rules}
+        for name in [name for name in self._rules if name not in names]:
+            self.removeRule(name)
+        for rule in rules:
+            self.setRule(rule)
+
+    def _applyChange(self, old, new):
+        # Rows where the rule's verdict flipped, found by XOR-ing the two vectors.
+        changed = (int.from_bytes(old, 'little') ^ int.from_bytes(new, 'little')).to_bytes(len(old), 'little')
+        hits = self._hits
+        became, cleared = [], []
+        for match in _NONZERO.finditer(changed):
+            row = match.start()
+            if new[row]:
+                hits[row] += 1
+                if hits[row] == 1:
+                    became.append(row)
+            else:
+                hits[row] -= 1
+                if hits[row] == 0:
+                    cleared.append(row)
+        self._countRows(became, +1)
+        self._countRows(cleared, -1)
+
+    def patients(self):
+        """
+        Returns the IDs of the patients who need a follow-up visit.
+
+        return: A list of patient IDs, in the order of the store, as a scan of its patients finds them.
+        """
+        rows = self._store.rows
+        return sorted(self._abnormalVisits, key=lambda patientId: rows(patientId)[0])
+
+    def abnormalVisitCounts(self):
+        """
+        Returns how many visits of each flagged patient break at least one rule.
+
+        return: A dictionary of patient ID -> number of abnormal visits.
+        """
+        return dict(self._abnormalVisits)
@@ -0,0 +1,215 @@
+"""
+Opt-in instrumentation of the hot paths.
+
+The public functions of main.py are decorated with @instrumented, and the
+parser times each stage of every block of lines it parses (field count,
+split, convert, range check, dates, append). While instrumentation is off,
+which is the default, a decorated function costs one extra call and one flag
+test, and the parser one flag test per block.
+
+    instrumentation.enable(traceMemory=True)
+    patients = main.readPatientsFromFile('patients.txt')
+    main.displayStats(patients)
+    print(instrumentation.summaryTable())
+    instrumentation.writeJson('profile.json')
+
+For every function or stage it records the number of calls, the wall time
+(inclusive: displayStats also counts the time of the vitalSummaries it
+calls), the slowest call, the rows handled (parser stages only) and, with
+traceMemory, the bytes it allocated and still held on return, measured with
+tracemalloc. Tracing memory slows everything down several times, so leave it
+off when the times matter.
+
+Only the current process is measured: the parser stages of
+readPatientsParallel run in worker processes and are not recorded.
+
+profileTo writes a cProfile export of a block of code, for use with pstats
+or snakeviz, when call counts per function are not detailed enough.
+"""
+import cProfile
+import functools
+import json
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+# True while measurements are recorded; read by the instrumented code.
+enabled = False
+
+# name -> [calls, seconds, slowest call in seconds, bytes allocated, rows]
+_records = {}
+_traceMemory = False
+_startedTracing = False
+
+SUMMARY_FIELDS = ('name', 'calls', 'seconds', 'maxSeconds', 'allocatedBytes', 'rows')
+
+
+def enable(traceMemory=False):
+    """
+    Starts recording.
+
+    traceMemory: Also record allocated bytes, tracing allocations with tracemalloc.
+    """
+    global enabled, _traceMemory, _startedTracing
+    if traceMemory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _startedTracing = True
+    _traceMemory = traceMemory
+    enabled = True
+
+
+def disable():
+    """Stops recording; what was recorded so far is kept until reset."""
+    global enabled, _traceMemory, _startedTracing
+    enabled = False
+    _traceMemory = False
+    if _startedTracing:
+        tracemalloc.stop()
+        _startedTracing = False
+
+
+def reset():
+    """Forgets everything recorded so far."""
+    _records.clear()
+
+
+def _allocated():
+    return tracemalloc.get_traced_memory()[0] if _traceMemory else 0
+
+
+def record(name, seconds, allocatedBytes=0, rows=0):
+    """
+    Adds one call to the measurements of a name.
+
+    name: The function or stage measured.
+    seconds: The wall time of the call.
+    allocatedBytes: The bytes the call allocated and did not free.
+    rows: The number of rows the call handled, for stages working on blocks of rows.
+    """
+    entry = _records.get(name)
+    if entry is None:
+        entry = _records[name] = [0, 0.0, 0.0, 0, 0]
+    entry[0] += 1
+    entry[1] += seconds
+    if seconds > entry[2]:
+        entry[2] = seconds
+    entry[3] += allocatedBytes
+    entry[4] += rows
+
+
+def instrumented(function):
+    """
+    Decorates a function so its calls are recorded under its name while instrumentation is enabled.
+
+    function: The function to measure.
+    """
+    name = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not enabled:
+            return function(*args, **kwargs)
+        allocated = _allocated()
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            record(name, time.perf_counter() - start, _allocated() - allocated)
+    return wrapper
+
+
+class StageClock:
+    """
+    Times consecutive stages of a piece of work, each from the end of the previous one.
+
+    prefix: Put before each stage name, followed by a dot.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._allocated = _allocated()
+        self._last = time.perf_counter()
+
+    def lap(self, stage, rows=0):
+        """
+        Records the stage that just finished.
+
+        stage: The name of the stage.
+        rows: The number of rows the stage worked on.
+        """
+        now = time.perf_counter()
+        allocated = _allocated()
+        record(f"{self.prefix}.{stage}", now - self._last, allocated - self._allocated, rows)
+        self._allocated = allocated
+        self._last = time.perf_counter()
+
+
+def results():
+    """
+    Returns what was recorded so far.
+
+    return: A list of dictionaries with the SUMMARY_FIELDS, slowest first.
+    """
+    rows = [dict(zip(SUMMARY_FIELDS, [name] + entry)) for name, entry in _records.items()]
+    rows.sort(key=lambda row: row['seconds'], reverse=True)
+    return rows
+
+
+def summaryTable():
+    """
+    Formats what was recorded so far as a table, slowest first.
+
+    return: The table, or a note that nothing was recorded.
+    """
+    rows = results()
+    if not rows:
+        return "No measurements recorded."
+    width = max(len('name'), max(len(row['name']) for row in rows))
+    lines = [f"{'name':<{width}} {'calls':>8} {'total ms':>11} {'mean ms':>10} {'max ms':>10} "
+             f"{'alloc KiB':>11} {'rows':>10} {'rows/s':>12}"]
+    for row in rows:
+        seconds = row['seconds']
+        rowRate = f"{row['rows'] / seconds:,.0f}" if row['rows'] and seconds else '-'
+        allocated = f"{row['allocatedBytes'] / 1024:,.1f}" if _traceMemory or row['allocatedBytes'] else '-'
+        lines.append(f"{row['name']:<{width}} {row['calls']:>8} {seconds * 1000:>11.2f} "
+                     f"{seconds * 1000 / row['calls']:>10.3f} {row['maxSeconds'] * 1000:>10.3f} "
+                     f"{allocated:>11} {row['rows'] or '-':>10} {rowRate:>12}")
+    return '\n'.join(lines)
+
+
+def printSummary(file=None):
+    """
+    Prints the summary table.
+
+    file: The stream to print to; defaults to standard error.
+    """
+    print(summaryTable(), file=file if file is not None else sys.stderr)
+
+
+def writeJson(fileName):
+    """
+    Writes what was recorded so far as JSON.
+
+    fileName: The file to write.
+    """
+    with open(fileName, 'w') as file:
+        json.dump({'traceMemory': _traceMemory, 'measurements': results()}, file, indent=2)
+        file.write('\n')
+
+
+@contextmanager
+def profileTo(fileName):
+    """
+    Runs a block of code under cProfile and writes the statistics to a file.
+
+    fileName: The file to write, readable with pstats.Stats.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(fileName)
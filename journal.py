@@ -0,0 +1,438 @@
+"""
+Append-only write-ahead journal for changes to patients.txt.
+
+Adding a visit or deleting a patient appends one record to
+patients.txt.journal instead of rewriting patients.txt. Records are written
+and fsync'ed by a background thread in batches: every caller waiting for
+durability at the same time shares one fsync (group commit).
+readPatientsFromFile replays the journal on top of the base file.
+
+Once the journal grows past a threshold it is compacted in the background:
+the journal is renamed to patients.txt.journal.compacting, a fresh journal
+takes new records, and the renamed one is folded into a new copy of
+patients.txt that replaces the old one atomically. The new base file ends
+with a '#compacted <journal id> <records>' line, so if the process dies between the
+replace and the removal of the folded journal, replay knows to skip it.
+
+Record format, one per line:
+    #journal <id>                       first line of every journal file
+    A,<patients.txt line>*<crc32>       visit added
+    D,<patientId>*<crc32>               all visits of a patient deleted
+    B,<count>*<crc32>                   the next <count> records are one batch
+The CRC covers everything before the '*'. Replay stops at the first record
+that is torn or fails its CRC, and drops a batch cut short by it.
+"""
+import atexit
+import os
+import threading
+import uuid
+import zlib
+
+from patient_parser import parseLines
+
+
+# Records in the journal that trigger a background compaction.
+DEFAULT_COMPACT_THRESHOLD = 100_000
+
+_HEADER_PREFIX = '#journal '
+_COMPACTED_PREFIX = '#compacted '
+
+
+def journalPath(fileName):
+    """
+    Returns the name of the journal kept for a patient file.
+
+    fileName: The name of the patient text file.
+    """
+    return fileName + '.journal'
+
+
+def _compactingPath(fileName):
+    return journalPath(fileName) + '.compacting'
+
+
+def _encode(kind, payload):
+    body = f"{kind},{payload}"
+    return f"{body}*{zlib.crc32(body.encode('utf-8')):08x}\n".encode('utf-8')
+
+
+def visitLine(patientId, visit):
+    """
+    Formats a visit as a line of patients.txt, without the newline.
+
+    patientId: The ID of the patient.
+    visit: [date, temperature, heart rate, respiratory rate, systolic bp, diastolic bp, oxygen saturation]
+    """
+    return f"{patientId},{','.join(str(value) for value in visit)}"
+
+
+def readJournal(path):
+    """
+    Reads the valid records of a journal file.
+
+    path: The name of the journal file.
+    return: (journal id, list of (kind, payload)) where kind is 'A' or 'D'; the id
+            is None if the file does not exist or has no header. A batch is
+            returned whole or not at all.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return None, []
+    if not lines or not lines[0].startswith(_HEADER_PREFIX):
+        return None, []
+    journalId = lines[0][len(_HEADER_PREFIX):].strip()
+    records = []
+    # records of the current batch still to come, and where it starts
+    pending = 0
+    batchStart = 0
+    for line in lines[1:]:
+        if not line.endswith('\n'):
+            break
+        body, _, crc = line[:-1].rpartition('*')
+        if f"{zlib.crc32(body.encode('utf-8')):08x}" != crc or body[1:2] != ',':
+            break
+        if body[0] == 'B':
+            pending = int(body[2:])
+            batchStart = len(records)
+            continue
+        records.append((body[0], body[2:]))
+        if pending:
+            pending -= 1
+    if pending:
+        del records[batchStart:]
+    return journalId, records
+
+
+def compactedJournal(fileName):
+    """
+    Tells which journal was last folded into a patient file, from its final line.
+
+    fileName: The name of the patient text file.
+    return: (journal id, number of records folded), (None, None) if the file was never
+            compacted; the number is None for files compacted before it was recorded.
+    """
+    try:
+        with open(fileName, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 128))
+            tail = f.read().decode('utf-8', 'replace')
+    except FileNotFoundError:
+        return None, None
+    lastLine = tail.rstrip('\n').rpartition('\n')[2]
+    if not lastLine.startswith(_COMPACTED_PREFIX):
+        return None, None
+    fields = lastLine[len(_COMPACTED_PREFIX):].split()
+    if not fields:
+        return None, None
+    return fields[0], int(fields[1]) if len(fields) > 1 and fields[1].isdigit() else None
+
+
+def applyRecords(records, store):
+    """
+    Applies journal records to a store.
+
+    records: A list of (kind, payload), as returned by readJournal.
+    store: The VisitStore, or any object with extend and deletePatient like it.
+    return: The number of records applied.
+    """
+    applied = 0
+    adds = []
+    for kind, payload in records + [('D', None)]:
+        if kind == 'A':
+            adds.append(payload)
+            continue
+        if adds:
+            chunk = parseLines(adds)
+            if len(chunk):
+                store.extend(chunk)
+            applied += len(adds)
+            adds = []
+        if payload is not None:
+            store.deletePatient(int(payload))
+            applied += 1
+    return applied
+
+
+def unfoldedJournals(fileName):
+    """
+    Reads the journals of a patient file whose records are not in the file yet.
+
+    fileName: The name of the patient text file.
+    return: A list of (journal id, records) as returned by readJournal, oldest first:
+            the journal being compacted, if its fold has not finished, then the current one.
+    """
+    journals = []
+    compactingId, records = readJournal(_compactingPath(fileName))
+    if compactingId is not None and compactingId != compactedJournal(fileName)[0]:
+        journals.append((compactingId, records))
+    journals.append(readJournal(journalPath(fileName)))
+    return journals
+
+
+def replayJournal(fileName, store):
+    """
+    Applies the journal of a patient file to a store loaded from that file.
+
+    fileName: The name of the patient text file.
+    store: The VisitStore holding the contents of fileName.
+    return: The number of records applied.
+    """
+    return sum(applyRecords(records, store) for _, records in unfoldedJournals(fileName))
+
+
+def foldJournal(fileName, path):
+    """
+    Writes a new patients file with the records of a journal folded in, then removes the journal.
+
+    fileName: The name of the patient text file.
+    path: The name of a journal file that no longer receives records.
+    """
+    journalId, records = readJournal(path)
+    if journalId is None or journalId == compactedJournal(fileName)[0]:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+
+    # Adds survive unless their patient is deleted later in the journal;
+    # base rows survive unless their patient is deleted anywhere in it.
+    deleted = set()
+    adds = []
+    addsByPatient = {}
+    for kind, payload in records:
+        if kind == 'A':
+            patientId = int(payload.split(',', 1)[0])
+            addsByPatient.setdefault(patientId, []).append(len(adds))
+            adds.append(payload)
+        else:
+            patientId = int(payload)
+            deleted.add(patientId)
+            for index in addsByPatient.pop(patientId, ()):
+                adds[index] = None
+
+    temporary = fileName + '.compact.tmp'
+    with open(temporary, 'w') as out:
+        try:
+            with open(fileName, 'r') as base:
+                for line in base:
+                    if line.startswith('#'):
+                        continue
+                    if deleted:
+                        try:
+                            if int(line.split(',', 1)[0]) in deleted:
+                                continue
+                        except ValueError:
+                            pass
+                    out.write(line if line.endswith('\n') else line + '\n')
+        except FileNotFoundError:
+            pass
+        for line in adds:
+            if line is not None:
+                out.write(line + '\n')
+        out.write(f"{_COMPACTED_PREFIX}{journalId} {len(records)}\n")
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(temporary, fileName)
+    os.remove(path)
+
+
+class VisitJournal:
+    """
+    The open journal of one patient file.
+
+    logAdd and logDelete append a record and, with sync=True, return once it
+    is on disk. A background thread writes whatever has accumulated with one
+    write and one fsync, so concurrent writers share the cost of each fsync.
+    """
+
+    def __init__(self, fileName, compactThreshold=DEFAULT_COMPACT_THRESHOLD):
+        self.fileName = fileName
+        self.path = journalPath(fileName)
+        self.compactThreshold = compactThreshold
+        self._cond = threading.Condition()
+        # held while writing to or swapping self._fd
+        self._ioLock = threading.Lock()
+        self._buffer = []
+        self._appended = 0
+        self._durable = 0
+        self._error = None
+        self._closed = False
+        self._records = len(readJournal(self.path)[1])
+        self._fd = self._open()
+        self._flusher = None
+        self._compactor = None
+
+    def _open(self):
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if os.fstat(fd).st_size == 0:
+            os.write(fd, f"{_HEADER_PREFIX}{uuid.uuid4().hex}\n".encode('utf-8'))
+            os.fsync(fd)
+        return fd
+
+    def logAdd(self, patientId, visit, sync=True):
+        """
+        Records a new visit.
+
+        patientId: The ID of the patient.
+        visit: [date, temperature, heart rate, respiratory rate, systolic bp, diastolic bp, oxygen saturation]
+        sync: Wait until the record is on disk.
+        """
+        self._append([_encode('A', visitLine(patientId, visit))], sync)
+
+    def logDelete(self, patientId, sync=True):
+        """
+        Records the deletion of all visits of a patient.
+
+        patientId: The ID of the patient.
+        sync: Wait until the record is on disk.
+        """
+        self._append([_encode('D', patientId)], sync)
+
+    def logAddBatch(self, lines, sync=True):
+        """
+        Records many new visits, all of which are replayed or none.
+
+        The records go out with a single write and fsync.
+
+        lines: The visits as lines of patients.txt, without newlines.
+        sync: Wait until the records are on disk.
+        """
+        if lines:
+            self._append([_encode('B', len(lines))] + [_encode('A', line) for line in lines], sync)
+
+    def _append(self, records, sync):
+        with self._cond:
+            if self._closed:
+                raise ValueError(f"the journal of '{self.fileName}' is closed")
+            self._buffer.extend(records)
+            self._appended += len(records)
+            self._records += len(records)
+            sequence = self._appended
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flushLoop, name='journal-flush', daemon=True)
+                self._flusher.start()
+            self._cond.notify_all()
+            if sync:
+                self._waitDurable(sequence)
+            compact = self._records >= self.compactThreshold
+        if compact:
+            self.compact()
+
+    def _waitDurable(self, sequence):
+        # Called with self._cond held.
+        while self._durable < sequence and self._error is None:
+            self._cond.wait()
+        if self._error is not None:
+            raise self._error
+
+    def _writeBuffer(self):
+        # Called with self._ioLock held: writes and syncs everything buffered so far.
+        with self._cond:
+            batch, self._buffer = self._buffer, []
+            last = self._appended
+        if batch:
+            data = memoryview(b''.join(batch))
+            try:
+                while data:
+                    data = data[os.write(self._fd, data):]
+                os.fsync(self._fd)
+            except OSError as e:
+                with self._cond:
+                    self._error = e
+                    self._cond.notify_all()
+                return
+        with self._cond:
+            self._durable = max(self._durable, last)
+            self._cond.notify_all()
+
+    def _flushLoop(self):
+        while True:
+            with self._cond:
+                while not self._buffer and not self._closed:
+                    self._cond.wait()
+                if not self._buffer and self._closed:
+                    return
+            with self._ioLock:
+                self._writeBuffer()
+
+    def flush(self):
+        """Waits until every record appended so far is on disk."""
+        with self._cond:
+            self._waitDurable(self._appended)
+
+    def compact(self, wait=False):
+        """
+        Folds the journal into the patient file in a background thread.
+
+        Does nothing if a compaction is already running.
+
+        wait: Block until the compaction has finished.
+        """
+        with self._cond:
+            if self._compactor is None or not self._compactor.is_alive():
+                self._compactor = threading.Thread(target=self._compact, name='journal-compact', daemon=True)
+                self._compactor.start()
+            compactor = self._compactor
+        if wait:
+            compactor.join()
+
+    def _compact(self):
+        compacting = _compactingPath(self.fileName)
+        # A journal left over from an interrupted compaction is folded first;
+        # the current one waits for the next round.
+        if not os.path.exists(compacting):
+            with self._ioLock:
+                self._writeBuffer()
+                with self._cond:
+                    if not self._records:
+                        return
+                    os.close(self._fd)
+                    os.replace(self.path, compacting)
+                    self._fd = self._open()
+                    self._records = 0
+        foldJournal(self.fileName, compacting)
+
+    def close(self):
+        """Writes out pending records, waits for a running compaction and closes the file."""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+            flusher, compactor = self._flusher, self._compactor
+        if flusher is not None:
+            flusher.join()
+        if compactor is not None:
+            compactor.join()
+        with self._ioLock:
+            self._writeBuffer()
+            os.close(self._fd)
+
+
+_journals = {}
+_journalsLock = threading.Lock()
+
+
+def openJournal(fileName):
+    """
+    Returns the open journal of a patient file, opening it on first use.
+
+    fileName: The name of the patient text file.
+    """
+    key = os.path.abspath(fileName)
+    with _journalsLock:
+        journal = _journals.get(key)
+        if journal is None:
+            journal = _journals[key] = VisitJournal(fileName)
+        return journal
+
+
+@atexit.register
+def closeJournals():
+    """Closes every journal opened with openJournal."""
+    with _journalsLock:
+        journals = list(_journals.values())
+        _journals.clear()
+    for journal in journals:
+        journal.close()
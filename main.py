@@ -1,13 +1,53 @@
+import datetime
+import os
+import sqlite3
+from collections import namedtuple
 from typing import List, Dict, Optional
 
-
-def readPatientsFromFile(fileName):
+import shards
+import snapshot
+import storage
+from cache import DEFAULT_MAX_ENTRIES, QueryCache, cachedQuery, followUpKey, rangeKey, statsKey, visitsKey
+from date_index import DateIndex
+from early_warning import BackendWorklist, EarlyWarningEngine
+from followup import DEFAULT_RULES, FollowUpEngine, breaksRule
+from instrumentation import instrumented
+from journal import openJournal, replayJournal
+from patient_index import LazyPatients
+from patient_parser import VITAL_RANGES, RejectLog, parseLines, readPatientsParallel, readPatientsStreaming
+from renderer import patientRecords, writeVisits
+from visit_store import INVALID_DATE, VisitStore, dateToOrdinal
+from vital_stats import VITALS, VitalStats, summarizeVisits
+
+
+# (label, unit) of each vital sign in displayStats, in vital_stats.VITALS order.
+STATS_LABELS = (
+    ("  Temperature:", "C"),
+    ("  Heart Rate:", "bpm"),
+    ("  Respiratory Rate:", "bpm"),
+    ("  Systolic Blood Pressure:", "mmHg"),
+    ("  Diastolic Blood Pressure:", "mmHg"),
+    ("  Oxygen Saturation:", "%"),
+)
+PATIENT_STATS_LABELS = (
+    ("  Average temperature:", "C"),
+    ("  Average heart rate:", "bpm"),
+    ("  Average respiratory rate:", "bpm"),
+    ("  Average systolic blood pressure:", "mmHg"),
+    ("  Average diastolic blood pressure:", "mmHg"),
+    ("  Average oxygen saturation:", "%"),
+)
+
+
+@instrumented
+def readPatientsFromFile(fileName, rejectLog=None, workers=None, useSnapshot=True, lazy=False,
+                         cacheEntries=DEFAULT_MAX_ENTRIES):
     """
     Reads patient data from a plaintext file.
 
     fileName: The name of the file to read patient data from.
-    Returns a dictionary of patient IDs, where each patient has a list of visits.
-    The dictionary has the following structure:
+    Returns a VisitStore, which behaves like a read-only dictionary of patient IDs,
+    where each patient has a list of visits. The dictionary has the following structure:
     {
         patientId (int): [
             [date (str), temperature (float), heart rate (int), respiratory rate (int), systolic blood pressure (int), diastolic blood pressure (int), oxygen saturation (int)],
@@ -20,85 +60,111 @@ def readPatientsFromFile(fileName):
         ],
         ...
     }
+    The visits themselves are kept in typed columns; see visit_store.VisitStore.
+
+    Lines with the wrong number of fields, values of the wrong type or vital signs
+    outside their valid range are skipped and recorded in rejectLog (a
+    patient_parser.RejectLog) with their line numbers; only a summary is printed.
+
+    workers: The number of processes parsing the file. None (the default) and 1
+    read it in this process; other values use patient_parser.readPatientsParallel
+    (0 means one per CPU). The result is the same as a serial read.
+
+    useSnapshot: If True (the default), open the binary snapshot kept next to
+    the file (see snapshot.py) when it is up to date instead of parsing the
+    text, and write a new snapshot after every successful parse. Nothing is
+    rejected when the snapshot is used, since it only holds rows that were
+    valid; pass False to always parse, e.g. to collect the rejected lines.
+
+    Visits added and patients deleted since the file was last compacted are
+    replayed from its journal (see journal.py). Lines starting with '#' are comments.
+
+    A fileName ending in .db, .sqlite or .sqlite3 is opened as a SQLite database
+    (see storage.py, which also imports text files) instead of being loaded; the
+    other functions then run their queries in the database.
+
+    lazy: If True, return a patient_index.LazyPatients that parses each patient
+    only when it is first asked for, using an offset index kept next to the
+    file. This suits looking at a few patients of a large file; invalid lines
+    are counted when the index is built and not recorded in rejectLog.
+
+    A fileName naming a sharded dataset directory (see shards.py) is opened as
+    a shards.ShardedDataset, with `workers` processes each holding some of the
+    shards (by default one per shard, up to one per CPU); queries run on every
+    shard at once and their answers are merged.
+
+    cacheEntries: The size of the QueryCache (see cache.py) registered on the
+    loaded data, so repeated queries are answered from it; 0 for no cache.
+    LazyPatients never get one.
     """
-    patients = {}
-    try:
-        with open(fileName, 'r') as file:
-            for line in file:
-                line = line.strip()
-                fields = line.split(',')
-                if len(fields) != 8:
-                    print(f"Invalid number of fields ({len(fields)}) in line: {line}")
-                else:
-                    continue
-
-                try:
-                    patientId = int(fields[0])
-                    date = str(fields[1])
-                    temperature = float(fields[2])
-                    heartRate = int(fields[3])
-                    respiratoryRate = int(fields[4])
-                    sbp = int(fields[5])
-                    dbp = int(fields[6])
-                    spo2 = int(fields[7])
-                except ValueError:
-                    print(f"Invalid data type in line: {line}")
-                    continue
-
-                if temperature < 35 or temperature > 42:
-                    print(f"Invalid temperature value ({temperature}) in line: {line}")
-                    continue
-
-                if heartRate < 30 or heartRate > 180:
-                    print(f"Invalid heart rate value ({heartRate}) in line: {line}")
-                    continue
-
-                if respiratoryRate < 5 or respiratoryRate > 40:
-                    print(f"Invalid respiratory rate value ({respiratoryRate}) in line: {line}")
-                    continue
-
-                if sbp < 70 or sbp > 200:
-                    print(f"Invalid systolic blood pressure value ({sbp}) in line: {line}")
-                    continue
-
-                if dbp < 40 or dbp > 120:
-                    print(f"Invalid diastolic blood pressure value ({dbp}) in line: {line}")
-                    continue
-
-                if spo2 < 70 or spo2 > 100:
-                    print(f"Invalid oxygen saturation value ({spo2}) in line: {line}")
-                    continue
-
-                visit = [date, temperature, heartRate, respiratoryRate, sbp, dbp, spo2]
-                if patientId not in patients:
-                    patients[patientId] = []
-                patients[patientId].append(visit)
+    patients = _loadPatients(fileName, rejectLog, workers, useSnapshot, lazy)
+    if cacheEntries and isinstance(patients, (VisitStore, storage.StorageBackend)):
+        QueryCache.forStore(patients, cacheEntries)
+    return patients
+
+
+def _loadPatients(fileName, rejectLog, workers, useSnapshot, lazy):
+    # readPatientsFromFile without the query cache.
+    if storage.isDatabase(fileName):
+        try:
+            return storage.SqliteBackend(fileName)
+        except FileNotFoundError:
+            print(f"The file '{fileName}' could not be found.")
+            return VisitStore()
+    if shards.isDataset(fileName):
+        patients = shards.ShardedDataset(fileName, workers)
+        if patients.rejected:
+            print(f"Skipped {patients.rejected} invalid line(s) in '{fileName}'.")
+        return patients
+    if lazy:
+        try:
+            patients = LazyPatients(fileName)
+        except FileNotFoundError:
+            print(f"The file '{fileName}' could not be found.")
+            return VisitStore()
+        if patients.index.rejected:
+            print(f"Skipped {patients.index.rejected} invalid line(s) in '{fileName}'.")
         return patients
+    if useSnapshot:
+        patients = snapshot.loadSnapshot(snapshot.snapshotPath(fileName), fileName)
+        if patients is not None:
+            replayJournal(fileName, patients)
+            return patients
+    patients = VisitStore()
+    if rejectLog is None:
+        rejectLog = RejectLog(keep=0)
+    try:
+        sourceStat = os.stat(fileName)
+        if workers is None or workers == 1:
+            readPatientsStreaming(fileName, store=patients, rejectLog=rejectLog)
+        else:
+            readPatientsParallel(fileName, store=patients, rejectLog=rejectLog, workers=workers)
+        if useSnapshot:
+            try:
+                snapshot.writeSnapshot(patients, snapshot.snapshotPath(fileName), sourceStat)
+            except OSError as e:
+                print(f"Could not write the snapshot of '{fileName}': {e}")
+        replayJournal(fileName, patients)
     except FileNotFoundError:
         print(f"The file '{fileName}' could not be found.")
     except Exception as e:
         print(f"An unexpected error occurred while reading the file: {e}")
         # raise  # uncomment to re-raise the exception if desired
+    if rejectLog.count:
+        print(f"Skipped {rejectLog.count} invalid line(s) in '{fileName}'.")
     return patients
 
+@instrumented
 def displayPatientData(patients, patientId=0):
     """
     Displays patient data for a given patient ID.
 
     patients: A dictionary of patient dictionaries, where each patient has a list of visits.
     patientId: The ID of the patient to display data for. If 0, data for all patients will be displayed.
+    Visits are formatted in batches and written with one call per batch (see renderer.py).
     """
     if patientId == 0:
-        for patientId, patientData in patients.items():
-            print("Patient ID:", patientId)
-            for visit in patientData:
-                print(" Visit Date:", visit[0])
-                print("  Temperature:", "%.2f" % visit[1], "C")
-                print("  Heart Rate:", visit[2], "bpm")
-                print("  Respiratory Rate:", visit[3], "bpm")
-                print("  Systolic Blood Pressure:", visit[4], "mmHg")
-                print("  Diastolic Blood Pressure:", visit[5], "mmHg")
-                print("  Oxygen Saturation:", visit[6], "%")
+        writeVisits(patientRecords(patients))
     else:
         if not isinstance(patientId, int) or patientId < 0:
             print("Error: patientId should be a non-negative integer")
@@ -106,16 +172,7 @@ def displayPatientData(patients, patientId=0):
         if patientId not in patients:
             print(f"Patient with ID {patientId} not found.")
             return
-        patient_data = patients[patientId]
-        print("Patient ID:", patientId)
-        for visit in patient_data:
-            print(" Visit Date:", visit[0])
-            print("  Temperature:", "%.2f" % visit[1], "C")
-            print("  Heart Rate:", visit[2], "bpm")
-            print("  Respiratory Rate:", visit[3], "bpm")
-            print("  Systolic Blood Pressure:", visit[4], "mmHg")
-            print("  Diastolic Blood Pressure:", visit[5], "mmHg")
-            print("  Oxygen Saturation:", visit[6], "%")
+        writeVisits(patientRecords(patients, [patientId]))
 
 # def displayPatientData(patients, patientId=0):
 #     """
@@ -179,97 +236,100 @@ def displayPatientData(patients, patientId=0):
 
 ##########
 
+@instrumented
+@cachedQuery(statsKey)
+def vitalSummaries(patients, patientId=0):
+    """
+    Computes the statistics of each vital sign for all patients or for the specified patient.
+
+    patients: A dictionary of patient IDs, where each patient has a list of visits.
+    patientId: The ID of the patient to compute statistics for. If 0, statistics are computed over all patients.
+    return: A dictionary of vital name -> vital_stats.Summary, or {} if there are no matching visits.
+    For a VisitStore the figures come from its running VitalStats and cost O(1); a
+    storage.StorageBackend computes them in the database.
+    """
+    if isinstance(patients, storage.StorageBackend):
+        return patients.summaries(patientId)
+    if isinstance(patients, VisitStore):
+        stats = VitalStats.forStore(patients)
+        return stats.population() if patientId == 0 else stats.patient(patientId)
+    if patientId == 0:
+        return summarizeVisits(visit for visits in patients.values() for visit in visits)
+    return summarizeVisits(patients.get(patientId, []))
+
+def printStats(summaries, patientId=0):
+    """
+    Prints statistics computed by vitalSummaries.
+
+    summaries: A non-empty dictionary of vital name -> vital_stats.Summary.
+    patientId: The ID of the patient the statistics belong to, or 0 for all patients.
+    """
+    if patientId == 0:
+        print("Average vital signs for all patients:")
+        labels = STATS_LABELS
+    else:
+        print("Vital Signs for Patient {}:".format(patientId))
+        labels = PATIENT_STATS_LABELS
+    for name, (label, unit) in zip(VITALS, labels):
+        summary = summaries[name]
+        print(label, "%.2f" % summary.mean, unit,
+              "(min %.2f, max %.2f, sd %.2f)" % (summary.min, summary.max, summary.std))
+
+@instrumented
 def displayStats(patients, patientId=0):
     """
-    Prints the average of each vital sign for all patients or for the specified patient.
+    Prints the average of each vital sign for all patients or for the specified patient,
+    together with its minimum, maximum and standard deviation.
 
     patients: A dictionary of patient IDs, where each patient has a list of visits.
     patientId: The ID of the patient to display vital signs for. If 0, vital signs will be displayed for all patients.
+    return: A dictionary of vital name -> vital_stats.Summary, or None if there was nothing to display.
     """
-    # Check if patients is a dictionary
+    try:
+        patientId = int(patientId)
+    except ValueError:
+        print("Error: patientId should be a non-negative integer")
+        return None
 
-    if patientId == 0:
-        # Display vital signs for all patients
-        temp_total = 0
-        hr_total = 0
-        rr_total = 0
-        sbp_total = 0
-        dbp_total = 0
-        spo2_total = 0
-        num_patients = 0
-
-        for patientId, visits in patients.items():
-            for visit in visits:
-                temp_total += visit['temp']
-                hr_total += visit['hr']
-                rr_total += visit['rr']
-                sbp_total += visit['sbp']
-                dbp_total += visit['dbp']
-                spo2_total += visit['spo2']
-            num_visits = len(visits)
-            num_patients += 1
-
-        if num_patients > 0:
-            avg_temp = temp_total / (num_patients * num_visits)
-            avg_hr = hr_total / (num_patients * num_visits)
-            avg_rr = rr_total / (num_patients * num_visits)
-            avg_sbp = sbp_total / (num_patients * num_visits)
-            avg_dbp = dbp_total / (num_patients * num_visits)
-            avg_spo2 = spo2_total / (num_patients * num_visits)
-
-            print("Average vital signs for all patients:")
-            print("  Temperature:", "%.2f" % avg_temp, "C")
-            print("  Heart Rate:", "%.2f" % avg_hr, "bpm")
-            print("  Respiratory Rate:", "%.2f" % avg_rr, "bpm")
-            print("  Systolic Blood Pressure:", "%.2f" % avg_sbp, "mmHg")
-            print("  Diastolic Blood Pressure:", "%.2f" % avg_dbp, "mmHg")
-            print("  Oxygen Saturation:", "%.2f" % avg_spo2, "%")
-        else:
+    summaries = vitalSummaries(patients, patientId)
+    if not summaries:
+        if patientId == 0:
             print("No patient data found.")
+        else:
+            print(f"Patient with ID {patientId} not found.")
+        return None
+    printStats(summaries, patientId)
+    return summaries
 
-    else:
-        # Display vital signs for the specified patient
-        if patientId in patients:
-            visits = patients[patientId]
-            temp_total = 0
-            hr_total = 0
-            rr_total = 0
-            sbp_total = 0
-            dbp_total = 0
-            spo2_total = 0
-            num_visits = len(visits)
-
-            for visit in visits:
-                temp_total += visit['temp']
-                hr_total += visit['hr']
-                rr_total += visit['rr']
-                sbp_total += visit['sbp']
-                dbp_total += visit['dbp']
-                spo2_total += visit['spo2']
-
-            if num_visits > 0:
-                avg_temp = temp_total / num_visits
-                avg_hr = hr_total / num_visits
-                avg_rr = rr_total / num_visits
-                avg_sbp = sbp_total / num_visits
-                avg_dbp = dbp_total / num_visits
-                avg_spo2 = spo2_total / num_visits
-
-                print("Vital Signs for Patient {}:".format(patientId))
-                print("  Average temperature:", "{:.2f}".format(avg_temp), "C")
-                print("  Average heart rate:", "{:.2f}".format(avg_hr), "bpm")
-                print("  Average respiratory rate:", "{:.2f}".format(avg_rr), "bpm")
-                print("  Average systolic blood pressure:", "{:.2f}".format(avg_sbp), "mmHg")
-                print("  Average diastolic blood pressure:", "{:.2f}".format(avg_dbp), "mmHg")
-                print("  Average oxygen saturation:", "{:.2f}".format(avg_spo2), "%")
+    #######################
 
 
 
+def checkVisit(patientId, date, temp, hr, rr, sbp, dbp, spo2):
+    """
+    Checks the values of a new visit, as addPatientData does before saving it.
 
-    #######################
+    The arguments are those of addPatientData.
+    return: (patientId as an int, None) if the visit is valid, otherwise (None, the error message).
+    """
+    try:
+        patientId = int(patientId)
+    except ValueError:
+        return None, "Invalid patient ID. Please enter a whole number."
+    try:
+        # check date format
+        datetime.datetime.strptime(date, '%Y-%m-%d')
+    except ValueError:
+        return None, "Invalid date format. Please enter date in the format 'yyyy-mm-dd'."
+
+    for (_, name, low, high), value in zip(VITAL_RANGES, (temp, hr, rr, sbp, dbp, spo2)):
+        if not (low <= value <= high):
+            return None, f"Invalid {name}. Please enter a {name} between {low} and {high}."
+    return patientId, None
 
 
 
+@instrumented
 def addPatientData(patients, patientId, date, temp, hr, rr, sbp, dbp, spo2, fileName):
     """
     Adds new patient data to the patient list.
@@ -283,65 +343,145 @@ def addPatientData(patients, patientId, date, temp, hr, rr, sbp, dbp, spo2, file
     sbp: The patient's systolic blood pressure.
     dbp: The patient's diastolic blood pressure.
     spo2: The patient's oxygen saturation level.
-    fileName: The name of the file to append new data to.
+    fileName: The name of the patient file. The visit is appended to its journal
+    (see journal.py), which readPatientsFromFile replays on the next load. A
+    storage.StorageBackend stores the visit itself and fileName is not used.
     """
     #######################
-    '''
     # check for input errors
-    try:
-        # check date format
-        datetime.datetime.strptime(date, '%Y-%m-%d')
-        # check date validity
-        year, month, day = map(int, date.split('-'))
-        datetime.date(year, month, day)
-    except ValueError:
-        print("Invalid date format. Please enter date in the format 'yyyy-mm-dd'.")
+    patientId, error = checkVisit(patientId, date, temp, hr, rr, sbp, dbp, spo2)
+    if error is not None:
+        print(error)
         return
 
-    if not (35.0 <= temp <= 42.0):
-        print("Invalid temperature. Please enter a temperature between 35.0 and 42.0 Celsius.")
+    visit = [date, temp, hr, rr, sbp, dbp, spo2]
+    if isinstance(patients, storage.StorageBackend):
+        try:
+            patients.addVisit(patientId, visit)
+        except (sqlite3.Error, OSError) as e:
+            print(f"Could not save the visit: {e}")
+            return
+        print(f"Visit is saved successfully for Patient #{patientId}")
         return
 
-    if not (30 <= hr <= 180):
-        print("Invalid heart rate. Please enter a heart rate between 30 and 180 bpm.")
+    # log the visit before applying it, so it is never in memory without being on disk
+    try:
+        openJournal(fileName).logAdd(patientId, visit)
+    except OSError as e:
+        print(f"Could not save the visit: {e}")
         return
 
-    if not (5 <= rr <= 40):
-        print("Invalid respiratory rate. Please enter a respiratory rate between 5 and 40 bpm.")
-        return
+    # add visit to patients dictionary
+    if isinstance(patients, (VisitStore, LazyPatients)):
+        patients.append(patientId, visit)
+    elif patientId in patients:
+        patients[patientId].append(visit)
+    else:
+        patients[patientId] = [visit]
 
-    if not (70 <= sbp <= 200):
-        print("Invalid systolic blood pressure. Please enter a systolic blood pressure between 70 and 200 mmHg.")
-        return
+    print(f"Visit is saved successfully for Patient #{patientId}")
+    #######################
 
-    if not (40 <= dbp <= 120):
-        print("Invalid diastolic blood pressure. Please enter a diastolic blood pressure between 40 and 120 mmHg.")
-        return
 
-    if not (70 <= spo2 <= 100):
-        print("Invalid oxygen saturation. Please enter an oxygen saturation between 70 and 100%.")
-        return
+ImportResult = namedtuple('ImportResult', ['accepted', 'rejected', 'rejects'])
+ImportResult.__doc__ = """
+The outcome of importVisits.
 
-    # add visit to patients dictionary
-    if patientId in patients:
-        patients[patientId].append({'date': date, 'temperature': temp, 'heart_rate': hr,
-                                    'respiratory_rate': rr, 'systolic_blood_pressure': sbp,
-                                    'diastolic_blood_pressure': dbp, 'oxygen_saturation': spo2})
-    else:
-        patients[patientId] = [{'date': date, 'temperature': temp, 'heart_rate': hr,
-                                    'respiratory_rate': rr, 'systolic_blood_pressure': sbp,
-                                    'diastolic_blood_pressure': dbp, 'oxygen_saturation': spo2}]
+accepted: The number of visits saved.
+rejected: The number of rows that were not.
+rejects: (row number, reason, row) for every rejected row; rows are numbered from 1,
+         as are the lines of a CSV file (header included).
+"""
 
-    # add visit to file
-    with open(readPatientsFromFile(), 'a') as f:
-        f.write(f"{patientId},{date},{temp},{hr},{rr},{sbp},{dbp},{spo2}\n")
 
-    print(f"Visit is saved successfully for Patient #{patientId}")
-'''
-    #######################
+def _importLines(visits):
+    # (lines, number of the first line) of the rows to import.
+    if isinstance(visits, str) or hasattr(visits, 'readlines'):
+        if isinstance(visits, str):
+            with open(visits, 'r') as file:
+                lines = file.readlines()
+        else:
+            lines = visits.readlines()
+        # a header such as the one cli.py writes with --format csv
+        if lines and lines[0].split(',', 1)[0].strip() == 'patientId':
+            return lines[1:], 2
+        return lines, 1
+    return [','.join(map(str, row)) for row in visits], 1
 
 
+@instrumented
+def importVisits(patients, visits, fileName, strict=False):
+    """
+    Adds many visits at once.
 
+    The rows are checked together, with the same rules as readPatientsFromFile
+    plus a valid date, as addPatientData requires. The valid ones are written to
+    the journal of the patient file with one write (see journal.py), all of them
+    or none, and then added to patients.
+
+    patients: The dictionary of patient IDs, where each patient has a list of visits, to add data to.
+    visits: The rows to add, each (patientId, date, temp, hr, rr, sbp, dbp, spo2), or a CSV file
+    of such rows in the format of patients.txt, optionally with a header line, given by name
+    or open for reading.
+    fileName: The name of the patient file. A storage.StorageBackend stores the visits in
+    one transaction instead and fileName is not used.
+    strict: Save nothing if any row is invalid.
+    return: An ImportResult.
+    """
+    try:
+        lines, firstLineNumber = _importLines(visits)
+    except OSError as e:
+        print(f"Could not read the visits to import: {e}")
+        return ImportResult(0, 0, [])
+    chunk = parseLines(lines, firstLineNumber)
+    rejects = chunk.rejects
+    rejected = {lineNumber for lineNumber, _, _ in rejects}
+    # (line number, line) of the rows in chunk, in the same order
+    kept = [(lineNumber, line.strip()) for lineNumber, line in enumerate(lines, firstLineNumber)
+            if lineNumber not in rejected and not line.startswith('#')]
+    if INVALID_DATE in chunk.dates:
+        # Rare: drop the rows with unreadable dates and check the rest again.
+        badDates = {position for position, ordinal in enumerate(chunk.dates) if ordinal == INVALID_DATE}
+        rejects.extend((kept[position][0], "invalid date", kept[position][1]) for position in sorted(badDates))
+        rejects.sort()
+        kept = [entry for position, entry in enumerate(kept) if position not in badDates]
+        chunk = parseLines([line for _, line in kept])
+    accepted = [line for _, line in kept]
+    if strict and rejects:
+        print(f"Nothing was imported: {len(rejects)} row(s) are invalid.")
+        return ImportResult(0, len(rejects), rejects)
+    if not accepted:
+        print(f"No visits to import; {len(rejects)} row(s) rejected.")
+        return ImportResult(0, len(rejects), rejects)
+
+    if isinstance(patients, storage.StorageBackend):
+        try:
+            patients.extend(chunk)
+        except (sqlite3.Error, OSError) as e:
+            print(f"Could not save the visits: {e}")
+            return ImportResult(0, len(rejects), rejects)
+    else:
+        # log the batch before applying it, so it is never in memory without being on disk
+        try:
+            openJournal(fileName).logAddBatch(accepted)
+        except OSError as e:
+            print(f"Could not save the visits: {e}")
+            return ImportResult(0, len(rejects), rejects)
+        if isinstance(patients, (VisitStore, LazyPatients)):
+            patients.extend(chunk)
+        else:
+            batch = VisitStore()
+            batch.extend(chunk)
+            for patientId in batch:
+                patients.setdefault(patientId, []).extend(batch[patientId])
+
+    print(f"Imported {len(chunk)} visit(s) for {len(set(chunk.patientIds))} patient(s); "
+          f"rejected {len(rejects)} row(s).")
+    return ImportResult(len(chunk), len(rejects), rejects)
+
+
+@instrumented
+@cachedQuery(visitsKey)
 def findVisitsByDate(patients, year=None, month=None):
     """
     Find visits by year, month, or both.
@@ -350,9 +490,17 @@ def findVisitsByDate(patients, year=None, month=None):
     year: The year to filter by.
     month: The month to filter by.
     return: A list of tuples containing patient ID and visit that match the filter.
+    For a VisitStore the visits come from its date index; a storage.StorageBackend
+    answers from the date index of its database. Either way they are listed
+    patient by patient, in the order of the scan below.
     """
     visits = []
     #######################
+    if isinstance(patients, storage.StorageBackend):
+        return patients.visitsByYearMonth(year, month)
+    if isinstance(patients, VisitStore):
+        rows = DateIndex.forStore(patients).rowsByYearMonth(year, month)
+        return [(patients.patientIds[row], patients.visit(row)) for row in rows]
     ####
     for patientId, patientVisits in patients.items():
         for visit in patientVisits:
@@ -372,36 +520,104 @@ def findVisitsByDate(patients, year=None, month=None):
     #######################
 
 
+@instrumented
+@cachedQuery(rangeKey)
+def findVisitsInRange(patients, startDate, endDate):
+    """
+    Find visits between two dates, both included.
 
-def findPatientsWhoNeedFollowUp(patients):
+    patients: A dictionary of patient IDs, where each patient has a list of visits.
+    startDate: The first date, in the format 'yyyy-mm-dd'.
+    endDate: The last date, in the format 'yyyy-mm-dd'.
+    return: A list of tuples containing patient ID and visit, sorted by date.
+    """
+    start = dateToOrdinal(startDate)
+    end = dateToOrdinal(endDate)
+    if start == INVALID_DATE or end == INVALID_DATE:
+        print("Invalid date format. Please enter dates in the format 'yyyy-mm-dd'.")
+        return []
+    if isinstance(patients, storage.StorageBackend):
+        return patients.visitsBetween(start, end + 1)
+    if isinstance(patients, VisitStore):
+        rows = DateIndex.forStore(patients).rowsBetween(start, end + 1)
+        return [(patients.patientIds[row], patients.visit(row)) for row in rows]
+    visits = []
+    for patientId, patientVisits in patients.items():
+        for visit in patientVisits:
+            if start <= dateToOrdinal(visit[0]) <= end:
+                visits.append((patientId, visit))
+    visits.sort(key=lambda visit: dateToOrdinal(visit[1][0]))
+    return visits
+
+
+
+@instrumented
+@cachedQuery(followUpKey)
+def findPatientsWhoNeedFollowUp(patients, rules=None):
     """
     Find patients who need follow-up visits based on abnormal vital signs.
 
     patients: A dictionary of patient IDs, where each patient has a list of visits.
+    rules: The followup.FollowUpRule thresholds to apply. Defaults to followup.DEFAULT_RULES:
+    heart rate above 100 or below 60, systolic bp above 140, diastolic bp above 90 or
+    oxygen saturation below 90.
     return: A list of patient IDs that need follow-up visits to to abnormal health stats.
+    For a VisitStore the answer comes from its incrementally maintained FollowUpEngine;
+    a storage.StorageBackend runs one query in its database.
     """
+    if isinstance(patients, storage.StorageBackend):
+        return patients.followUpPatients(DEFAULT_RULES if rules is None else rules)
+    if isinstance(patients, VisitStore):
+        engine = FollowUpEngine.forStore(patients)
+        rules = DEFAULT_RULES if rules is None else tuple(rules)
+        if engine.rules != rules:
+            engine.setRules(rules)
+        return engine.patients()
+    rules = DEFAULT_RULES if rules is None else rules
     followup_patients = []
     #######################
     for patient_id, visits in patients.items():
         for visit in visits:
-            heart_rate = visit[2]
-            systolic_bp = visit[4]
-            diastolic_bp = visit[5]
-            oxygen_sat = visit[6]
-            if heart_rate > 100 or heart_rate < 60 or systolic_bp > 140 or diastolic_bp > 90 or oxygen_sat < 90:
+            if any(breaksRule(rule, visit) for rule in rules):
                 followup_patients.append(patient_id)
                 break
     #######################
     return followup_patients
 
 
+@instrumented
+def earlyWarningWorklist(patients, limit=None, minScore=0):
+    """
+    Ranks patients by the NEWS2 early-warning score of their latest visit, sickest first.
+
+    patients: A dictionary of patient IDs, where each patient has a list of visits.
+    limit: The number of patients to return, or None for all of them.
+    minScore: Leave out patients whose latest score is lower.
+    return: A list of early_warning.WorklistEntry.
+    For a VisitStore the scores are kept up to date by its EarlyWarningEngine, and
+    for a storage.StorageBackend by its BackendWorklist; other data is copied into
+    a temporary VisitStore and scored in one pass.
+    """
+    if isinstance(patients, VisitStore):
+        engine = EarlyWarningEngine.forStore(patients)
+    elif isinstance(patients, storage.StorageBackend):
+        engine = BackendWorklist.forStore(patients)
+    else:
+        engine = EarlyWarningEngine(VisitStore.fromPatients(patients))
+    return engine.worklist(limit, minScore)
+
+
+
+@instrumented
 def deleteAllVisitsOfPatient(patients, patientId, filename):
     """
     Delete all visits of a particular patient.
 
     patients: The dictionary of patient IDs, where each patient has a list of visits, to delete data from.
     patientId: The ID of the patient to delete data for.
-    filename: The name of the file to save the updated patient data.
+    filename: The name of the patient file. The deletion is appended to its journal
+    (see journal.py) and folded into the file by a later compaction. A
+    storage.StorageBackend deletes the visits itself and filename is not used.
     return: None
     """
     #######################
@@ -409,15 +625,27 @@ def deleteAllVisitsOfPatient(patients, patientId, filename):
         print(f"No data found for patient with ID {patientId}")
         return
 
-        # Remove all visits for the given patientId
-    del patients[patientId]
+    if isinstance(patients, storage.StorageBackend):
+        try:
+            patients.deletePatient(patientId)
+        except (sqlite3.Error, OSError) as e:
+            print(f"Could not delete the data for patient {patientId}: {e}")
+            return
+        print(f"Data for patient {patientId} has been deleted.")
+        return
 
-    # Write remaining patient data back to the file
-    with open(filename, 'w') as f:
-        for pid, visits in patients.items():
-            for visit in visits:
-                f.write(
-                    f"{pid},{visit['date']},{visit['temp']},{visit['hr']},{visit['rr']},{visit['sbp']},{visit['dbp']},{visit['spo2']}\n")
+    # Record the deletion in the journal instead of rewriting the whole file
+    try:
+        openJournal(filename).logDelete(patientId)
+    except OSError as e:
+        print(f"Could not delete the data for patient {patientId}: {e}")
+        return
+
+    # Remove all visits for the given patientId
+    if isinstance(patients, (VisitStore, LazyPatients)):
+        patients.deletePatient(patientId)
+    else:
+        del patients[patientId]
 
     print(f"Data for patient {patientId} has been deleted.")
     #######################
@@ -0,0 +1,384 @@
+"""
+Per-patient offset index of patients.txt, for loading patients on demand.
+
+The index is kept next to the file as patients.txt.idx. It maps every patient
+ID to the byte ranges of that patient's valid lines, merged where lines are
+adjacent. Like a snapshot, it remembers the size and modification time of
+the text file and is rebuilt as soon as either changes. Building it parses
+the whole file once, a block at a time, with patient_parser.parseLines, so
+invalid lines are left out of the index and never parsed again.
+
+LazyPatients is a mapping of patientId -> visits on top of the index. It maps
+the index into memory, reads and parses only the lines of the patients it is
+asked for, and keeps the most recently used ones in a bounded LRU, so opening
+a file of any size takes milliseconds and memory grows with the patients
+looked at. The journal (see journal.py) is replayed on top of it, and it can
+record new visits and deletions as a VisitStore does.
+
+Queries over every patient (statistics, follow-up, searches by date) still
+work, but they parse each patient in turn; load the whole file for those.
+
+Layout (little-endian, every section is int64):
+    header          HEADER struct, see below
+    patient IDs     sorted
+    first runs      the index of each patient's first run, plus the number of runs
+    run offsets     byte offset of each run of lines
+    run lengths     byte length of each run
+"""
+import mmap
+import os
+import sys
+import threading
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from collections.abc import Mapping
+from struct import Struct
+
+from journal import replayJournal
+from patient_parser import DEFAULT_CHUNK_BYTES, parseLines
+from visit_store import VisitStore
+
+
+MAGIC = b'EHRPIDX\x00'
+# 2: lines end at b'\n' only; earlier indexes also split lines at other line breaks
+VERSION = 2
+
+# magic, version, source size, source mtime (ns), patients, runs, rejected lines,
+# header crc32 (of everything before it)
+HEADER = Struct('<8sIqqqqqI')
+
+# Patients kept parsed by a LazyPatients.
+DEFAULT_MAX_PATIENTS = 1024
+
+
+def indexPath(fileName):
+    """
+    Returns the name of the offset index kept for a patient file.
+
+    fileName: The name of the patient text file.
+    """
+    return fileName + '.idx'
+
+
+class PatientIndex:
+    """
+    The byte ranges of the valid lines of every patient of a file.
+
+    patientIds: The patient IDs, sorted.
+    firstRuns: The index in offsets of the first run of each patient, plus one past the last run.
+    offsets, lengths: The byte offset and length of each run of adjacent lines.
+    sourceSize, sourceMtime: The size and modification time (ns) of the file indexed.
+    rejected: The number of invalid lines in the file.
+    """
+
+    def __init__(self, patientIds, firstRuns, offsets, lengths, sourceSize, sourceMtime, rejected):
+        self.patientIds = patientIds
+        self.firstRuns = firstRuns
+        self.offsets = offsets
+        self.lengths = lengths
+        self.sourceSize = sourceSize
+        self.sourceMtime = sourceMtime
+        self.rejected = rejected
+        # mmap backing the arrays of an index opened from disk
+        self._mapped = None
+
+    def __len__(self):
+        return len(self.patientIds)
+
+    def runs(self, patientId):
+        """
+        Returns the byte ranges of a patient's lines.
+
+        return: A list of (offset, length), in file order; empty for an unknown patient.
+        """
+        position = bisect_left(self.patientIds, patientId)
+        if position == len(self.patientIds) or self.patientIds[position] != patientId:
+            return []
+        first, end = self.firstRuns[position], self.firstRuns[position + 1]
+        return list(zip(self.offsets[first:end], self.lengths[first:end]))
+
+
+def _splitLines(data, errors):
+    # Decoded lines of a block of bytes, with their newlines. Only b'\n' ends a
+    # line, as when the file is read line by line; str.splitlines would also
+    # split on \x0b, \x0c, \x1c-\x1e, \x85 and \u2028, moving every offset after them.
+    lines = data.split(b'\n')
+    last = lines.pop()
+    lines = [line + b'\n' for line in lines]
+    if last:
+        lines.append(last)
+    return [line.decode('utf-8', errors) for line in lines], lines
+
+
+def _blocks(file, chunkBytes):
+    # Yields (byte offset, lines, byte lines) for blocks of whole lines of a binary file.
+    offset = 0
+    while True:
+        data = file.read(chunkBytes)
+        if not data:
+            return
+        if not data.endswith(b'\n'):
+            data += file.readline()
+        yield (offset,) + _splitLines(data, 'surrogateescape')
+        offset += len(data)
+
+
+def buildIndex(fileName, chunkBytes=DEFAULT_CHUNK_BYTES):
+    """
+    Scans a patient file and indexes the byte ranges of every patient's valid lines.
+
+    fileName: The name of the patient text file.
+    chunkBytes: Approximate number of bytes parsed at a time.
+    return: A PatientIndex held in memory.
+    """
+    # patientId -> [start, end, start, end, ...] of its runs
+    runs = {}
+    rejected = 0
+    lineNumber = 1
+    with open(fileName, 'rb') as file:
+        sourceStat = os.fstat(file.fileno())
+        for offset, lines, byteLines in _blocks(file, chunkBytes):
+            chunk = parseLines(lines, lineNumber)
+            rejected += len(chunk.rejects)
+            bad = {number for number, _, _ in chunk.rejects}
+            patientIds = iter(chunk.patientIds)
+            for number, (line, byteLine) in enumerate(zip(lines, byteLines), lineNumber):
+                end = offset + len(byteLine)
+                if number not in bad and not line.startswith('#'):
+                    patientId = next(patientIds)
+                    spans = runs.get(patientId)
+                    if spans is None:
+                        runs[patientId] = array('q', (offset, end))
+                    elif spans[-1] == offset:
+                        spans[-1] = end
+                    else:
+                        spans.extend((offset, end))
+                offset = end
+            lineNumber += len(lines)
+
+    patientIds = array('q', sorted(runs))
+    firstRuns = array('q')
+    offsets = array('q')
+    lengths = array('q')
+    for patientId in patientIds:
+        spans = runs[patientId]
+        firstRuns.append(len(offsets))
+        offsets.extend(spans[0::2])
+        lengths.extend(map(int.__sub__, spans[1::2], spans[0::2]))
+    firstRuns.append(len(offsets))
+    return PatientIndex(patientIds, firstRuns, offsets, lengths,
+                        sourceStat.st_size, sourceStat.st_mtime_ns, rejected)
+
+
+def _sections(index):
+    return (index.patientIds, index.firstRuns, index.offsets, index.lengths)
+
+
+def writeIndex(index, indexName):
+    """
+    Writes an index, under a temporary name renamed into place.
+
+    index: The PatientIndex.
+    indexName: The name of the index file.
+    """
+    body = bytearray()
+    for section in _sections(index):
+        if sys.byteorder != 'little':
+            section = array('q', section)
+            section.byteswap()
+        body += section.tobytes()
+    fields = (MAGIC, VERSION, index.sourceSize, index.sourceMtime, len(index.patientIds),
+              len(index.offsets), index.rejected)
+    header = HEADER.pack(*fields, 0)
+    header = HEADER.pack(*fields, zlib.crc32(header[:HEADER.size - 4]))
+    temporary = indexName + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(header)
+        f.write(body)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, indexName)
+
+
+def loadIndex(indexName, sourceStat):
+    """
+    Opens an index file without reading it into memory.
+
+    indexName: The name of the index file.
+    sourceStat: os.stat() of the text file the index should describe.
+    return: A PatientIndex backed by the mapped file, or None if the index is
+            missing, corrupt, of another version or older than the text file.
+    """
+    try:
+        with open(indexName, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if len(mapped) < HEADER.size:
+        return None
+    magic, version, sourceSize, sourceMtime, patientCount, runCount, rejected, headerCrc = \
+        HEADER.unpack_from(mapped)
+    if (magic != MAGIC or version != VERSION
+            or headerCrc != zlib.crc32(mapped[:HEADER.size - 4])):
+        return None
+    if sourceSize != sourceStat.st_size or sourceMtime != sourceStat.st_mtime_ns:
+        return None
+    counts = (patientCount, patientCount + 1, runCount, runCount)
+    if len(mapped) != HEADER.size + 8 * sum(counts):
+        return None
+    view = memoryview(mapped)
+    sections = []
+    offset = HEADER.size
+    for count in counts:
+        data = view[offset:offset + 8 * count]
+        if sys.byteorder == 'little':
+            sections.append(data.cast('q'))
+        else:
+            section = array('q')
+            section.frombytes(data)
+            section.byteswap()
+            sections.append(section)
+        offset += 8 * count
+    index = PatientIndex(*sections, sourceSize, sourceMtime, rejected)
+    index._mapped = mapped
+    return index
+
+
+def openIndex(fileName, sourceStat):
+    """
+    Returns the index of a patient file, rebuilding and saving it if it is missing or stale.
+
+    fileName: The name of the patient text file.
+    sourceStat: os.stat() of that file.
+    return: A PatientIndex.
+    """
+    index = loadIndex(indexPath(fileName), sourceStat)
+    if index is not None:
+        return index
+    index = buildIndex(fileName)
+    try:
+        writeIndex(index, indexPath(fileName))
+    except OSError as e:
+        print(f"Could not write the index of '{fileName}': {e}")
+    return index
+
+
+class LazyPatients(Mapping):
+    """
+    Patients of a text file, parsed one patient at a time when first asked for.
+
+    fileName: The patient text file.
+    maxPatients: The number of parsed patients kept in memory.
+    """
+
+    def __init__(self, fileName, maxPatients=DEFAULT_MAX_PATIENTS):
+        self.fileName = fileName
+        self.maxPatients = maxPatients
+        # Keep the file open, so a compaction replacing it cannot move lines under the index.
+        self._file = open(fileName, 'rb')
+        self._lock = threading.Lock()
+        self.index = openIndex(fileName, os.fstat(self._file.fileno()))
+        # patientId -> visits from the file, least recently used first
+        self._parsed = OrderedDict()
+        # changes since the file was written: visits added after the patient's last
+        # deletion, and patients whose visits in the file are deleted
+        self._added = {}
+        self._deleted = set()
+        replayJournal(fileName, self)
+
+    def close(self):
+        """Closes the patient file."""
+        self._file.close()
+
+    def _fromFile(self, patientId):
+        # The lock guards the file position and the order of the LRU.
+        with self._lock:
+            visits = self._parsed.get(patientId)
+            if visits is not None:
+                self._parsed.move_to_end(patientId)
+                return visits
+            runs = self.index.runs(patientId)
+            if not runs:
+                return []
+            parts = []
+            for offset, length in runs:
+                self._file.seek(offset)
+                parts.append(self._file.read(length))
+        store = VisitStore()
+        store.extend(parseLines(_splitLines(b''.join(parts), 'replace')[0]))
+        visits = store.get(patientId, [])
+        with self._lock:
+            self._parsed[patientId] = visits
+            if len(self._parsed) > self.maxPatients:
+                self._parsed.popitem(last=False)
+        return visits
+
+    def __getitem__(self, patientId):
+        visits = [] if patientId in self._deleted else self._fromFile(patientId)
+        visits = [list(visit) for visit in visits]
+        visits.extend(list(visit) for visit in self._added.get(patientId, ()))
+        if not visits:
+            raise KeyError(patientId)
+        return visits
+
+    def __contains__(self, patientId):
+        if patientId in self._added:
+            return True
+        if patientId in self._deleted or not isinstance(patientId, int):
+            return False
+        return bool(self.index.runs(patientId))
+
+    def __iter__(self):
+        deleted = self._deleted
+        indexed = self.index.patientIds
+        for patientId in indexed:
+            if patientId not in deleted or patientId in self._added:
+                yield patientId
+        for patientId in self._added:
+            position = bisect_left(indexed, patientId)
+            if position == len(indexed) or indexed[position] != patientId:
+                yield patientId
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def cachedPatients(self):
+        """Returns the number of patients currently kept parsed."""
+        with self._lock:
+            return len(self._parsed)
+
+    # The changes of a VisitStore, used by main.py and by journal replay.
+
+    def append(self, patientId, visit):
+        """
+        Adds one visit.
+
+        visit: [date, temperature, heart rate, respiratory rate, systolic bp, diastolic bp, oxygen saturation]
+        """
+        self._added.setdefault(patientId, []).append(list(visit))
+
+    def extend(self, chunk):
+        """
+        Adds the visits of a patient_parser.ParsedChunk.
+
+        chunk: The ParsedChunk.
+        """
+        store = VisitStore()
+        store.extend(chunk)
+        for patientId in store:
+            self._added.setdefault(patientId, []).extend(store[patientId])
+
+    def deletePatient(self, patientId):
+        """
+        Deletes all visits of a patient.
+
+        return: The number of visits deleted.
+        """
+        count = len(self[patientId]) if patientId in self else 0
+        self._added.pop(patientId, None)
+        self._deleted.add(patientId)
+        with self._lock:
+            self._parsed.pop(patientId, None)
+        return count
@@ -0,0 +1,393 @@
+"""
+Streaming, chunked reader for patients.txt.
+
+The file is read in large blocks of lines. Each block is split into fields with
+a single call, converted a whole column at a time and range-checked with one
+pass per vital, and the
+surviving rows are appended to a VisitStore as typed arrays. Rejected rows go
+to a RejectLog together with their line numbers instead of being printed; as in
+the original reader, blank lines are rejected too (as "blank line"), while lines
+starting with '#' are skipped.
+While instrumentation is enabled, each of these stages is timed per block.
+"""
+import io
+import json
+import operator
+import os
+from array import array
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import instrumentation
+from visit_store import COLUMNS, VisitStore, dateToOrdinal, ordinalToDate
+
+
+# Number of comma-separated fields in a valid line.
+FIELD_COUNT = 8
+
+# Bytes of text handed to parseLines at a time.
+DEFAULT_CHUNK_BYTES = 1 << 22
+
+# (field index, reject reason, lowest valid value, highest valid value), checked in this order.
+VITAL_RANGES = (
+    (2, 'temperature', 35, 42),
+    (3, 'heart rate', 30, 180),
+    (4, 'respiratory rate', 5, 40),
+    (5, 'systolic blood pressure', 70, 200),
+    (6, 'diastolic blood pressure', 40, 120),
+    (7, 'oxygen saturation', 70, 100),
+)
+
+# Bytes of the file parsed by one worker task in readPatientsParallel.
+DEFAULT_SHARD_BYTES = 1 << 24
+
+# Patient IDs are stored as int64.
+PATIENT_ID_RANGE = (0, 'patient ID', -2 ** 63, 2 ** 63 - 1)
+
+# Converter for every field of a line, by field index.
+FIELD_TYPES = (int, str, float, int, int, int, int, int)
+
+
+class RejectLog:
+    """
+    Collects the lines rejected while reading a patient file.
+
+    Every reject is counted by reason. The first `keep` rejects are kept in
+    memory as (line number, reason, line) tuples, and if fileName is given all
+    of them are also written there as JSON lines.
+    """
+
+    def __init__(self, fileName=None, keep=1000):
+        self.count = 0
+        self.reasons = Counter()
+        self.records = []
+        self.keep = keep
+        self._file = open(fileName, 'w') if fileName else None
+
+    def add(self, lineNumber, reason, line):
+        """
+        Records one rejected line.
+
+        lineNumber: The 1-based line number in the source file.
+        reason: A short description of why the line was rejected.
+        line: The text of the line, without the trailing newline.
+        """
+        self.count += 1
+        self.reasons[reason] += 1
+        if len(self.records) < self.keep:
+            self.records.append((lineNumber, reason, line))
+        if self._file is not None:
+            self._file.write(json.dumps({'line': lineNumber, 'reason': reason, 'text': line}) + '\n')
+
+    def extend(self, rejects):
+        """
+        Records several rejected lines.
+
+        rejects: An iterable of (line number, reason, line) tuples.
+        """
+        for lineNumber, reason, line in rejects:
+            self.add(lineNumber, reason, line)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ParsedChunk:
+    """
+    The valid rows of a block of lines, in columns, plus the rejected ones.
+
+    The column arrays use the same typecodes as VisitStore, so a chunk can be
+    handed to VisitStore.extend directly (and pickled compactly between processes).
+    """
+
+    def __init__(self):
+        self.patientIds = array('q')
+        for name, typecode in COLUMNS:
+            setattr(self, name, array(typecode))
+        # position in the chunk -> date text, for dates the ordinal cannot reproduce
+        self.rawDates = {}
+        # (line number, reason, line) for every rejected line
+        self.rejects = []
+        # number of lines consumed, including blank, comment and rejected ones
+        self.lineCount = 0
+
+    def __len__(self):
+        return len(self.patientIds)
+
+    def extend(self, other):
+        """
+        Appends the rows, rejects and line count of a chunk that follows this one.
+
+        other: A ParsedChunk whose line numbers continue from this chunk's.
+        """
+        first = len(self.patientIds)
+        self.patientIds.extend(other.patientIds)
+        for name, _ in COLUMNS:
+            getattr(self, name).extend(getattr(other, name))
+        for position, date in other.rawDates.items():
+            self.rawDates[first + position] = date
+        self.rejects.extend(other.rejects)
+        self.lineCount += other.lineCount
+
+
+_countCommas = operator.methodcaller('count', ',')
+
+
+def _convertRow(fields):
+    return [convert(field) for convert, field in zip(FIELD_TYPES, fields)]
+
+
+def _inRange(column, low, high):
+    # Whole-column check done by C loops; the sum catches NaN, which min/max can miss.
+    total = sum(column)
+    return low <= min(column) and max(column) <= high and total == total
+
+
+def parseLines(lines, firstLineNumber=1):
+    """
+    Parses and validates a block of lines from a patient file.
+
+    lines: A list of lines, with or without trailing newlines.
+    firstLineNumber: The line number of lines[0] in the source file.
+    return: A ParsedChunk.
+    """
+    chunk = ParsedChunk()
+    chunk.lineCount = len(lines)
+    _parseInto(chunk, lines, firstLineNumber)
+    # Each validation stage reports its own rejects; put them back in file order.
+    chunk.rejects.sort()
+    return chunk
+
+
+def _parseInto(chunk, lines, firstLineNumber):
+    clock = instrumentation.StageClock('parser') if instrumentation.enabled else None
+    rejects = chunk.rejects
+    numbers = range(firstLineNumber, firstLineNumber + len(lines))
+    commas = list(map(_countCommas, lines))
+    if commas.count(FIELD_COUNT - 1) != len(lines):
+        keptLines, keptNumbers = [], []
+        for lineNumber, line, count in zip(numbers, lines, commas):
+            if count == FIELD_COUNT - 1:
+                keptLines.append(line)
+                keptNumbers.append(lineNumber)
+            elif not line.strip():
+                rejects.append((lineNumber, "blank line", ''))
+            elif not line.startswith('#'):
+                rejects.append((lineNumber, "invalid number of fields", line.strip()))
+        lines, numbers = keptLines, keptNumbers
+    if clock:
+        clock.lap('field count', chunk.lineCount)
+    if not lines:
+        return
+
+    # Every line has exactly FIELD_COUNT fields, so one split of the whole block
+    # gives a flat list from which each column is a strided slice. The newline
+    # stays on the last field of each line, which int() ignores.
+    fields = ','.join(lines).split(',')
+    if clock:
+        clock.lap('split', len(lines))
+    try:
+        values = [list(map(convert, fields[index::FIELD_COUNT]))
+                  for index, convert in enumerate(FIELD_TYPES)]
+    except ValueError:
+        # At least one bad value somewhere: convert row by row to find out which.
+        keptValues, keptLines, keptNumbers = [], [], []
+        for lineNumber, line in zip(numbers, lines):
+            try:
+                keptValues.append(_convertRow(line.strip().split(',')))
+            except ValueError:
+                rejects.append((lineNumber, "invalid data type", line.strip()))
+                continue
+            keptLines.append(line)
+            keptNumbers.append(lineNumber)
+        if not keptValues:
+            return
+        values = [list(column) for column in zip(*keptValues)]
+        lines, numbers = keptLines, keptNumbers
+    if clock:
+        clock.lap('convert', len(fields) // FIELD_COUNT)
+
+    bad = {}
+    for index, reason, low, high in (PATIENT_ID_RANGE,) + VITAL_RANGES:
+        column = values[index]
+        if _inRange(column, low, high):
+            continue
+        for position, value in enumerate(column):
+            if not low <= value <= high and position not in bad:
+                bad[position] = f"invalid {reason} value"
+    if bad:
+        for position in sorted(bad):
+            rejects.append((numbers[position], bad[position], lines[position].strip()))
+        keep = [position for position in range(len(numbers)) if position not in bad]
+        values = [[column[position] for position in keep] for column in values]
+    if clock:
+        clock.lap('range check', len(numbers))
+    if not values[0]:
+        return
+
+    dates = values[1]
+    ordinals = list(map(dateToOrdinal, dates))
+    rebuilt = list(map(ordinalToDate, ordinals))
+    if rebuilt != dates:
+        chunk.rawDates = {position: date for position, (date, iso) in enumerate(zip(dates, rebuilt))
+                          if date != iso}
+    if clock:
+        clock.lap('dates', len(dates))
+    chunk.patientIds.extend(values[0])
+    chunk.dates.extend(ordinals)
+    for (name, typecode), column in zip(COLUMNS[1:], values[2:]):
+        if typecode == 'B':
+            getattr(chunk, name).frombytes(bytes(column))
+        else:
+            getattr(chunk, name).extend(column)
+    if clock:
+        clock.lap('append', len(dates))
+
+
+def iterChunks(file, chunkBytes=DEFAULT_CHUNK_BYTES, firstLineNumber=1):
+    """
+    Reads an open patient file in blocks and parses each one.
+
+    file: A file object opened for reading text.
+    chunkBytes: Approximate number of bytes per block.
+    firstLineNumber: The line number of the first line read from file.
+    return: A generator of ParsedChunk objects, in file order.
+    """
+    lineNumber = firstLineNumber
+    while True:
+        lines = file.readlines(chunkBytes)
+        if not lines:
+            return
+        yield parseLines(lines, lineNumber)
+        lineNumber += len(lines)
+
+
+def readPatientsStreaming(fileName, store=None, rejectLog=None, chunkBytes=DEFAULT_CHUNK_BYTES):
+    """
+    Reads a patient file into a VisitStore, one block of lines at a time.
+
+    fileName: The name of the file to read patient data from.
+    store: The VisitStore to append to. A new one is created if None.
+    rejectLog: A RejectLog receiving the rejected lines. Rejects are only counted if None.
+    chunkBytes: Approximate number of bytes parsed at a time.
+    return: The VisitStore.
+    """
+    if store is None:
+        store = VisitStore()
+    if rejectLog is None:
+        rejectLog = RejectLog(keep=0)
+    with open(fileName, 'r') as file:
+        for chunk in iterChunks(file, chunkBytes):
+            if chunk.rejects:
+                rejectLog.extend(chunk.rejects)
+            if len(chunk):
+                store.extend(chunk)
+    return store
+
+
+def splitFile(fileName, shardBytes=DEFAULT_SHARD_BYTES):
+    """
+    Splits a file into byte ranges that start and end on line boundaries.
+
+    fileName: The name of the file to split.
+    shardBytes: The approximate size of each range.
+    return: A list of (start, end) byte offsets covering the whole file, in order.
+    """
+    size = os.path.getsize(fileName)
+    offsets = [0]
+    with open(fileName, 'rb') as file:
+        position = shardBytes
+        while position < size:
+            file.seek(position)
+            file.readline()
+            position = file.tell()
+            if position >= size:
+                break
+            offsets.append(position)
+            position += shardBytes
+    offsets.append(size)
+    return list(zip(offsets, offsets[1:]))
+
+
+def parseShard(fileName, start, end, chunkBytes=DEFAULT_CHUNK_BYTES):
+    """
+    Parses one byte range of a patient file.
+
+    Runs in a worker process. Line numbers in the result are relative to the
+    start of the range, counting from 1.
+
+    fileName: The name of the patient file.
+    start: Offset of the first byte of the range; must be at the start of a line.
+    end: Offset just past the last byte of the range; must be at the end of a line.
+    chunkBytes: Approximate number of bytes parsed at a time.
+    return: A ParsedChunk holding the whole range.
+    """
+    with open(fileName, 'rb') as file:
+        file.seek(start)
+        data = file.read(end - start)
+    # Decode with the same defaults as open(fileName, 'r') so lines split identically.
+    text = io.TextIOWrapper(io.BytesIO(data))
+    shard = ParsedChunk()
+    for chunk in iterChunks(text, chunkBytes):
+        shard.extend(chunk)
+    return shard
+
+
+def readPatientsParallel(fileName, store=None, rejectLog=None, workers=None,
+                         shardBytes=DEFAULT_SHARD_BYTES):
+    """
+    Reads a patient file into a VisitStore using a pool of worker processes.
+
+    The file is cut into newline-aligned shards that are parsed and validated in
+    parallel. Shards are merged strictly in file order, so the store and the
+    rejects are exactly what readPatientsStreaming produces. At most two shards
+    per worker are in flight at any time, which bounds memory during the merge.
+
+    fileName: The name of the file to read patient data from.
+    store: The VisitStore to append to. A new one is created if None.
+    rejectLog: A RejectLog receiving the rejected lines. Rejects are only counted if None.
+    workers: The number of worker processes; None or 0 for one per CPU. A negative
+             number raises ValueError.
+    shardBytes: Approximate number of bytes parsed by one task.
+    return: The VisitStore.
+    """
+    if workers is not None and workers < 0:
+        raise ValueError(f"the number of workers should not be negative, not {workers}")
+    if store is None:
+        store = VisitStore()
+    if rejectLog is None:
+        rejectLog = RejectLog(keep=0)
+    workers = workers or os.cpu_count() or 1
+    shards = splitFile(fileName, shardBytes)
+    if workers == 1 or len(shards) == 1:
+        return readPatientsStreaming(fileName, store, rejectLog)
+
+    linesBefore = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        remaining = iter(shards)
+
+        def submitNext():
+            nextShard = next(remaining, None)
+            if nextShard is not None:
+                pending.append(pool.submit(parseShard, fileName, *nextShard))
+
+        for _ in range(2 * workers):
+            submitNext()
+        while pending:
+            shard = pending.popleft().result()
+            submitNext()
+            for lineNumber, reason, line in shard.rejects:
+                rejectLog.add(linesBefore + lineNumber, reason, line)
+            if len(shard):
+                store.extend(shard)
+            linesBefore += shard.lineCount
+    return store
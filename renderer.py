@@ -0,0 +1,142 @@
+"""
+Buffered rendering of patient visits.
+
+Every visit is formatted by formatVisit, in the layout displayPatientData has
+always printed. Rendering works on an iterable of (patientId, visit) records:
+iterRender formats them lazily, renderTo joins them into one buffer per batch
+and writes each batch with a single call, and renderPage returns one page of
+text plus the cursor of the next page.
+"""
+import sys
+from itertools import islice
+
+from storage import StorageBackend
+from visit_store import VisitStore
+
+
+# Visits formatted into one buffer before it is written.
+DEFAULT_BATCH_SIZE = 2048
+
+VISIT_TEMPLATE = (" Visit Date: %s\n"
+                  "  Temperature: %.2f C\n"
+                  "  Heart Rate: %s bpm\n"
+                  "  Respiratory Rate: %s bpm\n"
+                  "  Systolic Blood Pressure: %s mmHg\n"
+                  "  Diastolic Blood Pressure: %s mmHg\n"
+                  "  Oxygen Saturation: %s %%\n")
+
+
+def formatVisit(visit):
+    """
+    Formats one visit.
+
+    visit: [date, temperature, heart rate, respiratory rate, systolic bp, diastolic bp, oxygen saturation]
+    return: The text of the visit, seven lines ending with a newline.
+    """
+    return VISIT_TEMPLATE % tuple(visit)
+
+
+def formatHeader(patientId):
+    """
+    Formats the line introducing the visits of a patient.
+
+    patientId: The ID of the patient.
+    """
+    return f"Patient ID: {patientId}\n"
+
+
+def patientRecords(patients, patientIds=None):
+    """
+    Lazily lists the visits of some or all patients.
+
+    patients: A dictionary of patient IDs, where each patient has a list of visits.
+    patientIds: The patients to list, or None for all of them.
+    return: A generator of (patientId, visit) records, patient by patient.
+    """
+    if isinstance(patients, StorageBackend):
+        yield from patients.records(patientIds)
+        return
+    if patientIds is None:
+        patientIds = iter(patients)
+    if isinstance(patients, VisitStore):
+        visit = patients.visit
+        for patientId in patientIds:
+            for row in patients.rows(patientId):
+                yield patientId, visit(row)
+    else:
+        for patientId in patientIds:
+            for visit in patients[patientId]:
+                yield patientId, visit
+
+
+def iterRender(records, grouped=True):
+    """
+    Lazily formats visit records.
+
+    records: An iterable of (patientId, visit).
+    grouped: If True the patient header is only written when the patient changes,
+             as in displayPatientData; otherwise every visit gets its own header.
+    return: A generator of strings, one per visit.
+    """
+    previous = object()
+    for patientId, visit in records:
+        if grouped and patientId == previous:
+            yield formatVisit(visit)
+        else:
+            yield formatHeader(patientId) + formatVisit(visit)
+        previous = patientId
+
+
+def renderTo(out, records, grouped=True, batchSize=DEFAULT_BATCH_SIZE):
+    """
+    Writes visit records to a stream, one write call per batch of visits.
+
+    out: A text stream, e.g. sys.stdout or an open file.
+    records: An iterable of (patientId, visit).
+    grouped: See iterRender.
+    batchSize: The number of visits per write.
+    return: The number of visits written.
+    """
+    texts = iterRender(records, grouped)
+    count = 0
+    while True:
+        batch = list(islice(texts, batchSize))
+        if not batch:
+            break
+        out.write(''.join(batch))
+        count += len(batch)
+    out.flush()
+    return count
+
+
+def renderPage(records, pageSize, cursor=0, grouped=True):
+    """
+    Formats one page of visit records.
+
+    Each page starts with a patient header, so pages can be shown on their own.
+
+    records: A sequence or iterable of (patientId, visit). Sequences are sliced
+             directly; other iterables are consumed up to the end of the page.
+    pageSize: The number of visits per page.
+    cursor: The position of the first visit of the page.
+    grouped: See iterRender.
+    return: (text of the page, cursor of the next page or None after the last page)
+    """
+    if hasattr(records, '__getitem__'):
+        page = records[cursor:cursor + pageSize + 1]
+    else:
+        page = list(islice(records, cursor, cursor + pageSize + 1))
+    nextCursor = cursor + pageSize if len(page) > pageSize else None
+    return ''.join(iterRender(page[:pageSize], grouped)), nextCursor
+
+
+def writeVisits(records, grouped=True, out=None):
+    """
+    Writes visit records to standard output in batches.
+
+    records: An iterable of (patientId, visit).
+    grouped: See iterRender.
+    out: The stream to write to instead of sys.stdout.
+    return: The number of visits written.
+    """
+    return renderTo(out if out is not None else sys.stdout, records, grouped)
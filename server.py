@@ -0,0 +1,657 @@
+"""
+Asyncio query service over one warm copy of the patient data.
+
+The server loads the patient file once and answers requests on a local TCP
+port or Unix socket. The protocol is line-delimited JSON; every request is
+one line:
+
+    {"id": 1, "op": "find-by-date", "args": {"year": 2018, "month": 6}}
+
+and gets one response line with the same id:
+
+    {"id": 1, "ok": true, "fields": ["patientId", "date", ...], "rows": [[...], ...]}
+    {"id": 2, "ok": true, "message": "Visit is saved successfully for Patient #7"}
+    {"id": 3, "ok": false, "error": "Patient with ID 9 not found."}
+
+Operations and their arguments (all optional unless marked):
+    display       patientId, offset, limit             displayPatientData
+    stats         patientId                            displayStats
+    find-by-date  year, month | start, end             findVisitsByDate / findVisitsInRange
+    follow-up                                          findPatientsWhoNeedFollowUp
+    add           patientId, date, temp, hr, rr, sbp, dbp, spo2 (all required)
+                                                       addPatientData
+    delete        patientId (required)                 deleteAllVisitsOfPatient
+    cache-stats                                        counters of the query cache
+
+Query results are cached (see cache.py) unless the server is started with
+--cache-entries 0; adds and deletes only drop the entries they could change.
+
+Reads run in a pool of threads (--read-threads), so a long one does not hold
+up the other connections. Writes are queued to a single writer task, which
+applies them in arrival order. The writer journals each batch of queued
+writes with one fsync, off the event loop, so reads keep being answered while
+it waits on the disk; it then waits for the reads in progress and applies the
+batch before new reads start. A write is acknowledged once it is on disk and
+visible to reads. display returns at most DISPLAY_LIMIT rows unless given a
+limit; when rows are left, the response has the offset of the next page in
+"next".
+
+    python server.py [--file patients.txt] [--host 127.0.0.1 --port 8765 | --socket PATH]
+
+QueryClient is the matching client. It keeps a pool of connections, so one
+client object can have as many requests in flight as it has connections.
+"""
+import argparse
+import asyncio
+import json
+import os
+import stat
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from itertools import islice
+
+import storage
+from cache import DEFAULT_MAX_ENTRIES, QueryCache
+from cli import STATS_FIELDS, VISIT_FIELDS
+from date_index import DateIndex
+from followup import FollowUpEngine
+from journal import openJournal
+from main import (checkVisit, findPatientsWhoNeedFollowUp, findVisitsByDate, findVisitsInRange,
+                  readPatientsFromFile, vitalSummaries)
+from renderer import patientRecords
+from visit_store import INVALID_DATE, VisitStore, dateToOrdinal
+from vital_stats import VITALS, VitalStats
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# Longest request or response line, in bytes.
+LINE_LIMIT = 1 << 26
+
+# Connections a QueryClient opens by default.
+DEFAULT_POOL_SIZE = 8
+
+# Threads answering reads by default.
+DEFAULT_READ_THREADS = 4
+
+# Rows a display request returns when it gives no limit.
+DISPLAY_LIMIT = 1000
+
+
+class RequestError(Exception):
+    """A request that cannot be answered; the message is sent back to the client."""
+
+
+def _intArg(args, name, required=False):
+    value = args.get(name)
+    if value is None:
+        if required:
+            raise RequestError(f"'{name}' is required.")
+        return None
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise RequestError(f"'{name}' should be an integer.")
+    return value
+
+
+def _countArg(args, name, default):
+    value = _intArg(args, name)
+    if value is None:
+        return default
+    if value < 0:
+        raise RequestError(f"'{name}' should not be negative.")
+    return value
+
+
+def _visitRows(records):
+    return [[patientId] + list(visit) for patientId, visit in records]
+
+
+def _display(patients, args):
+    patientId = _intArg(args, 'patientId')
+    offset = _countArg(args, 'offset', 0)
+    limit = _countArg(args, 'limit', DISPLAY_LIMIT)
+    if patientId:
+        if patientId not in patients:
+            raise RequestError(f"Patient with ID {patientId} not found.")
+        records = patientRecords(patients, [patientId])
+    else:
+        records = patientRecords(patients)
+    # One row past the page tells whether there is another one.
+    rows = _visitRows(islice(records, offset, offset + limit + 1))
+    if len(rows) > limit:
+        return VISIT_FIELDS, rows[:limit], {'next': offset + limit}
+    return VISIT_FIELDS, rows
+
+
+def _stats(patients, args):
+    patientId = _intArg(args, 'patientId') or 0
+    summaries = vitalSummaries(patients, patientId)
+    if not summaries:
+        raise RequestError("No patient data found." if patientId == 0 else f"Patient with ID {patientId} not found.")
+    return STATS_FIELDS, [[patientId, name] + list(summaries[name]) for name in VITALS]
+
+
+def _findByDate(patients, args):
+    start, end = args.get('start'), args.get('end')
+    if start is None and end is None:
+        return VISIT_FIELDS, _visitRows(findVisitsByDate(patients, _intArg(args, 'year'), _intArg(args, 'month')))
+    if not isinstance(start, str) or not isinstance(end, str) \
+            or dateToOrdinal(start) == INVALID_DATE or dateToOrdinal(end) == INVALID_DATE:
+        raise RequestError("Invalid date format. Please enter dates in the format 'yyyy-mm-dd'.")
+    return VISIT_FIELDS, _visitRows(findVisitsInRange(patients, start, end))
+
+
+def _followUp(patients, args):
+    return ('patientId',), [[patientId] for patientId in findPatientsWhoNeedFollowUp(patients)]
+
+
+def _cacheStats(patients, args):
+    cache = QueryCache.find(patients)
+    if cache is None:
+        raise RequestError("The query cache is disabled.")
+    counters = cache.counters()
+    return tuple(counters), [list(counters.values())]
+
+
+# op -> function(patients, args) returning (fields, rows), or (fields, rows, extra
+# members of the response).
+READS = {
+    'display': _display,
+    'stats': _stats,
+    'find-by-date': _findByDate,
+    'follow-up': _followUp,
+    'cache-stats': _cacheStats,
+}
+
+WRITES = ('add', 'delete')
+
+# Argument -> conversion of each value of an added visit, in addPatientData order.
+VISIT_ARGS = (('date', str), ('temp', float), ('hr', int), ('rr', int), ('sbp', int), ('dbp', int), ('spo2', int))
+
+
+def _checkAdd(args):
+    # Returns (patientId, visit) or raises RequestError, with addPatientData's messages.
+    try:
+        values = [convert(args[name]) for name, convert in VISIT_ARGS]
+    except KeyError as e:
+        raise RequestError(f"'{e.args[0]}' is required.")
+    except (TypeError, ValueError):
+        raise RequestError("Invalid input. Please enter valid data.")
+    patientId = args.get('patientId')
+    if isinstance(patientId, bool) or not isinstance(patientId, (int, str)):
+        raise RequestError("Invalid patient ID. Please enter a whole number.")
+    patientId, error = checkVisit(patientId, *values)
+    if error is not None:
+        raise RequestError(error)
+    return patientId, values
+
+
+class AccessGate:
+    """
+    Lets reads run together, or one write alone.
+
+    Reads run in threads while the event loop keeps going, so the writer waits
+    for the reads in progress before applying a change and holds new ones back
+    until it is done: no read sees half a batch, or caches a result the batch
+    makes stale. Only the writer task writes, so writes never wait for each other.
+    """
+
+    def __init__(self):
+        self._reads = 0
+        # set while no write is pending, and while no read is in progress
+        self._open = asyncio.Event()
+        self._open.set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def enterRead(self):
+        """Waits until no write is pending, then counts one more read in progress."""
+        while not self._open.is_set():
+            await self._open.wait()
+        self._reads += 1
+        self._idle.clear()
+
+    def leaveRead(self):
+        """Ends a read started with enterRead."""
+        self._reads -= 1
+        if not self._reads:
+            self._idle.set()
+
+    @asynccontextmanager
+    async def writing(self):
+        """Holds back new reads and waits for the ones in progress, for the duration of the block."""
+        self._open.clear()
+        try:
+            while self._reads:
+                await self._idle.wait()
+            yield
+        finally:
+            self._open.set()
+
+
+class Writer:
+    """
+    Applies add and delete requests one batch at a time, in arrival order.
+
+    patients: The VisitStore or storage.StorageBackend being served.
+    fileName: The patient file whose journal records the changes to a VisitStore.
+    gate: The AccessGate shared with the reads.
+    """
+
+    def __init__(self, patients, fileName, gate):
+        self.patients = patients
+        self.fileName = fileName
+        self.gate = gate
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    def start(self):
+        """Starts the writer task on the running event loop."""
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Cancels the writer task; queued requests are not applied."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def submit(self, op, args):
+        """
+        Queues a write.
+
+        op: 'add' or 'delete'.
+        args: The arguments of the request.
+        return: A future resolving to the status message, or raising RequestError.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((op, args, future))
+        return future
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._apply(batch)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(RequestError(f"Could not save the change: {e}"))
+
+    async def _apply(self, batch):
+        patients = self.patients
+        # Patients added or deleted by earlier writes of the batch, which are not applied yet.
+        present = {}
+        changes = []
+        for op, args, future in batch:
+            try:
+                if op == 'add':
+                    patientId, visit = _checkAdd(args)
+                    present[patientId] = True
+                    changes.append((future, 'add', patientId, visit))
+                else:
+                    patientId = _intArg(args, 'patientId', required=True)
+                    if not present.get(patientId, patientId in patients):
+                        raise RequestError(f"No data found for patient with ID {patientId}")
+                    present[patientId] = False
+                    changes.append((future, 'delete', patientId, None))
+            except RequestError as e:
+                future.set_exception(e)
+        if not changes:
+            return
+
+        # A StorageBackend makes every change durable itself, one at a time.
+        backend = isinstance(patients, storage.StorageBackend)
+        if not backend:
+            journal = openJournal(self.fileName)
+            for future, op, patientId, visit in changes:
+                if op == 'add':
+                    journal.logAdd(patientId, visit, sync=False)
+                else:
+                    journal.logDelete(patientId, sync=False)
+            # One fsync for the whole batch, waited for off the event loop.
+            await asyncio.get_running_loop().run_in_executor(None, journal.flush)
+
+        async with self.gate.writing():
+            for position, (future, op, patientId, visit) in enumerate(changes):
+                try:
+                    if op == 'add' and backend:
+                        patients.addVisit(patientId, visit)
+                    elif op == 'add':
+                        patients.append(patientId, visit)
+                    else:
+                        patients.deletePatient(patientId)
+                except Exception as e:
+                    # The changes before this one are saved and acknowledged; only the rest fail.
+                    for pending, _, _, _ in changes[position:]:
+                        if not pending.done():
+                            pending.set_exception(RequestError(f"Could not save the change: {e}"))
+                    return
+                if not future.done():
+                    future.set_result(f"Visit is saved successfully for Patient #{patientId}" if op == 'add'
+                                      else f"Data for patient {patientId} has been deleted.")
+
+
+class QueryServer:
+    """
+    Serves the patient data loaded from one file.
+
+    patients: The VisitStore or storage.StorageBackend to serve.
+    fileName: The patient file it was loaded from.
+    readThreads: The number of threads answering reads.
+    """
+
+    def __init__(self, patients, fileName, readThreads=DEFAULT_READ_THREADS):
+        if not isinstance(patients, (VisitStore, storage.StorageBackend)):
+            raise TypeError("the server needs a VisitStore or a StorageBackend")
+        if isinstance(patients, VisitStore):
+            # Build the indexes the reads use now, so the read threads only ever query them.
+            DateIndex.forStore(patients)
+            FollowUpEngine.forStore(patients)
+            VitalStats.forStore(patients)
+        self.patients = patients
+        self.fileName = fileName
+        self.gate = AccessGate()
+        self.writer = Writer(patients, fileName, self.gate)
+        self._readers = ThreadPoolExecutor(max_workers=readThreads, thread_name_prefix='read')
+        self._server = None
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT, path=None):
+        """
+        Starts listening.
+
+        host, port: The TCP address to listen on, used when path is None.
+        path: A Unix socket to listen on instead.
+        """
+        self.writer.start()
+        if path is not None:
+            self._server = await asyncio.start_unix_server(self._serve, path=path, limit=LINE_LIMIT)
+        else:
+            self._server = await asyncio.start_server(self._serve, host, port, limit=LINE_LIMIT)
+        return self
+
+    @property
+    def sockets(self):
+        """The listening sockets."""
+        return self._server.sockets
+
+    async def serveForever(self):
+        """Serves until cancelled."""
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        """Stops listening, stops the writer and lets the read threads finish."""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        await self.writer.stop()
+        await asyncio.get_running_loop().run_in_executor(None, self._readers.shutdown)
+
+    async def _read(self, op, args):
+        # Runs one read in the read threads, between writes.
+        await self.gate.enterRead()
+        future = asyncio.get_running_loop().run_in_executor(self._readers, READS[op], self.patients, args)
+        # The read ends when its thread is done, even if the request is cancelled first.
+        future.add_done_callback(lambda _: self.gate.leaveRead())
+        return await asyncio.shield(future)
+
+    async def handle(self, request):
+        """
+        Answers one decoded request.
+
+        request: The request object.
+        return: The response object.
+        """
+        requestId = request.get('id') if isinstance(request, dict) else None
+        try:
+            if not isinstance(request, dict):
+                raise RequestError("A request should be a JSON object.")
+            op = request.get('op')
+            args = request.get('args') or {}
+            if not isinstance(args, dict):
+                raise RequestError("'args' should be a JSON object.")
+            if op in READS:
+                fields, rows, *extra = await self._read(op, args)
+                response = {'id': requestId, 'ok': True, 'fields': fields, 'rows': rows}
+                for members in extra:
+                    response.update(members)
+                return response
+            if op in WRITES:
+                message = await self.writer.submit(op, args)
+                return {'id': requestId, 'ok': True, 'message': message}
+            raise RequestError(f"Unknown operation {op!r}.")
+        except RequestError as e:
+            return {'id': requestId, 'ok': False, 'error': str(e)}
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (asyncio.LimitOverrunError, ValueError):
+                    writer.write(b'{"id": null, "ok": false, "error": "Request too long."}\n')
+                    break
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    response = {'id': None, 'ok': False, 'error': "Invalid JSON."}
+                else:
+                    response = await self.handle(request)
+                writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+class ServerError(Exception):
+    """An error reported by the server for one request."""
+
+
+class QueryClient:
+    """
+    Client of a QueryServer with a pool of connections.
+
+    Connections are opened on demand, up to poolSize, and reused. Each one
+    carries one request at a time, so up to poolSize requests are in flight.
+
+    host, port: The TCP address of the server, used when path is None.
+    path: The Unix socket of the server.
+    poolSize: The largest number of open connections.
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, path=None, poolSize=DEFAULT_POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.poolSize = poolSize
+        self._idle = []
+        self._opened = 0
+        self._available = None
+        self._nextId = 0
+
+    async def _connect(self):
+        if self.path is not None:
+            return await asyncio.open_unix_connection(self.path, limit=LINE_LIMIT)
+        return await asyncio.open_connection(self.host, self.port, limit=LINE_LIMIT)
+
+    async def _acquire(self):
+        if self._available is None:
+            self._available = asyncio.Semaphore(self.poolSize)
+        await self._available.acquire()
+        if self._idle:
+            return self._idle.pop()
+        try:
+            connection = await self._connect()
+        except BaseException:
+            self._available.release()
+            raise
+        self._opened += 1
+        return connection
+
+    def _release(self, connection, reusable):
+        if reusable:
+            self._idle.append(connection)
+        else:
+            self._opened -= 1
+            connection[1].close()
+        self._available.release()
+
+    async def request(self, op, **args):
+        """
+        Sends one request and waits for its response.
+
+        op: The operation, e.g. 'find-by-date'.
+        args: The arguments of the operation.
+        return: The response object; raises ServerError if the server reports an error.
+        """
+        self._nextId += 1
+        requestId = self._nextId
+        connection = await self._acquire()
+        reader, writer = connection
+        reusable = False
+        try:
+            writer.write(json.dumps({'id': requestId, 'op': op, 'args': args}).encode('utf-8') + b'\n')
+            await writer.drain()
+            line = await reader.readline()
+            if not line:
+                raise ConnectionError("the server closed the connection")
+            response = json.loads(line)
+            reusable = True
+        finally:
+            self._release(connection, reusable)
+        if not response.get('ok'):
+            raise ServerError(response.get('error'))
+        return response
+
+    async def display(self, patientId=0, offset=0, limit=None):
+        """
+        Returns the visit rows of one or all patients.
+
+        offset: The number of rows to skip.
+        limit: The largest number of rows to return, or None for all of them, which
+               are fetched one page of DISPLAY_LIMIT rows at a time.
+        """
+        if limit is not None:
+            return (await self.request('display', patientId=patientId, offset=offset, limit=limit))['rows']
+        rows = []
+        while offset is not None:
+            response = await self.request('display', patientId=patientId, offset=offset)
+            rows.extend(response['rows'])
+            offset = response.get('next')
+        return rows
+
+    async def stats(self, patientId=0):
+        """Returns the statistic rows of one or all patients."""
+        return (await self.request('stats', patientId=patientId))['rows']
+
+    async def findVisitsByDate(self, year=None, month=None):
+        """Returns the visit rows of a year, a month or both."""
+        return (await self.request('find-by-date', year=year, month=month))['rows']
+
+    async def findVisitsInRange(self, start, end):
+        """Returns the visit rows between two 'yyyy-mm-dd' dates, both included."""
+        return (await self.request('find-by-date', start=start, end=end))['rows']
+
+    async def followUp(self):
+        """Returns the IDs of the patients who need a follow-up visit."""
+        return [row[0] for row in (await self.request('follow-up'))['rows']]
+
+    async def add(self, patientId, date, temp, hr, rr, sbp, dbp, spo2):
+        """Records a visit and returns the server's message."""
+        return (await self.request('add', patientId=patientId, date=date, temp=temp, hr=hr, rr=rr,
+                                   sbp=sbp, dbp=dbp, spo2=spo2))['message']
+
+    async def delete(self, patientId):
+        """Deletes all visits of a patient and returns the server's message."""
+        return (await self.request('delete', patientId=patientId))['message']
+
+    async def cacheStats(self):
+        """Returns the counters of the server's query cache."""
+        response = await self.request('cache-stats')
+        return dict(zip(response['fields'], response['rows'][0]))
+
+    async def close(self):
+        """Closes every idle connection."""
+        idle, self._idle = self._idle, []
+        for reader, writer in idle:
+            writer.close()
+            self._opened -= 1
+        for reader, writer in idle:
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+async def serve(fileName, host=DEFAULT_HOST, port=DEFAULT_PORT, path=None, workers=None, useSnapshot=True,
+                cacheEntries=DEFAULT_MAX_ENTRIES, cacheTtl=None, readThreads=DEFAULT_READ_THREADS):
+    """
+    Loads a patient file and serves it until cancelled.
+
+    The arguments are those of the command line.
+    """
+    # The cache is registered here, with the server's settings.
+    patients = readPatientsFromFile(fileName, workers=workers, useSnapshot=useSnapshot, cacheEntries=0)
+    if cacheEntries:
+        QueryCache.forStore(patients, cacheEntries, cacheTtl)
+    server = await QueryServer(patients, fileName, readThreads).start(host, port, path)
+    where = path if path is not None else '%s:%d' % server.sockets[0].getsockname()[:2]
+    print(f"Serving {len(patients)} patient(s) from '{fileName}' on {where}", flush=True)
+    try:
+        await server.serveForever()
+    finally:
+        await server.close()
+        if isinstance(patients, storage.StorageBackend):
+            patients.close()
+
+
+def main(argv=None):
+    """
+    Runs the server from the command line.
+
+    argv: The arguments, without the program name; defaults to sys.argv[1:].
+    return: The exit status.
+    """
+    parser = argparse.ArgumentParser(prog='server.py', description="Serve the patient data to many clients.")
+    parser.add_argument('--file', dest='fileName', default='patients.txt', help="the patient file (default: %(default)s)")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--socket', dest='path', help="listen on this Unix socket instead of TCP")
+    parser.add_argument('--workers', type=int,
+                        help="processes parsing the file when it has no up-to-date snapshot (default: 1), or "
+                             "holding the shards of a dataset directory (default: one per shard, up to one "
+                             "per CPU); 0: one per CPU")
+    parser.add_argument('--no-snapshot', dest='useSnapshot', action='store_false',
+                        help="always parse the text file instead of opening its snapshot")
+    parser.add_argument('--cache-entries', type=int, default=DEFAULT_MAX_ENTRIES,
+                        help="query results kept in the cache, 0 to disable it (default: %(default)s)")
+    parser.add_argument('--cache-ttl', type=float, help="seconds after which a cached result is recomputed")
+    parser.add_argument('--read-threads', dest='readThreads', type=int, default=DEFAULT_READ_THREADS,
+                        help="threads answering reads (default: %(default)s)")
+    args = parser.parse_args(argv)
+    if args.workers is not None and args.workers < 0:
+        parser.error("--workers should not be negative")
+    if args.path is not None and os.path.exists(args.path) and stat.S_ISSOCK(os.stat(args.path).st_mode):
+        # left behind by a previous server
+        os.remove(args.path)
+    try:
+        asyncio.run(serve(args.fileName, args.host, args.port, args.path, args.workers, args.useSnapshot,
+                          args.cache_entries, args.cache_ttl, args.readThreads))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,392 @@
+"""
+Patient data split over several patients.txt files, queried in parallel.
+
+A sharded dataset is a directory holding one patient file per shard and a
+manifest, shards.json:
+
+    {"scheme": "hash", "shards": ["shard-000.txt", "shard-001.txt", ...]}
+    {"scheme": "site", "shards": ["north.txt", "south.txt"], "default": 0}
+
+With the hash scheme a patient lives in shard patientId % number of shards.
+With the site scheme a patient lives in whichever site file has them, and new
+patients go to the shard numbered "default". Each shard is an ordinary
+patient file, with its own journal and snapshot.
+
+ShardedDataset is a storage.StorageBackend, so readPatientsFromFile returns
+one for a dataset directory and every main.py function accepts it. Every
+shard is loaded, and stays loaded, in one of a fixed set of worker processes
+(shard i in process i % workers). Queries go out to every shard at once and
+the answers are merged: visit lists by date (shard order breaks ties),
+follow-up lists in shard order, and statistics through the running sums of
+each shard (vital_stats.Aggregate), so the figures are those of one big file.
+
+Adds and deletes are written by this process to the journal of the shard that
+owns the patient only; the worker holding that shard applies the new journal
+records before its next query. This relies on one process writing the
+dataset at a time. A bulk import is atomic per shard, not across shards.
+
+Split an existing file by patient ID hash, or describe a set of site files:
+
+    python shards.py split patients.txt dataset/ --shards 8
+    python shards.py sites dataset/ north.txt south.txt
+"""
+import argparse
+import heapq
+import io
+import json
+import math
+import os
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+
+from date_index import DateIndex
+from followup import DEFAULT_RULES
+from journal import applyRecords, journalPath, openJournal, readJournal, visitLine
+from patient_parser import RejectLog
+from storage import StorageBackend
+from visit_store import INVALID_DATE, VisitStore, dateToOrdinal
+from vital_stats import Aggregate, VitalStats
+
+
+MANIFEST = 'shards.json'
+SCHEMES = ('hash', 'site')
+
+
+def isDataset(fileName):
+    """
+    Tells whether a patient file name refers to a sharded dataset directory.
+
+    fileName: The name of the patient file or directory.
+    """
+    return os.path.isfile(os.path.join(fileName, MANIFEST))
+
+
+def writeManifest(directory, shardNames, scheme='hash', default=0):
+    """
+    Writes the manifest of a dataset.
+
+    directory: The dataset directory.
+    shardNames: The names of the shard files, relative to the directory.
+    scheme: 'hash' or 'site'.
+    default: With the site scheme, the shard receiving new patients.
+    """
+    if scheme not in SCHEMES:
+        raise ValueError(f"unknown sharding scheme {scheme!r}")
+    if not shardNames or not 0 <= default < len(shardNames):
+        raise ValueError("a dataset needs at least one shard, and default must be one of them")
+    temporary = os.path.join(directory, MANIFEST + '.tmp')
+    with open(temporary, 'w') as f:
+        json.dump({'scheme': scheme, 'shards': list(shardNames), 'default': default}, f, indent=2)
+        f.write('\n')
+    os.replace(temporary, os.path.join(directory, MANIFEST))
+
+
+def readManifest(directory):
+    """
+    Reads the manifest of a dataset.
+
+    return: (scheme, list of shard file names with the directory, default shard)
+    """
+    with open(os.path.join(directory, MANIFEST), 'r') as f:
+        manifest = json.load(f)
+    scheme = manifest.get('scheme', 'hash')
+    if scheme not in SCHEMES:
+        raise ValueError(f"unknown sharding scheme {scheme!r} in {os.path.join(directory, MANIFEST)}")
+    return scheme, [os.path.join(directory, name) for name in manifest['shards']], manifest.get('default', 0)
+
+
+def splitFile(fileName, directory, numShards):
+    """
+    Creates a hash-sharded dataset from a patient file and its journal.
+
+    fileName: The patient text file.
+    directory: The dataset directory, created if needed.
+    numShards: The number of shards.
+    return: The number of invalid lines left out, which readPatientsFromFile also prints.
+    """
+    import main  # main.py opens datasets through this module
+
+    rejectLog = RejectLog(keep=0)
+    patients = main.readPatientsFromFile(fileName, rejectLog, useSnapshot=False, cacheEntries=0)
+    os.makedirs(directory, exist_ok=True)
+    names = [f'shard-{index:03}.txt' for index in range(numShards)]
+    files = [open(os.path.join(directory, name), 'w') for name in names]
+    try:
+        for patientId in patients:
+            files[patientId % numShards].writelines(visitLine(patientId, visit) + '\n'
+                                                    for visit in patients[patientId])
+    finally:
+        for file in files:
+            file.close()
+    writeManifest(directory, names, 'hash')
+    return rejectLog.count
+
+
+# The shards loaded by a worker process: fileName -> [VisitStore, shard file
+# (size, mtime), journal (size, mtime), journal id, journal records applied].
+_shards = {}
+
+
+def _fileStamp(fileName):
+    try:
+        stat = os.stat(fileName)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _shardStore(fileName):
+    # The store of a shard in this worker, brought up to date with its journal.
+    entry = _shards.get(fileName)
+    stamp = _fileStamp(fileName)
+    journalStamp = _fileStamp(journalPath(fileName))
+    if entry is not None and entry[1] == stamp:
+        if entry[2] == journalStamp:
+            return entry[0]
+        journalId, records = readJournal(journalPath(fileName))
+        # A journal created since the shard was loaded only holds new records.
+        if entry[3] in (None, journalId) and entry[4] <= len(records):
+            applyRecords(records[entry[4]:], entry[0])
+            entry[2:] = journalStamp, journalId, len(records)
+            return entry[0]
+    # First use, or the journal was compacted into a new shard file.
+    import main  # main.py opens datasets through this module
+
+    rejectLog = RejectLog(keep=0)
+    with redirect_stdout(io.StringIO()):
+        store = main.readPatientsFromFile(fileName, rejectLog, useSnapshot=True, cacheEntries=0)
+    store.rejected = rejectLog.count
+    journalStamp = _fileStamp(journalPath(fileName))
+    journalId, records = readJournal(journalPath(fileName))
+    _shards[fileName] = [store, _fileStamp(fileName), journalStamp, journalId, len(records)]
+    return store
+
+
+def _records(store, rows):
+    patientIds = store.patientIds
+    return [(patientIds[row], store.visit(row)) for row in rows]
+
+
+def _shardTask(fileName, operation, args):
+    # Runs one operation on one shard in a worker process.
+    store = _shardStore(fileName)
+    if operation == 'load':
+        return len(store), store.visitCount, getattr(store, 'rejected', 0)
+    if operation == 'count':
+        return len(store)
+    if operation == 'patientIds':
+        return list(store)
+    if operation == 'contains':
+        return args[0] in store
+    if operation == 'patient':
+        return store.get(args[0])
+    if operation == 'records':
+        return [(patientId, store.visit(row)) for patientId in store for row in store.rows(patientId)]
+    if operation == 'between':
+        return _records(store, DateIndex.forStore(store).rowsBetween(*args))
+    if operation == 'yearMonth':
+        return _records(store, DateIndex.forStore(store).rowsByYearMonth(*args))
+    if operation == 'followUp':
+        import main  # main.py opens datasets through this module
+        return main.findPatientsWhoNeedFollowUp(store, args[0])
+    if operation == 'aggregate':
+        return VitalStats.forStore(store).aggregate(args[0])
+    raise ValueError(f"unknown shard operation {operation!r}")
+
+
+def _shutDown(executors):
+    for executor in executors:
+        executor.shutdown()
+
+
+def _dateKey(record):
+    # Sort key of a (patientId, visit) record: its date, with unreal dates last.
+    ordinal = dateToOrdinal(record[1][0])
+    return math.inf if ordinal == INVALID_DATE else ordinal
+
+
+class ShardedDataset(StorageBackend):
+    """
+    A sharded dataset directory, each shard loaded in a worker process.
+
+    directory: The dataset directory; see the module documentation for its layout.
+    workers: The number of worker processes, at most one per shard; None or 0 for one per
+             shard, up to one per CPU. A negative number raises ValueError.
+    """
+
+    def __init__(self, directory, workers=None):
+        super().__init__()
+        self.directory = directory
+        if workers is not None and workers < 0:
+            raise ValueError(f"the number of workers should not be negative, not {workers}")
+        self.scheme, self.files, self._default = readManifest(directory)
+        workers = min(workers or os.cpu_count() or 1, len(self.files))
+        self._executors = [ProcessPoolExecutor(max_workers=1) for _ in range(workers)]
+        # Shut the workers down when the dataset is dropped; executors left to the
+        # interpreter's exit can fail to wake their closed management threads.
+        self._finalizer = weakref.finalize(self, _shutDown, self._executors)
+        loaded = self._fanOut('load')
+        self.visitCount = sum(visits for _, visits, _ in loaded)
+        self.rejected = sum(rejected for _, _, rejected in loaded)
+
+    def _submit(self, shard, operation, *args):
+        executor = self._executors[shard % len(self._executors)]
+        return executor.submit(_shardTask, self.files[shard], operation, args)
+
+    def _call(self, shard, operation, *args):
+        return self._submit(shard, operation, *args).result()
+
+    def _fanOut(self, operation, *args):
+        # Runs an operation on every shard at once; the answers in shard order.
+        futures = [self._submit(shard, operation, *args) for shard in range(len(self.files))]
+        return [future.result() for future in futures]
+
+    def _owners(self, patientId):
+        # The shards that may hold a patient.
+        if self.scheme == 'hash':
+            return [patientId % len(self.files)]
+        return [shard for shard, found in enumerate(self._fanOut('contains', patientId)) if found]
+
+    def shardOf(self, patientId):
+        """
+        Returns the shard that holds, or would receive, the visits of a patient.
+
+        patientId: The ID of the patient.
+        """
+        owners = self._owners(patientId)
+        return owners[0] if owners else self._default
+
+    def __repr__(self):
+        return f"<ShardedDataset {self.directory!r} shards={len(self.files)} visits={self.visitCount}>"
+
+    def __getitem__(self, patientId):
+        visits = []
+        for shard in self._owners(patientId):
+            visits.extend(self._call(shard, 'patient', patientId) or ())
+        if not visits:
+            raise KeyError(patientId)
+        return visits
+
+    def __contains__(self, patientId):
+        if not isinstance(patientId, int):
+            return False
+        return any(self._call(shard, 'contains', patientId) for shard in self._owners(patientId))
+
+    def __iter__(self):
+        seen = set() if self.scheme == 'site' else None
+        for patientIds in self._fanOut('patientIds'):
+            for patientId in patientIds:
+                if seen is None:
+                    yield patientId
+                elif patientId not in seen:
+                    seen.add(patientId)
+                    yield patientId
+
+    def __len__(self):
+        if self.scheme == 'site':
+            return sum(1 for _ in self)
+        return sum(self._fanOut('count'))
+
+    def records(self, patientIds=None):
+        if patientIds is not None:
+            return ((patientId, visit) for patientId in patientIds for visit in self.get(patientId, ()))
+        return self._allRecords()
+
+    def _allRecords(self):
+        # One shard at a time, fetching the next one while this one is consumed.
+        pending = self._submit(0, 'records') if self.files else None
+        for shard in range(len(self.files)):
+            records = pending.result()
+            pending = self._submit(shard + 1, 'records') if shard + 1 < len(self.files) else None
+            yield from records
+
+    def visitsBetween(self, startOrdinal, endOrdinal):
+        return list(heapq.merge(*self._fanOut('between', startOrdinal, endOrdinal), key=_dateKey))
+
+    def visitsByYearMonth(self, year=None, month=None):
+        # Shard by shard, the order in which the dataset lists its patients.
+        return [record for found in self._fanOut('yearMonth', year, month) for record in found]
+
+    def followUpPatients(self, rules=DEFAULT_RULES):
+        patientIds = []
+        for found in self._fanOut('followUp', list(rules)):
+            patientIds.extend(found)
+        return list(dict.fromkeys(patientIds))
+
+    def summaries(self, patientId=0):
+        if patientId == 0:
+            parts = self._fanOut('aggregate', 0)
+        else:
+            parts = [self._call(shard, 'aggregate', patientId) for shard in self._owners(patientId)]
+        total = Aggregate()
+        for part in parts:
+            total.merge(part)
+        return total.summaries()
+
+    def addVisit(self, patientId, visit):
+        openJournal(self.files[self.shardOf(patientId)]).logAdd(patientId, visit)
+        self.visitCount += 1
+        for listener in self._listeners:
+            listener.visitsStored(self, [(patientId, visit)])
+
+    def extend(self, chunk):
+        batch = VisitStore()
+        batch.extend(chunk)
+        lines = {}
+        records = []
+        for patientId in batch:
+            visits = batch[patientId]
+            lines.setdefault(self.shardOf(patientId), []).extend(visitLine(patientId, visit) for visit in visits)
+            records.extend((patientId, visit) for visit in visits)
+        for shard, shardLines in sorted(lines.items()):
+            openJournal(self.files[shard]).logAddBatch(shardLines)
+        self.visitCount += len(records)
+        for listener in self._listeners:
+            listener.visitsStored(self, records)
+
+    def deletePatient(self, patientId):
+        owners = self._owners(patientId)
+        dates = []
+        for shard in owners:
+            visits = self._call(shard, 'patient', patientId)
+            if visits:
+                dates.extend(visit[0] for visit in visits)
+                openJournal(self.files[shard]).logDelete(patientId)
+        if dates:
+            self.visitCount -= len(dates)
+            for listener in self._listeners:
+                listener.patientRemoved(self, patientId, dates)
+        return len(dates)
+
+    def close(self):
+        self._finalizer()
+
+
+def _main():
+    parser = argparse.ArgumentParser(prog='shards.py', description="Create a sharded patient dataset.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    split = commands.add_parser('split', help="split a patient file by patient ID hash")
+    split.add_argument('fileName', help="the patient file")
+    split.add_argument('directory', help="the dataset directory to create")
+    split.add_argument('--shards', type=int, default=4, help="the number of shards (default: %(default)s)")
+    sites = commands.add_parser('sites', help="make a dataset of one patient file per site")
+    sites.add_argument('directory', help="the dataset directory, holding the site files")
+    sites.add_argument('shardNames', nargs='+', metavar='file', help="the site files, relative to the directory")
+    sites.add_argument('--default', type=int, default=0, help="the site receiving new patients (default: first)")
+    args = parser.parse_args()
+    if args.command == 'split':
+        if args.shards < 1:
+            parser.error("--shards should be at least 1")
+        splitFile(args.fileName, args.directory, args.shards)
+        print(f"Split '{args.fileName}' into {args.shards} shard(s) in '{args.directory}'.")
+    else:
+        try:
+            writeManifest(args.directory, args.shardNames, 'site', args.default)
+        except ValueError as e:
+            parser.error(str(e))
+        print(f"Wrote the manifest of {len(args.shardNames)} site(s) in '{args.directory}'.")
+
+
+if __name__ == '__main__':
+    _main()
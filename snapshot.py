@@ -0,0 +1,182 @@
+"""
+Binary snapshots of a VisitStore, opened with mmap.
+
+After patients.txt has been parsed once, the store is written next to it as
+a snapshot. Later starts map the snapshot into memory and hand its columns to
+a VisitStore as memoryviews, so nothing is parsed or copied until the data is
+modified. A snapshot remembers the size and modification time of the text file
+it was built from and is ignored as soon as either changes.
+
+Layout (little-endian, every section starts on an 8-byte boundary):
+    header          HEADER struct, see below
+    patient table   int64 patient IDs, uint32 first rows, uint32 visit counts
+    visit records   one fixed-width record per visit, stored column by column:
+                    int64 patient ID, int32 date ordinal, float32 temperature,
+                    uint16 heart rate, uint8 respiratory rate, uint16 systolic
+                    and diastolic bp, uint8 oxygen saturation
+    raw dates       UTF-8 JSON object {row: date text} for non-canonical dates
+Visits are grouped by patient, so patient i owns rows [first, first + count).
+"""
+import json
+import mmap
+import os
+import sys
+import zlib
+from array import array
+from struct import Struct
+
+from visit_store import COLUMNS, VisitStore
+
+
+MAGIC = b'EHRSNAP\x00'
+# 2: heart rate and blood pressures are uint16 (uint8 in 1)
+VERSION = 2
+
+# magic, version, source size, source mtime (ns), visits, patients,
+# raw dates bytes, body crc32, header crc32 (of everything before it)
+HEADER = Struct('<8sIqqqqqII')
+
+
+def snapshotPath(fileName):
+    """
+    Returns the name of the snapshot kept for a patient file.
+
+    fileName: The name of the patient text file.
+    """
+    return fileName + '.snap'
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def _sections(visitCount, patientCount):
+    """Yields (name, typecode, count) for every array section after the header, in file order."""
+    yield 'tablePatientIds', 'q', patientCount
+    yield 'tableFirstRows', 'I', patientCount
+    yield 'tableCounts', 'I', patientCount
+    yield 'patientIds', 'q', visitCount
+    for name, typecode in COLUMNS:
+        yield name, typecode, visitCount
+
+
+def _layout(visitCount, patientCount):
+    """Returns ({name: (offset, typecode, count)}, offset of the raw dates section)."""
+    offsets = {}
+    offset = _align(HEADER.size)
+    for name, typecode, count in _sections(visitCount, patientCount):
+        offsets[name] = (offset, typecode, count)
+        offset = _align(offset + array(typecode).itemsize * count)
+    return offsets, offset
+
+
+def writeSnapshot(store, snapshotName, sourceStat):
+    """
+    Writes a snapshot of a store.
+
+    The file is written under a temporary name and renamed into place, so
+    readers never see a half-written snapshot.
+
+    store: The VisitStore to save.
+    snapshotName: The name of the snapshot file.
+    sourceStat: os.stat() of the text file the store was read from, taken before reading it.
+    """
+    patientIds = array('q')
+    firstRows = array('I')
+    counts = array('I')
+    order = array('I')
+    for patientId in store:
+        rows = store.rows(patientId)
+        patientIds.append(patientId)
+        firstRows.append(len(order))
+        counts.append(len(rows))
+        order.extend(rows)
+
+    arrays = {'tablePatientIds': patientIds, 'tableFirstRows': firstRows, 'tableCounts': counts,
+              'patientIds': array('q', map(store.patientIds.__getitem__, order))}
+    for name, typecode in COLUMNS:
+        arrays[name] = array(typecode, map(getattr(store, name).__getitem__, order))
+    newRows = {row: position for position, row in enumerate(order)} if store._rawDates else {}
+    rawDates = json.dumps({newRows[row]: date for row, date in store._rawDates.items()
+                           if row in newRows}).encode('utf-8')
+
+    offsets, rawDatesOffset = _layout(len(order), len(patientIds))
+    body = bytearray(rawDatesOffset - HEADER.size)
+    for name, (offset, _, _) in offsets.items():
+        column = arrays[name]
+        if sys.byteorder != 'little':
+            column.byteswap()
+        data = column.tobytes()
+        start = offset - HEADER.size
+        body[start:start + len(data)] = data
+    body += rawDates
+    bodyCrc = zlib.crc32(body)
+    fields = (MAGIC, VERSION, sourceStat.st_size, sourceStat.st_mtime_ns,
+              len(order), len(patientIds), len(rawDates), bodyCrc)
+    header = HEADER.pack(*fields, 0)
+    header = HEADER.pack(*fields, zlib.crc32(header[:HEADER.size - 4]))
+
+    temporary = snapshotName + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(header)
+        f.write(body)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, snapshotName)
+
+
+def loadSnapshot(snapshotName, sourceName, verify=False):
+    """
+    Opens a snapshot as a VisitStore without parsing or copying the visits.
+
+    snapshotName: The name of the snapshot file.
+    sourceName: The name of the text file the snapshot was built from.
+    verify: Also check the CRC of the whole body (reads every byte).
+    return: A VisitStore backed by the mapped file, or None if the snapshot is
+            missing, corrupt, of another version or older than sourceName.
+    """
+    try:
+        sourceStat = os.stat(sourceName)
+        with open(snapshotName, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if len(mapped) < HEADER.size:
+        return None
+    (magic, version, sourceSize, sourceMtime, visitCount, patientCount,
+     rawDatesBytes, bodyCrc, headerCrc) = HEADER.unpack_from(mapped)
+    if (magic != MAGIC or version != VERSION
+            or headerCrc != zlib.crc32(mapped[:HEADER.size - 4])):
+        return None
+    if sourceSize != sourceStat.st_size or sourceMtime != sourceStat.st_mtime_ns:
+        return None
+    offsets, rawDatesOffset = _layout(visitCount, patientCount)
+    if len(mapped) != rawDatesOffset + rawDatesBytes:
+        return None
+    view = memoryview(mapped)
+    if verify and zlib.crc32(view[HEADER.size:]) != bodyCrc:
+        return None
+
+    columns = {}
+    for name, (offset, typecode, count) in offsets.items():
+        size = array(typecode).itemsize * count
+        if sys.byteorder == 'little':
+            columns[name] = view[offset:offset + size].cast(typecode)
+        else:
+            column = array(typecode)
+            column.frombytes(view[offset:offset + size])
+            column.byteswap()
+            columns[name] = column
+    rawDates = json.loads(bytes(view[rawDatesOffset:]).decode('utf-8'))
+
+    store = VisitStore()
+    store.patientIds = columns['patientIds']
+    for name, _ in COLUMNS:
+        setattr(store, name, columns[name])
+    store._live = bytearray(b'\x01') * visitCount
+    store._rawDates = {int(row): date for row, date in rawDates.items()}
+    firstRows = columns['tableFirstRows']
+    store._patientRows = dict(zip(columns['tablePatientIds'],
+                                  map(range, firstRows, map(int.__add__, firstRows, columns['tableCounts']))))
+    store._mapped = mapped
+    return store
@@ -0,0 +1,499 @@
+"""
+Storage backends that answer queries without loading every visit into memory.
+
+A StorageBackend behaves like the dictionary returned by readPatientsFromFile
+(patient ID -> list of visits), so every function in main.py accepts one, and
+it also answers the common queries itself: visits of a date range, the
+patients who need follow-up and vital sign statistics.
+
+SqliteBackend keeps the visits in a local SQLite database:
+
+    patients(seq INTEGER PRIMARY KEY, patient_id INTEGER UNIQUE)
+        one row per patient, seq giving the order patients were first seen
+    visits(id INTEGER PRIMARY KEY, patient_id, date_ordinal, raw_date,
+           temperature, heart_rate, respiratory_rate, sbp, dbp, spo2)
+        indexed on patient_id and on date_ordinal
+
+Dates are stored as day ordinals, like in VisitStore; raw_date holds the
+original text only when the ordinal cannot reproduce it. The database runs in
+WAL mode, so readers are not blocked by a writer, and every statement is a
+constant string so sqlite3 reuses its prepared statement.
+
+importTextFile converts a patients.txt file, and its journal, to a database:
+
+    python storage.py patients.txt patients.db
+"""
+import datetime
+import errno
+import os
+import sqlite3
+import sys
+import threading
+from abc import ABC, abstractmethod
+from collections.abc import Mapping
+from itertools import repeat
+from urllib.request import pathname2url
+
+from date_index import monthStart, yearMonth
+from followup import DEFAULT_RULES, checkRule
+from journal import replayJournal
+from patient_parser import DEFAULT_CHUNK_BYTES, RejectLog, iterChunks
+from visit_store import INVALID_DATE, dateToOrdinal, ordinalToDate
+from vital_stats import VITALS, Aggregate
+
+
+# File name extensions opened as SQLite databases by readPatientsFromFile.
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+
+# Column of the visits table holding each VisitStore column.
+SQL_COLUMNS = {
+    'dates': 'date_ordinal',
+    'temperature': 'temperature',
+    'heartRate': 'heart_rate',
+    'respiratoryRate': 'respiratory_rate',
+    'sbp': 'sbp',
+    'dbp': 'dbp',
+    'spo2': 'spo2',
+}
+
+_TABLES = """
+CREATE TABLE IF NOT EXISTS patients (
+    seq INTEGER PRIMARY KEY,
+    patient_id INTEGER NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS visits (
+    id INTEGER PRIMARY KEY,
+    patient_id INTEGER NOT NULL,
+    date_ordinal INTEGER NOT NULL,
+    raw_date TEXT,
+    temperature REAL NOT NULL,
+    heart_rate INTEGER NOT NULL,
+    respiratory_rate INTEGER NOT NULL,
+    sbp INTEGER NOT NULL,
+    dbp INTEGER NOT NULL,
+    spo2 INTEGER NOT NULL
+);
+"""
+
+_INDEXES = """
+CREATE INDEX IF NOT EXISTS visits_by_patient ON visits (patient_id);
+CREATE INDEX IF NOT EXISTS visits_by_date ON visits (date_ordinal);
+"""
+
+_VISIT = "patient_id, date_ordinal, raw_date, temperature, heart_rate, respiratory_rate, sbp, dbp, spo2"
+
+_INSERT_VISIT = f"INSERT INTO visits ({_VISIT}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+_INSERT_PATIENT = "INSERT OR IGNORE INTO patients (patient_id) VALUES (?)"
+_SELECT_PATIENT = f"SELECT {_VISIT} FROM visits WHERE patient_id = ? ORDER BY id"
+_SELECT_ALL = ("SELECT v.patient_id, v.date_ordinal, v.raw_date, v.temperature, v.heart_rate, "
+               "v.respiratory_rate, v.sbp, v.dbp, v.spo2 "
+               "FROM patients p JOIN visits v ON v.patient_id = p.patient_id ORDER BY p.seq, v.id")
+_SELECT_BETWEEN = f"SELECT {_VISIT} FROM visits WHERE date_ordinal >= ? AND date_ordinal < ? ORDER BY date_ordinal, id"
+# (patient seq, visit id, visit columns) of the visits of a date range, and of those without a date ordinal
+_KEYED_VISITS = ("SELECT p.seq, v.id, v.patient_id, v.date_ordinal, v.raw_date, v.temperature, v.heart_rate, "
+                 "v.respiratory_rate, v.sbp, v.dbp, v.spo2 FROM visits v JOIN patients p ON p.patient_id = v.patient_id")
+_SELECT_KEYED_BETWEEN = f"{_KEYED_VISITS} WHERE v.date_ordinal >= ? AND v.date_ordinal < ?"
+_SELECT_KEYED_UNDATED = f"{_KEYED_VISITS} WHERE v.date_ordinal = {INVALID_DATE} AND v.raw_date IS NOT NULL"
+_AGGREGATE = "SELECT COUNT(*), " + ", ".join(
+    f"SUM({column}), SUM({column} * {column}), MIN({column}), MAX({column})"
+    for column in (SQL_COLUMNS[name] for name in VITALS)) + " FROM visits"
+
+
+def isDatabase(fileName):
+    """
+    Tells whether a patient file name refers to a SQLite database.
+
+    fileName: The name of the patient file.
+    """
+    return fileName.lower().endswith(SQLITE_EXTENSIONS)
+
+
+def _databaseUri(dbName, mode):
+    # sqlite3 URI of a database file opened in mode ('ro', 'rw' or 'rwc').
+    return f"file:{pathname2url(os.path.abspath(dbName))}?mode={mode}"
+
+
+def _visit(row):
+    # (patient_id, date_ordinal, raw_date, temperature, ...) -> (patientId, visit list)
+    patientId, ordinal, raw = row[0], row[1], row[2]
+    return patientId, [raw if raw is not None else ordinalToDate(ordinal)] + list(row[3:])
+
+
+def _dateColumns(date):
+    # (date_ordinal, raw_date) of a date string.
+    ordinal = dateToOrdinal(date)
+    return ordinal, (None if ordinalToDate(ordinal) == date else date)
+
+
+class BackendListener:
+    """
+    Base class for structures kept up to date as visits are stored in or deleted
+    from a StorageBackend. Register instances with StorageBackend.addListener.
+    """
+
+    def visitsStored(self, backend, records):
+        """Called after the (patientId, visit) records were stored."""
+
+    def patientRemoved(self, backend, patientId, dates):
+        """Called after all visits of patientId, dated as in the list dates, were deleted."""
+
+
+class StorageBackend(Mapping, ABC):
+    """
+    Base class for persistent visit stores queried in place.
+
+    Subclasses implement the read-only mapping protocol (patient ID -> list of
+    visit lists) and the abstract query and update methods below, and notify
+    the registered BackendListeners of every change; a subclass missing one
+    of them cannot be created.
+    """
+
+    def __init__(self):
+        self._listeners = []
+
+    def addListener(self, listener):
+        """
+        Registers a BackendListener to be notified of changes.
+
+        listener: The BackendListener.
+        """
+        self._listeners.append(listener)
+
+    def removeListener(self, listener):
+        """Unregisters a listener added with addListener."""
+        self._listeners.remove(listener)
+
+    def findListener(self, cls):
+        """
+        Returns the first registered listener that is an instance of cls, or None.
+
+        cls: The listener class.
+        """
+        for listener in self._listeners:
+            if isinstance(listener, cls):
+                return listener
+        return None
+
+    @abstractmethod
+    def records(self, patientIds=None):
+        """
+        Lists the visits of some or all patients.
+
+        patientIds: The patients to list, or None for all of them.
+        return: An iterable of (patientId, visit), patient by patient.
+        """
+
+    @abstractmethod
+    def visitsBetween(self, startOrdinal, endOrdinal):
+        """
+        Returns the visits dated in [startOrdinal, endOrdinal), sorted by date.
+
+        return: A list of (patientId, visit).
+        """
+
+    @abstractmethod
+    def visitsByYearMonth(self, year=None, month=None):
+        """
+        Returns the visits of a year, a month (of every year) or a month of a year.
+
+        return: A list of (patientId, visit), patient by patient in the order the
+                backend lists its patients, and in the order they were added for
+                each patient; visits whose date is not a real calendar day match
+                by their year and month.
+        """
+
+    @abstractmethod
+    def followUpPatients(self, rules=DEFAULT_RULES):
+        """
+        Returns the patients with at least one visit breaking a followup.FollowUpRule.
+
+        return: A list of patient IDs, in the order the backend lists its patients.
+        """
+
+    @abstractmethod
+    def summaries(self, patientId=0):
+        """
+        Computes the statistics of each vital sign.
+
+        patientId: The ID of the patient, or 0 for all patients.
+        return: A dictionary of vital name -> vital_stats.Summary, or {} if there are no visits.
+        """
+
+    @abstractmethod
+    def addVisit(self, patientId, visit):
+        """
+        Stores one visit durably.
+
+        visit: [date, temperature, heart rate, respiratory rate, systolic bp, diastolic bp, oxygen saturation]
+        """
+
+    @abstractmethod
+    def extend(self, chunk):
+        """
+        Stores the rows of a patient_parser.ParsedChunk in one transaction.
+
+        chunk: The ParsedChunk.
+        """
+
+    @abstractmethod
+    def deletePatient(self, patientId):
+        """
+        Removes all visits of a patient.
+
+        return: The number of visits removed, or 0 if the patient was not found.
+        """
+
+    def close(self):
+        """Releases the resources held by the backend."""
+
+
+class SqliteBackend(StorageBackend):
+    """
+    Visits kept in a local SQLite database; see the module documentation for the schema.
+
+    dbName: The database file; FileNotFoundError is raised if it does not exist
+            and is not being created.
+    bulkLoad: Open a new database for a one-off load: no rollback journal, no
+              fsync and no indexes until finishBulkLoad is called. The file is
+              created if needed.
+    create: Create the database if it does not exist.
+    """
+
+    def __init__(self, dbName, bulkLoad=False, create=False):
+        super().__init__()
+        self.dbName = dbName
+        try:
+            self._db = sqlite3.connect(_databaseUri(dbName, 'rwc' if create or bulkLoad else 'rw'), uri=True,
+                                       cached_statements=256)
+        except sqlite3.OperationalError:
+            # a mistyped name would otherwise leave an empty database behind
+            if not os.path.exists(dbName):
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), dbName) from None
+            raise
+        # A sqlite3 connection belongs to the thread that opened it; reads from other
+        # threads (e.g. the query server's) get a read-only connection of their own.
+        self._owner = threading.get_ident()
+        self._local = threading.local()
+        self._readers = []
+        self._readersLock = threading.Lock()
+        if bulkLoad:
+            self._db.execute("PRAGMA journal_mode = OFF")
+            self._db.execute("PRAGMA synchronous = OFF")
+            self._db.executescript(_TABLES)
+            return
+        self._db.execute("PRAGMA journal_mode = WAL")
+        # With WAL, NORMAL only risks the last commits on power loss, never corruption.
+        self._db.execute("PRAGMA synchronous = NORMAL")
+        with self._db:
+            self._db.executescript(_TABLES + _INDEXES)
+
+    def _reader(self):
+        # The connection reads go through in the calling thread.
+        if threading.get_ident() == self._owner:
+            return self._db
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            # Only this thread uses it, but close() may close it from another one.
+            db = sqlite3.connect(_databaseUri(self.dbName, 'ro'), uri=True, cached_statements=256,
+                                 check_same_thread=False)
+            self._local.db = db
+            with self._readersLock:
+                self._readers.append(db)
+        return db
+
+    def finishBulkLoad(self):
+        """Creates the indexes and switches to WAL mode after a bulk load."""
+        self._db.executescript(_INDEXES)
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = NORMAL")
+
+    def __getitem__(self, patientId):
+        visits = [_visit(row)[1] for row in self._reader().execute(_SELECT_PATIENT, (patientId,))]
+        if not visits:
+            raise KeyError(patientId)
+        return visits
+
+    def __contains__(self, patientId):
+        query = "SELECT 1 FROM patients WHERE patient_id = ?"
+        return self._reader().execute(query, (patientId,)).fetchone() is not None
+
+    def __iter__(self):
+        return (row[0] for row in self._reader().execute("SELECT patient_id FROM patients ORDER BY seq"))
+
+    def __len__(self):
+        return self._reader().execute("SELECT COUNT(*) FROM patients").fetchone()[0]
+
+    def __repr__(self):
+        return f"<SqliteBackend {self.dbName!r} patients={len(self)} visits={self.visitCount}>"
+
+    @property
+    def visitCount(self):
+        """The number of visits in the database."""
+        return self._reader().execute("SELECT COUNT(*) FROM visits").fetchone()[0]
+
+    def records(self, patientIds=None):
+        if patientIds is None:
+            return map(_visit, self._reader().execute(_SELECT_ALL))
+        db = self._reader()
+        return (_visit(row) for patientId in patientIds for row in db.execute(_SELECT_PATIENT, (patientId,)))
+
+    def visitsBetween(self, startOrdinal, endOrdinal):
+        startOrdinal = max(startOrdinal, INVALID_DATE + 1)
+        return list(map(_visit, self._reader().execute(_SELECT_BETWEEN, (startOrdinal, endOrdinal))))
+
+    def visitsByYearMonth(self, year=None, month=None):
+        if month is not None and not 1 <= month <= 12:
+            return []
+        db = self._reader()
+        if year is not None and month is not None:
+            ranges = [(monthStart(year, month), monthStart(year, month + 1))]
+        elif year is not None:
+            ranges = [(monthStart(year, 1), monthStart(year + 1, 1))]
+        elif month is not None:
+            ranges = []
+            first, last = db.execute(
+                f"SELECT MIN(date_ordinal), MAX(date_ordinal) FROM visits WHERE date_ordinal > {INVALID_DATE}").fetchone()
+            if first is not None:
+                firstYear = datetime.date.fromordinal(first).year
+                lastYear = datetime.date.fromordinal(last).year
+                ranges = [(monthStart(eachYear, month), monthStart(eachYear, month + 1))
+                          for eachYear in range(firstYear, lastYear + 1)]
+        else:
+            ranges = [(INVALID_DATE + 1, datetime.date.max.toordinal() + 1)]
+        rows = []
+        for startOrdinal, endOrdinal in ranges:
+            rows.extend(db.execute(_SELECT_KEYED_BETWEEN, (startOrdinal, endOrdinal)))
+        for row in db.execute(_SELECT_KEYED_UNDATED):
+            parts = yearMonth(row[4])
+            if parts is not None and (year is None or year == parts[0]) and (month is None or month == parts[1]):
+                rows.append(row)
+        # (patient seq, visit id) is unique, so the rest of a row is never compared.
+        rows.sort()
+        return [_visit(row[2:]) for row in rows]
+
+    def followUpPatients(self, rules=DEFAULT_RULES):
+        rules = list(rules)
+        if not rules:
+            return []
+        for rule in rules:
+            checkRule(rule)
+        # Columns and operators come from checked rules; thresholds are bound as parameters.
+        condition = " OR ".join(f"{SQL_COLUMNS[rule.column]} {rule.op} ?" for rule in rules)
+        query = (f"SELECT patient_id FROM patients WHERE patient_id IN "
+                 f"(SELECT patient_id FROM visits WHERE {condition}) ORDER BY seq")
+        return [row[0] for row in self._reader().execute(query, [rule.threshold for rule in rules])]
+
+    def summaries(self, patientId=0):
+        if patientId == 0:
+            row = self._reader().execute(_AGGREGATE).fetchone()
+        else:
+            row = self._reader().execute(_AGGREGATE + " WHERE patient_id = ?", (patientId,)).fetchone()
+        count = row[0]
+        if not count:
+            return {}
+        return Aggregate(count=count,
+                         sums=[float(value) for value in row[1::4]],
+                         squares=[float(value) for value in row[2::4]],
+                         mins=list(row[3::4]),
+                         maxs=list(row[4::4])).summaries()
+
+    def addVisit(self, patientId, visit):
+        with self._db:
+            self._db.execute(_INSERT_PATIENT, (patientId,))
+            self._db.execute(_INSERT_VISIT, (patientId,) + _dateColumns(visit[0]) + tuple(visit[1:]))
+        for listener in self._listeners:
+            listener.visitsStored(self, [(patientId, visit)])
+
+    def extend(self, chunk):
+        count = len(chunk)
+        rawDates = [None] * count
+        for position, date in chunk.rawDates.items():
+            rawDates[position] = date
+        # float32 -> float64 widening adds noise past the 7th digit, as in VisitStore.visit
+        temperatures = map(round, chunk.temperature, repeat(4, count))
+        rows = zip(chunk.patientIds, chunk.dates, rawDates, temperatures, chunk.heartRate,
+                   chunk.respiratoryRate, chunk.sbp, chunk.dbp, chunk.spo2)
+        with self._db:
+            self._db.executemany(_INSERT_PATIENT, ((patientId,) for patientId in dict.fromkeys(chunk.patientIds)))
+            self._db.executemany(_INSERT_VISIT, rows)
+        if self._listeners:
+            records = [(patientId, [rawDates[position] or ordinalToDate(chunk.dates[position]),
+                                    round(chunk.temperature[position], 4), chunk.heartRate[position],
+                                    chunk.respiratoryRate[position], chunk.sbp[position],
+                                    chunk.dbp[position], chunk.spo2[position]])
+                       for position, patientId in enumerate(chunk.patientIds)]
+            for listener in self._listeners:
+                listener.visitsStored(self, records)
+
+    def deletePatient(self, patientId):
+        with self._db:
+            dates = None
+            if self._listeners:
+                dates = [raw if raw is not None else ordinalToDate(ordinal) for ordinal, raw in self._db.execute(
+                    "SELECT date_ordinal, raw_date FROM visits WHERE patient_id = ?", (patientId,))]
+            removed = self._db.execute("DELETE FROM visits WHERE patient_id = ?", (patientId,)).rowcount
+            self._db.execute("DELETE FROM patients WHERE patient_id = ?", (patientId,))
+        if removed and dates is not None:
+            for listener in self._listeners:
+                listener.patientRemoved(self, patientId, dates)
+        return removed
+
+    def close(self):
+        with self._readersLock:
+            readers, self._readers = self._readers, []
+        for db in readers:
+            db.close()
+        self._db.close()
+
+
+def importTextFile(fileName, dbName, rejectLog=None, chunkBytes=DEFAULT_CHUNK_BYTES):
+    """
+    Converts a patient text file, with its journal replayed, to a SQLite database.
+
+    The database is built in a temporary file with the indexes created last, then
+    moved over dbName, so an interrupted import never leaves a partial database.
+
+    fileName: The name of the patient text file.
+    dbName: The database file to create or replace.
+    rejectLog: A RejectLog receiving the rejected lines. Rejects are only counted if None.
+    chunkBytes: Approximate number of bytes parsed and inserted at a time.
+    return: The number of visits in the new database.
+    """
+    if rejectLog is None:
+        rejectLog = RejectLog(keep=0)
+    temporary = dbName + '.import.tmp'
+    if os.path.exists(temporary):
+        os.remove(temporary)
+    # Nothing to protect until the file is moved into place.
+    backend = SqliteBackend(temporary, bulkLoad=True)
+    count = None
+    try:
+        with open(fileName, 'r') as file:
+            for chunk in iterChunks(file, chunkBytes):
+                if chunk.rejects:
+                    rejectLog.extend(chunk.rejects)
+                if len(chunk):
+                    backend.extend(chunk)
+        replayJournal(fileName, backend)
+        backend.finishBulkLoad()
+        count = backend.visitCount
+    finally:
+        backend.close()
+        if count is None:
+            os.remove(temporary)
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(dbName + suffix):
+            os.remove(dbName + suffix)
+    os.replace(temporary, dbName)
+    return count
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("usage: python storage.py <patients.txt> <patients.db>")
+        sys.exit(2)
+    rejects = RejectLog(keep=0)
+    visitCount = importTextFile(sys.argv[1], sys.argv[2], rejects)
+    print(f"Imported {visitCount} visit(s) into '{sys.argv[2]}'.")
+    if rejects.count:
+        print(f"Skipped {rejects.count} invalid line(s) in '{sys.argv[1]}'.")
@@ -0,0 +1,92 @@
+"""
+Helpers shared by the tests: synthetic visits, patient files in a temporary
+directory, and silencing the messages main.py prints.
+"""
+import datetime
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+# Make the modules in the repository root importable however the tests are started.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from journal import closeJournals
+
+
+def randomVisit(rng):
+    """
+    Returns a valid random visit.
+
+    rng: The random.Random to draw from.
+    return: [date, temperature, heart rate, respiratory rate, systolic bp, diastolic bp, oxygen saturation]
+    """
+    date = datetime.date.fromordinal(datetime.date(2015, 1, 1).toordinal() + rng.randrange(3650)).isoformat()
+    return [date, round(rng.uniform(35.5, 40.0), 1), rng.randint(45, 130), rng.randint(10, 30),
+            rng.randint(90, 170), rng.randint(55, 100), rng.randint(85, 100)]
+
+
+def randomVisits(count, patients=50, seed=7):
+    """
+    Returns (patientId, visit) pairs with random patients and visits.
+
+    count: The number of visits.
+    patients: The number of distinct patient IDs to draw from.
+    seed: The seed for the random number generator.
+    """
+    rng = random.Random(seed)
+    return [(rng.randint(1, patients), randomVisit(rng)) for _ in range(count)]
+
+
+def visitLine(patientId, visit):
+    """Returns the line of a patient file holding one visit, without its newline."""
+    return ','.join(str(value) for value in [patientId] + list(visit))
+
+
+def writePatientFile(fileName, visits, extraLines=()):
+    """
+    Writes a patient file.
+
+    fileName: The file to write.
+    visits: (patientId, visit) pairs, one line each.
+    extraLines: Lines written after the visits, e.g. invalid ones.
+    """
+    with open(fileName, 'w') as f:
+        for patientId, visit in visits:
+            f.write(visitLine(patientId, visit) + '\n')
+        for line in extraLines:
+            f.write(line + '\n')
+
+
+def asDict(patients):
+    """Returns any patient data as a plain dictionary of patient ID -> list of visit lists."""
+    return {patientId: [list(visit) for visit in patients[patientId]] for patientId in patients}
+
+
+def quietly(call, *args, **kwargs):
+    """
+    Calls a function with its standard output captured.
+
+    return: (result of the call, text printed)
+    """
+    output = io.StringIO()
+    with redirect_stdout(output):
+        result = call(*args, **kwargs)
+    return result, output.getvalue()
+
+
+class TemporaryDirectoryTest(unittest.TestCase):
+    """A test case working in a fresh temporary directory, with its journals closed afterwards."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        self.addCleanup(closeJournals)
+
+    def path(self, name):
+        """Returns the path of a file in the temporary directory."""
+        return os.path.join(self.directory, name)
@@ -0,0 +1,92 @@
+"""
+Checks that importVisits keeps the valid rows and reports the others by line,
+saves a batch with one journal write or not at all, and reads CSV files with
+or without a header.
+"""
+import io
+import unittest
+from unittest import mock
+
+import support  # puts the repository root on sys.path
+import main
+from journal import openJournal
+
+
+GOOD = [(1001, '2024-03-01', 38.5, 120, 22, 95, 60, 91),
+        (1001, '2024-03-02', 37.0, 80, 16, 120, 80, 97),
+        (7, '2024-03-03', 36.5, 70, 16, 120, 80, 97)]
+
+BAD = [(1002, '2024-03-04', 37.0, 80, 16, 120, 80, 300),
+       (1002, '2023-02-30', 37.0, 80, 16, 120, 80, 97),
+       (1002, '2024-03-05', 37.0)]
+
+
+class ImportVisitsTest(support.TemporaryDirectoryTest):
+
+    def setUp(self):
+        super().setUp()
+        self.fileName = self.path('patients.txt')
+        support.writePatientFile(self.fileName, support.randomVisits(300, patients=20))
+        self.store, _ = support.quietly(main.readPatientsFromFile, self.fileName, useSnapshot=False, cacheEntries=0)
+
+    def reload(self):
+        return support.quietly(main.readPatientsFromFile, self.fileName, useSnapshot=False, cacheEntries=0)[0]
+
+    def testAcceptedAndRejected(self):
+        before = support.asDict(self.store)
+        rows = [GOOD[0], BAD[0], GOOD[1], BAD[1], BAD[2], GOOD[2]]
+        result, printed = support.quietly(main.importVisits, self.store, rows, self.fileName)
+        self.assertEqual((result.accepted, result.rejected), (3, 3))
+        self.assertEqual([(lineNumber, reason) for lineNumber, reason, _ in result.rejects],
+                         [(2, "invalid oxygen saturation value"), (4, "invalid date"),
+                          (5, "invalid number of fields")])
+        self.assertEqual(result.rejects[0][2], ','.join(map(str, BAD[0])))
+        self.assertEqual(printed, "Imported 3 visit(s) for 2 patient(s); rejected 3 row(s).\n")
+        expected = before
+        for row in GOOD:
+            expected.setdefault(row[0], []).append(list(row[1:]))
+        self.assertEqual(support.asDict(self.store), expected)
+        self.assertEqual(support.asDict(self.reload()), expected)
+
+    def testOneJournalWrite(self):
+        journal = openJournal(self.fileName)
+        with mock.patch.object(journal, '_append', wraps=journal._append) as append:
+            support.quietly(main.importVisits, self.store, GOOD, self.fileName)
+        self.assertEqual(append.call_count, 1)
+        self.assertEqual(len(append.call_args.args[0]), 1 + len(GOOD))
+
+    def testNothingSaved(self):
+        before = support.asDict(self.store)
+        result, printed = support.quietly(main.importVisits, self.store, GOOD + BAD[:1], self.fileName, strict=True)
+        self.assertEqual((result.accepted, result.rejected), (0, 1))
+        self.assertEqual(printed, "Nothing was imported: 1 row(s) are invalid.\n")
+        result, printed = support.quietly(main.importVisits, self.store, BAD, self.fileName)
+        self.assertEqual((result.accepted, result.rejected), (0, 3))
+        self.assertEqual(printed, "No visits to import; 3 row(s) rejected.\n")
+        # A failed journal write leaves the data as it was.
+        with mock.patch.object(openJournal(self.fileName), 'logAddBatch', side_effect=OSError("disk full")):
+            result, printed = support.quietly(main.importVisits, self.store, GOOD, self.fileName)
+        self.assertEqual((result.accepted, printed), (0, "Could not save the visits: disk full\n"))
+        self.assertEqual(support.asDict(self.store), before)
+        self.assertEqual(support.asDict(self.reload()), before)
+
+    def testCsvFiles(self):
+        csvName = self.path('visits.csv')
+        with open(csvName, 'w') as f:
+            f.write("patientId,date,temperature,heartRate,respiratoryRate,systolicBp,diastolicBp,oxygenSaturation\n")
+            f.write('\n'.join(','.join(map(str, row)) for row in GOOD + BAD[:1]) + '\n')
+        result, _ = support.quietly(main.importVisits, self.store, csvName, self.fileName)
+        # Line numbers count the header.
+        self.assertEqual((result.accepted, [lineNumber for lineNumber, _, _ in result.rejects]), (3, [5]))
+        plain = support.asDict(self.store)
+        rows = io.StringIO("# a comment\n2001,2024-03-06,37.0,80,16,120,80,97\n")
+        result, _ = support.quietly(main.importVisits, plain, rows, self.fileName)
+        self.assertEqual(result.accepted, 1)
+        self.assertEqual(plain[2001], [['2024-03-06', 37.0, 80, 16, 120, 80, 97]])
+        result, printed = support.quietly(main.importVisits, self.store, self.path('missing.csv'), self.fileName)
+        self.assertEqual(result, main.ImportResult(0, 0, []))
+        self.assertTrue(printed.startswith("Could not read the visits to import: "))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+"""
+Checks that the query cache answers like the uncached queries, drops only the
+results a change can alter, and does not keep results computed during a change.
+"""
+import threading
+import unittest
+from unittest import mock
+
+import support  # puts the repository root on sys.path
+import main
+from cache import CLEAR_BATCH, QueryCache, followUpKey, rangeKey, statsKey, visitsKey
+from patient_parser import parseLines
+from visit_store import VisitStore
+
+
+class QueryCacheTest(support.TemporaryDirectoryTest):
+
+    def setUp(self):
+        super().setUp()
+        self.fileName = self.path('patients.txt')
+        self.store = VisitStore()
+        for patientId, visit in support.randomVisits(1000, patients=40):
+            self.store.append(patientId, visit)
+        self.cache = QueryCache.forStore(self.store)
+        self.plain = support.asDict(self.store)
+
+    def fill(self):
+        main.findVisitsByDate(self.store, 2016, 3)
+        main.findVisitsByDate(self.store, 2019)
+        main.findVisitsInRange(self.store, '2016-01-01', '2016-12-31')
+        main.findVisitsInRange(self.store, '2020-01-01', '2020-12-31')
+        main.vitalSummaries(self.store)
+        main.vitalSummaries(self.store, 3)
+        main.findPatientsWhoNeedFollowUp(self.store)
+
+    def testSameAnswers(self):
+        for _ in range(2):
+            self.assertEqual(main.findVisitsByDate(self.store, 2016, 3), main.findVisitsByDate(self.plain, 2016, 3))
+            self.assertEqual(main.findPatientsWhoNeedFollowUp(self.store),
+                             main.findPatientsWhoNeedFollowUp(self.plain))
+            self.assertEqual(main.vitalSummaries(self.store, 3), main.vitalSummaries(self.plain, 3))
+        self.assertEqual((self.cache.hits, self.cache.misses), (3, 3))
+
+    def testResultsAreCopies(self):
+        found = main.findVisitsByDate(self.store, 2016)
+        found[0][1][1] = 99.0
+        found.clear()
+        self.assertEqual(main.findVisitsByDate(self.store, 2016), main.findVisitsByDate(self.plain, 2016))
+
+    def testAddDropsOnlyWhatItChanges(self):
+        self.fill()
+        # A normal visit: only the follow-up list stays.
+        support.quietly(main.addPatientData, self.store, 3, '2016-03-05', 37.0, 70, 16, 120, 80, 97,
+                        self.fileName)
+        self.assertNotIn(visitsKey(2016, 3), self.cache._entries)
+        self.assertNotIn(rangeKey('2016-01-01', '2016-12-31'), self.cache._entries)
+        self.assertNotIn(statsKey(3), self.cache._entries)
+        self.assertNotIn(statsKey(), self.cache._entries)
+        for key in (visitsKey(2019), rangeKey('2020-01-01', '2020-12-31'), followUpKey()):
+            self.assertIn(key, self.cache._entries)
+        # A visit breaking a rule drops the follow-up list.
+        support.quietly(main.addPatientData, self.store, 1001, '2020-06-01', 37.0, 120, 16, 120, 80, 97,
+                        self.fileName)
+        self.assertNotIn(followUpKey(), self.cache._entries)
+        self.assertIn(1001, main.findPatientsWhoNeedFollowUp(self.store))
+        self.assertEqual(main.findVisitsByDate(self.store, 2016, 3),
+                         main.findVisitsByDate(support.asDict(self.store), 2016, 3))
+
+    def testDeleteDropsItsDates(self):
+        self.fill()
+        patientId = main.findPatientsWhoNeedFollowUp(self.store)[0]
+        support.quietly(main.deleteAllVisitsOfPatient, self.store, patientId, self.fileName)
+        self.assertNotIn(followUpKey(), self.cache._entries)
+        self.assertNotIn(patientId, main.findPatientsWhoNeedFollowUp(self.store))
+        for year, month in ((2016, 3), (2019, None)):
+            self.assertEqual(main.findVisitsByDate(self.store, year, month),
+                             main.findVisitsByDate(support.asDict(self.store), year, month))
+
+    def testLargeBatchClears(self):
+        self.fill()
+        # Normal visits on a date no query covers: visit by visit, only the overall statistics go.
+        line = support.visitLine(5, ['2030-01-01', 37.0, 70, 16, 120, 80, 97])
+        self.store.extend(parseLines([line] * CLEAR_BATCH))
+        self.assertEqual(len(self.cache), 6)
+        self.store.extend(parseLines([line] * (CLEAR_BATCH + 1)))
+        self.assertEqual(len(self.cache), 0)
+
+    def testSizeLimit(self):
+        cache = QueryCache(self.store, maxEntries=2)
+        for year in (2016, 2017, 2018):
+            cache.lookup(visitsKey(year), list)
+        self.assertEqual(list(cache._entries), [visitsKey(2017), visitsKey(2018)])
+        self.assertEqual(cache.counters()['evictions'], 1)
+        with self.assertRaises(ValueError):
+            QueryCache(self.store, maxEntries=0)
+
+    def testExpiry(self):
+        cache = QueryCache(self.store, ttl=10)
+        with mock.patch('cache.time.monotonic', return_value=100.0):
+            cache.lookup(visitsKey(2016), list)
+            cache.lookup(visitsKey(2016), list)
+        with mock.patch('cache.time.monotonic', return_value=110.0):
+            cache.lookup(visitsKey(2016), list)
+        counters = cache.counters()
+        self.assertEqual((counters['hits'], counters['misses'], counters['expirations']), (1, 2, 1))
+
+    def testRegisteredByLoad(self):
+        support.writePatientFile(self.fileName, support.randomVisits(200, patients=20))
+        patients, _ = support.quietly(main.readPatientsFromFile, self.fileName, useSnapshot=False)
+        cache = QueryCache.find(patients)
+        self.assertIsNotNone(cache)
+        main.findVisitsByDate(patients, 2016)
+        main.findVisitsByDate(patients, 2016)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        # An invalid range is not cached, so its message is printed every time.
+        for _ in range(2):
+            self.assertEqual(support.quietly(main.findVisitsInRange, patients, '2016-13-01', '2016-12-31'),
+                             ([], "Invalid date format. Please enter dates in the format 'yyyy-mm-dd'.\n"))
+        self.assertEqual(len(cache), 1)
+        patients, _ = support.quietly(main.readPatientsFromFile, self.fileName, useSnapshot=False, cacheEntries=0)
+        self.assertIsNone(QueryCache.find(patients))
+        self.assertIsNone(QueryCache.find(support.asDict(patients)))
+
+    def testChangeDuringCompute(self):
+        # The visit is added after the query read the store but before its result is stored.
+        def compute():
+            result = main.findVisitsByDate.__wrapped__(self.store, 2016, 3)
+            self.store.append(3, ['2016-03-05', 37.0, 70, 16, 120, 80, 97])
+            return result
+        stale = self.cache.lookup(visitsKey(2016, 3), compute)
+        self.assertNotIn(visitsKey(2016, 3), self.cache._entries)
+        fresh = main.findVisitsByDate(self.store, 2016, 3)
+        self.assertEqual(len(fresh), len(stale) + 1)
+
+    def testConcurrentChanges(self):
+        started = threading.Event()
+        added = threading.Event()
+
+        def compute():
+            result = main.findVisitsByDate.__wrapped__(self.store, 2016)
+            started.set()
+            added.wait()
+            return result
+
+        reader = threading.Thread(target=self.cache.lookup, args=(visitsKey(2016), compute))
+        reader.start()
+        started.wait()
+        try:
+            support.quietly(main.addPatientData, self.store, 3, '2016-07-01', 37.0, 70, 16, 120, 80, 97,
+                            self.fileName)
+        finally:
+            added.set()
+            reader.join()
+        self.assertEqual(main.findVisitsByDate(self.store, 2016),
+                         main.findVisitsByDate(support.asDict(self.store), 2016))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+"""
+Runs cli.py commands against a patient file and checks their output in each
+format, their exit status, and run-files sharing one loaded file.
+"""
+import csv
+import io
+import json
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+
+import support  # puts the repository root on sys.path
+import cli
+import main
+
+
+class CliTest(support.TemporaryDirectoryTest):
+
+    def setUp(self):
+        super().setUp()
+        self.fileName = self.path('patients.txt')
+        support.writePatientFile(self.fileName, support.randomVisits(300, patients=25), ['bad,line'])
+        self.patients, _ = support.quietly(main.readPatientsFromFile, self.fileName, useSnapshot=False,
+                                           cacheEntries=0)
+
+    def runCli(self, *argv):
+        # (exit status, standard output, standard error) of one cli.py run.
+        out, err = io.StringIO(), io.StringIO()
+        with redirect_stdout(out), redirect_stderr(err):
+            try:
+                status = cli.main(['--file', self.fileName] + list(argv))
+            except SystemExit as e:
+                status = e.code
+        return status, out.getvalue(), err.getvalue()
+
+    def testDisplayText(self):
+        status, out, _ = self.runCli('display')
+        self.assertEqual(status, 0)
+        self.assertEqual(out, "Skipped 1 invalid line(s) in '%s'.\n" % self.fileName
+                         + support.quietly(main.displayPatientData, self.patients)[1])
+        status, out, _ = self.runCli('display', '--patient', '3')
+        self.assertTrue(out.endswith(support.quietly(main.displayPatientData, self.patients, 3)[1]))
+
+    def testDisplayCsv(self):
+        status, out, err = self.runCli('--format', 'csv', 'display')
+        self.assertEqual((status, err), (0, "Skipped 1 invalid line(s) in '%s'.\n" % self.fileName))
+        rows = list(csv.reader(io.StringIO(out)))
+        self.assertEqual(tuple(rows[0]), cli.VISIT_FIELDS)
+        visits = {}
+        for row in rows[1:]:
+            visits.setdefault(int(row[0]), []).append([row[1], float(row[2])] + [int(value) for value in row[3:]])
+        self.assertEqual(visits, support.asDict(self.patients))
+
+    def testQueriesJsonl(self):
+        status, out, _ = self.runCli('--format', 'jsonl', 'stats', '--patient', '3')
+        rows = [json.loads(line) for line in out.splitlines()]
+        summaries = main.vitalSummaries(self.patients, 3)
+        self.assertEqual({row['vital']: row['mean'] for row in rows},
+                         {name: summary.mean for name, summary in summaries.items()})
+        status, out, _ = self.runCli('--format', 'jsonl', 'follow-up')
+        self.assertEqual([json.loads(line)['patientId'] for line in out.splitlines()],
+                         main.findPatientsWhoNeedFollowUp(self.patients))
+        status, out, _ = self.runCli('--format', 'jsonl', 'worklist', '--limit', '5')
+        self.assertEqual([json.loads(line)['patientId'] for line in out.splitlines()],
+                         [entry.patientId for entry in main.earlyWarningWorklist(self.patients, 5)])
+        status, out, _ = self.runCli('--format', 'csv', 'find-by-date', '--from', '2016-01-01', '--to', '2016-06-30')
+        self.assertEqual(len(out.splitlines()) - 1,
+                         len(main.findVisitsInRange(self.patients, '2016-01-01', '2016-06-30')))
+
+    def testErrors(self):
+        status, out, err = self.runCli('find-by-date', '--from', '2016-01-01')
+        self.assertEqual(status, 1)
+        self.assertIn("find-by-date: --from and --to must be given together.", err)
+        status, _, err = self.runCli('display', '--patient', '999')
+        self.assertEqual(status, 1)
+        self.assertIn("Patient with ID 999 not found.", err)
+        status, _, _ = self.runCli('add', '1', '2020-01-01', '37.0', '80', '16', '120', '80', '250')
+        self.assertEqual(status, 1)
+        self.assertEqual(self.runCli('display', '--patient', '-1')[0], 2)
+        self.assertEqual(self.runCli('no-such-command')[0], 2)
+
+    def testRunFile(self):
+        commands = self.path('commands.txt')
+        with open(commands, 'w') as f:
+            f.write("# a comment\n"
+                    "\n"
+                    "add 1001 2024-03-01 38.5 120 22 95 60 91\n"
+                    "display --patient 1001\n"
+                    "delete 3\n"
+                    "display --patient 3\n"
+                    "not-a-command\n")
+        status, out, err = self.runCli('run-file', commands)
+        self.assertEqual(status, 1)
+        self.assertIn("Visit is saved successfully for Patient #1001", out)
+        self.assertIn("Patient ID: 1001\n Visit Date: 2024-03-01\n", out)
+        self.assertIn(f"{commands}:6: display: Patient with ID 3 not found.", err)
+        self.assertIn(f"{commands}:7: invalid command", err)
+        # The changes are in the journal, for the next run.
+        status, out, _ = self.runCli('--format', 'csv', 'display', '--patient', '1001')
+        self.assertEqual(out.splitlines()[1:], ['1001,2024-03-01,38.5,120,22,95,60,91'])
+
+
+if __name__ == '__main__':
+    unittest.main()
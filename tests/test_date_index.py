@@ -0,0 +1,117 @@
+"""
+Checks that findVisitsByDate and findVisitsInRange answer from the date index
+exactly as the original scan does, as visits are added between queries (the
+unsorted tail), patients are deleted and the store is compacted.
+"""
+import datetime
+import random
+import threading
+import unittest
+
+import support  # puts the repository root on sys.path
+import main
+from date_index import REBUILD_BATCH, DateIndex, monthStart, yearMonth
+from patient_parser import parseLines
+from visit_store import INVALID_DATE, VisitStore, dateToOrdinal
+
+
+QUERIES = ((None, None), (2019, None), (None, 2), (2016, 5), (2020, 2), (2023, 2), (None, 13), (1999, None))
+
+
+class DateIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = random.Random(5)
+        visits = support.randomVisits(2000, patients=150)
+        visits[10][1][0] = '2023-02-30'
+        visits[20][1][0] = 'not a date'
+        visits[30][1][0] = '2021-7-4'
+        self.store = VisitStore()
+        for patientId, visit in visits:
+            self.store.append(patientId, visit)
+        self.index = DateIndex.forStore(self.store)
+
+    def assertSameAnswers(self):
+        plain = support.asDict(self.store)
+        for year, month in QUERIES:
+            self.assertEqual(main.findVisitsByDate(self.store, year, month), main.findVisitsByDate(plain, year, month),
+                             (year, month))
+        for start, end in (('2016-01-01', '2016-12-31'), ('2018-02-28', '2018-03-01'), ('2030-01-01', '2031-01-01')):
+            found = main.findVisitsInRange(self.store, start, end)
+            expected = main.findVisitsInRange(plain, start, end)
+            self.assertEqual(sorted(found), sorted(expected))
+            self.assertEqual([visit[0] for _, visit in found], [visit[0] for _, visit in expected])
+
+    def testSameAnswers(self):
+        self.assertSameAnswers()
+
+    def testAddsBetweenQueries(self):
+        dates = [visit[0] for _, visit in support.randomVisits(50)]
+        for step in range(200):
+            visit = support.randomVisit(self.rng)
+            if step % 3 == 0:
+                # On a date that is already indexed: goes after the older rows of that date.
+                visit[0] = self.rng.choice(dates)
+            self.store.append(self.rng.randint(1, 200), visit)
+            if step % 40 == 0:
+                self.assertSameAnswers()
+        self.assertTrue(self.index._tail)
+        self.assertSameAnswers()
+        self.assertFalse(self.index._tail)
+        entries = list(zip(self.index._ordinals, self.index._rows))
+        self.assertEqual(entries, sorted(entries))
+        self.assertEqual(entries, [(self.store.dates[row], row) for row in self.index._rows])
+
+    def testDeletesAndCompaction(self):
+        patientIds = list(self.store)
+        for patientId in patientIds[:10]:
+            self.store.deletePatient(patientId)
+        self.assertSameAnswers()
+        # Past half of the rows dead, the index is rebuilt without them.
+        for patientId in patientIds[10:]:
+            if self.index._deadRows:
+                self.store.deletePatient(patientId)
+        self.assertEqual(self.index._deadRows, 0)
+        self.assertEqual(len(self.index._rows), sum(1 for row, ordinal in enumerate(self.store.dates)
+                                                    if self.store.isLive(row) and ordinal != INVALID_DATE))
+        self.assertSameAnswers()
+        self.store.append(7, ['2019-06-01', 37.0, 80, 16, 120, 80, 97])
+        self.store.compact()
+        self.assertSameAnswers()
+
+    def testLargeBatch(self):
+        lines = [support.visitLine(patientId, visit)
+                 for patientId, visit in support.randomVisits(REBUILD_BATCH + 1, seed=9)]
+        self.store.extend(parseLines(lines))
+        self.assertFalse(self.index._tail)
+        self.assertSameAnswers()
+
+    def testConcurrentQueries(self):
+        for _, visit in support.randomVisits(300, seed=3):
+            self.store.append(9, visit)
+        expected = main.findVisitsByDate(support.asDict(self.store), 2017)
+        answers = []
+        threads = [threading.Thread(target=lambda: answers.append(main.findVisitsByDate(self.store, 2017)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(answers, [expected] * 8)
+
+    def testRowsBetween(self):
+        start, end = dateToOrdinal('2017-01-01'), dateToOrdinal('2017-02-01')
+        rows = self.index.rowsBetween(start, end)
+        self.assertTrue(all(start <= self.store.dates[row] < end for row in rows))
+        self.assertEqual(len(rows), sum(1 for ordinal in self.store.dates if start <= ordinal < end))
+
+    def testHelpers(self):
+        self.assertEqual(yearMonth('2023-02-30'), (2023, 2))
+        self.assertIsNone(yearMonth('2023-02'))
+        self.assertEqual(monthStart(2020, 13), datetime.date(2021, 1, 1).toordinal())
+        self.assertEqual(monthStart(2020, 0), datetime.date(2019, 12, 1).toordinal())
+        self.assertEqual(monthStart(datetime.MAXYEAR, 13), datetime.date.max.toordinal() + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
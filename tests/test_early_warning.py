@@ -0,0 +1,115 @@
+"""
+Checks NEWS2 scoring, the worklists of a VisitStore and of a storage backend
+through adds and deletes, and vital sign trends.
+"""
+import random
+import unittest
+
+import support  # puts the repository root on sys.path
+import main
+import storage
+from early_warning import BackendWorklist, EarlyWarningEngine, patientTrends, riskLevel, scoreRows, scoreVisit
+from visit_store import VisitStore
+
+
+NORMAL = ['2020-01-01', 37.0, 70, 16, 120, 80, 97]
+
+
+class ScoreTest(unittest.TestCase):
+
+    def testScoreVisit(self):
+        self.assertEqual(scoreVisit(NORMAL), (0, False))
+        # respiratory rate 25 (3), spo2 93 (2), sbp 100 (2), heart rate 115 (2), temperature 39.5 (2)
+        self.assertEqual(scoreVisit(['2020-01-01', 39.5, 115, 25, 100, 60, 93]), (11, True))
+        # heart rate 95 (1), temperature 35.5 (1)
+        self.assertEqual(scoreVisit(['2020-01-01', 35.5, 95, 16, 120, 80, 97]), (2, False))
+
+    def testRiskLevel(self):
+        self.assertEqual(riskLevel(7, False), 'high')
+        self.assertEqual(riskLevel(5, False), 'medium')
+        self.assertEqual(riskLevel(3, True), 'low-medium')
+        self.assertEqual(riskLevel(4, False), 'low')
+
+    def testScoreRowsMatchesScoreVisit(self):
+        store = VisitStore()
+        for patientId, visit in support.randomVisits(2000):
+            store.append(patientId, visit)
+        # Values past a byte, in the uint16 columns.
+        store.append(1, ['2020-01-01', 37.0, 300, 16, 260, 80, 97])
+        scores, flags = scoreRows(store)
+        for row in range(len(store.patientIds)):
+            self.assertEqual((scores[row], bool(flags[row])), scoreVisit(store.visit(row)), row)
+        self.assertEqual(scoreRows(store, 100, 200), (scores[100:200], flags[100:200]))
+
+    def testTrends(self):
+        visits = [['2020-01-%02d' % day, 37.0, 60 + 2 * day, 16, 120, 80, 97] for day in (1, 2, 4)]
+        visits.append(['2020-02-30', 37.0, 200, 16, 120, 80, 97])
+        trend = patientTrends(visits, window=2)['heartRate']
+        self.assertEqual(trend.dates, ['2020-01-01', '2020-01-02', '2020-01-04'])
+        self.assertEqual(trend.values, [62, 64, 68])
+        self.assertEqual(trend.deltas, [2, 4])
+        self.assertEqual(trend.rollingMeans, [62, 63, 66])
+        self.assertAlmostEqual(trend.slope, 2.0)
+
+
+class WorklistTest(support.TemporaryDirectoryTest):
+
+    def setUp(self):
+        super().setUp()
+        self.fileName = self.path('patients.txt')
+        support.writePatientFile(self.fileName, support.randomVisits(1500, patients=120))
+        self.store, _ = support.quietly(main.readPatientsFromFile, self.fileName, useSnapshot=False, cacheEntries=0)
+
+    def change(self, patients, fileName):
+        # The same random adds and deletes, whatever the patients are.
+        rng = random.Random(11)
+        for step in range(60):
+            if step % 7 == 6:
+                support.quietly(main.deleteAllVisitsOfPatient, patients, rng.randint(1, 130), fileName)
+            else:
+                visit = support.randomVisit(rng)
+                if step % 5 == 0:
+                    # A second visit on the date of the latest one.
+                    visit[0] = max(visit[0] for visit in patients.get(5, [['2015-01-01']]))
+                support.quietly(main.addPatientData, patients, rng.choice((5, rng.randint(1, 130))), *visit,
+                                fileName)
+
+    def testEngineFollowsChanges(self):
+        EarlyWarningEngine.forStore(self.store)
+        self.change(self.store, self.fileName)
+        self.assertEqual(main.earlyWarningWorklist(self.store), EarlyWarningEngine(self.store).worklist())
+        self.store.compact()
+        self.assertEqual(main.earlyWarningWorklist(self.store), EarlyWarningEngine(self.store).worklist())
+
+    def testWorklistOrder(self):
+        worklist = main.earlyWarningWorklist(self.store)
+        keys = [(-entry.score, -entry.redFlag, -(entry.change or 0), entry.patientId) for entry in worklist]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(main.earlyWarningWorklist(self.store, limit=5), worklist[:5])
+        self.assertEqual(main.earlyWarningWorklist(self.store, minScore=4), [entry for entry in worklist
+                                                                             if entry.score >= 4])
+
+    def testBackendMatchesStore(self):
+        dbName = self.path('patients.db')
+        storage.importTextFile(self.fileName, dbName)
+        backend = storage.SqliteBackend(dbName)
+        self.addCleanup(backend.close)
+        self.assertEqual(main.earlyWarningWorklist(backend), main.earlyWarningWorklist(self.store))
+        worklist = BackendWorklist.forStore(backend)
+        self.change(backend, None)
+        self.change(self.store, self.fileName)
+        # The worklist follows the changes without reading the database again.
+        reads = []
+        reader = backend._reader
+        backend._reader = lambda: reads.append(1) or reader()
+        self.assertEqual(main.earlyWarningWorklist(backend), main.earlyWarningWorklist(self.store))
+        self.assertEqual(main.earlyWarningWorklist(backend, 10, 3), main.earlyWarningWorklist(self.store, 10, 3))
+        self.assertEqual(reads, [])
+        self.assertIs(BackendWorklist.forStore(backend), worklist)
+        backend._reader = reader
+        worklist.rebuild()
+        self.assertEqual(worklist.worklist(), main.earlyWarningWorklist(self.store))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+"""
+Round trips of export.py: full exports read back with readBatches, and change
+feeds after adds and deletes, from a parsed store and from a snapshot.
+"""
+import os
+import unittest
+from array import array
+
+import support  # puts the repository root on sys.path
+import export
+import main
+import snapshot
+from visit_store import COLUMNS, VisitStore
+
+
+def exportedRows(fileName):
+    # (change, patientId, visit) of every row of a column file, in order.
+    rows = []
+    for batch in export.readBatches(fileName, verify=True):
+        columns = batch.columns
+        for row in range(export.batchRowCount(batch)):
+            store = VisitStore()
+            store.patientIds.append(columns['patientId'][row])
+            for name, _ in COLUMNS:
+                getattr(store, name).append(columns[name][row])
+            store._live.append(1)
+            if row in batch.rawDates:
+                store._rawDates[0] = batch.rawDates[row]
+            visit = store.visit(0) if columns['change'][row] == export.CHANGE_ADDED else None
+            rows.append((columns['change'][row], columns['patientId'][row], visit))
+    return rows
+
+
+class ExportTest(support.TemporaryDirectoryTest):
+
+    def setUp(self):
+        super().setUp()
+        self.fileName = self.path('patients.txt')
+        self.visits = support.randomVisits(500)
+        self.visits[3][1][0] = '2023-02-30'
+        support.writePatientFile(self.fileName, self.visits)
+
+    def load(self, useSnapshot):
+        if useSnapshot and not os.path.exists(snapshot.snapshotPath(self.fileName)):
+            # The first load parses the text and writes the snapshot.
+            support.quietly(main.readPatientsFromFile, self.fileName, cacheEntries=0)
+        patients, _ = support.quietly(main.readPatientsFromFile, self.fileName, useSnapshot=useSnapshot,
+                                      cacheEntries=0)
+        return patients
+
+    def expectedRows(self, store):
+        return [(export.CHANGE_ADDED, store.patientIds[row], store.visit(row))
+                for row in range(len(store.patientIds)) if store.isLive(row)]
+
+    def assertRoundTrip(self, store):
+        output = self.path('full.columns')
+        result = export.exportVisits(store, output, self.fileName, batchRows=128, outputFormat='columns')
+        self.assertEqual(result.rows, store.visitCount)
+        self.assertEqual(result.batches, -(-store.visitCount // 128))
+        self.assertEqual(exportedRows(output), self.expectedRows(store))
+        return result
+
+    def testFullExportOfParsedStore(self):
+        store = self.load(useSnapshot=False)
+        self.assertIsInstance(store.heartRate, array)
+        self.assertRoundTrip(store)
+
+    def testFullExportOfSnapshot(self):
+        self.load(useSnapshot=True)
+        store = snapshot.loadSnapshot(snapshot.snapshotPath(self.fileName), self.fileName, verify=True)
+        self.assertIsInstance(store.heartRate, memoryview)
+        self.assertRoundTrip(store)
+        # The export leaves the mapped columns alone.
+        self.assertIsInstance(store.heartRate, memoryview)
+
+    def testExportSkipsDeletedPatients(self):
+        store = self.load(useSnapshot=False)
+        support.quietly(main.deleteAllVisitsOfPatient, store, self.visits[0][0], self.fileName)
+        self.assertRoundTrip(store)
+
+    def assertChangeFeed(self, useSnapshot):
+        store = self.load(useSnapshot)
+        if useSnapshot:
+            self.assertIsInstance(store.heartRate, memoryview)
+        checkpoint = self.assertRoundTrip(store).checkpoint
+        deleted = self.visits[0][0]
+        support.quietly(main.addPatientData, store, 9999, '2024-03-01', 38.5, 120, 22, 95, 60, 91, self.fileName)
+        support.quietly(main.deleteAllVisitsOfPatient, store, deleted, self.fileName)
+        changes = self.path('changes.columns')
+        result = export.exportChanges(self.fileName, checkpoint, changes, outputFormat='columns')
+        self.assertEqual(exportedRows(changes), [
+            (export.CHANGE_ADDED, 9999, ['2024-03-01', 38.5, 120, 22, 95, 60, 91]),
+            (export.CHANGE_DELETED, deleted, None),
+        ])
+        # Nothing changed since the new checkpoint.
+        export.exportChanges(self.fileName, result.checkpoint, changes, outputFormat='columns')
+        self.assertEqual(exportedRows(changes), [])
+        # The next load holds the changes, and exports them in full.
+        self.assertRoundTrip(self.load(useSnapshot))
+
+    def testChangeFeedOfParsedStore(self):
+        self.assertChangeFeed(useSnapshot=False)
+
+    def testChangeFeedOfSnapshot(self):
+        self.assertChangeFeed(useSnapshot=True)
+
+    def testCheckpointFileRoundTrip(self):
+        checkpoint = export.currentCheckpoint(self.fileName)
+        name = self.path('feed.json')
+        export.saveCheckpoint(checkpoint, name)
+        self.assertEqual(export.loadCheckpoint(name), checkpoint)
+        with open(name, 'w') as f:
+            f.write('{}')
+        with self.assertRaises(export.CheckpointError):
+            export.loadCheckpoint(name)
+        self.assertFalse(os.path.exists(name + '.tmp'))
+
+
+if __name__ == '__main__':
+    unittest.main()
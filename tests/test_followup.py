@@ -0,0 +1,84 @@
+"""
+Checks the incremental FollowUpEngine against a scan of every visit, through
+adds, deletes, rule changes and compaction.
+
+Run from the repository root:
+    python -m pytest tests
+    python -m unittest discover tests
+"""
+import datetime
+import os
+import random
+import sys
+import unittest
+
+# Make the modules in the repository root importable however the tests are started.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+from followup import DEFAULT_RULES, FollowUpEngine, FollowUpRule, breaksRule
+from visit_store import VisitStore
+
+
+def randomVisit(rng):
+    date = datetime.date.fromordinal(datetime.date(2015, 1, 1).toordinal() + rng.randrange(3650)).isoformat()
+    return [date, round(rng.uniform(35.5, 40.0), 1), rng.randint(45, 130), rng.randint(10, 30),
+            rng.randint(90, 170), rng.randint(55, 100), rng.randint(85, 100)]
+
+
+def scan(store, rules):
+    # The answer of the original findPatientsWhoNeedFollowUp, on a plain dictionary.
+    return main.findPatientsWhoNeedFollowUp({patientId: store[patientId] for patientId in store}, rules)
+
+
+class FollowUpEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = random.Random(7)
+        self.store = VisitStore()
+        for _ in range(2000):
+            self.store.append(self.rng.randint(1, 200), randomVisit(self.rng))
+
+    def assertConsistent(self, rules):
+        engine = FollowUpEngine.forStore(self.store)
+        engine.setRules(rules)
+        self.assertEqual(engine.patients(), scan(self.store, rules))
+        for patientId, count in engine.abnormalVisitCounts().items():
+            expected = sum(1 for visit in self.store[patientId] if any(breaksRule(rule, visit) for rule in rules))
+            self.assertEqual(count, expected, patientId)
+
+    def testMatchesScan(self):
+        self.assertConsistent(DEFAULT_RULES)
+        self.assertEqual(main.findPatientsWhoNeedFollowUp(self.store), scan(self.store, DEFAULT_RULES))
+
+    def testAddsAndDeletes(self):
+        FollowUpEngine.forStore(self.store)
+        for step in range(200):
+            if self.rng.random() < 0.7:
+                self.store.append(self.rng.randint(1, 250), randomVisit(self.rng))
+            elif len(self.store):
+                self.store.deletePatient(self.rng.choice(list(self.store)))
+            if step % 20 == 0:
+                self.assertConsistent(DEFAULT_RULES)
+        self.assertConsistent(DEFAULT_RULES)
+
+    def testRuleChanges(self):
+        rules = list(DEFAULT_RULES)
+        for _ in range(20):
+            index = self.rng.randrange(len(rules))
+            rules[index] = rules[index]._replace(threshold=rules[index].threshold + self.rng.randint(-10, 10))
+            self.assertConsistent(rules)
+        self.assertConsistent(rules[:2])
+        self.assertConsistent(DEFAULT_RULES + (FollowUpRule('fever', 'temperature', '>', 38.0),))
+
+    def testCompact(self):
+        FollowUpEngine.forStore(self.store)
+        for patientId in list(self.store)[::3]:
+            self.store.deletePatient(patientId)
+        self.store.append(1, ['2020-01-01', 37.0, 130, 16, 120, 80, 97])
+        self.store.compact()
+        self.assertConsistent(DEFAULT_RULES)
+
+
+if __name__ == '__main__':
+    unittest.main()
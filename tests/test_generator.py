@@ -0,0 +1,59 @@
+"""
+Checks that the synthetic patient files of benchmarks/generate_patients.py are
+reproducible from their seed, load as expected, and follow their settings.
+"""
+import datetime
+import os
+import sys
+import unittest
+from collections import Counter
+
+import support  # puts the repository root on sys.path
+import main
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+from generate_patients import PatientGenerator
+
+
+class PatientGeneratorTest(support.TemporaryDirectoryTest):
+
+    def testReproducible(self):
+        lines = list(PatientGenerator(2000, invalidFraction=0.1, seed=3).lines())
+        self.assertEqual(len(lines), 2000)
+        self.assertEqual(list(PatientGenerator(2000, invalidFraction=0.1, seed=3).lines()), lines)
+        self.assertNotEqual(list(PatientGenerator(2000, invalidFraction=0.1, seed=4).lines()), lines)
+
+    def testValidVisits(self):
+        start, end = datetime.date(2018, 1, 1), datetime.date(2019, 12, 31)
+        generator = PatientGenerator(3000, 100, startDate=start, endDate=end, seed=5)
+        for patientId, visit in generator.visits():
+            self.assertTrue(1 <= patientId <= 100)
+            self.assertEqual(main.checkVisit(patientId, *visit), (patientId, None), visit)
+            self.assertTrue(start <= datetime.date.fromisoformat(visit[0]) <= end)
+            self.assertLess(visit[5], visit[4])
+
+    def testInvalidLines(self):
+        fileName = self.path('patients.txt')
+        generator = PatientGenerator(3000, invalidFraction=0.2, seed=6)
+        invalid = generator.write(fileName)
+        self.assertTrue(500 < invalid < 700)
+        patients, printed = support.quietly(main.readPatientsFromFile, fileName, useSnapshot=False, cacheEntries=0)
+        self.assertEqual(patients.visitCount, 3000 - invalid)
+        self.assertEqual(printed, f"Skipped {invalid} invalid line(s) in '{fileName}'.\n")
+
+    def testSkew(self):
+        def topShare(skew):
+            counts = Counter(patientId for patientId, _ in PatientGenerator(20000, 100, skew=skew, seed=7).visits())
+            return sum(counts[patientId] for patientId in range(1, 11)) / 20000
+        self.assertAlmostEqual(topShare(1.0), 0.1, delta=0.02)
+        self.assertAlmostEqual(topShare(3.0), 0.46, delta=0.03)
+
+    def testSettingsChecked(self):
+        for kwargs in ({'skew': 0}, {'invalidFraction': 1.5},
+                       {'startDate': datetime.date(2020, 1, 1), 'endDate': datetime.date(2019, 1, 1)}):
+            with self.assertRaises(ValueError):
+                PatientGenerator(10, **kwargs)
+
+
+if __name__ == '__main__':
+    unittest.main()
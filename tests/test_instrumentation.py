@@ -0,0 +1,90 @@
+"""
+Checks that instrumentation records nothing while off, counts the calls of the
+main.py functions and the rows of each parser stage while on, and exports
+what it recorded as a table, JSON and a cProfile file.
+"""
+import io
+import json
+import pstats
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+
+import support  # puts the repository root on sys.path
+import cli
+import instrumentation
+import main
+
+
+class InstrumentationTest(support.TemporaryDirectoryTest):
+
+    def setUp(self):
+        super().setUp()
+        self.fileName = self.path('patients.txt')
+        support.writePatientFile(self.fileName, support.randomVisits(500, patients=30), ['bad,line'])
+        instrumentation.reset()
+        self.addCleanup(instrumentation.reset)
+        self.addCleanup(instrumentation.disable)
+
+    def measurements(self):
+        return {row['name']: row for row in instrumentation.results()}
+
+    def testOffByDefault(self):
+        patients, _ = support.quietly(main.readPatientsFromFile, self.fileName, useSnapshot=False)
+        main.findVisitsByDate(patients, 2016)
+        self.assertEqual(instrumentation.results(), [])
+        self.assertEqual(instrumentation.summaryTable(), "No measurements recorded.")
+
+    def testCallsAndStages(self):
+        instrumentation.enable(traceMemory=True)
+        patients, _ = support.quietly(main.readPatientsFromFile, self.fileName, useSnapshot=False, cacheEntries=0)
+        for _ in range(3):
+            main.findVisitsByDate(patients, 2016)
+        support.quietly(main.displayStats, patients)
+        instrumentation.disable()
+        main.findVisitsByDate(patients, 2017)
+        measurements = self.measurements()
+        self.assertEqual(measurements['readPatientsFromFile']['calls'], 1)
+        self.assertEqual(measurements['findVisitsByDate']['calls'], 3)
+        # Inclusive times: displayStats counts the vitalSummaries it calls.
+        self.assertEqual(measurements['vitalSummaries']['calls'], 1)
+        self.assertGreaterEqual(measurements['displayStats']['seconds'], measurements['vitalSummaries']['seconds'])
+        self.assertEqual(measurements['parser.field count']['rows'], 501)
+        self.assertEqual(measurements['parser.split']['rows'], 500)
+        self.assertGreater(measurements['readPatientsFromFile']['allocatedBytes'], 0)
+        self.assertEqual([row['name'] for row in instrumentation.results()],
+                         sorted(measurements, key=lambda name: measurements[name]['seconds'], reverse=True))
+        table = instrumentation.summaryTable().splitlines()
+        self.assertEqual(table[0].split()[:3], ['name', 'calls', 'total'])
+        self.assertEqual(len(table), 1 + len(measurements))
+
+    def testExports(self):
+        instrumentation.enable()
+        patients, _ = support.quietly(main.readPatientsFromFile, self.fileName, useSnapshot=False)
+        jsonName = self.path('profile.json')
+        instrumentation.writeJson(jsonName)
+        with open(jsonName) as f:
+            exported = json.load(f)
+        self.assertFalse(exported['traceMemory'])
+        self.assertEqual(exported['measurements'], instrumentation.results())
+        profileName = self.path('profile.out')
+        with instrumentation.profileTo(profileName):
+            main.findPatientsWhoNeedFollowUp(patients)
+        functions = {function for _, _, function in pstats.Stats(profileName).stats}
+        self.assertIn('findPatientsWhoNeedFollowUp', functions)
+
+    def testCommandLine(self):
+        jsonName = self.path('profile.json')
+        out, err = io.StringIO(), io.StringIO()
+        with redirect_stdout(out), redirect_stderr(err):
+            status = cli.main(['--file', self.fileName, '--no-snapshot', '--profile', '--profile-json', jsonName,
+                               'follow-up'])
+        self.assertEqual(status, 0)
+        self.assertIn("findPatientsWhoNeedFollowUp", err.getvalue())
+        with open(jsonName) as f:
+            names = [row['name'] for row in json.load(f)['measurements']]
+        self.assertIn('readPatientsFromFile', names)
+        self.assertIn('findPatientsWhoNeedFollowUp', names)
+
+
+if __name__ == '__main__':
+    unittest.main()
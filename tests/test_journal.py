@@ -0,0 +1,170 @@
+"""
+Checks the write-ahead journal: changes survive a reload, replay stops at a
+torn or corrupted record and drops a partial batch, and compaction folds the
+journal into the patient file exactly once.
+"""
+import os
+import threading
+import unittest
+
+import support  # puts the repository root on sys.path
+import main
+import snapshot
+from journal import (VisitJournal, closeJournals, compactedJournal, foldJournal, journalPath, readJournal,
+                     replayJournal, visitLine)
+from patient_parser import readPatientsStreaming
+
+
+NEW_VISIT = ['2024-03-01', 38.5, 120, 22, 95, 60, 91]
+
+
+class JournalTest(support.TemporaryDirectoryTest):
+
+    def setUp(self):
+        super().setUp()
+        self.fileName = self.path('patients.txt')
+        self.journalName = journalPath(self.fileName)
+        self.visits = support.randomVisits(300, patients=20)
+        support.writePatientFile(self.fileName, self.visits)
+        self.expected = {}
+        for patientId, visit in self.visits:
+            self.expected.setdefault(patientId, []).append(list(visit))
+
+    def load(self, useSnapshot=False):
+        patients, _ = support.quietly(main.readPatientsFromFile, self.fileName, useSnapshot=useSnapshot,
+                                      cacheEntries=0)
+        return patients
+
+    def change(self, patients):
+        support.quietly(main.addPatientData, patients, 3, *NEW_VISIT, self.fileName)
+        support.quietly(main.deleteAllVisitsOfPatient, patients, 5, self.fileName)
+        support.quietly(main.addPatientData, patients, 5, *NEW_VISIT, self.fileName)
+        support.quietly(main.addPatientData, patients, 1001, *NEW_VISIT, self.fileName)
+        self.expected[3].append(NEW_VISIT)
+        self.expected[5] = [NEW_VISIT]
+        self.expected[1001] = [NEW_VISIT]
+
+    def journal(self):
+        journal = VisitJournal(self.fileName)
+        self.addCleanup(journal.close)
+        return journal
+
+    def testReplay(self):
+        patients = self.load()
+        self.change(patients)
+        self.assertEqual(support.asDict(patients), self.expected)
+        # The base file is untouched; the changes come back from the journal.
+        with open(self.fileName) as f:
+            self.assertEqual(len(f.readlines()), len(self.visits))
+        closeJournals()
+        self.assertEqual(support.asDict(self.load()), self.expected)
+
+    def testReplayOnSnapshot(self):
+        self.load(useSnapshot=True)
+        self.change(self.load(useSnapshot=True))
+        closeJournals()
+        # The snapshot still matches the base file, and the journal goes on top of it.
+        self.assertIsNotNone(snapshot.loadSnapshot(snapshot.snapshotPath(self.fileName), self.fileName))
+        self.assertEqual(support.asDict(self.load(useSnapshot=True)), self.expected)
+
+    def testCorruptedRecord(self):
+        journal = self.journal()
+        for patientId in (1, 2, 3):
+            journal.logAdd(patientId, NEW_VISIT)
+        journal.close()
+        with open(self.journalName, 'rb') as f:
+            lines = f.readlines()
+        # Flip a digit of the second record: replay keeps only the first.
+        lines[2] = lines[2].replace(b'120', b'121', 1)
+        with open(self.journalName, 'wb') as f:
+            f.writelines(lines)
+        self.assertEqual(readJournal(self.journalName)[1], [('A', visitLine(1, NEW_VISIT))])
+
+    def testTornRecord(self):
+        journal = self.journal()
+        journal.logAdd(1, NEW_VISIT)
+        journal.logDelete(2)
+        journal.close()
+        with open(self.journalName, 'rb+') as f:
+            f.truncate(os.path.getsize(self.journalName) - 1)
+        self.assertEqual(readJournal(self.journalName)[1], [('A', visitLine(1, NEW_VISIT))])
+
+    def testPartialBatch(self):
+        journal = self.journal()
+        journal.logAdd(1, NEW_VISIT)
+        journal.logAddBatch([visitLine(patientId, NEW_VISIT) for patientId in (2, 3, 4)])
+        journal.close()
+        self.assertEqual(len(readJournal(self.journalName)[1]), 4)
+        with open(self.journalName, 'rb') as f:
+            lines = f.readlines()
+        with open(self.journalName, 'wb') as f:
+            f.writelines(lines[:-1])
+        self.assertEqual(readJournal(self.journalName)[1], [('A', visitLine(1, NEW_VISIT))])
+
+    def testConcurrentWriters(self):
+        journal = self.journal()
+        threads = [threading.Thread(target=lambda first=first: [journal.logAdd(patientId, NEW_VISIT)
+                                                                for patientId in range(first, first + 50)])
+                   for first in range(0, 400, 50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        journal.close()
+        records = readJournal(self.journalName)[1]
+        self.assertEqual(sorted(int(payload.split(',')[0]) for _, payload in records), list(range(400)))
+
+    def testCompaction(self):
+        patients = self.load()
+        self.change(patients)
+        closeJournals()
+        journal = self.journal()
+        journalId = readJournal(self.journalName)[0]
+        journal.compact(wait=True)
+        self.assertEqual(compactedJournal(self.fileName), (journalId, 4))
+        self.assertEqual(readJournal(self.journalName)[1], [])
+        self.assertNotEqual(readJournal(self.journalName)[0], journalId)
+        self.assertFalse(os.path.exists(self.journalName + '.compacting'))
+        self.assertEqual(support.asDict(self.load()), self.expected)
+        # New records go to the fresh journal and survive the next compaction too.
+        journal.logDelete(1001)
+        del self.expected[1001]
+        journal.compact(wait=True)
+        self.assertEqual(support.asDict(self.load()), self.expected)
+
+    def testCompactionThreshold(self):
+        journal = VisitJournal(self.fileName, compactThreshold=3)
+        self.addCleanup(journal.close)
+        for patientId in (1, 2, 3):
+            journal.logAdd(patientId, NEW_VISIT)
+            self.expected[patientId].append(NEW_VISIT)
+        journal.close()
+        self.assertIsNotNone(compactedJournal(self.fileName)[0])
+        self.assertEqual(support.asDict(self.load()), self.expected)
+
+    def testInterruptedCompaction(self):
+        journal = self.journal()
+        journal.logAdd(1, NEW_VISIT)
+        journal.close()
+        self.expected[1].append(NEW_VISIT)
+        compacting = self.journalName + '.compacting'
+        os.rename(self.journalName, compacting)
+        # Renamed but not folded yet: replay still applies it.
+        store = readPatientsStreaming(self.fileName)
+        self.assertEqual(replayJournal(self.fileName, store), 1)
+        self.assertEqual(support.asDict(store), self.expected)
+        # Folded, but the process died before removing it: replay skips it.
+        with open(compacting, 'rb') as f:
+            kept = f.read()
+        foldJournal(self.fileName, compacting)
+        with open(compacting, 'wb') as f:
+            f.write(kept)
+        self.assertEqual(support.asDict(self.load()), self.expected)
+        # The next compaction only removes it.
+        foldJournal(self.fileName, compacting)
+        self.assertFalse(os.path.exists(compacting))
+        self.assertEqual(support.asDict(self.load()), self.expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+"""
+Checks the streaming parser against the rules of the original line-by-line
+reader: the visits kept, and every rejected line with its number and reason;
+and that the parallel parser gives exactly what the streaming one does.
+"""
+import unittest
+
+import support  # puts the repository root on sys.path
+import main
+from patient_parser import RejectLog, parseLines, readPatientsParallel, readPatientsStreaming, splitFile
+
+
+GOOD = ['1,2020-01-01,37.0,80,16,120,80,97', '2,2020-13-45,36.5,45,12,95,60,99', '1,2021-7-4,42.0,180,40,200,120,100']
+
+BAD = [
+    ('', 'blank line'),
+    ('   ', 'blank line'),
+    ('1,2020-01-01,37.0,80,16,120,80', 'invalid number of fields'),
+    ('1,2020-01-01,37.0,80,16,120,80,97,5', 'invalid number of fields'),
+    ('x,2020-01-01,37.0,80,16,120,80,97', 'invalid data type'),
+    ('1,2020-01-01,37.0,80.5,16,120,80,97', 'invalid data type'),
+    ('1,2020-01-01,34.9,80,16,120,80,97', 'invalid temperature value'),
+    ('1,2020-01-01,nan,80,16,120,80,97', 'invalid temperature value'),
+    ('1,2020-01-01,37.0,181,16,120,80,97', 'invalid heart rate value'),
+    ('1,2020-01-01,37.0,80,4,120,80,97', 'invalid respiratory rate value'),
+    ('1,2020-01-01,37.0,80,16,201,80,97', 'invalid systolic blood pressure value'),
+    ('1,2020-01-01,37.0,80,16,120,39,97', 'invalid diastolic blood pressure value'),
+    ('1,2020-01-01,37.0,80,16,120,80,101', 'invalid oxygen saturation value'),
+    # Out of range in two vitals: the first check in the original order wins.
+    ('1,2020-01-01,43.0,20,16,120,80,97', 'invalid temperature value'),
+    ('99999999999999999999,2020-01-01,37.0,80,16,120,80,97', 'invalid patient ID value'),
+]
+
+
+class ParserTest(support.TemporaryDirectoryTest):
+
+    def setUp(self):
+        super().setUp()
+        # Each bad line between two good ones, and a comment.
+        self.lines = ['# exported 2024-01-01']
+        for line, _ in BAD:
+            self.lines.extend(GOOD)
+            self.lines.append(line)
+        self.lines.extend(GOOD)
+        self.fileName = self.path('patients.txt')
+        with open(self.fileName, 'w') as f:
+            f.write('\n'.join(self.lines) + '\n')
+
+    def expectedRejects(self):
+        return [(number, reason, self.lines[number - 1].strip())
+                for number, (_, reason) in zip(range(2 + len(GOOD), len(self.lines), len(GOOD) + 1), BAD)]
+
+    def testKeepsValidLines(self):
+        store = readPatientsStreaming(self.fileName)
+        expected = {}
+        for _ in range(len(BAD) + 1):
+            for line in GOOD:
+                fields = line.split(',')
+                expected.setdefault(int(fields[0]), []).append(
+                    [fields[1], float(fields[2])] + [int(field) for field in fields[3:]])
+        self.assertEqual(support.asDict(store), expected)
+
+    def testRejects(self):
+        rejectLog = RejectLog()
+        readPatientsStreaming(self.fileName, rejectLog=rejectLog)
+        self.assertEqual(rejectLog.records, self.expectedRejects())
+        self.assertEqual(rejectLog.count, len(BAD))
+        self.assertEqual(rejectLog.reasons['blank line'], 2)
+
+    def testSmallChunks(self):
+        # Every block boundary falls somewhere else; the result is the same.
+        for chunkBytes in (1, 40, 100):
+            rejectLog = RejectLog()
+            store = readPatientsStreaming(self.fileName, rejectLog=rejectLog, chunkBytes=chunkBytes)
+            self.assertEqual(support.asDict(store), support.asDict(readPatientsStreaming(self.fileName)))
+            self.assertEqual(rejectLog.records, self.expectedRejects())
+
+    def testRejectLogFile(self):
+        name = self.path('rejects.jsonl')
+        with RejectLog(name, keep=2) as rejectLog:
+            readPatientsStreaming(self.fileName, rejectLog=rejectLog)
+        self.assertEqual(len(rejectLog.records), 2)
+        with open(name) as f:
+            self.assertEqual(len(f.readlines()), len(BAD))
+
+    def testLoadReportsRejects(self):
+        patients, printed = support.quietly(main.readPatientsFromFile, self.fileName, useSnapshot=False,
+                                            cacheEntries=0)
+        self.assertEqual(printed, f"Skipped {len(BAD)} invalid line(s) in '{self.fileName}'.\n")
+        self.assertEqual(patients.visitCount, len(GOOD) * (len(BAD) + 1))
+
+    def testRawDates(self):
+        chunk = parseLines(GOOD)
+        self.assertEqual(chunk.rawDates, {1: '2020-13-45', 2: '2021-7-4'})
+        self.assertEqual(chunk.lineCount, 3)
+        self.assertEqual(list(chunk.heartRate), [80, 45, 180])
+
+
+class ParallelParserTest(support.TemporaryDirectoryTest):
+
+    def setUp(self):
+        super().setUp()
+        self.fileName = self.path('patients.txt')
+        visits = support.randomVisits(3000, patients=200)
+        visits[100][1][0] = '2019-02-29'
+        lines = [line for line, _ in BAD] + ['# comment']
+        support.writePatientFile(self.fileName, visits[:1500], lines)
+        with open(self.fileName, 'a') as f:
+            f.writelines(support.visitLine(patientId, visit) + '\n' for patientId, visit in visits[1500:])
+            f.write(GOOD[0])
+
+    def read(self, reader, **kwargs):
+        rejectLog = RejectLog()
+        store = reader(self.fileName, rejectLog=rejectLog, **kwargs)
+        return store, rejectLog
+
+    def testSplitFile(self):
+        shards = splitFile(self.fileName, 4096)
+        self.assertGreater(len(shards), 10)
+        with open(self.fileName, 'rb') as f:
+            data = f.read()
+        self.assertEqual(b''.join(data[start:end] for start, end in shards), data)
+        for start, _ in shards[1:]:
+            self.assertEqual(data[start - 1:start], b'\n')
+
+    def testSameAsStreaming(self):
+        expected, expectedRejects = self.read(readPatientsStreaming)
+        for workers, shardBytes in ((2, 4096), (3, 10000), (2, 1 << 30)):
+            store, rejectLog = self.read(readPatientsParallel, workers=workers, shardBytes=shardBytes)
+            self.assertEqual(list(store.patientIds), list(expected.patientIds))
+            self.assertEqual(support.asDict(store), support.asDict(expected))
+            self.assertEqual(rejectLog.records, expectedRejects.records)
+        self.assertEqual(expectedRejects.count, len(BAD))
+
+    def testWorkers(self):
+        expected, _ = self.read(readPatientsStreaming)
+        store, _ = self.read(readPatientsParallel, workers=1, shardBytes=4096)
+        self.assertEqual(support.asDict(store), support.asDict(expected))
+        with self.assertRaises(ValueError):
+            readPatientsParallel(self.fileName, workers=-1)
+        patients, _ = support.quietly(main.readPatientsFromFile, self.fileName, workers=2, useSnapshot=False,
+                                      cacheEntries=0)
+        self.assertEqual(support.asDict(patients), support.asDict(expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
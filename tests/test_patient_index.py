@@ -0,0 +1,121 @@
+"""
+Checks that LazyPatients gives the same visits as loading the whole file, with
+line breaks other than b'\\n' inside lines, that the offset index is reused
+until the file changes, and that only a bounded number of patients stay parsed.
+"""
+import os
+import threading
+import unittest
+
+import support  # puts the repository root on sys.path
+import main
+from patient_index import LazyPatients, buildIndex, indexPath, loadIndex
+
+
+class LazyPatientsTest(support.TemporaryDirectoryTest):
+
+    def setUp(self):
+        super().setUp()
+        self.fileName = self.path('patients.txt')
+        visits = support.randomVisits(1500, patients=120)
+        # Lines holding characters str.splitlines breaks at, among valid ones.
+        support.writePatientFile(self.fileName, visits[:700],
+                                 ['# ward notes\x0cand\x85more', '3,2020-01-01,37.0\x1e,80'])
+        with open(self.fileName, 'a') as f:
+            f.writelines(support.visitLine(patientId, visit) + '\n' for patientId, visit in visits[700:])
+        self.store, _ = support.quietly(main.readPatientsFromFile, self.fileName, useSnapshot=False, cacheEntries=0)
+
+    def open(self, **kwargs):
+        patients = LazyPatients(self.fileName, **kwargs)
+        self.addCleanup(patients.close)
+        return patients
+
+    def testSameVisits(self):
+        patients, printed = support.quietly(main.readPatientsFromFile, self.fileName, lazy=True)
+        self.addCleanup(patients.close)
+        self.assertIsInstance(patients, LazyPatients)
+        self.assertEqual(printed, f"Skipped 1 invalid line(s) in '{self.fileName}'.\n")
+        self.assertEqual(support.asDict(patients), support.asDict(self.store))
+        self.assertNotIn(10 ** 6, patients)
+        with self.assertRaises(KeyError):
+            patients[10 ** 6]
+        self.assertEqual(support.quietly(main.displayPatientData, patients, 3),
+                         support.quietly(main.displayPatientData, self.store, 3))
+
+    def testBlocks(self):
+        # Blocks split anywhere give the same byte ranges.
+        index = buildIndex(self.fileName)
+        small = buildIndex(self.fileName, chunkBytes=100)
+        self.assertEqual(list(small.patientIds), list(index.patientIds))
+        for patientId in index.patientIds:
+            self.assertEqual(small.runs(patientId), index.runs(patientId))
+        self.assertEqual(index.rejected, 1)
+        with open(self.fileName, 'rb') as f:
+            data = f.read()
+        for offset, length in index.runs(3):
+            lines = data[offset:offset + length].split(b'\n')
+            self.assertEqual(lines.pop(), b'')
+            self.assertTrue(all(line.startswith(b'3,') for line in lines))
+
+    def testIndexKeptUntilFileChanges(self):
+        self.open()
+        stat = os.stat(self.fileName)
+        self.assertIsNotNone(loadIndex(indexPath(self.fileName), stat))
+        with open(self.fileName, 'a') as f:
+            f.write('2001,2024-03-01,37.0,80,16,120,80,97\n')
+        stat = os.stat(self.fileName)
+        self.assertIsNone(loadIndex(indexPath(self.fileName), stat))
+        self.assertEqual(self.open()[2001], [['2024-03-01', 37.0, 80, 16, 120, 80, 97]])
+        self.assertIsNotNone(loadIndex(indexPath(self.fileName), stat))
+        # A damaged index is rebuilt.
+        with open(indexPath(self.fileName), 'r+b') as f:
+            f.seek(20)
+            f.write(b'\xff')
+        self.assertIsNone(loadIndex(indexPath(self.fileName), stat))
+        self.assertEqual(support.asDict(self.open())[2001], [['2024-03-01', 37.0, 80, 16, 120, 80, 97]])
+
+    def testBoundedCache(self):
+        patients = self.open(maxPatients=5)
+        patientIds = list(self.store)
+        for patientId in patientIds[:20]:
+            self.assertEqual(patients[patientId], self.store[patientId])
+        self.assertEqual(patients.cachedPatients(), 5)
+        self.assertEqual(list(patients._parsed), patientIds[15:20])
+        patients[patientIds[15]]
+        self.assertEqual(list(patients._parsed), patientIds[16:20] + patientIds[15:16])
+        # Lists handed out are copies.
+        patients[patientIds[16]].clear()
+        self.assertEqual(patients[patientIds[16]], self.store[patientIds[16]])
+
+    def testConcurrentReads(self):
+        patients = self.open(maxPatients=8)
+        patientIds = list(self.store)
+        failures = []
+
+        def read(start):
+            for patientId in patientIds[start::4]:
+                if patients[patientId] != self.store[patientId]:
+                    failures.append(patientId)
+        threads = [threading.Thread(target=read, args=(start,)) for start in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(failures, [])
+        self.assertLessEqual(patients.cachedPatients(), 8)
+
+    def testChanges(self):
+        patients = self.open()
+        # The store records the same changes in a journal of its own.
+        for data, fileName in ((patients, self.fileName), (self.store, self.path('other.txt'))):
+            support.quietly(main.addPatientData, data, 1001, '2024-03-01', 38.5, 120, 22, 95, 60, 91, fileName)
+            support.quietly(main.deleteAllVisitsOfPatient, data, 3, fileName)
+            support.quietly(main.addPatientData, data, 3, '2024-03-02', 37.0, 80, 16, 120, 80, 97, fileName)
+        self.assertEqual(patients[3], [['2024-03-02', 37.0, 80, 16, 120, 80, 97]])
+        self.assertEqual(support.asDict(patients), support.asDict(self.store))
+        # The journal is replayed on top of the index.
+        self.assertEqual(support.asDict(self.open()), support.asDict(self.store))
+
+
+if __name__ == '__main__':
+    unittest.main()
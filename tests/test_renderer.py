@@ -0,0 +1,96 @@
+"""
+Checks that the buffered renderer prints exactly what displayPatientData used
+to print visit by visit, in few writes, and that pages fit together.
+"""
+import io
+import unittest
+from contextlib import redirect_stdout
+
+import support  # puts the repository root on sys.path
+import main
+import renderer
+from visit_store import VisitStore
+
+
+def printedOriginally(patients, patientIds):
+    # The output of the original displayPatientData, one print per line.
+    output = io.StringIO()
+    with redirect_stdout(output):
+        for patientId in patientIds:
+            print("Patient ID:", patientId)
+            for visit in patients[patientId]:
+                print(" Visit Date:", visit[0])
+                print("  Temperature:", "%.2f" % visit[1], "C")
+                print("  Heart Rate:", visit[2], "bpm")
+                print("  Respiratory Rate:", visit[3], "bpm")
+                print("  Systolic Blood Pressure:", visit[4], "mmHg")
+                print("  Diastolic Blood Pressure:", visit[5], "mmHg")
+                print("  Oxygen Saturation:", visit[6], "%")
+    return output.getvalue()
+
+
+class CountingStream(io.StringIO):
+
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def write(self, text):
+        self.writes += 1
+        return super().write(text)
+
+
+class RendererTest(unittest.TestCase):
+
+    def setUp(self):
+        self.plain = {}
+        for patientId, visit in support.randomVisits(600, patients=40):
+            self.plain.setdefault(patientId, []).append(visit)
+        self.store = VisitStore.fromPatients(self.plain)
+
+    def testSameOutput(self):
+        for patients in (self.plain, self.store):
+            _, printed = support.quietly(main.displayPatientData, patients)
+            self.assertEqual(printed, printedOriginally(self.plain, self.plain))
+            patientId = list(self.plain)[3]
+            _, printed = support.quietly(main.displayPatientData, patients, patientId)
+            self.assertEqual(printed, printedOriginally(self.plain, [patientId]))
+
+    def testMessages(self):
+        self.assertEqual(support.quietly(main.displayPatientData, self.store, 10 ** 6)[1],
+                         f"Patient with ID {10 ** 6} not found.\n")
+        self.assertEqual(support.quietly(main.displayPatientData, self.store, -3)[1],
+                         "Error: patientId should be a non-negative integer\n")
+
+    def testBatches(self):
+        out = CountingStream()
+        count = renderer.renderTo(out, renderer.patientRecords(self.store), batchSize=100)
+        self.assertEqual(count, self.store.visitCount)
+        self.assertEqual(out.writes, -(-count // 100))
+        self.assertEqual(out.getvalue(), printedOriginally(self.plain, self.plain))
+
+    def testUngrouped(self):
+        records = [(1, ['2020-01-01', 37.0, 80, 16, 120, 80, 97])] * 2
+        text = ''.join(renderer.iterRender(records, grouped=False))
+        self.assertEqual(text.count("Patient ID: 1\n"), 2)
+        self.assertEqual(''.join(renderer.iterRender(records)).count("Patient ID: 1\n"), 1)
+
+    def testPages(self):
+        records = list(renderer.patientRecords(self.store))
+        pages = []
+        cursor = 0
+        while cursor is not None:
+            text, cursor = renderer.renderPage(records, 25, cursor)
+            pages.append(text)
+        self.assertEqual(len(pages), -(-len(records) // 25))
+        # Every page starts with a header, so it can be shown on its own.
+        self.assertTrue(all(page.startswith("Patient ID: ") for page in pages))
+        for page, start in zip(pages, range(0, len(records), 25)):
+            self.assertEqual(page, ''.join(renderer.iterRender(records[start:start + 25])))
+        # An iterator gives the same page as a list.
+        self.assertEqual(renderer.renderPage(iter(records), 25, 50), renderer.renderPage(records, 25, 50))
+        self.assertEqual(renderer.renderPage(records, 25, len(records)), ('', None))
+
+
+if __name__ == '__main__':
+    unittest.main()
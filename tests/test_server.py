@@ -0,0 +1,131 @@
+"""
+Runs a QueryServer on a local port and checks that its answers over the
+line-delimited JSON protocol are those of main.py, that writes are acknowledged
+once journaled and visible, and that bad requests get an error response.
+"""
+import asyncio
+import json
+import unittest
+
+import support  # puts the repository root on sys.path
+import main
+from renderer import patientRecords
+from server import DISPLAY_LIMIT, QueryClient, QueryServer, ServerError
+
+
+def asRows(records):
+    # The rows of (patientId, visit) records, as they come out of the protocol.
+    return json.loads(json.dumps([[patientId] + list(visit) for patientId, visit in records]))
+
+
+class QueryServerTest(support.TemporaryDirectoryTest):
+
+    def setUp(self):
+        super().setUp()
+        self.fileName = self.path('patients.txt')
+        support.writePatientFile(self.fileName, support.randomVisits(DISPLAY_LIMIT + 500, patients=80))
+        self.store, _ = support.quietly(main.readPatientsFromFile, self.fileName, useSnapshot=False, cacheEntries=0)
+
+    def serving(self, body):
+        # Runs body(client, server) against a server on a free port.
+        async def run():
+            server = await QueryServer(self.store, self.fileName, readThreads=2).start(port=0)
+            client = QueryClient(port=server.sockets[0].getsockname()[1], poolSize=4)
+            try:
+                return await body(client, server)
+            finally:
+                await client.close()
+                await server.close()
+        return asyncio.run(run())
+
+    def testQueries(self):
+        async def body(client, server):
+            first = await client.request('display')
+            self.assertEqual((len(first['rows']), first['next']), (DISPLAY_LIMIT, DISPLAY_LIMIT))
+            self.assertEqual(await client.display(), asRows(patientRecords(self.store)))
+            self.assertEqual(await client.display(5, limit=3), asRows(patientRecords(self.store, [5]))[:3])
+            self.assertEqual(await client.findVisitsByDate(2019, 6), asRows(main.findVisitsByDate(self.store, 2019, 6)))
+            self.assertEqual(await client.findVisitsInRange('2016-01-01', '2016-03-31'),
+                             asRows(main.findVisitsInRange(self.store, '2016-01-01', '2016-03-31')))
+            self.assertEqual(await client.followUp(), main.findPatientsWhoNeedFollowUp(self.store))
+            rows = await client.stats(5)
+            summaries = main.vitalSummaries(self.store, 5)
+            self.assertEqual({row[1]: row[2:] for row in rows},
+                             json.loads(json.dumps({name: list(summary) for name, summary in summaries.items()})))
+            # Many requests in flight at once share the pool of connections.
+            answers = await asyncio.gather(*[client.findVisitsByDate(2017) for _ in range(12)])
+            self.assertEqual(answers, [asRows(main.findVisitsByDate(self.store, 2017))] * 12)
+            self.assertLessEqual(client._opened, 4)
+        self.serving(body)
+
+    def testWrites(self):
+        async def body(client, server):
+            messages = await asyncio.gather(*[client.add(2000 + n, '2024-03-01', 38.5, 120, 22, 95, 60, 91)
+                                              for n in range(10)])
+            self.assertEqual(sorted(messages), sorted(f"Visit is saved successfully for Patient #{2000 + n}"
+                                                      for n in range(10)))
+            self.assertEqual(await client.display(2003),
+                             [[2003, '2024-03-01', 38.5, 120, 22, 95, 60, 91]])
+            self.assertEqual(await client.delete(3), "Data for patient 3 has been deleted.")
+            with self.assertRaisesRegex(ServerError, "No data found for patient with ID 3"):
+                await client.delete(3)
+            # Writes queued together are checked against the earlier ones of their batch.
+            added = server.writer.submit('add', {'patientId': 3000, 'date': '2024-03-02', 'temp': 37.0, 'hr': 80,
+                                                 'rr': 16, 'sbp': 120, 'dbp': 80, 'spo2': 97})
+            deleted = server.writer.submit('delete', {'patientId': 3000})
+            self.assertEqual(await deleted, "Data for patient 3000 has been deleted.")
+            await added
+            self.assertNotIn(3000, self.store)
+        self.serving(body)
+        self.assertNotIn(3, self.store)
+        # The changes are in the journal.
+        reloaded, _ = support.quietly(main.readPatientsFromFile, self.fileName, useSnapshot=False, cacheEntries=0)
+        self.assertEqual(support.asDict(reloaded), support.asDict(self.store))
+
+    def testErrors(self):
+        async def body(client, server):
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            lines = [b'not json\n', b'[1, 2]\n',
+                     b'{"id": 1, "op": "no-such-op"}\n',
+                     b'{"id": 2, "op": "display", "args": [1]}\n',
+                     b'{"id": 3, "op": "display", "args": {"offset": -1}}\n',
+                     b'{"id": 4, "op": "display", "args": {"patientId": "5"}}\n',
+                     b'{"id": 5, "op": "display", "args": {"patientId": 999999}}\n',
+                     b'{"id": 6, "op": "find-by-date", "args": {"start": "2016-01-01", "end": "2016-13-01"}}\n',
+                     b'{"id": 7, "op": "add", "args": {"patientId": 1, "date": "2024-03-01"}}\n',
+                     b'{"id": 8, "op": "add", "args": {"patientId": 1, "date": "2024-03-01", "temp": "warm",'
+                     b' "hr": 80, "rr": 16, "sbp": 120, "dbp": 80, "spo2": 97}}\n',
+                     b'{"id": 9, "op": "add", "args": {"patientId": 1, "date": "2024-03-01", "temp": 37.0,'
+                     b' "hr": 80, "rr": 16, "sbp": 120, "dbp": 80, "spo2": 250}}\n',
+                     b'{"id": 10, "op": "cache-stats"}\n']
+            responses = []
+            for line in lines:
+                writer.write(line)
+                await writer.drain()
+                responses.append(json.loads(await reader.readline()))
+            writer.close()
+            await writer.wait_closed()
+            return responses
+        responses = self.serving(body)
+        self.assertEqual([(response['id'], response['ok']) for response in responses],
+                         [(None, False), (None, False)] + [(n, False) for n in range(1, 11)])
+        self.assertEqual([response['error'] for response in responses[:9]],
+                         ["Invalid JSON.",
+                          "A request should be a JSON object.",
+                          "Unknown operation 'no-such-op'.",
+                          "'args' should be a JSON object.",
+                          "'offset' should not be negative.",
+                          "'patientId' should be an integer.",
+                          "Patient with ID 999999 not found.",
+                          "Invalid date format. Please enter dates in the format 'yyyy-mm-dd'.",
+                          "'temp' is required."])
+        self.assertEqual(responses[9]['error'], "Invalid input. Please enter valid data.")
+        self.assertTrue(responses[10]['error'].startswith("Invalid "))
+        self.assertEqual(responses[11]['error'], "The query cache is disabled.")
+        # None of the rejected visits was saved.
+        self.assertEqual(main.findVisitsInRange(self.store, '2024-03-01', '2024-03-01'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
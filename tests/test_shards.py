@@ -0,0 +1,94 @@
+"""
+Checks that a sharded dataset answers like the single file it was split from,
+sees adds and deletes, and checks its number of worker processes.
+"""
+import os
+import unittest
+
+import support  # puts the repository root on sys.path
+import main
+import shards
+
+
+def scanByDate(patients, year=None, month=None):
+    # The answer of the original findVisitsByDate, on a plain dictionary.
+    return main.findVisitsByDate(support.asDict(patients), year, month)
+
+
+class ShardedDatasetTest(support.TemporaryDirectoryTest):
+
+    def setUp(self):
+        super().setUp()
+        self.fileName = self.path('patients.txt')
+        support.writePatientFile(self.fileName, support.randomVisits(600, patients=60), ['1,2020-01-01,37.0'])
+        self.single, _ = support.quietly(main.readPatientsFromFile, self.fileName, useSnapshot=False, cacheEntries=0)
+        self.dataset = self.open(workers=2)
+
+    def open(self, workers=None, directory=None):
+        directory = directory or self.path('dataset')
+        if not shards.isDataset(directory):
+            shards.splitFile(self.fileName, directory, 3)
+        dataset, _ = support.quietly(main.readPatientsFromFile, directory, workers=workers, cacheEntries=0)
+        self.addCleanup(dataset.close)
+        return dataset
+
+    def testSameVisits(self):
+        self.assertIsInstance(self.dataset, shards.ShardedDataset)
+        self.assertEqual(support.asDict(self.dataset), support.asDict(self.single))
+        self.assertEqual(len(self.dataset), len(self.single))
+        self.assertEqual(self.dataset.visitCount, self.single.visitCount)
+        for patientId in self.single:
+            self.assertEqual(self.dataset.shardOf(patientId), patientId % 3)
+
+    def testSameAnswers(self):
+        for year, month in ((2019, None), (None, 2), (2016, 5), (None, None)):
+            self.assertEqual(main.findVisitsByDate(self.dataset, year, month), scanByDate(self.dataset, year, month))
+        found = main.findVisitsInRange(self.dataset, '2016-01-01', '2017-12-31')
+        self.assertEqual(sorted(found), sorted(main.findVisitsInRange(self.single, '2016-01-01', '2017-12-31')))
+        self.assertEqual([visit[0] for _, visit in found], sorted(visit[0] for _, visit in found))
+        self.assertEqual(set(main.findPatientsWhoNeedFollowUp(self.dataset)),
+                         set(main.findPatientsWhoNeedFollowUp(self.single)))
+        for patientId in (0, 7):
+            expected = main.vitalSummaries(self.single, patientId)
+            for name, summary in main.vitalSummaries(self.dataset, patientId).items():
+                self.assertEqual(summary.count, expected[name].count)
+                self.assertAlmostEqual(summary.mean, expected[name].mean)
+                self.assertEqual((summary.min, summary.max), (expected[name].min, expected[name].max))
+
+    def testAddsAndDeletes(self):
+        support.quietly(main.addPatientData, self.dataset, 1001, '2024-03-01', 38.5, 120, 22, 95, 60, 91, None)
+        support.quietly(main.deleteAllVisitsOfPatient, self.dataset, 7, None)
+        self.assertEqual(self.dataset[1001], [['2024-03-01', 38.5, 120, 22, 95, 60, 91]])
+        self.assertNotIn(7, self.dataset)
+        self.assertEqual(self.dataset.visitCount, self.single.visitCount + 1 - len(self.single[7]))
+        self.assertIn(1001, main.findPatientsWhoNeedFollowUp(self.dataset))
+        # The changes are in the journal of the shard owning each patient.
+        reopened = self.open()
+        self.assertEqual(support.asDict(reopened), support.asDict(self.dataset))
+
+    def testSiteScheme(self):
+        directory = self.path('sites')
+        os.mkdir(directory)
+        support.writePatientFile(os.path.join(directory, 'north.txt'), [(1, support.randomVisits(1)[0][1])])
+        support.writePatientFile(os.path.join(directory, 'south.txt'),
+                                 [(2, ['2020-01-01', 37.0, 80, 16, 120, 80, 97]),
+                                  (1, ['2021-01-01', 37.5, 90, 18, 130, 85, 96])])
+        shards.writeManifest(directory, ['north.txt', 'south.txt'], 'site', default=1)
+        dataset = self.open(directory=directory)
+        self.assertEqual(list(dataset), [1, 2])
+        self.assertEqual(len(dataset[1]), 2)
+        self.assertEqual(dataset.shardOf(3), 1)
+        with self.assertRaises(ValueError):
+            shards.writeManifest(directory, ['north.txt'], 'site', default=1)
+
+    def testWorkers(self):
+        self.assertEqual(len(self.dataset._executors), 2)
+        self.assertEqual(len(self.open(workers=8)._executors), 3)
+        self.assertEqual(len(self.open(workers=1)._executors), 1)
+        for workers in (-1, -4):
+            with self.assertRaises(ValueError):
+                shards.ShardedDataset(self.path('dataset'), workers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+"""
+Checks that a store opened from a snapshot answers like the text file it was
+built from, and that stale or corrupted snapshots are not used.
+"""
+import os
+import unittest
+
+import support  # puts the repository root on sys.path
+import main
+import snapshot
+from visit_store import VisitStore
+
+
+class SnapshotTest(support.TemporaryDirectoryTest):
+
+    def setUp(self):
+        super().setUp()
+        self.fileName = self.path('patients.txt')
+        self.snapshotName = snapshot.snapshotPath(self.fileName)
+        visits = support.randomVisits(800, patients=80)
+        visits[5][1][0] = '2023-02-30'
+        visits[9][1][0] = '2021-7-4'
+        support.writePatientFile(self.fileName, visits, ['not,a,visit', '1,2020-01-01,37.0,999,16,120,80,97'])
+        self.parsed, _ = support.quietly(main.readPatientsFromFile, self.fileName, useSnapshot=False, cacheEntries=0)
+        snapshot.writeSnapshot(self.parsed, self.snapshotName, os.stat(self.fileName))
+
+    def open(self, verify=False):
+        return snapshot.loadSnapshot(self.snapshotName, self.fileName, verify)
+
+    def testSameVisits(self):
+        mapped = self.open(verify=True)
+        self.assertIsInstance(mapped.dates, memoryview)
+        self.assertEqual(list(mapped), list(self.parsed))
+        self.assertEqual(support.asDict(mapped), support.asDict(self.parsed))
+        self.assertEqual(mapped.visitCount, self.parsed.visitCount)
+
+    def testSameAnswers(self):
+        # Every consumer reads the mapped columns as memoryviews rather than arrays.
+        mapped = self.open()
+        for query in (lambda patients: main.findVisitsByDate(patients, 2019),
+                      lambda patients: main.findVisitsByDate(patients, None, 2),
+                      lambda patients: main.findVisitsByDate(patients, 2023, 2),
+                      lambda patients: sorted(main.findVisitsInRange(patients, '2016-01-01', '2018-06-30')),
+                      main.findPatientsWhoNeedFollowUp,
+                      main.vitalSummaries,
+                      lambda patients: main.vitalSummaries(patients, 7),
+                      main.earlyWarningWorklist):
+            self.assertEqual(query(mapped), query(self.parsed))
+        self.assertIsInstance(mapped.heartRate, memoryview)
+
+    def testChangesCopyTheColumns(self):
+        mapped = self.open()
+        patientId = next(iter(mapped))
+        mapped.append(patientId, ['2024-01-01', 37.0, 300, 16, 120, 80, 97])
+        mapped.deletePatient(list(mapped)[-1])
+        self.parsed.append(patientId, ['2024-01-01', 37.0, 300, 16, 120, 80, 97])
+        self.parsed.deletePatient(list(self.parsed)[-1])
+        self.assertEqual(support.asDict(mapped), support.asDict(self.parsed))
+        self.assertEqual(main.earlyWarningWorklist(mapped), main.earlyWarningWorklist(self.parsed))
+        # The mapped file itself is unchanged.
+        self.assertEqual(support.asDict(self.open(verify=True)), support.asDict(self.open()))
+
+    def testSnapshotOfDeletedPatients(self):
+        deleted = list(self.parsed)[::4]
+        for patientId in deleted:
+            self.parsed.deletePatient(patientId)
+        snapshot.writeSnapshot(self.parsed, self.snapshotName, os.stat(self.fileName))
+        mapped = self.open(verify=True)
+        self.assertEqual(support.asDict(mapped), support.asDict(self.parsed))
+        self.assertFalse(set(deleted) & set(mapped))
+
+    def testStaleAfterSizeChange(self):
+        with open(self.fileName, 'a') as f:
+            f.write('5,2024-01-01,37.0,80,16,120,80,97\n')
+        self.assertIsNone(self.open())
+        loaded, _ = support.quietly(main.readPatientsFromFile, self.fileName, cacheEntries=0)
+        self.assertEqual(loaded[5][-1], ['2024-01-01', 37.0, 80, 16, 120, 80, 97])
+
+    def testStaleAfterMtimeChange(self):
+        stat = os.stat(self.fileName)
+        os.utime(self.fileName, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        self.assertIsNone(self.open())
+
+    def testCorruptedBody(self):
+        # A byte in the middle of the visit records.
+        middle = os.path.getsize(self.snapshotName) // 2
+        with open(self.snapshotName, 'r+b') as f:
+            f.seek(middle)
+            byte = f.read(1)
+            f.seek(middle)
+            f.write(bytes([byte[0] ^ 0xFF]))
+        self.assertIsNone(self.open(verify=True))
+        # Without verify only the header is checked.
+        self.assertIsInstance(self.open(), VisitStore)
+
+    def testCorruptedHeaderOrVersion(self):
+        with open(self.snapshotName, 'r+b') as f:
+            f.seek(8)
+            f.write((snapshot.VERSION + 1).to_bytes(4, 'little'))
+        self.assertIsNone(self.open())
+        with open(self.snapshotName, 'r+b') as f:
+            f.truncate(snapshot.HEADER.size - 1)
+        self.assertIsNone(self.open())
+
+    def testDefaultLoadUsesSnapshot(self):
+        os.remove(self.snapshotName)
+        first, _ = support.quietly(main.readPatientsFromFile, self.fileName, cacheEntries=0)
+        self.assertTrue(os.path.exists(self.snapshotName))
+        second, _ = support.quietly(main.readPatientsFromFile, self.fileName, cacheEntries=0)
+        self.assertIsInstance(second.dates, memoryview)
+        self.assertEqual(support.asDict(second), support.asDict(first))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+"""
+Checks that a SQLite database imported from a patient file answers every query
+like the VisitStore parsed from that file, before and after adds and deletes.
+"""
+import os
+import threading
+import unittest
+
+import support  # puts the repository root on sys.path
+import main
+import storage
+from patient_parser import RejectLog
+from visit_store import VisitStore
+
+
+class SqliteBackendTest(support.TemporaryDirectoryTest):
+
+    def setUp(self):
+        super().setUp()
+        self.fileName = self.path('patients.txt')
+        self.dbName = self.path('patients.db')
+        visits = support.randomVisits(800, patients=60)
+        visits[3][1][0] = '2023-02-30'
+        visits[6][1][0] = '2021-7-4'
+        support.writePatientFile(self.fileName, visits, ['1,2020-01-01,37.0'])
+        self.store, _ = support.quietly(main.readPatientsFromFile, self.fileName, useSnapshot=False, cacheEntries=0)
+        rejectLog = RejectLog()
+        self.assertEqual(storage.importTextFile(self.fileName, self.dbName, rejectLog, chunkBytes=4096), 800)
+        self.assertEqual(rejectLog.count, 1)
+        self.backend = self.open()
+
+    def open(self):
+        backend, _ = support.quietly(main.readPatientsFromFile, self.dbName, cacheEntries=0)
+        self.addCleanup(backend.close)
+        return backend
+
+    def assertSameAnswers(self, backend):
+        self.assertEqual(support.asDict(backend), support.asDict(self.store))
+        self.assertEqual(list(backend), list(self.store))
+        self.assertEqual((len(backend), backend.visitCount), (len(self.store), self.store.visitCount))
+        for year, month in ((None, None), (2019, None), (None, 2), (2023, 2), (2021, 7), (None, 13)):
+            self.assertEqual(main.findVisitsByDate(backend, year, month),
+                             main.findVisitsByDate(self.store, year, month), (year, month))
+        found = main.findVisitsInRange(backend, '2016-01-01', '2017-06-30')
+        expected = main.findVisitsInRange(self.store, '2016-01-01', '2017-06-30')
+        self.assertEqual(sorted(found), sorted(expected))
+        self.assertEqual([visit[0] for _, visit in found], [visit[0] for _, visit in expected])
+        self.assertEqual(sorted(main.findPatientsWhoNeedFollowUp(backend)),
+                         sorted(main.findPatientsWhoNeedFollowUp(self.store)))
+        for patientId in (0, next(iter(self.store)), 10 ** 6):
+            summaries = main.vitalSummaries(backend, patientId)
+            expectedSummaries = main.vitalSummaries(self.store, patientId)
+            self.assertEqual(set(summaries), set(expectedSummaries))
+            for name, summary in summaries.items():
+                self.assertEqual(summary.count, expectedSummaries[name].count)
+                self.assertEqual((summary.min, summary.max), (expectedSummaries[name].min, expectedSummaries[name].max))
+                self.assertAlmostEqual(summary.mean, expectedSummaries[name].mean)
+                self.assertAlmostEqual(summary.std, expectedSummaries[name].std, places=5)
+
+    def testSameAnswers(self):
+        self.assertIsInstance(self.backend, storage.SqliteBackend)
+        self.assertSameAnswers(self.backend)
+
+    def testAddsAndDeletes(self):
+        for patients, fileName in ((self.backend, None), (self.store, self.fileName)):
+            support.quietly(main.addPatientData, patients, 1001, '2024-03-01', 38.5, 120, 22, 95, 60, 91, fileName)
+            support.quietly(main.addPatientData, patients, 7, '2024-03-02', 36.5, 70, 16, 120, 80, 97, fileName)
+            support.quietly(main.deleteAllVisitsOfPatient, patients, 3, fileName)
+            result, _ = support.quietly(main.importVisits, patients, [(1002, '2024-03-03', 37.0, 80, 16, 120, 80, 97),
+                                                                      (1002, '2024-03-04', 37.0, 80, 16, 120, 80, 300)],
+                                        fileName)
+            self.assertEqual((result.accepted, result.rejected), (1, 1))
+        self.assertNotIn(3, self.backend)
+        self.assertSameAnswers(self.backend)
+        # The changes are in the database itself.
+        self.assertSameAnswers(self.open())
+
+    def testJournalIsImported(self):
+        support.quietly(main.addPatientData, self.store, 1001, '2024-03-01', 38.5, 120, 22, 95, 60, 91, self.fileName)
+        support.quietly(main.deleteAllVisitsOfPatient, self.store, 3, self.fileName)
+        storage.importTextFile(self.fileName, self.dbName)
+        self.assertSameAnswers(self.open())
+
+    def testReadsFromOtherThreads(self):
+        answers = []
+        threads = [threading.Thread(target=lambda: answers.append(main.findVisitsByDate(self.backend, 2019)))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(answers, [main.findVisitsByDate(self.store, 2019)] * 4)
+
+    def testMissingDatabase(self):
+        missing = self.path('missing.db')
+        patients, printed = support.quietly(main.readPatientsFromFile, missing, cacheEntries=0)
+        self.assertIsInstance(patients, VisitStore)
+        self.assertEqual(printed, f"The file '{missing}' could not be found.\n")
+        self.assertFalse(os.path.exists(missing))
+
+    def testFailedImportKeepsDatabase(self):
+        with self.assertRaises(FileNotFoundError):
+            storage.importTextFile(self.path('missing.txt'), self.dbName)
+        self.assertSameAnswers(self.open())
+        self.assertFalse(os.path.exists(self.dbName + '.import.tmp'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+"""
+Checks that a VisitStore holds the same visits as the dictionary of lists it
+replaces, through deletes and compaction, and that the uint16 columns take
+values past a byte.
+"""
+import unittest
+from array import array
+
+import support  # puts the repository root on sys.path
+import main
+from visit_store import COLUMNS, INVALID_DATE, StoreListener, VisitStore, byteColumn, dateToOrdinal, ordinalToDate
+
+
+class Recorder(StoreListener):
+
+    def __init__(self):
+        self.calls = []
+
+    def visitsAdded(self, store, firstRow, endRow):
+        self.calls.append(('added', firstRow, endRow))
+
+    def patientDeleted(self, store, patientId, rows):
+        self.calls.append(('deleted', patientId, list(rows)))
+
+    def storeCompacted(self, store):
+        self.calls.append(('compacted',))
+
+
+class VisitStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.visits = support.randomVisits(500, patients=30)
+        self.visits[4][1][0] = '2023-02-30'
+        self.visits[8][1][0] = '2021-7-4'
+        self.plain = {}
+        for patientId, visit in self.visits:
+            self.plain.setdefault(patientId, []).append(list(visit))
+        self.store = VisitStore.fromPatients(self.plain)
+
+    def testSameAsDictionary(self):
+        self.assertEqual(support.asDict(self.store), self.plain)
+        self.assertEqual(list(self.store), list(self.plain))
+        self.assertEqual(len(self.store), len(self.plain))
+        self.assertEqual(self.store.visitCount, len(self.visits))
+        self.assertNotIn(10 ** 6, self.store)
+        with self.assertRaises(KeyError):
+            self.store[10 ** 6]
+
+    def testDates(self):
+        self.assertEqual(ordinalToDate(dateToOrdinal('2020-02-29')), '2020-02-29')
+        self.assertEqual(dateToOrdinal('2023-02-30'), INVALID_DATE)
+        self.assertEqual(dateToOrdinal(None), INVALID_DATE)
+        # Dates the ordinal cannot give back are kept as written.
+        self.assertIn(['2023-02-30'] + self.visits[4][1][1:], self.store[self.visits[4][0]])
+        self.assertIn(['2021-7-4'] + self.visits[8][1][1:], self.store[self.visits[8][0]])
+
+    def testDeleteAndCompact(self):
+        recorder = Recorder()
+        self.store.addListener(recorder)
+        self.assertIs(self.store.findListener(Recorder), recorder)
+        deleted = list(self.plain)[::3]
+        for patientId in deleted:
+            rows = list(self.store.rows(patientId))
+            self.assertEqual(self.store.deletePatient(patientId), len(rows))
+            self.assertFalse(any(self.store.isLive(row) for row in rows))
+            del self.plain[patientId]
+        self.assertEqual(self.store.deletePatient(deleted[0]), 0)
+        self.assertEqual(support.asDict(self.store), self.plain)
+        self.store.compact()
+        self.assertEqual(len(self.store.patientIds), self.store.visitCount)
+        self.assertEqual(support.asDict(self.store), self.plain)
+        self.store.append(deleted[0], ['2024-01-01', 37.0, 80, 16, 120, 80, 97])
+        self.assertEqual(self.store[deleted[0]], [['2024-01-01', 37.0, 80, 16, 120, 80, 97]])
+        self.assertEqual([call[0] for call in recorder.calls],
+                         ['deleted'] * len(deleted) + ['compacted', 'added'])
+
+    def testWideValues(self):
+        # Heart rate and blood pressures are uint16; respiratory rate and spo2 one byte.
+        self.assertEqual(dict(COLUMNS)['heartRate'], 'H')
+        self.assertNotIn(1001, main.findPatientsWhoNeedFollowUp(self.store))
+        visit = ['2020-01-01', 37.0, 300, 16, 260, 1000, 97]
+        self.store.append(1001, visit)
+        self.assertEqual(self.store[1001], [visit])
+        # The follow-up rules see the wide values, incrementally and on a rescan.
+        self.assertIn(1001, main.findPatientsWhoNeedFollowUp(self.store))
+        self.assertIn(1001, main.findPatientsWhoNeedFollowUp(VisitStore.fromPatients({1001: [visit]})))
+
+    def testByteColumn(self):
+        self.assertEqual(byteColumn(array('H', [1, 2, 255])), b'\x01\x02\xff')
+        self.assertIsNone(byteColumn(array('H', [1, 256, 3])))
+        self.assertEqual(byteColumn(array('H', [1, 256, 3]), 2), b'\x03')
+        self.assertEqual(byteColumn(memoryview(array('B', [4, 5, 6])), 1, 2), b'\x05')
+        self.assertEqual(byteColumn(array('H')), b'')
+
+    def testSmallerThanLists(self):
+        self.assertLess(self.store.nbytes(), 40 * self.store.visitCount)
+
+
+if __name__ == '__main__':
+    unittest.main()
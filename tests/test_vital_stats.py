@@ -0,0 +1,95 @@
+"""
+Checks the running statistics of a VisitStore against a direct computation
+over the visit lists, through adds and deletes, and what displayStats prints.
+"""
+import random
+import statistics
+import unittest
+
+import support  # puts the repository root on sys.path
+import main
+from vital_stats import VITALS, VitalStats, computePatientAggregates, summarizeVisits
+from visit_store import VisitStore
+
+
+class VitalStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = random.Random(4)
+        self.store = VisitStore()
+        for patientId, visit in support.randomVisits(1000, patients=60):
+            self.store.append(patientId, visit)
+        self.stats = VitalStats.forStore(self.store)
+
+    def assertSummariesEqual(self, summaries, expected):
+        self.assertEqual(set(summaries), set(expected))
+        for name, summary in summaries.items():
+            self.assertEqual(summary.count, expected[name].count)
+            self.assertEqual((summary.min, summary.max), (expected[name].min, expected[name].max), name)
+            self.assertAlmostEqual(summary.mean, expected[name].mean, places=6)
+            self.assertAlmostEqual(summary.std, expected[name].std, places=4)
+
+    def assertSameAsScan(self):
+        plain = support.asDict(self.store)
+        self.assertSummariesEqual(main.vitalSummaries(self.store), main.vitalSummaries(plain))
+        for patientId in list(plain)[:10] + [10 ** 6]:
+            self.assertSummariesEqual(main.vitalSummaries(self.store, patientId),
+                                      main.vitalSummaries(plain, patientId))
+
+    def testSummarizeVisits(self):
+        visits = [['2020-01-01', 36.5, 60, 12, 110, 70, 95],
+                  ['2020-01-02', 37.5, 80, 16, 130, 90, 99],
+                  ['2020-01-03', 38.0, 100, 20, 150, 80, 97]]
+        summaries = summarizeVisits(visits)
+        self.assertEqual(list(summaries), list(VITALS))
+        heartRate = summaries['heartRate']
+        self.assertEqual((heartRate.count, heartRate.mean, heartRate.min, heartRate.max), (3, 80, 60, 100))
+        self.assertAlmostEqual(heartRate.std, statistics.pstdev([60, 80, 100]))
+        self.assertAlmostEqual(summaries['temperature'].mean, 37.3333333, places=6)
+        self.assertEqual(summarizeVisits([]), {})
+
+    def testSameAsScan(self):
+        self.assertSameAsScan()
+        # Temperatures are reported as entered, not as float32.
+        temperature = self.stats.population()['temperature']
+        self.assertEqual((round(temperature.min, 1), round(temperature.max, 1)), (temperature.min, temperature.max))
+
+    def testAddsAndDeletes(self):
+        for step in range(300):
+            if step % 10 == 9:
+                self.store.deletePatient(self.rng.randint(1, 70))
+            else:
+                self.store.append(self.rng.randint(1, 70), support.randomVisit(self.rng))
+        self.assertSameAsScan()
+        # The extremes of everyone are still right after their visits are deleted.
+        lowest = min(self.store, key=lambda patientId: min(visit[2] for visit in self.store[patientId]))
+        self.store.deletePatient(lowest)
+        self.store.compact()
+        self.assertSameAsScan()
+
+    def testPatientAggregates(self):
+        aggregates = computePatientAggregates(self.store)
+        self.assertEqual(list(aggregates), list(self.store))
+        for patientId, aggregate in aggregates.items():
+            self.assertSummariesEqual(aggregate.summaries(), summarizeVisits(self.store[patientId]))
+        self.assertEqual(self.stats.aggregate(10 ** 6).count, 0)
+        self.assertEqual(self.stats.aggregate().count, self.store.visitCount)
+
+    def testDisplayStats(self):
+        summaries, printed = support.quietly(main.displayStats, self.store)
+        self.assertEqual(summaries, main.vitalSummaries(self.store))
+        lines = printed.splitlines()
+        self.assertEqual(lines[0], "Average vital signs for all patients:")
+        self.assertEqual(len(lines), 1 + len(VITALS))
+        patientId = next(iter(self.store))
+        _, printed = support.quietly(main.displayStats, self.store, patientId)
+        self.assertEqual(printed.splitlines()[0], f"Vital Signs for Patient {patientId}:")
+        self.assertEqual(support.quietly(main.displayStats, self.store, 10 ** 6),
+                         (None, f"Patient with ID {10 ** 6} not found.\n"))
+        self.assertEqual(support.quietly(main.displayStats, self.store, 'x'),
+                         (None, "Error: patientId should be a non-negative integer\n"))
+        self.assertEqual(support.quietly(main.displayStats, VisitStore()), (None, "No patient data found.\n"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,345 @@
+"""
+Columnar storage for patient visits.
+
+Instead of keeping one Python list (plus eight boxed values) per visit, a
+VisitStore keeps every vital sign in its own typed array and remembers which
+rows belong to which patient. The store is also a read-only mapping of
+patientId -> list of visits, so code written against the dictionary returned
+by readPatientsFromFile keeps working unchanged.
+"""
+import datetime
+import functools
+import sys
+from array import array
+from collections.abc import Mapping
+
+
+# (attribute name, array typecode) for every column of the store, in visit order.
+# Dates are stored as int32 day ordinals, temperature as float32, heart rate and
+# blood pressures as uint16 (they can go past 255) and the respiratory rate and
+# oxygen saturation as unsigned bytes.
+COLUMNS = (
+    ('dates', 'i'),
+    ('temperature', 'f'),
+    ('heartRate', 'H'),
+    ('respiratoryRate', 'B'),
+    ('sbp', 'H'),
+    ('dbp', 'H'),
+    ('spo2', 'B'),
+)
+
+# Ordinal used for dates that could not be parsed. The original text is kept
+# in VisitStore._rawDates so nothing is lost.
+INVALID_DATE = 0
+
+
+@functools.lru_cache(maxsize=65536)
+def dateToOrdinal(date):
+    """
+    Converts a date string to a day ordinal.
+
+    date: The date in the format 'yyyy-mm-dd'.
+    return: The proleptic Gregorian ordinal of the date, or INVALID_DATE if it cannot be parsed.
+    """
+    try:
+        year, month, day = [int(x) for x in date.split('-')]
+        return datetime.date(year, month, day).toordinal()
+    except (ValueError, AttributeError):
+        return INVALID_DATE
+
+
+@functools.lru_cache(maxsize=65536)
+def ordinalToDate(ordinal):
+    """
+    Converts a day ordinal back to a 'yyyy-mm-dd' date string.
+
+    ordinal: The proleptic Gregorian ordinal of the date.
+    return: The date as a string, or '' for INVALID_DATE.
+    """
+    if ordinal == INVALID_DATE:
+        return ''
+    return datetime.date.fromordinal(ordinal).isoformat()
+
+
+def byteColumn(column, start=0, end=None):
+    """
+    Returns some rows of an unsigned integer column with one byte per value, e.g. for bytes.translate.
+
+    column: An array or memoryview of typecode 'B' or 'H'.
+    start, end: The rows to return; end defaults to the last row.
+    return: The values as bytes, or None if one of them does not fit in a byte.
+    """
+    data = bytes(column[start:end])
+    if column.itemsize == 1:
+        return data
+    low, high = (data[0::2], data[1::2]) if sys.byteorder == 'little' else (data[1::2], data[0::2])
+    return low if high.count(0) == len(high) else None
+
+
+class StoreListener:
+    """
+    Base class for structures derived from a VisitStore that are kept up to date
+    as visits are added and deleted. Register instances with VisitStore.addListener.
+    """
+
+    def visitsAdded(self, store, firstRow, endRow):
+        """Called after rows firstRow .. endRow - 1 were appended."""
+
+    def patientDeleted(self, store, patientId, rows):
+        """Called after all visits of patientId (the given rows) were marked dead."""
+
+    def storeCompacted(self, store):
+        """Called after compact() renumbered the rows."""
+
+
+class VisitStore(Mapping):
+    """
+    Array-backed store of patient visits.
+
+    Rows are appended to the columns in load order. Each patient has an array of
+    the row numbers holding its visits, and deleted rows are only marked dead
+    until compact() is called, so deleting a patient never shifts the columns.
+    """
+
+    def __init__(self):
+        self.patientIds = array('q')
+        for name, typecode in COLUMNS:
+            setattr(self, name, array(typecode))
+        self._live = bytearray()
+        self._rawDates = {}
+        self._patientRows = {}
+        self._deadRows = 0
+        # mmap backing the columns of a store opened from a snapshot
+        self._mapped = None
+        self._listeners = []
+
+    @classmethod
+    def fromPatients(cls, patients):
+        """
+        Builds a store from a dictionary in the format returned by readPatientsFromFile.
+
+        patients: A dictionary of patient IDs, where each patient has a list of visits.
+        return: A new VisitStore holding the same visits.
+        """
+        store = cls()
+        for patientId, visits in patients.items():
+            for visit in visits:
+                store.append(patientId, visit)
+        return store
+
+    def append(self, patientId, visit):
+        """
+        Appends one visit to the store.
+
+        patientId: The ID of the patient the visit belongs to.
+        visit: [date, temperature, heart rate, respiratory rate, systolic bp, diastolic bp, oxygen saturation]
+        return: The row number of the new visit.
+        """
+        date, temperature, heartRate, respiratoryRate, sbp, dbp, spo2 = visit
+        self._makeWritable()
+        row = len(self.patientIds)
+        ordinal = dateToOrdinal(date)
+        if ordinalToDate(ordinal) != date:
+            self._rawDates[row] = date
+        self.patientIds.append(patientId)
+        self.dates.append(ordinal)
+        self.temperature.append(temperature)
+        self.heartRate.append(heartRate)
+        self.respiratoryRate.append(respiratoryRate)
+        self.sbp.append(sbp)
+        self.dbp.append(dbp)
+        self.spo2.append(spo2)
+        self._live.append(1)
+        rows = self._patientRows.get(patientId)
+        if rows is None or type(rows) is range:
+            rows = self._patientRows[patientId] = array('I', rows or ())
+        rows.append(row)
+        for listener in self._listeners:
+            listener.visitsAdded(self, row, row + 1)
+        return row
+
+    def extend(self, chunk):
+        """
+        Appends a block of already-validated visits in one go.
+
+        chunk: An object with patientIds and COLUMNS arrays of equal length and a
+               rawDates dictionary keyed by position in the chunk, such as
+               patient_parser.ParsedChunk.
+        return: The row number of the first appended visit.
+        """
+        self._makeWritable()
+        first = len(self.patientIds)
+        self.patientIds.extend(chunk.patientIds)
+        for name, _ in COLUMNS:
+            getattr(self, name).extend(getattr(chunk, name))
+        self._live.extend(b'\x01' * len(chunk.patientIds))
+        for offset, date in chunk.rawDates.items():
+            self._rawDates[first + offset] = date
+        patientRows = self._patientRows
+        if self._mapped is not None:
+            for patientId in set(chunk.patientIds):
+                rows = patientRows.get(patientId)
+                if type(rows) is range:
+                    patientRows[patientId] = array('I', rows)
+        for row, patientId in enumerate(chunk.patientIds, first):
+            rows = patientRows.get(patientId)
+            if rows is None:
+                rows = patientRows[patientId] = array('I')
+            rows.append(row)
+        for listener in self._listeners:
+            listener.visitsAdded(self, first, len(self.patientIds))
+        return first
+
+    def addListener(self, listener):
+        """
+        Registers a StoreListener to be told about every change to the store.
+
+        listener: The StoreListener.
+        """
+        self._listeners.append(listener)
+
+    def removeListener(self, listener):
+        self._listeners.remove(listener)
+
+    def findListener(self, cls):
+        """
+        Returns the registered listener of a given class, or None.
+
+        cls: The class of the listener.
+        """
+        for listener in self._listeners:
+            if type(listener) is cls:
+                return listener
+        return None
+
+    def isLive(self, row):
+        """
+        Tells whether a row still holds a visit, i.e. its patient was not deleted.
+
+        row: The row number.
+        """
+        return bool(self._live[row])
+
+    def _makeWritable(self):
+        # Columns opened from a snapshot are read-only memoryviews over the
+        # mapped file; copy them into arrays before the first modification.
+        if isinstance(self.patientIds, array):
+            return
+        for name, typecode in (('patientIds', 'q'),) + COLUMNS:
+            column = array(typecode)
+            column.frombytes(getattr(self, name).cast('B'))
+            setattr(self, name, column)
+
+    def dateString(self, row):
+        """
+        Returns the date of a row as it was originally given.
+
+        row: The row number of the visit.
+        """
+        raw = self._rawDates.get(row)
+        if raw is not None:
+            return raw
+        return ordinalToDate(self.dates[row])
+
+    def visit(self, row):
+        """
+        Materializes one row as a visit list.
+
+        row: The row number of the visit.
+        return: [date, temperature, heart rate, respiratory rate, systolic bp, diastolic bp, oxygen saturation]
+        """
+        return [self.dateString(row),
+                # float32 -> float64 widening adds noise past the 7th digit
+                round(self.temperature[row], 4),
+                self.heartRate[row],
+                self.respiratoryRate[row],
+                self.sbp[row],
+                self.dbp[row],
+                self.spo2[row]]
+
+    def rows(self, patientId):
+        """
+        Returns the row numbers holding the visits of a patient.
+
+        patientId: The ID of the patient.
+        return: An array of row numbers, in the order the visits were added.
+        """
+        return self._patientRows[patientId]
+
+    def deletePatient(self, patientId):
+        """
+        Removes all visits of a patient.
+
+        patientId: The ID of the patient to delete.
+        return: The number of visits removed, or 0 if the patient was not found.
+        """
+        rows = self._patientRows.pop(patientId, None)
+        if rows is None:
+            return 0
+        live = self._live
+        for row in rows:
+            live[row] = 0
+        self._deadRows += len(rows)
+        for listener in self._listeners:
+            listener.patientDeleted(self, patientId, rows)
+        return len(rows)
+
+    def compact(self):
+        """
+        Drops dead rows from the columns and renumbers the remaining ones.
+
+        Patients and their visits keep their order.
+        """
+        if not self._deadRows:
+            return
+        self._makeWritable()
+        keep = [row for row, alive in enumerate(self._live) if alive]
+        remap = {old: new for new, old in enumerate(keep)}
+        self.patientIds = array('q', [self.patientIds[row] for row in keep])
+        for name, typecode in COLUMNS:
+            column = getattr(self, name)
+            setattr(self, name, array(typecode, [column[row] for row in keep]))
+        self._rawDates = {remap[row]: date for row, date in self._rawDates.items() if row in remap}
+        self._patientRows = {patientId: array('I', [remap[row] for row in rows])
+                             for patientId, rows in self._patientRows.items()}
+        self._live = bytearray(b'\x01') * len(keep)
+        self._deadRows = 0
+        self._mapped = None
+        for listener in self._listeners:
+            listener.storeCompacted(self)
+
+    @property
+    def visitCount(self):
+        """The number of live visits in the store."""
+        return len(self.patientIds) - self._deadRows
+
+    def nbytes(self):
+        """
+        Approximates the memory held by the columns and the patient index.
+
+        return: The size in bytes.
+        """
+        total = self.patientIds.itemsize * len(self.patientIds) + len(self._live)
+        for name, _ in COLUMNS:
+            column = getattr(self, name)
+            total += column.itemsize * len(column)
+        for rows in self._patientRows.values():
+            total += rows.itemsize * len(rows)
+        return total
+
+    # Read-only mapping protocol: patientId -> list of visit lists.
+
+    def __getitem__(self, patientId):
+        return [self.visit(row) for row in self._patientRows[patientId]]
+
+    def __contains__(self, patientId):
+        return patientId in self._patientRows
+
+    def __iter__(self):
+        return iter(self._patientRows)
+
+    def __len__(self):
+        return len(self._patientRows)
+
+    def __repr__(self):
+        return f"<VisitStore patients={len(self)} visits={self.visitCount}>"
@@ -0,0 +1,298 @@
+"""
+Running statistics of the vital signs in a VisitStore.
+
+VitalStats keeps the count, sum, sum of squares, minimum and maximum of every
+vital sign, per patient and for the whole population, and updates them as
+visits are added and patients deleted. Mean, minimum, maximum and standard
+deviation of one patient or of everyone are then O(1) lookups. The population
+minimum and maximum come from per-value histograms so they survive deletes.
+
+computePatientAggregates builds the per-patient figures for the whole store
+in one pass, with NumPy when it is installed and in pure Python otherwise.
+"""
+import math
+from collections import Counter, namedtuple
+from itertools import compress
+from operator import mul
+
+try:
+    import numpy
+except ImportError:  # the pure-Python path is used instead
+    numpy = None
+
+from visit_store import COLUMNS, StoreListener
+
+
+# The columns of a VisitStore that hold vital signs, in visit order.
+VITALS = tuple(name for name, _ in COLUMNS[1:])
+
+# Temperatures are float32 in a VisitStore; like VisitStore.visit, they are
+# rounded to 4 digits before being summed, counted or compared, so 36.4 is not
+# reported as 36.400001525878906.
+TEMPERATURE = VITALS.index('temperature')
+
+
+def _roundTemperature(value):
+    return round(value, 4)
+
+
+Summary = namedtuple('Summary', ['count', 'mean', 'min', 'max', 'std'])
+Summary.__doc__ = "Count, mean, minimum, maximum and population standard deviation of one vital sign."
+
+
+class Aggregate:
+    """Count, sums, sums of squares, minimums and maximums of each vital over some visits."""
+
+    __slots__ = ('count', 'sums', 'squares', 'mins', 'maxs')
+
+    def __init__(self, count=0, sums=None, squares=None, mins=None, maxs=None):
+        self.count = count
+        self.sums = sums or [0.0] * len(VITALS)
+        self.squares = squares or [0.0] * len(VITALS)
+        self.mins = mins or [math.inf] * len(VITALS)
+        self.maxs = maxs or [-math.inf] * len(VITALS)
+
+    def add(self, values):
+        """
+        Adds one visit.
+
+        values: The vitals of the visit, in VITALS order.
+        """
+        self.count += 1
+        for index, value in enumerate(values):
+            self.sums[index] += value
+            self.squares[index] += value * value
+            if value < self.mins[index]:
+                self.mins[index] = value
+            if value > self.maxs[index]:
+                self.maxs[index] = value
+
+    def merge(self, other):
+        """
+        Adds the visits summarized by another Aggregate.
+
+        other: The Aggregate to add.
+        """
+        self.count += other.count
+        for index in range(len(VITALS)):
+            self.sums[index] += other.sums[index]
+            self.squares[index] += other.squares[index]
+            self.mins[index] = min(self.mins[index], other.mins[index])
+            self.maxs[index] = max(self.maxs[index], other.maxs[index])
+
+    def summaries(self, mins=None, maxs=None):
+        """
+        Returns a Summary per vital sign.
+
+        mins, maxs: Overrides for the minimums and maximums, in VITALS order.
+        return: A dictionary of vital name -> Summary, or {} if there are no visits.
+        """
+        if not self.count:
+            return {}
+        mins = mins or self.mins
+        maxs = maxs or self.maxs
+        result = {}
+        for index, name in enumerate(VITALS):
+            mean = self.sums[index] / self.count
+            variance = max(0.0, self.squares[index] / self.count - mean * mean)
+            result[name] = Summary(self.count, mean, mins[index], maxs[index], math.sqrt(variance))
+        return result
+
+
+def summarizeVisits(visits):
+    """
+    Summarizes a list of visit lists.
+
+    visits: An iterable of [date, temperature, heart rate, respiratory rate, systolic bp, diastolic bp, oxygen saturation].
+    return: A dictionary of vital name -> Summary, or {} if there are no visits.
+    """
+    aggregate = Aggregate()
+    for visit in visits:
+        aggregate.add(visit[1:])
+    return aggregate.summaries()
+
+
+def computePatientAggregates(store):
+    """
+    Computes the Aggregate of every patient of a store in one batch.
+
+    Uses NumPy when it is installed.
+
+    store: The VisitStore.
+    return: A dictionary of patient ID -> Aggregate, in store order.
+    """
+    if numpy is not None and store.visitCount:
+        return _numpyAggregates(store)
+    aggregates = {}
+    columns = [getattr(store, name) for name in VITALS]
+    for patientId in store:
+        rows = store.rows(patientId)
+        aggregate = Aggregate(count=len(rows))
+        for index, column in enumerate(columns):
+            values = list(map(column.__getitem__, rows))
+            if index == TEMPERATURE:
+                values = list(map(_roundTemperature, values))
+            aggregate.sums[index] = float(sum(values))
+            aggregate.squares[index] = float(sum(map(mul, values, values)))
+            aggregate.mins[index] = min(values)
+            aggregate.maxs[index] = max(values)
+        aggregates[patientId] = aggregate
+    return aggregates
+
+
+def _exact(name, value):
+    # value of the vital name as the pure-Python path computes it
+    return _roundTemperature(value) if name == 'temperature' else value
+
+
+def _numpyAggregates(store):
+    # Rows are grouped by patient with one stable sort, then every column is
+    # reduced per group with reduceat.
+    live = numpy.frombuffer(bytes(store._live), dtype=numpy.uint8).astype(bool)
+    patientIds = numpy.frombuffer(store.patientIds, dtype=numpy.int64)[live]
+    order = numpy.argsort(patientIds, kind='stable')
+    sortedIds = patientIds[order]
+    starts = numpy.flatnonzero(numpy.r_[True, sortedIds[1:] != sortedIds[:-1]])
+    counts = numpy.diff(numpy.r_[starts, len(sortedIds)])
+    byPatient = {}
+    for name in VITALS:
+        column = getattr(store, name)
+        values = numpy.frombuffer(column, dtype=numpy.dtype(column.format if isinstance(column, memoryview)
+                                                             else column.typecode))
+        values = values[live][order].astype(numpy.float64)
+        if name == 'temperature':
+            values = numpy.round(values, 4)
+        byPatient[name] = (numpy.add.reduceat(values, starts),
+                           numpy.add.reduceat(values * values, starts),
+                           numpy.minimum.reduceat(values, starts),
+                           numpy.maximum.reduceat(values, starts))
+    aggregates = {}
+    position = {int(patientId): index for index, patientId in enumerate(sortedIds[starts])}
+    for patientId in store:
+        index = position[patientId]
+        aggregates[patientId] = Aggregate(
+            count=int(counts[index]),
+            sums=[float(byPatient[name][0][index]) for name in VITALS],
+            squares=[float(byPatient[name][1][index]) for name in VITALS],
+            # round again: numpy.round can be one bit off Python's round
+            mins=[_exact(name, byPatient[name][2][index].item()) for name in VITALS],
+            maxs=[_exact(name, byPatient[name][3][index].item()) for name in VITALS])
+    return aggregates
+
+
+class VitalStats(StoreListener):
+    """
+    Per-patient and population statistics of a VisitStore, kept up to date.
+
+    Use VitalStats.forStore to get the statistics of a store, building them on first use.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self.rebuild()
+
+    @classmethod
+    def forStore(cls, store):
+        """
+        Returns the statistics registered on a store, building and registering them if needed.
+
+        store: The VisitStore.
+        """
+        stats = store.findListener(cls)
+        if stats is None:
+            stats = cls(store)
+            store.addListener(stats)
+        return stats
+
+    def rebuild(self):
+        """Recomputes everything from the live rows of the store."""
+        store = self._store
+        self._patients = computePatientAggregates(store)
+        self._total = Aggregate()
+        for aggregate in self._patients.values():
+            self._total.merge(aggregate)
+        # value -> number of live visits with that value, per vital
+        self._histograms = [Counter(compress(getattr(store, name), store._live)) for name in VITALS]
+        temperatures = Counter()
+        # Few distinct values, so they are rounded after counting.
+        for value, count in self._histograms[TEMPERATURE].items():
+            temperatures[_roundTemperature(value)] += count
+        self._histograms[TEMPERATURE] = temperatures
+
+    def visitsAdded(self, store, firstRow, endRow):
+        columns = [getattr(store, name) for name in VITALS]
+        for row in range(firstRow, endRow):
+            values = [column[row] for column in columns]
+            values[TEMPERATURE] = _roundTemperature(values[TEMPERATURE])
+            patientId = store.patientIds[row]
+            aggregate = self._patients.get(patientId)
+            if aggregate is None:
+                aggregate = self._patients[patientId] = Aggregate()
+            aggregate.add(values)
+            self._total.add(values)
+            for histogram, value in zip(self._histograms, values):
+                histogram[value] += 1
+
+    def patientDeleted(self, store, patientId, rows):
+        aggregate = self._patients.pop(patientId, None)
+        if aggregate is None:
+            return
+        total = self._total
+        total.count -= aggregate.count
+        for index in range(len(VITALS)):
+            total.sums[index] -= aggregate.sums[index]
+            total.squares[index] -= aggregate.squares[index]
+        for name, histogram in zip(VITALS, self._histograms):
+            column = getattr(store, name)
+            for row in rows:
+                value = column[row] if name != 'temperature' else _roundTemperature(column[row])
+                histogram[value] -= 1
+                if not histogram[value]:
+                    del histogram[value]
+
+    def storeCompacted(self, store):
+        # Row numbers changed but no aggregate depends on them.
+        pass
+
+    def patient(self, patientId):
+        """
+        Returns the statistics of one patient.
+
+        patientId: The ID of the patient.
+        return: A dictionary of vital name -> Summary, or {} if the patient has no visits.
+        """
+        aggregate = self._patients.get(patientId)
+        return aggregate.summaries() if aggregate is not None else {}
+
+    def aggregate(self, patientId=0):
+        """
+        Returns the running sums of one patient or of everyone, e.g. to merge with other stores.
+
+        patientId: The ID of the patient, or 0 for all patients.
+        return: A new Aggregate, empty if there are no matching visits.
+        """
+        if patientId != 0:
+            aggregate = self._patients.get(patientId)
+            if aggregate is None:
+                return Aggregate()
+            return Aggregate(aggregate.count, list(aggregate.sums), list(aggregate.squares),
+                             list(aggregate.mins), list(aggregate.maxs))
+        total = self._total
+        if not total.count:
+            return Aggregate()
+        return Aggregate(total.count, list(total.sums), list(total.squares),
+                         [min(histogram) for histogram in self._histograms],
+                         [max(histogram) for histogram in self._histograms])
+
+    def population(self):
+        """
+        Returns the statistics over every visit of every patient.
+
+        return: A dictionary of vital name -> Summary, or {} if there are no visits.
+        """
+        if not self._total.count:
+            return {}
+        # Bounded by the number of distinct values, not the number of visits.
+        mins = [min(histogram) for histogram in self._histograms]
+        maxs = [max(histogram) for histogram in self._histograms]
+        return self._total.summaries(mins, maxs)